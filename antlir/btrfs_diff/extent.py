@@ -113,8 +113,8 @@ class Extent(NamedTuple):
     For the purposes of write/clone/truncate modeling, `Extent` could do a
     lot more on-the-fly normalization, which could save RAM.  E.g. we could
     discard HOLE provenance (just store "hole of length N"), and we could
-    flatten to trimmed leaves more eagerly.  However, none of this extra
-    complexity seems worthwhile for now.
+    flatten to trimmed leaves more eagerly.  `FlatExtent` in
+    `flat_extent.py` does the latter, for files with many small writes.
 
     """
 
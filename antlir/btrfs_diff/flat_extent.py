@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+`FlatExtent` is a compact alternative to the `Extent` tree, for files
+with many small writes -- e.g. the send-streams of databases and logs.
+
+Each `write`, `clone`, or `truncate` of an `Extent` adds a few tree nodes,
+and each `gen_trimmed_leaves` has to walk the whole history.  In
+contrast, `FlatExtent` only stores the trimmed leaves themselves, as three
+parallel arrays sorted by file offset:
+  - `_starts`: the file offset of each leaf,
+  - `_leaf_offsets`: the number of bytes trimmed from the leaf's front,
+  - `_leaves`: the ground-truth `Extent` leaf (of `Extent.Kind` content).
+A leaf ends where the next one starts, or at `length`.
+
+A `bisect` finds the leaves at an offset in O(log n), so modifying a
+file costs that, plus a `memmove` of the arrays' tails.  Iterating over
+the leaves is linear.
+
+Since the leaves are the very same `Extent` objects that `Extent` would
+create, `gen_trimmed_leaves` yields the same sequence, and
+`extents_to_chunks_with_clones` gives the same output, clones included.
+
+IMPORTANT: Unlike `Extent`, `FlatExtent` is mutable.  `write`, `clone`,
+and `truncate` change it in place, and return `self`, so that the
+`extent = extent.write(...)` idiom works with either class.  `copy` and
+`deepcopy` copy the arrays, but share the immutable leaves, which keeps
+clone tracking intact for `Subvolume` snapshots.
+"""
+import itertools
+from array import array
+from bisect import bisect_right
+from typing import Iterator, List, Optional, Tuple
+
+from .extent import Extent
+
+
+class FlatExtent:
+    def __init__(self):
+        self._starts = array("q")
+        self._leaf_offsets = array("q")
+        self._leaves: List[Extent] = []
+        self.length = 0
+
+    @staticmethod
+    def empty() -> "FlatExtent":
+        return FlatExtent()
+
+    def _split(self, offset: int) -> int:
+        "Returns the index of the leaf starting at `offset`, splitting one."
+        assert 0 <= offset <= self.length, (offset, self.length)
+        if offset == self.length:
+            return len(self._leaves)
+        idx = bisect_right(self._starts, offset) - 1
+        start = self._starts[idx]
+        if start == offset:
+            return idx
+        self._starts.insert(idx + 1, offset)
+        self._leaf_offsets.insert(
+            idx + 1, self._leaf_offsets[idx] + offset - start
+        )
+        self._leaves.insert(idx + 1, self._leaves[idx])
+        return idx + 1
+
+    def _append(self, leaf: Extent) -> None:
+        "Adds a whole leaf at the end of the file."
+        self._starts.append(self.length)
+        self._leaf_offsets.append(0)
+        self._leaves.append(leaf)
+        self.length += leaf.length
+
+    def truncate(self, length: int) -> "FlatExtent":
+        if length < self.length:
+            idx = self._split(length)
+            del self._starts[idx:]
+            del self._leaf_offsets[idx:]
+            del self._leaves[idx:]
+            self.length = length
+        elif length > self.length:
+            self._append(
+                Extent(
+                    content=Extent.Kind.HOLE,
+                    offset=0,
+                    length=length - self.length,
+                )
+            )
+        return self
+
+    def __put(
+        self,
+        offset: int,
+        length: int,
+        trimmed_leaves: List[Tuple[int, int, Extent]],
+    ) -> "FlatExtent":
+        "Overwrites `length` bytes at `offset` with the given leaves."
+        assert length > 0, "Future: not sure how to hangle length = 0"
+        self.truncate(max(offset, self.length))  # Maybe add a hole
+        begin = self._split(offset)
+        end = self._split(min(self.length, offset + length))
+        starts = array("q")
+        leaf_offsets = array("q")
+        leaves = []
+        start = offset
+        for leaf_offset, leaf_length, leaf in trimmed_leaves:
+            starts.append(start)
+            leaf_offsets.append(leaf_offset)
+            leaves.append(leaf)
+            start += leaf_length
+        assert start == offset + length, (start, offset, length)
+        self._starts[begin:end] = starts
+        self._leaf_offsets[begin:end] = leaf_offsets
+        self._leaves[begin:end] = leaves
+        self.length = max(self.length, offset + length)
+        return self
+
+    def write(self, *, offset: int, length: int) -> "FlatExtent":
+        leaf = Extent(content=Extent.Kind.DATA, offset=0, length=length)
+        return self.__put(offset, length, [(0, length, leaf)])
+
+    def clone(
+        self,
+        *,
+        to_offset: int,
+        from_extent: "FlatExtent",
+        from_offset: int,
+        length: int,
+    ) -> "FlatExtent":
+        assert from_offset + length <= from_extent.length, (
+            from_offset,
+            length,
+            from_extent.length,
+        )
+        # A `list` since `from_extent` may be `self`.
+        return self.__put(
+            to_offset,
+            length,
+            list(
+                from_extent.gen_trimmed_leaves(
+                    offset=from_offset, length=length
+                )
+            ),
+        )
+
+    def gen_trimmed_leaves(
+        self, *, offset: int = 0, length: Optional[int] = None
+    ) -> Iterator[Tuple[int, int, Extent]]:
+        "Same as `Extent.gen_trimmed_leaves`."
+        if length is None:
+            length = self.length - offset
+        assert offset >= 0 and length >= 0, f"offset {offset}, len {length}"
+        assert offset + length <= self.length, f"{offset} + {length}"
+        if length == 0:
+            return
+        end = offset + length
+        idx = max(0, bisect_right(self._starts, offset) - 1)
+        num_leaves = len(self._leaves)
+        while idx < num_leaves:
+            start = self._starts[idx]
+            if start >= end:
+                break
+            leaf_end = (
+                self._starts[idx + 1] if idx + 1 < num_leaves else self.length
+            )
+            trim_front = max(0, offset - start)
+            yield (
+                self._leaf_offsets[idx] + trim_front,
+                min(leaf_end, end) - start - trim_front,
+                self._leaves[idx],
+            )
+            idx += 1
+
+    def __repr__(self):
+        "Same as `Extent.__repr__`."
+        return "".join(
+            f"{'h' if kind == Extent.Kind.HOLE else 'd'}"
+            f"{sum(length for _, length, _ in leaves)}"
+            for kind, leaves in itertools.groupby(
+                self.gen_trimmed_leaves(), lambda leaf: leaf[2].content
+            )
+        )
+
+    def __copy__(self):
+        new = FlatExtent()
+        new._starts = array("q", self._starts)
+        new._leaf_offsets = array("q", self._leaf_offsets)
+        new._leaves = list(self._leaves)
+        new.length = self.length
+        return new
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()  # The leaves are immutable, see `Extent`
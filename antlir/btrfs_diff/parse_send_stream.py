@@ -6,11 +6,21 @@
 
 "Parses the btrfs send-stream binary format. Only version 1 is supported."
 import enum
+import io
+import mmap
 import os
+import stat
 import struct
 import uuid
-from io import BytesIO
-from typing import Iterator, NamedTuple, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from .send_stream import SendStreamItem, SendStreamItems
 
@@ -129,76 +139,232 @@ class AttributeHeader(NamedTuple):
 
 
 def conv_uuid(s: bytes) -> bytes:
-    return str(uuid.UUID(bytes=s)).encode()  # All our other strings are bytes
+    # `bytes()` since `s` may be a `memoryview`
+    return str(uuid.UUID(bytes=bytes(s))).encode()  # Our strings are bytes
+
+
+_UINT64 = struct.Struct("<Q")
+_TIME = struct.Struct("<QI")
+_COMMAND_HEADER = struct.Struct("<IHI")
+_ATTRIBUTE_HEADER = struct.Struct("<HH")
 
 
 def conv_uint64(s: bytes) -> int:
-    (i,) = struct.unpack("<Q", s)
+    (i,) = _UINT64.unpack(s)
     return i
 
 
 def conv_time(s: bytes) -> Tuple[int, int]:
-    s, us = struct.unpack("<QI", s)
+    s, us = _TIME.unpack(s)
     # pyre wants an explicit check even though struct.unpack will raise
     assert isinstance(s, int) and isinstance(us, int), "struct.unpack() failed"
     return s, us
 
 
+def _conv_bytes(s: bytes) -> bytes:
+    return bytes(s)
+
+
+def _conv_path(s: bytes) -> bytes:
+    return os.path.normpath(bytes(s))
+
+
+_ATTRIBUTE_KIND_TO_CONV = {
+    AttributeKind.UUID: conv_uuid,
+    AttributeKind.CTRANSID: conv_uint64,
+    AttributeKind.INO: conv_uint64,
+    AttributeKind.SIZE: conv_uint64,
+    AttributeKind.MODE: conv_uint64,
+    AttributeKind.UID: conv_uint64,
+    AttributeKind.GID: conv_uint64,
+    AttributeKind.RDEV: conv_uint64,
+    AttributeKind.CTIME: conv_time,
+    AttributeKind.MTIME: conv_time,
+    AttributeKind.ATIME: conv_time,
+    AttributeKind.XATTR_NAME: _conv_bytes,
+    AttributeKind.XATTR_DATA: _conv_bytes,
+    AttributeKind.PATH: _conv_path,
+    AttributeKind.PATH_TO: _conv_path,
+    # NB This is NOT normalized since we don't want to normalize symlinks
+    AttributeKind.PATH_LINK: _conv_bytes,
+    AttributeKind.FILE_OFFSET: conv_uint64,
+    AttributeKind.DATA: _conv_bytes,
+    AttributeKind.CLONE_UUID: conv_uuid,
+    AttributeKind.CLONE_CTRANSID: conv_uint64,
+    AttributeKind.CLONE_PATH: _conv_path,
+    AttributeKind.CLONE_OFFSET: conv_uint64,
+    AttributeKind.CLONE_LEN: conv_uint64,
+}
+assert set(_ATTRIBUTE_KIND_TO_CONV) == set(AttributeKind)
+# Looking up the raw value avoids an `AttributeKind(value)` call per attribute
+_ATTRIBUTE_VALUE_TO_KIND_AND_CONV = {
+    k.value: (k, conv) for k, conv in _ATTRIBUTE_KIND_TO_CONV.items()
+}
+
+
 def read_attribute(infile):
     attr_header = AttributeHeader.from_file(infile)
     attr_data = infile.read(attr_header.length)
     if len(attr_data) != attr_header.length:
         raise RuntimeError(f"{attr_header} got {len(attr_data)} bytes")
-
-    if attr_header.kind == AttributeKind.UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.INO:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.SIZE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.MODE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.UID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.GID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.RDEV:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.MTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.ATIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.XATTR_NAME:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.XATTR_DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_TO:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_LINK:
-        # NB This is NOT normalized since we don't want to normalize symlinks
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.FILE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.CLONE_UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_LEN:
-        return attr_header.kind, conv_uint64(attr_data)
-
-    raise RuntimeError(f"Fix me: unhandled {attr_header}")  # pragma: no cover
+    return (
+        attr_header.kind,
+        _ATTRIBUTE_KIND_TO_CONV[attr_header.kind](attr_data),
+    )
+
+
+def _read_attributes(
+    cmd_header: CommandHeader, buf: memoryview, *, skip_data: bool
+) -> Dict[AttributeKind, Any]:
+    """
+    Decodes the attributes of one command from `buf`, without copying it.
+    With `skip_data`, `AttributeKind.DATA` maps to the length of the data.
+    """
+    kind_to_attr = {}
+    offset = 0
+    end = len(buf)
+    while offset != end:
+        if end - offset < _ATTRIBUTE_HEADER.size:
+            raise RuntimeError(f"{cmd_header} has a truncated attribute")
+        value, length = _ATTRIBUTE_HEADER.unpack_from(buf, offset)
+        offset += _ATTRIBUTE_HEADER.size
+        kind_and_conv = _ATTRIBUTE_VALUE_TO_KIND_AND_CONV.get(value)
+        if kind_and_conv is None:
+            AttributeKind(value)  # Raises the usual `ValueError`
+        kind, conv = kind_and_conv
+        if end - offset < length:
+            raise RuntimeError(
+                f"{AttributeHeader(kind=kind, length=length)} got "
+                f"{end - offset} bytes"
+            )
+        if kind in kind_to_attr:
+            raise RuntimeError(f"{kind} occurred twice in {cmd_header}")
+        if skip_data and kind is AttributeKind.DATA:
+            kind_to_attr[kind] = length
+        else:
+            kind_to_attr[kind] = conv(buf[offset : offset + length])
+        offset += length
+    return kind_to_attr
+
+
+# Each of these makes a `SendStreamItem` from the command's attributes.
+_COMMAND_KIND_TO_ITEM_MAKER: Dict[
+    CommandKind, Callable[[Dict[AttributeKind, Any]], SendStreamItem]
+] = {
+    CommandKind.SUBVOL: lambda a: SendStreamItems.subvol(
+        path=a[AttributeKind.PATH],
+        uuid=a[AttributeKind.UUID],
+        transid=a[AttributeKind.CTRANSID],
+    ),
+    CommandKind.SNAPSHOT: lambda a: SendStreamItems.snapshot(
+        path=a[AttributeKind.PATH],
+        uuid=a[AttributeKind.UUID],
+        transid=a[AttributeKind.CTRANSID],
+        parent_uuid=a[AttributeKind.CLONE_UUID],
+        parent_transid=a[AttributeKind.CLONE_CTRANSID],
+    ),
+    CommandKind.MKFILE: lambda a: SendStreamItems.mkfile(
+        path=a[AttributeKind.PATH]
+    ),
+    CommandKind.MKDIR: lambda a: SendStreamItems.mkdir(
+        path=a[AttributeKind.PATH]
+    ),
+    CommandKind.MKNOD: lambda a: SendStreamItems.mknod(
+        path=a[AttributeKind.PATH],
+        mode=a[AttributeKind.MODE],
+        dev=a[AttributeKind.RDEV],
+    ),
+    CommandKind.MKFIFO: lambda a: SendStreamItems.mkfifo(
+        path=a[AttributeKind.PATH]
+    ),
+    CommandKind.MKSOCK: lambda a: SendStreamItems.mksock(
+        path=a[AttributeKind.PATH]
+    ),
+    CommandKind.SYMLINK: lambda a: SendStreamItems.symlink(
+        path=a[AttributeKind.PATH],
+        # NB Unlike the other `dest` attributes, we don't normalize this.
+        dest=os.path.normpath(a[AttributeKind.PATH_LINK]),
+    ),
+    CommandKind.RENAME: lambda a: SendStreamItems.rename(
+        path=a[AttributeKind.PATH],
+        dest=a[AttributeKind.PATH_TO],
+    ),
+    CommandKind.LINK: lambda a: SendStreamItems.link(
+        path=a[AttributeKind.PATH],
+        dest=os.path.normpath(a[AttributeKind.PATH_LINK]),
+    ),
+    CommandKind.UNLINK: lambda a: SendStreamItems.unlink(
+        path=a[AttributeKind.PATH]
+    ),
+    CommandKind.RMDIR: lambda a: SendStreamItems.rmdir(
+        path=a[AttributeKind.PATH]
+    ),
+    CommandKind.WRITE: lambda a: SendStreamItems.write(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        data=a[AttributeKind.DATA],
+    ),
+    CommandKind.CLONE: lambda a: SendStreamItems.clone(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.CLONE_LEN],
+        from_uuid=a[AttributeKind.CLONE_UUID],
+        from_transid=a[AttributeKind.CLONE_CTRANSID],
+        from_path=a[AttributeKind.CLONE_PATH],
+        clone_offset=a[AttributeKind.CLONE_OFFSET],
+    ),
+    CommandKind.SET_XATTR: lambda a: SendStreamItems.set_xattr(
+        path=a[AttributeKind.PATH],
+        name=a[AttributeKind.XATTR_NAME],
+        data=a[AttributeKind.XATTR_DATA],
+    ),
+    CommandKind.REMOVE_XATTR: lambda a: SendStreamItems.remove_xattr(
+        path=a[AttributeKind.PATH],
+        name=a[AttributeKind.XATTR_NAME],
+    ),
+    CommandKind.TRUNCATE: lambda a: SendStreamItems.truncate(
+        path=a[AttributeKind.PATH],
+        size=a[AttributeKind.SIZE],
+    ),
+    CommandKind.CHMOD: lambda a: SendStreamItems.chmod(
+        path=a[AttributeKind.PATH],
+        mode=a[AttributeKind.MODE],
+    ),
+    CommandKind.CHOWN: lambda a: SendStreamItems.chown(
+        path=a[AttributeKind.PATH],
+        uid=a[AttributeKind.UID],
+        gid=a[AttributeKind.GID],
+    ),
+    CommandKind.UTIMES: lambda a: SendStreamItems.utimes(
+        path=a[AttributeKind.PATH],
+        ctime=a[AttributeKind.CTIME],
+        mtime=a[AttributeKind.MTIME],
+        atime=a[AttributeKind.ATIME],
+    ),
+    CommandKind.END: lambda a: None,
+    CommandKind.UPDATE_EXTENT: lambda a: SendStreamItems.update_extent(
+        path=a[AttributeKind.PATH],
+        offset=a[AttributeKind.FILE_OFFSET],
+        len=a[AttributeKind.SIZE],
+    ),
+}
+assert set(_COMMAND_KIND_TO_ITEM_MAKER) == set(CommandKind)
+_COMMAND_VALUE_TO_KIND = {k.value: k for k in CommandKind}
+
+
+def _make_item(
+    cmd_header: CommandHeader, buf: memoryview, *, skip_data: bool
+) -> Optional[SendStreamItem]:
+    "Returns None for `CommandKind.END`."
+    kind_to_attr = _read_attributes(cmd_header, buf, skip_data=skip_data)
+    if skip_data and cmd_header.kind is CommandKind.WRITE:
+        # Just what `btrfs send --no-data` would have sent.
+        return SendStreamItems.update_extent(
+            path=kind_to_attr[AttributeKind.PATH],
+            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
+            len=kind_to_attr[AttributeKind.DATA],
+        )
+    return _COMMAND_KIND_TO_ITEM_MAKER[cmd_header.kind](kind_to_attr)
 
 
 def read_command(infile):
@@ -209,129 +375,114 @@ def read_command(infile):
         raise RuntimeError(f"{cmd_header} got {len(s)} bytes")
     # Future: pull in the `crc32c` module and check the CRC.
 
-    attr_bytes = BytesIO(s)
-    kind_to_attr = {}
-    while attr_bytes.tell() != len(s):
-        kind, attr = read_attribute(attr_bytes)
-        if kind in kind_to_attr:
-            raise RuntimeError(f"{kind} occurred twice in {cmd_header}")
-        kind_to_attr[kind] = attr
+    return _make_item(cmd_header, memoryview(s), skip_data=False)
 
-    if cmd_header.kind == CommandKind.SUBVOL:
-        return SendStreamItems.subvol(
-            path=kind_to_attr[AttributeKind.PATH],
-            uuid=kind_to_attr[AttributeKind.UUID],
-            transid=kind_to_attr[AttributeKind.CTRANSID],
-        )
-    elif cmd_header.kind == CommandKind.SNAPSHOT:
-        return SendStreamItems.snapshot(
-            path=kind_to_attr[AttributeKind.PATH],
-            uuid=kind_to_attr[AttributeKind.UUID],
-            transid=kind_to_attr[AttributeKind.CTRANSID],
-            parent_uuid=kind_to_attr[AttributeKind.CLONE_UUID],
-            parent_transid=kind_to_attr[AttributeKind.CLONE_CTRANSID],
-        )
-    elif cmd_header.kind == CommandKind.MKFILE:
-        return SendStreamItems.mkfile(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKDIR:
-        return SendStreamItems.mkdir(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKNOD:
-        return SendStreamItems.mknod(
-            path=kind_to_attr[AttributeKind.PATH],
-            mode=kind_to_attr[AttributeKind.MODE],
-            dev=kind_to_attr[AttributeKind.RDEV],
-        )
-    elif cmd_header.kind == CommandKind.MKFIFO:
-        return SendStreamItems.mkfifo(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.MKSOCK:
-        return SendStreamItems.mksock(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.SYMLINK:
-        return SendStreamItems.symlink(
-            path=kind_to_attr[AttributeKind.PATH],
-            # NB Unlike the other `dest` attributes, we don't normalize this.
-            dest=os.path.normpath(kind_to_attr[AttributeKind.PATH_LINK]),
-        )
-    elif cmd_header.kind == CommandKind.RENAME:
-        return SendStreamItems.rename(
-            path=kind_to_attr[AttributeKind.PATH],
-            dest=kind_to_attr[AttributeKind.PATH_TO],
-        )
-    elif cmd_header.kind == CommandKind.LINK:
-        return SendStreamItems.link(
-            path=kind_to_attr[AttributeKind.PATH],
-            dest=os.path.normpath(kind_to_attr[AttributeKind.PATH_LINK]),
-        )
-    elif cmd_header.kind == CommandKind.UNLINK:
-        return SendStreamItems.unlink(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.RMDIR:
-        return SendStreamItems.rmdir(path=kind_to_attr[AttributeKind.PATH])
-    elif cmd_header.kind == CommandKind.WRITE:
-        return SendStreamItems.write(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            data=kind_to_attr[AttributeKind.DATA],
-        )
-    elif cmd_header.kind == CommandKind.CLONE:
-        return SendStreamItems.clone(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            len=kind_to_attr[AttributeKind.CLONE_LEN],
-            from_uuid=kind_to_attr[AttributeKind.CLONE_UUID],
-            from_transid=kind_to_attr[AttributeKind.CLONE_CTRANSID],
-            from_path=kind_to_attr[AttributeKind.CLONE_PATH],
-            clone_offset=kind_to_attr[AttributeKind.CLONE_OFFSET],
-        )
-    elif cmd_header.kind == CommandKind.SET_XATTR:
-        return SendStreamItems.set_xattr(
-            path=kind_to_attr[AttributeKind.PATH],
-            name=kind_to_attr[AttributeKind.XATTR_NAME],
-            data=kind_to_attr[AttributeKind.XATTR_DATA],
-        )
-    elif cmd_header.kind == CommandKind.REMOVE_XATTR:
-        return SendStreamItems.remove_xattr(
-            path=kind_to_attr[AttributeKind.PATH],
-            name=kind_to_attr[AttributeKind.XATTR_NAME],
-        )
-    elif cmd_header.kind == CommandKind.TRUNCATE:
-        return SendStreamItems.truncate(
-            path=kind_to_attr[AttributeKind.PATH],
-            size=kind_to_attr[AttributeKind.SIZE],
-        )
-    elif cmd_header.kind == CommandKind.CHMOD:
-        return SendStreamItems.chmod(
-            path=kind_to_attr[AttributeKind.PATH],
-            mode=kind_to_attr[AttributeKind.MODE],
-        )
-    elif cmd_header.kind == CommandKind.CHOWN:
-        return SendStreamItems.chown(
-            path=kind_to_attr[AttributeKind.PATH],
-            uid=kind_to_attr[AttributeKind.UID],
-            gid=kind_to_attr[AttributeKind.GID],
-        )
-    elif cmd_header.kind == CommandKind.UTIMES:
-        return SendStreamItems.utimes(
-            path=kind_to_attr[AttributeKind.PATH],
-            ctime=kind_to_attr[AttributeKind.CTIME],
-            mtime=kind_to_attr[AttributeKind.MTIME],
-            atime=kind_to_attr[AttributeKind.ATIME],
-        )
-    elif cmd_header.kind == CommandKind.END:
-        return None
-    elif cmd_header.kind == CommandKind.UPDATE_EXTENT:
-        return SendStreamItems.update_extent(
-            path=kind_to_attr[AttributeKind.PATH],
-            offset=kind_to_attr[AttributeKind.FILE_OFFSET],
-            len=kind_to_attr[AttributeKind.SIZE],
-        )
 
-    raise AssertionError(f"Fix me: unhandled {cmd_header}")  # pragma: no cover
+def _unpack_command_header(buf) -> CommandHeader:
+    length, value, crc = _COMMAND_HEADER.unpack(buf)
+    kind = _COMMAND_VALUE_TO_KIND.get(value)
+    if kind is None:
+        kind = CommandKind(value)  # Raises the usual `ValueError`
+    return CommandHeader(kind=kind, length=length, crc=crc)
 
 
-def parse_send_stream(infile) -> Iterator[SendStreamItem]:
+def _read_command_from_buffer(
+    buf: memoryview, offset: int, *, skip_data: bool
+) -> Tuple[int, Optional[SendStreamItem]]:
+    "Returns the offset after the command at `offset`, and its item."
+    end = offset + _COMMAND_HEADER.size
+    if len(buf) < end:
+        raise RuntimeError(
+            f"Not enough bytes {bytes(buf[offset:])} for command header"
+        )
+    cmd_header = _unpack_command_header(buf[offset:end])
+    offset, end = end, end + cmd_header.length
+    if len(buf) < end:
+        raise RuntimeError(f"{cmd_header} got {len(buf) - offset} bytes")
+    return end, _make_item(cmd_header, buf[offset:end], skip_data=skip_data)
+
+
+def _read_into(infile, buf: bytearray, size: int) -> memoryview:
+    "Returns a view of `buf` with the next `size` bytes of `infile`, or less."
+    view = memoryview(buf)[:size]
+    num_read = 0
+    while num_read < size:
+        n = infile.readinto(view[num_read:])
+        if not n:
+            return view[:num_read]
+        num_read += n
+    return view
+
+
+def _gen_items_from_file(
+    infile, *, skip_data: bool
+) -> Iterator[Optional[SendStreamItem]]:
+    # Commands are at most 64KiB, so reusing one buffer keeps our memory
+    # use flat, no matter how big the stream is.
+    buf = bytearray(_COMMAND_HEADER.size)
+    while True:
+        header = _read_into(infile, buf, _COMMAND_HEADER.size)
+        if len(header) != _COMMAND_HEADER.size:
+            raise RuntimeError(
+                f"Not enough bytes {bytes(header)} for command header"
+            )
+        cmd_header = _unpack_command_header(header)
+        if len(buf) < cmd_header.length:
+            buf = bytearray(cmd_header.length)
+        attrs = _read_into(infile, buf, cmd_header.length)
+        if len(attrs) != cmd_header.length:
+            raise RuntimeError(f"{cmd_header} got {len(attrs)} bytes")
+        yield _make_item(cmd_header, attrs, skip_data=skip_data)
+
+
+def _map_stream(infile) -> Optional[mmap.mmap]:
+    "Returns a read-only `mmap` of `infile` if it is a regular file."
+    try:
+        fd = infile.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except OSError:  # pragma: no cover
+        return None  # Some filesystems cannot `mmap`
+
+
+def parse_send_stream(
+    infile, *, skip_data: bool = False
+) -> Iterator[SendStreamItem]:
+    """
+    Yields the items of the send-stream in `infile`, which may be any
+    binary file object, including a pipe.
+
+    If `infile` is a regular file, we `mmap` it and decode in place.
+    Otherwise, each command is read into a reused buffer.  Either way, the
+    only copies are of the decoded attribute values.
+
+    With `skip_data`, `WRITE`s become `update_extent` items, just like with
+    `btrfs send --no-data`, so we never copy their data.  This is enough
+    for anything that only looks at metadata or extents, e.g. to compare
+    the filesystems described by two send-streams.
+    """
     check_magic(infile)
     check_version(infile)
+    mm = _map_stream(infile)
+    if mm is None:
+        for item in _gen_items_from_file(infile, skip_data=skip_data):
+            if item is None:
+                return
+            yield item
+    # We don't `close()` the map, since an exception's traceback may still
+    # refer to views of it.  It gets unmapped once it is garbage.
+    buf = memoryview(mm)
+    offset = infile.tell()
     while True:
-        cmd = read_command(infile)
-        if cmd is None:
+        offset, item = _read_command_from_buffer(
+            buf, offset, skip_data=skip_data
+        )
+        if item is None:
+            # Leave `infile` after the stream, as when we read it.
+            infile.seek(offset)
             return
-        yield cmd
+        yield item
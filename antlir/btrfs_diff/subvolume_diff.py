@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compares two `Subvolume`s that were built up by `SubvolumeSetMutator`s.
+
+When both are `snapshot`s of the same parent -- i.e. they came from
+incremental send-streams, `btrfs send -p parent` -- only the paths that
+either stream changed are compared.  This makes comparing two large
+layers that share a parent about as cheap as the layers' own changes.
+Otherwise, every path of both subvolumes is compared.
+
+Each path is compared via the `repr` of its inode, which covers the file
+type, owner, mode, xattrs, symlink target, device number, and the
+lengths of the file's data & holes.  It does NOT cover the bytes of the
+data, since a `--no-data` send-stream lacks them, and `IncompleteInode`
+does not retain them in any case.  Instead, `PathDiff.data_changed` flags
+regular files whose content might differ, so callers can compare just
+those.
+"""
+from typing import Callable, Iterator, NamedTuple, Optional, Set, Union
+
+from .incomplete_inode import IncompleteDir, IncompleteFile, IncompleteInode
+from .inode import Inode
+from .subvolume import Subvolume
+from .subvolume_set import SubvolumeSetMutator
+
+
+class PathDiff(NamedTuple):
+    path: bytes
+    # The `inode_repr` of the inode at `path`, or None if there is none.
+    left: Optional[str]
+    right: Optional[str]
+    # Set when both sides are regular files, and at least one side's data
+    # was written by its send-stream, so the contents may differ even if
+    # `left == right`.
+    data_changed: bool
+
+
+def _gen_subtree_paths(subvol: Subvolume, top_path: bytes) -> Iterator[bytes]:
+    id_map = subvol.id_map
+    to_visit = [top_path]
+    while to_visit:
+        path = to_visit.pop()
+        yield path
+        to_visit.extend(id_map.get_children(id_map.get_id(path)) or ())
+
+
+def _inode_at_path(
+    subvol: Subvolume, path: bytes
+) -> Optional[Union[IncompleteInode, Inode]]:
+    "Unlike `Subvolume.inode_at_path`, a path under a file does not exist."
+    try:
+        return subvol.inode_at_path(path)
+    except RuntimeError:  # One of the parent paths is a file
+        return None
+
+
+def _is_data_changed(mutator: SubvolumeSetMutator, path: bytes) -> bool:
+    if mutator.changes is None:
+        return True  # Full send-stream, all the data was written.
+    return mutator.subvolume.id_map.get_id(path) in (
+        mutator.changes.data_inode_ids
+    )
+
+
+def diff_subvolumes(
+    left: SubvolumeSetMutator,
+    right: SubvolumeSetMutator,
+    *,
+    inode_repr: Callable[[Union[IncompleteInode, Inode]], str] = repr,
+) -> Iterator[PathDiff]:
+    """
+    Yields a `PathDiff` in path order for each path that differs between
+    the two subvolumes, or whose data may differ.
+
+    `inode_repr` lets the caller ignore some metadata, e.g. by erasing the
+    inode's utimes before rendering it.  It may mutate the inode, and is
+    called once per compared path.
+    """
+    left_desc = left.subvolume.id_map.inner.description
+    right_desc = right.subvolume.id_map.inner.description
+    paths: Set[bytes] = set()
+    if (
+        left.changes is not None
+        and right.changes is not None
+        and left_desc.parent_id == right_desc.parent_id
+    ):
+        paths.update(left.changes.gen_paths(left.subvolume))
+        paths.update(right.changes.gen_paths(right.subvolume))
+    else:
+        paths.update(_gen_subtree_paths(left.subvolume, b"."))
+        paths.update(_gen_subtree_paths(right.subvolume, b"."))
+    # A directory that is missing on one side, e.g. because it was removed
+    # or renamed away, differs along with everything underneath it.
+    for path in list(paths):
+        is_left_dir, is_right_dir = (
+            isinstance(_inode_at_path(m.subvolume, path), IncompleteDir)
+            for m in (left, right)
+        )
+        if is_left_dir != is_right_dir:
+            paths.update(
+                _gen_subtree_paths(
+                    (left if is_left_dir else right).subvolume, path
+                )
+            )
+
+    for path in sorted(paths):
+        left_ino = _inode_at_path(left.subvolume, path)
+        right_ino = _inode_at_path(right.subvolume, path)
+        left_repr = None if left_ino is None else inode_repr(left_ino)
+        right_repr = None if right_ino is None else inode_repr(right_ino)
+        data_changed = (
+            isinstance(left_ino, IncompleteFile)
+            and isinstance(right_ino, IncompleteFile)
+            and (_is_data_changed(left, path) or _is_data_changed(right, path))
+        )
+        if left_repr != right_repr or data_changed:
+            yield PathDiff(
+                path=path,
+                left=left_repr,
+                right=right_repr,
+                data_changed=data_changed,
+            )
@@ -21,13 +21,13 @@ from types import MappingProxyType
 
 # Future: `deepfrozen` would let us lose the `new` methods on NamedTuples,
 # and avoid `deepcopy`.
-from typing import Iterator, Mapping, NamedTuple, Optional, Union
+from typing import Iterator, Mapping, NamedTuple, Optional, Set, Union
 
 from .extents_to_chunks import extents_to_chunks_with_clones
 from .freeze import freeze
-from .incomplete_inode import IncompleteInode
+from .incomplete_inode import IncompleteDir, IncompleteInode
 from .inode import Inode
-from .inode_id import InodeIDMap
+from .inode_id import InodeID, InodeIDMap
 from .rendered_tree import RenderedTree
 from .send_stream import SendStreamItem, SendStreamItems
 from .subvolume import Subvolume
@@ -165,6 +165,60 @@ class SubvolumeSet(NamedTuple):
         }
 
 
+class SubvolumeChanges(NamedTuple):
+    """
+    What an incremental send-stream changed relative to its parent.  This
+    lets `diff_subvolumes` visit just these paths, instead of the whole
+    snapshot.
+
+    We track inodes rather than paths, since a later `rename` -- which is
+    how send-streams place each new inode -- would make a path stale.
+    """
+
+    # Inodes that any item touched, or that a `link` added a path to.
+    inode_ids: Set[InodeID]
+    # Inodes whose data was written, truncated, or cloned into.
+    data_inode_ids: Set[InodeID]
+    # Directories that were renamed, so every path underneath changed.
+    moved_inode_ids: Set[InodeID]
+    # Paths that were unlinked, removed, or renamed away.  They might not
+    # exist at the end of the stream.
+    removed_paths: Set[bytes]
+
+    @classmethod
+    def new(cls) -> "SubvolumeChanges":
+        return cls(
+            inode_ids=set(),
+            data_inode_ids=set(),
+            moved_inode_ids=set(),
+            removed_paths=set(),
+        )
+
+    def gen_paths(self, subvol: Subvolume) -> Iterator[bytes]:
+        "May yield duplicates, and paths that no longer exist in `subvol`."
+        yield from self.removed_paths
+        id_map = subvol.id_map
+        for ino_id in self.inode_ids:
+            yield from id_map.get_paths(ino_id)
+        to_visit = [
+            path
+            for ino_id in self.moved_inode_ids
+            for path in id_map.get_paths(ino_id)
+        ]
+        while to_visit:
+            path = to_visit.pop()
+            yield path
+            to_visit.extend(id_map.get_children(id_map.get_id(path)) or ())
+
+
+_DATA_ITEMS = (
+    SendStreamItems.clone,
+    SendStreamItems.truncate,
+    SendStreamItems.update_extent,
+    SendStreamItems.write,
+)
+
+
 class SubvolumeSetMutator(NamedTuple):
     """
     A send-stream always starts with a command defining the subvolume,
@@ -179,6 +233,8 @@ class SubvolumeSetMutator(NamedTuple):
 
     subvolume: Subvolume
     subvolume_set: SubvolumeSet
+    # Only tracked for `snapshot` streams, see `SubvolumeChanges`.
+    changes: Optional[SubvolumeChanges] = None
 
     @classmethod
     def new(
@@ -239,7 +295,15 @@ class SubvolumeSetMutator(NamedTuple):
             description.name_uuid_prefixes()
         )
 
-        return cls(subvolume=subvol, subvolume_set=subvol_set)
+        return cls(
+            subvolume=subvol,
+            subvolume_set=subvol_set,
+            changes=(
+                SubvolumeChanges.new()
+                if isinstance(subvol_item, SendStreamItems.snapshot)
+                else None
+            ),
+        )
 
     def apply_item(self, item: SendStreamItem):
         if isinstance(item, SendStreamItems.clone):
@@ -248,5 +312,24 @@ class SubvolumeSetMutator(NamedTuple):
             )
             if not from_subvol:
                 raise RuntimeError(f"Unknown from_uuid for {item}")
-            return self.subvolume.apply_clone(item, from_subvol)
-        return self.subvolume.apply_item(item)
+            self.subvolume.apply_clone(item, from_subvol)
+        else:
+            self.subvolume.apply_item(item)
+        if self.changes is not None:
+            self._record_change(item)
+
+    def _record_change(self, item: SendStreamItem):
+        changes = self.changes
+        if isinstance(item, (SendStreamItems.unlink, SendStreamItems.rmdir)):
+            changes.removed_paths.add(item.path)
+            return
+        ino_id = self.subvolume.id_map.get_id(
+            item.dest if isinstance(item, SendStreamItems.rename) else item.path
+        )
+        changes.inode_ids.add(ino_id)
+        if isinstance(item, SendStreamItems.rename):
+            changes.removed_paths.add(item.path)
+            if isinstance(self.subvolume.id_to_inode[ino_id], IncompleteDir):
+                changes.moved_inode_ids.add(ino_id)
+        elif isinstance(item, _DATA_ITEMS):
+            changes.data_inode_ids.add(ino_id)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compares `Extent` and `FlatExtent` on synthetic fragmented files, like
+those in the send-streams of databases and logs: each file gets many
+small writes at random offsets, and a few clones from other files.
+
+For each class, we report the time to apply the operations, the time for
+`extents_to_chunks_with_clones`, and the memory held by the extents.
+
+  $ buck run //antlir/btrfs_diff:benchmark-extents -- --writes 10000
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from ..extent import Extent
+from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..flat_extent import FlatExtent
+from ..inode_id import InodeIDMap
+
+
+def _gen_ops(rng: random.Random, *, files: int, writes: int, file_bytes: int):
+    "Yields (file index, method, kwargs), `from_extent` is a file index."
+    for i in range(writes):
+        idx = rng.randrange(files)
+        if i % 100 == 99:
+            from_offset = rng.randrange(file_bytes // 2)
+            yield idx, "clone", {
+                "to_offset": rng.randrange(file_bytes // 2),
+                "from_extent": rng.randrange(files),
+                "from_offset": from_offset,
+                "length": rng.randrange(1, file_bytes // 64),
+            }
+        else:
+            yield idx, "write", {
+                "offset": rng.randrange(file_bytes),
+                "length": rng.randrange(1, 16),
+            }
+
+
+def _run(extent_cls, ops, files: int, file_bytes: int):
+    tracemalloc.start()
+    start = time.monotonic()
+    # Start from a full file, so that every clone source exists.
+    extents = [
+        extent_cls.empty().write(offset=0, length=file_bytes)
+        for _ in range(files)
+    ]
+    for idx, op, kwargs in ops:
+        if op == "clone":
+            kwargs = {**kwargs, "from_extent": extents[kwargs["from_extent"]]}
+        extents[idx] = getattr(extents[idx], op)(**kwargs)
+    apply_seconds = time.monotonic() - start
+    mem_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    id_map = InodeIDMap.new()
+    ids = [id_map.add_file(id_map.next(), b"%d" % i) for i in range(files)]
+    start = time.monotonic()
+    num_chunks = sum(
+        len(chunks)
+        for _, chunks in extents_to_chunks_with_clones(list(zip(ids, extents)))
+    )
+    chunks_seconds = time.monotonic() - start
+    print(
+        f"{extent_cls.__name__}: applied {len(ops)} ops in "
+        f"{apply_seconds:.2f}s, holding {mem_bytes / 2 ** 20:.1f} MiB; "
+        f"{num_chunks} chunks in {chunks_seconds:.2f}s"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--writes", type=int, default=5000)
+    parser.add_argument("--file-bytes", type=int, default=2 ** 20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    ops = list(
+        _gen_ops(
+            random.Random(args.seed),
+            files=args.files,
+            writes=args.writes,
+            file_bytes=args.file_bytes,
+        )
+    )
+    for extent_cls in [Extent, FlatExtent]:
+        _run(extent_cls, ops, args.files, args.file_bytes)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -9,7 +9,7 @@ If your test has a subvolume or a sendstream, these helpers here make it
 easy to make assertions against its content. Grep around for usage examples.
 """
 from io import BytesIO
-from typing import Tuple
+from typing import Iterator, Tuple
 
 from ..freeze import freeze as btrfs_diff_freeze
 from ..inode import InodeOwner
@@ -20,6 +20,7 @@ from ..inode_utils import (
 )
 from ..parse_send_stream import parse_send_stream
 from ..rendered_tree import RenderedTree, emit_non_unique_traversal_ids
+from ..send_stream import SendStreamItem
 from ..subvolume import Subvolume
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
 from .subvolume_utils import expected_subvol_add_traversal_ids
@@ -36,14 +37,23 @@ def render_subvolume(subvol: "Subvolume") -> "RenderedTree":
     return emit_non_unique_traversal_ids(btrfs_diff_freeze(subvol).render())
 
 
-def add_sendstream_to_subvol_set(subvols: SubvolumeSet, sendstream: bytes):
-    parsed = parse_send_stream(BytesIO(sendstream))
-    mutator = SubvolumeSetMutator.new(subvols, next(parsed))
-    for i in parsed:
+def add_send_stream_items_to_subvol_set(
+    subvols: SubvolumeSet, items: Iterator[SendStreamItem]
+):
+    "Also see `Subvol.mark_readonly_and_gen_send_stream_items`."
+    items = iter(items)
+    mutator = SubvolumeSetMutator.new(subvols, next(items))
+    for i in items:
         mutator.apply_item(i)
     return mutator.subvolume
 
 
+def add_sendstream_to_subvol_set(subvols: SubvolumeSet, sendstream: bytes):
+    return add_send_stream_items_to_subvol_set(
+        subvols, parse_send_stream(BytesIO(sendstream))
+    )
+
+
 # We could do this on each `mutator.subvol` in `add_...`, but that would
 # make `add_...` less reusable.  E.g., it would preclude cross-subvolume
 # clone detection.
@@ -68,7 +78,13 @@ def prepare_subvol_set_for_render(
 
 # Often, we just want to render 1 sendstream
 def render_sendstream(sendstream: bytes) -> "RenderedTree":
+    return render_send_stream_items(parse_send_stream(BytesIO(sendstream)))
+
+
+def render_send_stream_items(
+    items: Iterator[SendStreamItem],
+) -> "RenderedTree":
     subvol_set = SubvolumeSet.new()
-    subvolume = add_sendstream_to_subvol_set(subvol_set, sendstream)
+    subvolume = add_send_stream_items_to_subvol_set(subvol_set, items)
     prepare_subvol_set_for_render(subvol_set)
     return render_subvolume(subvolume)
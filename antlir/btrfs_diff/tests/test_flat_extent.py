@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import random
+import unittest
+
+from ..extent import Extent
+from ..extents_to_chunks import extents_to_chunks_with_clones
+from ..flat_extent import FlatExtent
+from ..inode_id import InodeIDMap
+
+
+def _random_ops(rng: random.Random, num_files: int, num_ops: int):
+    "Yields (file index, method, kwargs), `from_extent` is a file index."
+    lengths = [0] * num_files
+    for _ in range(num_ops):
+        idx = rng.randrange(num_files)
+        op = rng.choice(["write", "write", "clone", "truncate"])
+        if op == "write":
+            offset = rng.randrange(lengths[idx] + 5)
+            length = rng.randrange(1, 8)
+            yield idx, op, {"offset": offset, "length": length}
+            lengths[idx] = max(lengths[idx], offset + length)
+        elif op == "truncate":
+            length = rng.randrange(lengths[idx] + 5)
+            yield idx, op, {"length": length}
+            lengths[idx] = length
+        else:
+            from_idx = rng.randrange(num_files)
+            if not lengths[from_idx]:
+                continue
+            from_offset = rng.randrange(lengths[from_idx])
+            length = rng.randrange(1, lengths[from_idx] - from_offset + 1)
+            to_offset = rng.randrange(lengths[idx] + 5)
+            yield idx, op, {
+                "to_offset": to_offset,
+                "from_extent": from_idx,
+                "from_offset": from_offset,
+                "length": length,
+            }
+            lengths[idx] = max(lengths[idx], to_offset + length)
+
+
+def _apply_ops(extent_cls, ops, num_files: int):
+    extents = [extent_cls.empty() for _ in range(num_files)]
+    for idx, op, kwargs in ops:
+        if op == "clone":
+            kwargs = {**kwargs, "from_extent": extents[kwargs["from_extent"]]}
+        extents[idx] = getattr(extents[idx], op)(**kwargs)
+    return extents
+
+
+def _trimmed_leaves(extents):
+    "Replaces leaves by their index in order of appearance, for comparison."
+    leaf_ids = {}
+    return [
+        [
+            (
+                offset,
+                length,
+                leaf.content,
+                leaf_ids.setdefault(id(leaf), len(leaf_ids)),
+            )
+            for offset, length, leaf in extent.gen_trimmed_leaves()
+        ]
+        for extent in extents
+    ]
+
+
+class FlatExtentTestCase(unittest.TestCase):
+    def test_same_as_extent(self):
+        num_files = 4
+        for seed in range(50):
+            ops = list(_random_ops(random.Random(seed), num_files, 60))
+            extents = _apply_ops(Extent, ops, num_files)
+            flat_extents = _apply_ops(FlatExtent, ops, num_files)
+            self.assertEqual(
+                [repr(e) for e in extents], [repr(e) for e in flat_extents]
+            )
+            self.assertEqual(
+                [e.length for e in extents], [e.length for e in flat_extents]
+            )
+            self.assertEqual(
+                _trimmed_leaves(extents), _trimmed_leaves(flat_extents)
+            )
+            id_map = InodeIDMap.new()
+            ids = [
+                id_map.add_file(id_map.next(), f"f{i}".encode())
+                for i in range(num_files)
+            ]
+            self.assertEqual(
+                *(
+                    [
+                        (repr(ino_id), repr(chunks))
+                        for ino_id, chunks in extents_to_chunks_with_clones(
+                            list(zip(ids, es))
+                        )
+                    ]
+                    for es in (extents, flat_extents)
+                )
+            )
+
+    def test_trimmed_leaves(self):
+        e = FlatExtent.empty().write(offset=3, length=4).truncate(9)
+        self.assertEqual("h3d4h2", repr(e))
+        (_, _, hole), (_, _, data), (_, _, hole2) = e.gen_trimmed_leaves()
+        self.assertEqual(
+            [(1, 2, hole), (0, 4, data), (0, 1, hole2)],
+            list(e.gen_trimmed_leaves(offset=1, length=7)),
+        )
+        self.assertEqual([], list(e.gen_trimmed_leaves(offset=4, length=0)))
+        self.assertEqual("h3d1", repr(e.truncate(4)))
+        self.assertEqual("", repr(FlatExtent.empty()))
+
+    def test_copy(self):
+        e = FlatExtent.empty().write(offset=0, length=2)
+        for e_copy in [copy.copy(e), copy.deepcopy(e)]:
+            # Mutations don't affect the copy, which shares the leaves.
+            e_copy.write(offset=1, length=3)
+            self.assertEqual("d2", repr(e))
+            self.assertEqual("d4", repr(e_copy))
+            self.assertIs(
+                next(e.gen_trimmed_leaves())[2],
+                next(e_copy.gen_trimmed_leaves())[2],
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
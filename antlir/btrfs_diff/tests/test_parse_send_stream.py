@@ -9,7 +9,10 @@ This test only validates the binary send-stream parser. We rely on the fact
 that `test_parse_dump.py` already sanity-checks the gold data.
 """
 import io
+import os
 import struct
+import tempfile
+import threading
 from typing import Iterable
 
 from antlir.tests.common import AntlirTestCase
@@ -24,7 +27,7 @@ from ..parse_send_stream import (
     read_attribute,
     read_command,
 )
-from ..send_stream import SendStreamItem
+from ..send_stream import SendStreamItem, SendStreamItems
 from .demo_sendstreams import gold_demo_sendstreams
 from .demo_sendstreams_expected import get_filtered_and_expected_items
 
@@ -47,6 +50,60 @@ class ParseSendStreamTestCase(AntlirTestCase):
         )
         self.assertEqual(filtered_items, expected_items)
 
+    def test_stream_kinds_and_skip_data(self):
+        for name, d in gold_demo_sendstreams().items():
+            s = d["sendstream"]
+            expected = list(_parse_stream_bytes(s))
+            # A regular file is `mmap`ed, and left just after the stream.
+            with tempfile.TemporaryFile() as tf:
+                tf.write(s + b"trailing")
+                tf.seek(0)
+                self.assertEqual(expected, list(parse_send_stream(tf)))
+                self.assertEqual(b"trailing", tf.read())
+            # A pipe is read one command at a time.
+            r_fd, w_fd = os.pipe()
+            with open(r_fd, "rb") as r:
+
+                def write_and_close():
+                    with open(w_fd, "wb") as w:
+                        w.write(s)
+
+                writer = threading.Thread(target=write_and_close)
+                writer.start()
+                self.assertEqual(expected, list(parse_send_stream(r)))
+                writer.join()
+            # `skip_data` turns writes into `btrfs send --no-data` extents
+            no_data = [
+                SendStreamItems.update_extent(
+                    path=i.path, offset=i.offset, len=len(i.data)
+                )
+                if isinstance(i, SendStreamItems.write)
+                else i
+                for i in expected
+            ]
+            if name == "create_ops":
+                self.assertNotEqual(expected, no_data)
+            with tempfile.TemporaryFile() as tf:
+                tf.write(s)
+                tf.seek(0)
+                for infile in [io.BytesIO(s), tf]:
+                    self.assertEqual(
+                        no_data, list(parse_send_stream(infile, skip_data=True))
+                    )
+
+    def test_truncated_stream(self):
+        s = gold_demo_sendstreams()["mutate_ops"]["sendstream"]
+        for cut, err in [
+            (17 + 5, "Not enough bytes .* for command header"),
+            (17 + 10 + 5, "CommandHeader.* got 5 bytes"),
+        ]:
+            with tempfile.TemporaryFile() as tf:
+                tf.write(s[:cut])
+                tf.seek(0)
+                for infile in [io.BytesIO(s[:cut]), tf]:
+                    with self.assertRaisesRegex(RuntimeError, err):
+                        list(parse_send_stream(infile))
+
     def test_errors(self):
         with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
             check_magic(io.BytesIO(b"xxx"))
@@ -93,3 +150,27 @@ class ParseSendStreamTestCase(AntlirTestCase):
                     )
                 )
             )
+
+        def cmd_with_attrs(attrs: bytes, kind=CommandKind.MKFILE.value):
+            return struct.pack("<IHI", len(attrs), kind, 0) + attrs
+
+        with self.assertRaisesRegex(RuntimeError, "has a truncated attribute"):
+            read_command(io.BytesIO(cmd_with_attrs(b"ab")))
+        with self.assertRaisesRegex(RuntimeError, "AttributeH.* got 1 bytes"):
+            read_command(
+                io.BytesIO(
+                    cmd_with_attrs(
+                        struct.pack("<HH1s", AttributeKind.PATH.value, 2, b"x")
+                    )
+                )
+            )
+        with self.assertRaisesRegex(ValueError, "99 is not a valid Attr"):
+            read_command(io.BytesIO(cmd_with_attrs(struct.pack("<HH", 99, 0))))
+        with self.assertRaisesRegex(ValueError, "99 is not a valid Command"):
+            list(
+                _parse_stream_bytes(
+                    b"btrfs-stream\0"
+                    + struct.pack("<I", 1)
+                    + cmd_with_attrs(b"", kind=99)
+                )
+            )
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from ..inode_utils import erase_utimes_in_range
+from ..parse_dump import SendStreamItems
+from ..subvolume_diff import PathDiff, diff_subvolumes
+from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
+
+si = SendStreamItems
+
+
+def _repr_without_utimes(ino):
+    erase_utimes_in_range(ino, start=(0, 0), end=(2**64, 0))
+    return repr(ino)
+
+
+def _diff(left, right):
+    return {
+        d.path: d
+        for d in diff_subvolumes(left, right, inode_repr=_repr_without_utimes)
+    }
+
+
+class SubvolumeDiffTestCase(unittest.TestCase):
+    def _make_parent(self, subvols):
+        parent = SubvolumeSetMutator.new(
+            subvols, si.subvol(path=b"parent", uuid=b"p", transid=1)
+        )
+        self.assertIsNone(parent.changes)
+        for item in [
+            si.mkdir(path=b"d"),
+            si.mkfile(path=b"d/f"),
+            si.write(path=b"d/f", offset=0, data=b"abc"),
+            si.mkfile(path=b"same"),
+            si.mkfile(path=b"unlinked"),
+            si.mkdir(path=b"moved"),
+            si.mkfile(path=b"moved/g"),
+            si.mkdir(path=b"e"),
+            si.mkdir(path=b"e/sub"),
+        ]:
+            parent.apply_item(item)
+        return parent
+
+    def _snapshot(self, subvols, name: bytes, items):
+        mutator = SubvolumeSetMutator.new(
+            subvols,
+            si.snapshot(
+                path=name,
+                uuid=name,
+                transid=2,
+                parent_uuid=b"p",
+                parent_transid=1,
+            ),
+        )
+        for item in items:
+            mutator.apply_item(item)
+        return mutator
+
+    def test_incremental(self):
+        subvols = SubvolumeSet.new()
+        self._make_parent(subvols)
+        left = self._snapshot(
+            subvols,
+            b"left",
+            [
+                si.chmod(path=b"d/f", mode=0o600),
+                si.unlink(path=b"unlinked"),
+                si.rename(path=b"moved", dest=b"renamed"),
+                # Like send-streams, make a file under a temporary name.
+                si.mkfile(path=b"o260-7-0"),
+                si.rename(path=b"o260-7-0", dest=b"d/new"),
+                si.rmdir(path=b"e/sub"),
+                si.rmdir(path=b"e"),
+                si.mkfile(path=b"e"),
+                si.update_extent(path=b"d/new", offset=0, len=5),
+                si.utimes(
+                    path=b"same", atime=(1, 0), mtime=(1, 0), ctime=(1, 0)
+                ),
+            ],
+        )
+        right = self._snapshot(
+            subvols,
+            b"right",
+            [
+                si.update_extent(path=b"d/f", offset=0, len=3),
+                si.link(path=b"d/new", dest=b"same"),
+            ],
+        )
+        # Neither side has the temporary name, and we ignore utimes.
+        self.assertEqual(
+            {b"o260-7-0", b"same"},
+            set(left.changes.gen_paths(left.subvolume))
+            - set(_diff(left, right)),
+        )
+        diffs = _diff(left, right)
+        self.assertEqual(
+            [
+                b"d/f",
+                b"d/new",
+                b"e",
+                b"e/sub",
+                b"moved",
+                b"moved/g",
+                b"renamed",
+                b"renamed/g",
+                b"unlinked",
+            ],
+            list(diffs),
+        )
+        # Metadata & data both changed
+        self.assertNotEqual(diffs[b"d/f"].left, diffs[b"d/f"].right)
+        self.assertTrue(diffs[b"d/f"].data_changed)
+        # Different files at the same path
+        self.assertIn("d5", diffs[b"d/new"].left)
+        self.assertNotIn("d5", diffs[b"d/new"].right)
+        self.assertTrue(diffs[b"d/new"].data_changed)
+        # A file replaced a directory
+        self.assertIn("File", diffs[b"e"].left)
+        self.assertIn("Dir", diffs[b"e"].right)
+        for path in [b"e/sub", b"moved", b"moved/g", b"unlinked"]:
+            self.assertIsNone(diffs[path].left)
+            self.assertFalse(diffs[path].data_changed)
+        for path in [b"renamed", b"renamed/g"]:
+            self.assertIsNone(diffs[path].right)
+
+        # Comparing a snapshot to itself only reports data changes.
+        self.assertEqual(
+            [PathDiff(b"d/f", *([diffs[b"d/f"].right] * 2), True)],
+            list(_diff(right, right).values()),
+        )
+
+    def test_full(self):
+        subvols = SubvolumeSet.new()
+        parent = self._make_parent(subvols)
+        left = self._snapshot(subvols, b"left", [])
+        # Without a common parent, every file's data may differ.
+        self.assertEqual(
+            [b"d/f", b"moved/g", b"same", b"unlinked"],
+            [
+                d.path
+                for d in _diff(left, parent).values()
+                if d.data_changed and d.left == d.right
+            ],
+        )
+        self.assertEqual(
+            [b"d/f", b"moved/g", b"same", b"unlinked"],
+            list(_diff(parent, parent)),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -247,6 +247,64 @@ class SubvolumeSetTestCase(AntlirTestCase):
         for expected, frozen in reprs_and_frozens:
             self._check_repr(expected, frozen)
 
+    def test_snapshot_changes(self):
+        si = SendStreamItems
+        subvols = SubvolumeSet.new()
+        parent = SubvolumeSetMutator.new(
+            subvols, si.subvol(path=b"p", uuid=b"pp", transid=1)
+        )
+        self.assertIsNone(parent.changes)
+        for item in [
+            si.mkdir(path=b"d"),
+            si.mkfile(path=b"d/f"),
+            si.mkfile(path=b"gone"),
+            si.mkfile(path=b"src"),
+            si.write(path=b"src", offset=0, data=b"hi"),
+            si.mkfile(path=b"untouched"),
+        ]:
+            parent.apply_item(item)
+
+        snap = SubvolumeSetMutator.new(
+            subvols,
+            si.snapshot(
+                path=b"s",
+                uuid=b"ss",
+                transid=2,
+                parent_uuid=b"pp",
+                parent_transid=1,
+            ),
+        )
+        for item in [
+            si.rename(path=b"d", dest=b"e"),
+            si.unlink(path=b"gone"),
+            si.chmod(path=b"src", mode=0o644),
+            si.mkfile(path=b"o1"),
+            si.clone(
+                path=b"o1",
+                offset=0,
+                from_uuid=b"pp",
+                from_transid=1,
+                from_path=b"src",
+                clone_offset=0,
+                len=2,
+            ),
+            si.rename(path=b"o1", dest=b"new"),
+            si.link(path=b"link", dest=b"new"),
+        ]:
+            snap.apply_item(item)
+        id_map = snap.subvolume.id_map
+        self.assertEqual(
+            {id_map.get_id(p) for p in [b"e", b"new", b"src"]},
+            snap.changes.inode_ids,
+        )
+        self.assertEqual({id_map.get_id(b"new")}, snap.changes.data_inode_ids)
+        self.assertEqual({id_map.get_id(b"e")}, snap.changes.moved_inode_ids)
+        self.assertEqual({b"d", b"gone", b"o1"}, snap.changes.removed_paths)
+        self.assertEqual(
+            {b"d", b"e", b"e/f", b"gone", b"link", b"new", b"o1", b"src"},
+            set(snap.changes.gen_paths(snap.subvolume)),
+        )
+
     def test_errors(self):
         si = SendStreamItems
         subvols = SubvolumeSet.new()
@@ -143,6 +143,12 @@ EOF
         $(exe {compiler}) {maybe_artifacts_require_repo} \
           ${{ANTLIR_DEBUG:+--debug}} \
           --subvolumes-dir "$subvolumes_dir" \
+          --image-source-cache-dir "$subvolumes_dir/../image_source_cache" \
+          --provides-index-dir "$subvolumes_dir/../provides_index" \
+          --repo-server-blob-cache-dir \
+            "$subvolumes_dir/../repo_server_blob_cache" \
+          --yum-dnf-shared-cache-dir \
+            "$subvolumes_dir/../yum_dnf_shared_cache" \
           --subvolume-rel-path \
             "$subvolume_wrapper_dir/"{subvol_name_quoted} \
           {maybe_flavor_config} \
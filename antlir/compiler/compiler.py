@@ -13,18 +13,26 @@ This compiler builds a btrfs subvolume in
 To do so, it parses `--child-feature-json` and the `--child-dependencies`
 that referred therein, creates `ImageItems`, sorts them in dependency order,
 and invokes `.build()` to apply each item to actually construct the subvol.
+Items that do not depend on each other build concurrently.
 """
 
 import argparse
 import os
 import stat
 import sys
-from contextlib import ExitStack
+from contextlib import ExitStack, nullcontext
 from typing import Iterator
 
 from antlir.cli import add_targets_and_outputs_arg
+from antlir.compiler.items.build_appliance_sessions import (
+    BuildApplianceSessions,
+)
 from antlir.compiler.items.common import LayerOpts
-from antlir.compiler.items.phases_provide import PhasesProvideItem
+from antlir.compiler.items.make_subvol import ParentLayerItem
+from antlir.compiler.items.phases_provide import (
+    PhasesProvideItem,
+    save_subvolume_provides_index,
+)
 from antlir.compiler.items_for_features import gen_items_for_features
 from antlir.config import repo_config
 from antlir.find_built_subvol import find_built_subvol
@@ -109,6 +117,70 @@ def parse_args(args) -> argparse.Namespace:
         "of the child layer",
     )
 
+    parser.add_argument(
+        "--image-source-cache-dir",
+        type=Path.from_argparse,
+        help="A directory in which to persist the content hashes of "
+        "`image.source`s, and the outputs of their generators, across "
+        "builds.  Safe to share between concurrent builds.",
+    )
+
+    parser.add_argument(
+        "--provides-index-dir",
+        type=Path.from_argparse,
+        help="A directory in which to save an index of the paths of every "
+        "built layer.  Child layers derive their paths from the parent's "
+        "index, instead of walking the whole filesystem.  Safe to share "
+        "between concurrent builds.  Only the most recently used indexes "
+        "are kept.",
+    )
+
+    parser.add_argument(
+        "--repo-server-blob-cache-dir",
+        type=Path.from_argparse,
+        help="A directory in which the `repo-server`s of RPM items cache "
+        "the RPMs & repodata they fetched from storage, so that later "
+        "builds with the same snapshot need not fetch them again.  Safe to "
+        "share between concurrent builds.",
+    )
+
+    parser.add_argument(
+        "--yum-dnf-shared-cache-dir",
+        type=Path.from_argparse,
+        help="A directory on the same `btrfs` volume as the build appliance, "
+        "in which RPM items keep read-only copies of the RPM snapshots' "
+        "repodata caches.  Each `yum` / `dnf` run then takes a `btrfs` "
+        "snapshot of the copy, instead of copying the whole cache.  Safe to "
+        "share between concurrent builds.  Caches unused for a week are "
+        "deleted.",
+    )
+
+    parser.add_argument(
+        "--rpm-single-transaction",
+        action="store_true",
+        help="Run all the RPM installs & removes of a phase as a single "
+        "`yum/dnf shell` transaction, which boots the build appliance and "
+        "loads repodata just once.",
+    )
+
+    parser.add_argument(
+        "--item-build-workers",
+        type=int,
+        default=1,
+        help="Build up to this many independent `ImageItem`s at once.  "
+        "Items that write state outside of their own paths, like users and "
+        "groups, still build one at a time.  With more than 1, the build "
+        "order, and thus the log output, is no longer deterministic.",
+    )
+
+    parser.add_argument(
+        "--reuse-build-appliance-containers",
+        action="store_true",
+        help="Run the build appliance commands of tarball and symlink "
+        "items, and of each RPM phase, in one container per layer or "
+        "phase, instead of one container per command.",
+    )
+
     add_targets_and_outputs_arg(parser)
     return Path.parse_args(parser, args)
 
@@ -124,19 +196,44 @@ def compile_items_to_subvol(
         iter_items=iter_items,
         layer_target=layer_opts.layer_target,
     )
+    phases = list(dep_graph.ordered_phases())
+    parent = next(
+        (
+            item.subvol
+            for _, items in phases
+            for item in items
+            if isinstance(item, ParentLayerItem)
+        ),
+        None,
+    )
     # Creating all the builders up-front lets phases validate their input
-    for builder in [
-        builder_maker(items, layer_opts)
-        for builder_maker, items in dep_graph.ordered_phases()
-    ]:
-        builder(subvol)
-    # We cannot validate or sort `ImageItem`s until the phases are
-    # materialized since the items may depend on the output of the phases.
-    for item in dep_graph.gen_dependency_order_items(
-        PhasesProvideItem(from_target=layer_opts.layer_target, subvol=subvol)
-    ):
-        # pyre-fixme[16]: `ImageItem` has no attribute `build`.
-        item.build(subvol, layer_opts)
+    builders = [
+        builder_maker(items, layer_opts) for builder_maker, items in phases
+    ]
+    # The build appliance containers must exit before we mark `subvol`
+    # read-only.
+    with layer_opts.build_appliance_sessions or nullcontext():
+        for builder in builders:
+            builder(subvol)
+        # We cannot validate or sort `ImageItem`s until the phases are
+        # materialized since the items may depend on the output of the
+        # phases.
+        dep_graph.build_items(
+            PhasesProvideItem(
+                from_target=layer_opts.layer_target,
+                subvol=subvol,
+                parent=parent,
+                provides_index_dir=layer_opts.provides_index_dir,
+            ),
+            # pyre-fixme[16]: `ImageItem` has no attribute `build`.
+            lambda item: item.build(subvol, layer_opts),
+            max_workers=layer_opts.item_build_workers,
+        )
+    if layer_opts.provides_index_dir:
+        # This marks `subvol` read-only, since `btrfs send` requires it.
+        save_subvolume_provides_index(
+            subvol, parent=parent, index_dir=layer_opts.provides_index_dir
+        )
 
 
 def get_parent_layer_flavor_config(parent_layer: Subvol) -> flavor_config_t:
@@ -190,6 +287,17 @@ def build_image(args):
         # as it is generally used to create a new build appliance flavor
         # by force overriding an existing flavor.
         unsafe_bypass_flavor_check=flavor_config.unsafe_bypass_flavor_check,
+        image_source_cache_dir=args.image_source_cache_dir,
+        rpm_single_transaction=args.rpm_single_transaction,
+        provides_index_dir=args.provides_index_dir,
+        repo_server_blob_cache_dir=args.repo_server_blob_cache_dir,
+        yum_dnf_shared_cache_dir=args.yum_dnf_shared_cache_dir,
+        item_build_workers=args.item_build_workers,
+        build_appliance_sessions=BuildApplianceSessions(
+            args.child_layer_target
+        )
+        if args.reuse_build_appliance_containers
+        else None,
     )
 
     # This stack allows build items to hold temporary state on disk.
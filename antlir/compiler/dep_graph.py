@@ -13,7 +13,9 @@ already been installed.  This is known as dependency order or topological
 sort.
 """
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from typing import (
+    Callable,
     Dict,
     Generator,
     Iterator,
@@ -459,11 +461,23 @@ class DependencyGraph:
         # {item: {items, requiring, it}}
         # pyre-fixme[16]: `Namespace` has no attribute `predecessor_to_items`.
         ns.predecessor_to_items = defaultdict(set)
+        # {item: {other, items, providing, the, same, thing}} -- these are
+        # the permitted duplicates of `ItemProv.conflicts`, and must not
+        # build at the same time.
+        # pyre-fixme[16]: `Namespace` has no attribute `item_to_co_providers`.
+        ns.item_to_co_providers = defaultdict(set)
 
         # For each path, treat items that provide something at that path as
         # predecessors of items that require something at the path.
         for rp in ValidatedReqsProvs(self.items).item_reqs_provs():
             self._add_dir_deps_for_item_provs(ns, rp.item_provs)
+            if len(rp.item_provs) > 1:
+                for item_prov in rp.item_provs:
+                    ns.item_to_co_providers[item_prov.item].update(
+                        ip.item
+                        for ip in rp.item_provs
+                        if ip.item is not item_prov.item
+                    )
             for item_prov in rp.item_provs:
                 for item_req in rp.item_reqs:
                     ns.predecessor_to_items[item_prov.item].add(item_req.item)
@@ -499,22 +513,110 @@ class DependencyGraph:
             else:
                 yield item
             yield_idx += 1
+            self._release_dependents(ns, item)
 
-            # All items, which had `item` was a dependency, must have their
-            # "predecessors" sets updated
-            for requiring_item in ns.predecessor_to_items[item]:
-                predecessors = ns.item_to_predecessors[requiring_item]
-                predecessors.remove(item)
-                if not predecessors:
-                    ns.items_without_predecessors.add(requiring_item)
-                    # With no more predecessors, this will no longer be used.
-                    del ns.item_to_predecessors[requiring_item]
+        self._assert_no_cycle(ns)
 
-            # We won't need this value again, and this lets us detect cycles.
-            del ns.predecessor_to_items[item]
+    @staticmethod
+    def _release_dependents(ns, item: ImageItem) -> None:
+        # All items, which had `item` was a dependency, must have their
+        # "predecessors" sets updated
+        for requiring_item in ns.predecessor_to_items[item]:
+            predecessors = ns.item_to_predecessors[requiring_item]
+            predecessors.remove(item)
+            if not predecessors:
+                ns.items_without_predecessors.add(requiring_item)
+                # With no more predecessors, this will no longer be used.
+                del ns.item_to_predecessors[requiring_item]
+
+        # We won't need this value again, and this lets us detect cycles.
+        del ns.predecessor_to_items[item]
 
+    @staticmethod
+    def _assert_no_cycle(ns) -> None:
         # Initially, every item was indexed here. If there's anything left,
         # we must have a cycle. Future: print a cycle to simplify debugging.
         assert not ns.predecessor_to_items, "Cycle in {}".format(
             ns.predecessor_to_items
         )
+
+    def build_items(
+        self,
+        phases_provide: PhasesProvideItem,
+        build_item: Callable[[ImageItem], None],
+        *,
+        max_workers: int,
+    ) -> None:
+        """
+        Calls `build_item` on every item in dependency order, like
+        `gen_dependency_order_items`, but with up to `max_workers` items
+        building at once.  An item starts as soon as all of the items that
+        it requires are built.
+
+        This is safe because the items that may run together do not depend
+        on one another, and `ValidatedReqsProvs` ensures that their
+        `provides` do not conflict.  Items whose `build_concurrently()` is
+        false may touch shared state (e.g. `/etc/passwd`) that is not
+        modeled by `provides`, so each of them is built alone.
+
+        On error, items that have not yet started are cancelled, and the
+        first error is raised once the running items finish.
+        """
+        if max_workers <= 1:
+            for item in self.gen_dependency_order_items(phases_provide):
+                build_item(item)
+            return
+        if not self.items:
+            return  # See `gen_dependency_order_items`
+        ns = self._prep_item_predecessors(phases_provide)
+        # This item deliberately lacks `build()`.
+        ns.items_without_predecessors.remove(phases_provide)
+        self._release_dependents(ns, phases_provide)
+
+        ready_concurrent = []
+        ready_alone = []
+        running: Dict[Future, ImageItem] = {}
+        running_alone = False
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while True:
+                    for item in ns.items_without_predecessors:
+                        # pyre-fixme[16]: `ImageItem` has no attribute
+                        # `build_concurrently`.
+                        if item.build_concurrently():
+                            ready_concurrent.append(item)
+                        else:
+                            ready_alone.append(item)
+                    ns.items_without_predecessors.clear()
+                    # An item that must build alone waits for the running
+                    # items to finish, and no others start until it is done.
+                    if ready_alone:
+                        if not running:
+                            item = ready_alone.pop()
+                            running[executor.submit(build_item, item)] = item
+                            running_alone = True
+                    elif not running_alone:
+                        blocked = []
+                        for item in ready_concurrent:
+                            if ns.item_to_co_providers[item].isdisjoint(
+                                running.values()
+                            ):
+                                fut = executor.submit(build_item, item)
+                                running[fut] = item
+                            else:
+                                blocked.append(item)
+                        ready_concurrent = blocked
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        item = running.pop(fut)
+                        fut.result()  # Raise the item's build error
+                        self._release_dependents(ns, item)
+                        running_alone = False
+            except BaseException:
+                for fut in running:
+                    fut.cancel()
+                raise
+        assert not ready_concurrent and not ready_alone
+        self._assert_no_cycle(ns)
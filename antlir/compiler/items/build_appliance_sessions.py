@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Many items run a command in the build appliance, with the layer being built
+bind-mounted read-write.  Booting a container per command means that a
+layer with a few dozen such items snapshots the build appliance, creates a
+cgroup, and starts & stops `systemd-nspawn` a few dozen times.
+
+With `--reuse-build-appliance-containers`, the compiler puts a
+`BuildApplianceSessions` into `LayerOpts`, and these commands instead run
+in a `nspawn_session` that stays up until the layer is compiled.  Upon
+exit, we log how much container setup time this saved.
+
+Commands in one session share the build appliance's filesystem, so they
+must not depend on it being pristine.  The ones here only write to the
+layer, and to temporary files.
+"""
+import pwd
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+from antlir.common import get_logger
+from antlir.fs_utils import Path, generate_work_dir
+from antlir.nspawn_in_subvol.args import PopenArgs, new_nspawn_opts
+from antlir.nspawn_in_subvol.nspawn import (
+    NspawnSession,
+    nspawn_session,
+    run_nspawn,
+)
+from antlir.nspawn_in_subvol.plugins import NspawnPlugin
+from antlir.subvol_utils import Subvol
+
+from .common import LayerOpts
+
+
+log = get_logger()
+
+
+class _CountedSession:
+    "Counts the commands run in a session, to report the time saved."
+
+    def __init__(self, session: NspawnSession, setup_seconds: float):
+        self._session = session
+        self.setup_seconds = setup_seconds
+        self.num_cmds = 0
+        # Concurrent items may share a session.
+        self._num_cmds_lock = threading.Lock()
+
+    def run(self, cmd: Iterable[str], **kwargs) -> None:
+        with self._num_cmds_lock:
+            self.num_cmds += 1
+        self._session.run(cmd, **kwargs)
+
+
+class BuildApplianceSessions:
+    def __init__(self, layer_target: str):
+        self._layer_target = layer_target
+        self._exit_stack = ExitStack()
+        self._lock = threading.Lock()
+        self._key_to_session_and_work_dir: Dict[
+            Tuple[Path, bool], Tuple[_CountedSession, Path]
+        ] = {}
+        self._sessions: List[_CountedSession] = []
+
+    def __enter__(self) -> "BuildApplianceSessions":
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        try:
+            return self._exit_stack.__exit__(*exc_info)
+        finally:
+            self._log_savings()
+
+    def _log_savings(self) -> None:
+        num_cmds = sum(s.num_cmds for s in self._sessions)
+        if not num_cmds:
+            return
+        # Each command would otherwise have paid for its own setup.
+        saved_seconds = sum(
+            s.setup_seconds * (s.num_cmds - 1) for s in self._sessions
+        )
+        log.info(
+            f"{self._layer_target}: Ran {num_cmds} build appliance commands "
+            f"in {len(self._sessions)} containers, saving about "
+            f"{saved_seconds:.1f}s of container setup"
+        )
+
+    @contextmanager
+    def session(
+        self, opts, *, plugins: Iterable[NspawnPlugin] = ()
+    ) -> Iterator[_CountedSession]:
+        "A `nspawn_session` whose commands count towards the savings."
+        start = time.monotonic()
+        with nspawn_session(opts, PopenArgs(), plugins=plugins) as session:
+            counted = _CountedSession(session, time.monotonic() - start)
+            self._sessions.append(counted)
+            yield counted
+
+    def run(
+        self,
+        build_appliance: Subvol,
+        subvol: Subvol,
+        make_cmd: Callable[[Path], List[str]],
+        *,
+        forward_fd: Iterable[int] = (),
+        allow_mknod: bool = False,
+    ) -> None:
+        "See `run_in_build_appliance`."
+        key = (subvol.path(), allow_mknod)
+        # Concurrent items wait for the first one to start the session.
+        with self._lock:
+            if key not in self._key_to_session_and_work_dir:
+                work_dir = generate_work_dir()
+                self._key_to_session_and_work_dir[key] = (
+                    self._exit_stack.enter_context(
+                        self.session(
+                            new_nspawn_opts(
+                                cmd=[],
+                                layer=build_appliance,
+                                bindmount_rw=[(subvol.path(), work_dir)],
+                                user=pwd.getpwnam("root"),
+                                allow_mknod=allow_mknod,
+                            )
+                        )
+                    ),
+                    work_dir,
+                )
+            session, work_dir = self._key_to_session_and_work_dir[key]
+        session.run(make_cmd(work_dir), forward_fd=forward_fd)
+
+
+def run_in_build_appliance(
+    subvol: Subvol,
+    layer_opts: LayerOpts,
+    make_cmd: Callable[[Path], List[str]],
+    *,
+    forward_fd: Iterable[int] = (),
+    allow_mknod: bool = False,
+) -> None:
+    """
+    Runs `make_cmd(work_dir)` as `root` in `layer_opts.build_appliance`,
+    with `subvol` bind-mounted read-write at `work_dir`.
+    """
+    build_appliance = layer_opts.requires_build_appliance()
+    if layer_opts.build_appliance_sessions is not None:
+        layer_opts.build_appliance_sessions.run(
+            build_appliance,
+            subvol,
+            make_cmd,
+            forward_fd=forward_fd,
+            allow_mknod=allow_mknod,
+        )
+        return
+    work_dir = generate_work_dir()
+    run_nspawn(
+        new_nspawn_opts(
+            cmd=make_cmd(work_dir),
+            layer=build_appliance,
+            bindmount_rw=[(subvol.path(), work_dir)],
+            user=pwd.getpwnam("root"),
+            forward_fd=forward_fd,
+            allow_mknod=allow_mknod,
+        ),
+        PopenArgs(),
+    )
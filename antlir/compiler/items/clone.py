@@ -62,6 +62,9 @@ class CloneItem(clone_t, ImageItem):
             path=self.dest if self.pre_existing_dest else self.dest.dirname()
         )
 
+    def build_concurrently(self) -> bool:
+        return True
+
     def build(self, subvol: Subvol, layer_opts: LayerOpts):
         # The compiler should have caught this, this is just paranoia.
         if self.pre_existing_dest:
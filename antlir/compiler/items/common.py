@@ -16,12 +16,11 @@ top of `provides.py`.
 """
 import dataclasses
 import enum
-import hashlib
 import inspect
 import os
-import subprocess
 import tempfile
 from typing import (
+    Any,
     AnyStr,
     FrozenSet,
     List,
@@ -37,6 +36,7 @@ from antlir.rpm.yum_dnf_conf import YumDnf
 from antlir.subvol_utils import Subvol
 from pydantic import validator
 
+from .image_source_cache import ImageSourceCache, hash_path, run_generator
 from .mount_utils import mountpoints_from_subvol_meta
 
 
@@ -126,6 +126,26 @@ class LayerOpts(NamedTuple):
     debug: bool = False
     allowed_host_mount_targets: FrozenSet[str] = frozenset()
     unsafe_bypass_flavor_check: bool = False
+    # Persists `image.source` digests & generator outputs, see
+    # `image_source_cache.py`.
+    image_source_cache_dir: Optional[Path] = None
+    # Run each RPM phase as one `yum/dnf shell` transaction, instead of
+    # one `yum` / `dnf` run per command, see `rpm_action.py`.
+    rpm_single_transaction: bool = False
+    # Where layers persist their `ProvidesIndex`, see `phases_provide.py`.
+    provides_index_dir: Optional[Path] = None
+    # The `repo-server`s of RPM items share this on-host cache of blobs,
+    # see `repo_server.py`.
+    repo_server_blob_cache_dir: Optional[Path] = None
+    # RPM items share read-only copies of the snapshots' repodata caches
+    # here, see `yum_dnf_from_snapshot.py`.  Must be on the same `btrfs`
+    # volume as the build appliance.
+    yum_dnf_shared_cache_dir: Optional[Path] = None
+    # Up to this many `ImageItem`s build at once, see `dep_graph.py`.
+    item_build_workers: int = 1
+    # A `BuildApplianceSessions` (not imported, since that would be
+    # circular), for items to reuse build appliance containers.
+    build_appliance_sessions: Optional[Any] = None
 
     def requires_build_appliance(self) -> Subvol:
         assert self.build_appliance is not None, (
@@ -145,6 +165,13 @@ class ImageItem:
         # pyre-fixme[7]: Expected `PhaseOrder` but got `None`.
         return None
 
+    def build_concurrently(self) -> bool:
+        """
+        Items that only write the paths in their `provides` may build
+        concurrently with other such items, see `DependencyGraph.build_items`.
+        """
+        return False
+
     @classmethod
     def customize_fields(cls, kwargs):
         pass
@@ -336,11 +363,7 @@ def setup_meta_dir(subvol: Subvol, layer_opts: LayerOpts):
 
 def _hash_path(path: str, algorithm: str) -> str:
     "Returns the hex digest"
-    algo = hashlib.new(algorithm)
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            algo.update(chunk)
-    return algo.hexdigest()
+    return hash_path(path, algorithm)
 
 
 def _generate_file(
@@ -367,15 +390,9 @@ def _generate_file(
     # Future: it would be best to sandbox the generator to limit its
     # filesystem writes.  At the moment, we trust rule authors not to abuse
     # this feature and write stuff outside the given directory.
-    output_filename = subprocess.check_output(
-        [generator, *generator_args, temp_dir]
-    ).decode()
-    assert output_filename.endswith("\n"), (generator, output_filename)
-    output_filename = os.path.normpath(output_filename[:-1])
-    assert not output_filename.startswith(
-        "/"
-    ) and not output_filename.startswith("../"), output_filename
-    return os.path.join(temp_dir, output_filename)
+    return os.path.join(
+        temp_dir, run_generator(temp_dir, generator, generator_args)
+    )
 
 
 def _image_source_path(
@@ -409,8 +426,14 @@ def _make_image_source_item(
     layer_opts: LayerOpts,
     *,
     source: Optional[Mapping[str, str]],
+    source_cache: Optional[ImageSourceCache] = None,
     **kwargs,
 ):
+    """
+    With `source_cache`, generator outputs are memoized, and `content_hash`
+    checks are deferred to `source_cache.wait_for_verifications()`, so that
+    they can run in parallel, and hit the persistent digest cache.
+    """
     if source is None:
         return item_cls(**kwargs, source=None)
 
@@ -424,29 +447,36 @@ def _make_image_source_item(
     # being constructed.  The file is deleted when the `exit_stack` context
     # exits.
     #
-    # NB: With `generator`, identical constructor arguments to this factory
-    # will create different items, so if we needed item deduplication to
-    # work across inputs, this is broken.  However, I don't believe the
-    # compiler relies on that.  If we need it, it should not be too hard to
-    # share the same source file for all generates with the same command --
-    # you'd add a global map of (generator, args) -> output, perhaps using
-    # weakref hooks to refcount output files and GC them.
+    # NB: Without `source_cache`, identical constructor arguments to this
+    # factory will create different items when using `generator`, so if we
+    # needed item deduplication to work across inputs, this is broken.
+    # However, I don't believe the compiler relies on that.  With
+    # `source_cache`, all generates with the same command share the same
+    # source file.
     # pyre-fixme[16]: `Mapping` has no attribute `pop`.
     generator = source.pop("generator", None)
     generator_args = source.pop("generator_args", None)
     generator_args = list(generator_args) if generator_args is not None else []
     if generator or generator_args:
         # pyre-fixme[16]: `Mapping` has no attribute `__setitem__`.
-        source["source"] = _generate_file(
-            exit_stack.enter_context(tempfile.TemporaryDirectory()),
-            generator,
-            generator_args,
+        source["source"] = (
+            source_cache.generate_file(generator, generator_args)
+            if source_cache
+            else _generate_file(
+                exit_stack.enter_context(tempfile.TemporaryDirectory()),
+                generator,
+                generator_args,
+            )
         )
 
     algo_and_hash = source.pop("content_hash", None)
     # pyre-fixme[6]: Expected `Subvol` for 2nd param but got `str`.
     source_path = _image_source_path(layer_opts, **source)
-    if algo_and_hash:
+    if algo_and_hash and source_cache:
+        source_cache.verify_content_hash(
+            source_path, algo_and_hash, f"{item_cls} {kwargs}"
+        )
+    elif algo_and_hash:
         algorithm, expected_hash = algo_and_hash.split(":")
         # pyre-fixme[6]: Expected `str` for 1st param but got `Path`.
         actual_hash = _hash_path(source_path, algorithm)
@@ -458,7 +488,12 @@ def _make_image_source_item(
     return item_cls(**kwargs, source=source_path)
 
 
-def image_source_item(item_cls, exit_stack, layer_opts: LayerOpts):
+def image_source_item(
+    item_cls,
+    exit_stack,
+    layer_opts: LayerOpts,
+    source_cache: Optional[ImageSourceCache] = None,
+):
     return lambda **kwargs: _make_image_source_item(
-        item_cls, exit_stack, layer_opts, **kwargs
+        item_cls, exit_stack, layer_opts, source_cache=source_cache, **kwargs
     )
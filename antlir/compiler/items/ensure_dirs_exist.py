@@ -4,7 +4,6 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import pwd
 import subprocess
 from typing import Iterator, Optional
 
@@ -14,9 +13,7 @@ from antlir.compiler.requires_provides import (
     RequireUser,
     RequireGroup,
 )
-from antlir.fs_utils import Path, generate_work_dir
-from antlir.nspawn_in_subvol.args import PopenArgs, new_nspawn_opts
-from antlir.nspawn_in_subvol.nspawn import run_nspawn
+from antlir.fs_utils import Path
 from antlir.subvol_utils import Subvol
 from pydantic import root_validator, validator
 
@@ -28,9 +25,11 @@ from .common import (
 from .ensure_subdirs_exist_t import ensure_subdirs_exist_t
 from .stat_options import (
     Mode,
-    build_stat_options,
+    StatOptions,
+    apply_stat_options,
     customize_stat_options,
     mode_to_octal_str,
+    resolve_user_group,
 )
 
 
@@ -38,26 +37,6 @@ class MismatchError(Exception):
     pass
 
 
-_BUILD_SCRIPT = r"""
-path_to_make="$1"
-expected_stat="$2"
-if  [ -d "$path_to_make" ]; then
-    stat_res="$(stat --format="0%a %U:%G" "$path_to_make")"
-    if [ "$stat_res" != "$expected_stat" ]; then
-        echo "ERROR: stat did not match \"$expected_stat\" for $path_to_make: $stat_res"
-        exit 1
-    fi
-    xattrs_res="$(getfattr -m '-' -d --absolute-names "$path_to_make" | (grep -vE '^(# file: |security\.selinux=|$)' || :))"
-    if [ -n "$xattrs_res" ]; then
-        echo "ERROR: xattrs was not empty for $path_to_make: $xattrs_res"
-        exit 1
-    fi
-else
-    mkdir "$path_to_make"
-fi
-"""  # noqa: E501
-
-
 def _validate_into_dir(into_dir: Optional[str]) -> str:
     if into_dir == "":
         raise ValueError('`into_dir` was the empty string; for root, use "/"')
@@ -120,50 +99,33 @@ class EnsureDirsExistItem(ensure_subdirs_exist_t, ImageItem):
         yield RequireUser(user)
         yield RequireGroup(group)
 
+    def build_concurrently(self) -> bool:
+        return True
+
     def build(self, subvol: Subvol, layer_opts: LayerOpts):
         # If path already exists ensure it has expected attrs, else make it.
-        work_dir = generate_work_dir()
-        full_path = work_dir / self.into_dir / self.basename
-        path_to_make = subvol.path() / self.into_dir / self.basename
-        # Cannot postpone exists() check because _BUILD_SCRIPT will create the
-        # directory `path_to_make`
-        path_to_make_exists = path_to_make.exists()
-        opts = new_nspawn_opts(
-            cmd=[
-                "/bin/bash",
-                "-eu",
-                "-o",
-                "pipefail",
-                "-c",
-                _BUILD_SCRIPT,
-                "bash",
-                full_path,
-                # pyre-fixme[6]: Expected `Union[int, str]` for 1st param but
-                #  got `Union[None, int, str]`.
-                f"{mode_to_octal_str(self.mode)} {self.user_group}",
-            ],
-            layer=layer_opts.build_appliance,
-            bindmount_rw=[(subvol.path(), work_dir)],
-            user=pwd.getpwnam("root"),
-        )
+        path_in_image = Path(self.into_dir) / self.basename
+        # pyre-fixme[6]: Expected `Union[int, str]` for 1st param but got
+        #  `Union[None, int, str]`.
+        octal_mode = mode_to_octal_str(self.mode)
         try:
-            run_nspawn(opts, PopenArgs())
+            apply_stat_options(
+                subvol,
+                [
+                    StatOptions(
+                        path=path_in_image,
+                        mode=int(octal_mode, 8),
+                        owner=resolve_user_group(subvol, self.user_group),
+                        ensure_dir=True,
+                    )
+                ],
+            )
         except subprocess.CalledProcessError as e:
             raise MismatchError(
-                f"Failed to ensure_subdirs_exist for path '{full_path}' with"
-                # pyre-fixme[6]: Expected `Union[int, str]` for 1st param but
-                #  got `Union[None, int, str]`.
-                f" stat {mode_to_octal_str(self.mode)}"
-                ": see bash error above for more details",
+                "Failed to ensure_subdirs_exist for path "
+                f"'{path_in_image}' with stat {octal_mode}"
+                ": see error above for more details",
             ) from e
-        if not path_to_make_exists:
-            build_stat_options(
-                self,
-                subvol,
-                # pyre-fixme[6]: Expected `str` for 3rd param but got `Path`.
-                path_to_make,
-                build_appliance=layer_opts.build_appliance,
-            )
 
 
 def ensure_subdirs_exist_factory(
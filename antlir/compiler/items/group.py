@@ -4,6 +4,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 from collections import OrderedDict
 from typing import AnyStr, Dict, Generator, List, NamedTuple
 
@@ -13,7 +14,7 @@ from antlir.compiler.requires_provides import (
     Requirement,
     RequireFile,
 )
-from antlir.fs_utils import Path
+from antlir.fs_utils import Path, open_beneath
 from antlir.subvol_utils import Subvol
 
 from .common import ImageItem, LayerOpts
@@ -104,8 +105,10 @@ class GroupFile:
 
 
 # These provide mocking capabilities for testing
-def _read_group_file(subvol: Subvol) -> str:
-    return subvol.read_path_text(GROUP_FILE_PATH)
+def read_group_file(subvol: Subvol) -> str:
+    "Reads the image's group DB, refusing to follow symlinks out of it."
+    with os.fdopen(open_beneath(subvol.path(), GROUP_FILE_PATH)) as f:
+        return f.read()
 
 
 def _write_group_file(subvol: Subvol, contents: AnyStr):
@@ -124,7 +127,7 @@ class GroupItem(group_t, ImageItem):
 
     # pyre-fixme[9]: layer_opts has type `LayerOpts`; used as `None`.
     def build(self, subvol: Subvol, layer_opts: LayerOpts = None):
-        group_file = GroupFile(_read_group_file(subvol))
+        group_file = GroupFile(read_group_file(subvol))
         gid = self.id or group_file.next_group_id()
         group_file.add(self.name, gid)
         # pyre-fixme[6]: Expected `AnyStr` for 2nd param but got `GroupFile`.
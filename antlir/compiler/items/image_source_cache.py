@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+`image.source` items may carry a `content_hash`, and may be made by a
+`generator`.  Both are expensive to redo on every layer build: hashing
+reads every byte of every source, and generators often build tarballs.
+
+`ImageSourceCache` makes these cheaper in three ways:
+
+  - Content hashes are computed on a thread pool with large reads, so that
+    a layer with hundreds of big sources is limited by disk, not by one
+    core.  `hashlib` releases the GIL for large updates.
+
+  - If `cache_dir` is set, digests are persisted keyed by the file's
+    (device, inode, mtime, size) plus the algorithm, so an unchanged file
+    is never re-read.  Like `git`, we do not persist digests for "racily
+    clean" files whose mtime is too recent to trust.
+
+  - Generator outputs are memoized by (generator, its stat, args).  With
+    `cache_dir`, the outputs persist across builds, otherwise they are
+    shared only within one compiler run.  This requires generators to be
+    deterministic functions of their binary and arguments -- which is
+    already what `image.source` expects, since it pins a `content_hash`.
+
+The on-disk cache is safe for concurrent builds: every entry is written
+to a temporary name, and atomically renamed into place.  Cache hits bump
+an entry's mtime, and entries unused for `max_entry_age_s` are removed,
+at most once per `_PRUNE_INTERVAL_SECONDS`.  Deleting the directory is
+always safe.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple
+
+from antlir.common import get_logger
+from antlir.fs_utils import Path, populate_temp_file_and_rename
+
+
+log = get_logger()
+
+_HASH_CHUNK_BYTES = 2 ** 20
+# Don't persist digests of files modified this recently, since a write in
+# the same mtime tick would not change the cache key.
+_RACY_MTIME_SECONDS = 2
+# Remove on-disk entries that no build used for this long.
+_MAX_ENTRY_AGE_SECONDS = 7 * 24 * 3600
+# Listing the cache is not free, so builds take turns pruning it.
+_PRUNE_INTERVAL_SECONDS = 3600
+_LAST_PRUNED_FILENAME = "last_pruned"
+
+
+def hash_path(path: str, algorithm: str) -> str:
+    "Returns the hex digest"
+    algo = hashlib.new(algorithm)
+    buf = bytearray(_HASH_CHUNK_BYTES)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            num_read = f.readinto(buf)
+            if not num_read:
+                break
+            algo.update(view[:num_read])
+    return algo.hexdigest()
+
+
+def _key_hash(*parts) -> str:
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def run_generator(
+    out_dir: str, generator: bytes, generator_args: List[str]
+) -> str:
+    "Returns the output path relative to `out_dir`"
+    output_filename = subprocess.check_output(
+        [generator, *generator_args, out_dir]
+    ).decode()
+    assert output_filename.endswith("\n"), (generator, output_filename)
+    output_filename = os.path.normpath(output_filename[:-1])
+    assert not output_filename.startswith(
+        "/"
+    ) and not output_filename.startswith("../"), output_filename
+    return output_filename
+
+
+def _remove_entries_older_than(entries_dir: Path, cutoff: float) -> None:
+    for name in os.listdir(entries_dir):
+        path = entries_dir / name
+        try:
+            if os.lstat(path).st_mtime >= cutoff:
+                continue
+            if os.path.isdir(path):
+                # Rename first, so that no reader sees a partial entry.
+                doomed = Path(tempfile.mkdtemp(dir=entries_dir.decode()))
+                os.rename(path, doomed / "entry")
+                shutil.rmtree(doomed)
+            else:
+                os.unlink(path)
+        except FileNotFoundError:  # pragma: no cover
+            pass  # A concurrent build pruned it.
+
+
+class ImageSourceCache:
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        *,
+        max_workers: Optional[int] = None,
+        max_entry_age_s: float = _MAX_ENTRY_AGE_SECONDS,
+    ):
+        self._cache_dir = Path.or_none(cache_dir)
+        self._max_workers = max_workers
+        self._max_entry_age_s = max_entry_age_s
+        self._exit_stack = ExitStack()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Tuple[Future, str, str]] = []
+        self._generated: Dict[Tuple, str] = {}
+        # Items may build concurrently, see `LayerOpts.item_build_workers`.
+        self._stats_lock = threading.Lock()
+        self.num_hash_hits = 0
+        self.num_hash_misses = 0
+        self.num_generator_hits = 0
+        self.num_generator_misses = 0
+
+    def __enter__(self) -> "ImageSourceCache":
+        self._exit_stack.__enter__()
+        self._pool = self._exit_stack.enter_context(
+            ThreadPoolExecutor(max_workers=self._max_workers)
+        )
+        if self._cache_dir:
+            for subdir in ("digests", "generated"):
+                os.makedirs(self._cache_dir / subdir, exist_ok=True)
+            self._maybe_prune()
+        return self
+
+    def _maybe_prune(self) -> None:
+        last_pruned = self._cache_dir / _LAST_PRUNED_FILENAME
+        now = time.time()
+        try:
+            if now - os.stat(last_pruned).st_mtime < _PRUNE_INTERVAL_SECONDS:
+                return
+        except FileNotFoundError:
+            pass
+        last_pruned.touch()
+        for subdir in ("digests", "generated"):
+            _remove_entries_older_than(
+                self._cache_dir / subdir, now - self._max_entry_age_s
+            )
+
+    def _count(self, stat: str) -> None:
+        with self._stats_lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        # Don't let a forgotten `wait_for_verifications` skip hash checks.
+        if exc_type is None and self._pending:
+            try:
+                self.wait_for_verifications()
+            except BaseException:
+                self._pool = None
+                self._exit_stack.__exit__(*sys.exc_info())
+                raise
+        self._pool = None
+        log.info(
+            f"Image source cache: {self.num_hash_hits} content hash hits, "
+            f"{self.num_hash_misses} misses; {self.num_generator_hits} "
+            f"generator hits, {self.num_generator_misses} misses"
+        )
+        return self._exit_stack.__exit__(exc_type, exc_val, exc_tb)
+
+    def hash_path(self, path: str, algorithm: str) -> str:
+        "Returns the hex digest, reading the file only on a cache miss."
+        st = os.stat(path)
+        digest_path = None
+        if self._cache_dir:
+            digest_path = (
+                self._cache_dir
+                / "digests"
+                / _key_hash(
+                    os.path.realpath(path),
+                    st.st_dev,
+                    st.st_ino,
+                    st.st_mtime_ns,
+                    st.st_size,
+                    algorithm,
+                )
+            )
+            try:
+                digest = digest_path.read_text()
+                # Mark the entry as used, see the module docblock.
+                os.utime(digest_path)
+                self._count("num_hash_hits")
+                return digest
+            except FileNotFoundError:
+                pass
+        self._count("num_hash_misses")
+        digest = hash_path(path, algorithm)
+        if (
+            digest_path
+            and time.time() - st.st_mtime_ns / 1e9 > _RACY_MTIME_SECONDS
+        ):
+            with populate_temp_file_and_rename(
+                digest_path, overwrite=True
+            ) as f:
+                f.write(digest)
+        return digest
+
+    def verify_content_hash(
+        self, path: str, algo_and_hash: str, error_msg: str
+    ) -> None:
+        """
+        Queues a hash check on the thread pool.  `wait_for_verifications`
+        raises an `AssertionError` for the first mismatch.
+        """
+        assert self._pool, "Use `ImageSourceCache` as a context manager"
+        algorithm, expected_hash = algo_and_hash.split(":")
+        self._pending.append(
+            (
+                self._pool.submit(self.hash_path, path, algorithm),
+                expected_hash,
+                error_msg,
+            )
+        )
+
+    def wait_for_verifications(self) -> None:
+        pending, self._pending = self._pending, []
+        for future, expected_hash, error_msg in pending:
+            actual_hash = future.result()
+            if actual_hash != expected_hash:
+                raise AssertionError(
+                    f"{error_msg} failed hash validation, got {actual_hash}"
+                )
+
+    def generate_file(
+        self, generator: bytes, generator_args: List[str]
+    ) -> str:
+        """
+        Returns the path of the generator's output for these arguments,
+        running the generator only if it is not already cached.  Callers
+        must treat the output as read-only.
+        """
+        generator_path = shutil.which(generator) or generator
+        gen_st = os.stat(generator_path)
+        key = (
+            os.path.realpath(generator_path),
+            gen_st.st_ino,
+            gen_st.st_mtime_ns,
+            gen_st.st_size,
+            tuple(generator_args),
+        )
+        output = self._generated.get(key)
+        if output is not None:
+            self._count("num_generator_hits")
+            return output
+        if self._cache_dir:
+            output = self._generate_file_cached(key, generator, generator_args)
+        else:
+            self._count("num_generator_misses")
+            out_dir = self._exit_stack.enter_context(
+                tempfile.TemporaryDirectory()
+            )
+            output = os.path.join(
+                out_dir, run_generator(out_dir, generator, generator_args)
+            )
+        self._generated[key] = output
+        return output
+
+    def _generate_file_cached(
+        self, key: Tuple, generator: bytes, generator_args: List[str]
+    ) -> str:
+        entry_dir = self._cache_dir / "generated" / _key_hash(*key)
+        name_path = entry_dir / "output_filename"
+        try:
+            # Mark the entry as used first, so it is not pruned under us.
+            os.utime(entry_dir)
+            output_filename = name_path.read_text()
+            self._count("num_generator_hits")
+        except FileNotFoundError:
+            self._count("num_generator_misses")
+            tmp_dir = Path(
+                tempfile.mkdtemp(dir=(self._cache_dir / "generated").decode())
+            )
+            try:
+                os.mkdir(tmp_dir / "output")
+                output_filename = run_generator(
+                    (tmp_dir / "output").decode(), generator, generator_args
+                )
+                with open(tmp_dir / "output_filename", "w") as f:
+                    f.write(output_filename)
+                try:
+                    os.rename(tmp_dir, entry_dir)
+                except OSError:
+                    # A concurrent build won the race, use its output.
+                    output_filename = name_path.read_text()
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return (entry_dir / "output" / output_filename).decode()
@@ -4,7 +4,6 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import itertools
 import os
 import stat
 from typing import Iterable, NamedTuple, Optional, Union
@@ -24,9 +23,11 @@ from .common import ImageItem, LayerOpts, make_path_normal_relative
 from .install_files_t import install_files_t
 from .stat_options import (
     Mode,
-    build_stat_options,
+    StatOptions,
+    apply_stat_options,
     customize_stat_options,
-    mode_to_str,
+    mode_bits,
+    resolve_user_group,
 )
 
 
@@ -165,6 +166,9 @@ class InstallFileItem(install_files_t, ImageItem):
         yield RequireUser(user)
         yield RequireGroup(group)
 
+    def build_concurrently(self) -> bool:
+        return True
+
     def build(self, subvol: Subvol, layer_opts: LayerOpts):
         dest = subvol.path(self.dest)
         # The compiler should have detected any collisons, so `--no-clobber`
@@ -189,31 +193,28 @@ class InstallFileItem(install_files_t, ImageItem):
                 dest,
             ]
         )
-        build_stat_options(
-            self,
+        # One privileged call per item, however many files it installs.
+        # The modes are per-path, while the owner applies to the whole
+        # tree.  No symlinks are followed, though `customize_fields` should
+        # have failed on them.
+        apply_stat_options(
             subvol,
-            # pyre-fixme[6]: Expected `str` for 3rd param but got `Path`.
-            dest,
-            do_not_set_mode=True,
-            build_appliance=layer_opts.build_appliance,
+            [
+                StatOptions(
+                    path=self.dest,
+                    owner=resolve_user_group(subvol, self.user_group),
+                    recursive=True,
+                ),
+                *(
+                    StatOptions(
+                        path=i.provides.path(),
+                        mode=mode_bits(
+                            i.mode,
+                            is_dir=isinstance(i.provides, ProvidesDirectory),
+                        ),
+                    )
+                    # pyre-fixme[16]: `Optional` has no attribute `__iter__`.
+                    for i in self._paths
+                ),
+            ],
         )
-        # Group by mode to make as few shell calls as possible.
-        for mode_str, modes_and_paths in itertools.groupby(
-            sorted(
-                (mode_to_str(i.mode), i.provides.path())
-                # pyre-fixme[16]: `Optional` has no attribute `__iter__`.
-                for i in self._paths
-            ),
-            lambda x: x[0],
-        ):
-            # Batching chmod calls has the unfortunate side effect of failing
-            # on installing large amounts of files with one `image.install`.
-            # xargs will break up the command for us if we overrun the maximum
-            # args size limit.
-            # `chmod` follows symlinks, and there's no option to stop it.
-            # However, `customize_fields` should have failed on symlinks.
-            paths = b"\0".join(subvol.path(p) for _, p in modes_and_paths)
-            subvol.run_as_root(
-                ["xargs", "-0", "chmod", mode_str],
-                input=paths,
-            )
@@ -11,10 +11,13 @@ subvolume after all the phases have finished executing, in order to
 `provide()` whatever was created during the phases to the dependency sorter.
 """
 import itertools
+import os
 import subprocess
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Generator
+from typing import Generator, List, Optional, Set, Tuple
+
+from antlir.common import get_logger
 
 from antlir.compiler.requires_provides import (
     ProvidesDirectory,
@@ -30,28 +33,27 @@ from antlir.subvol_utils import Subvol
 
 from .common import ImageItem, is_path_protected, protected_path_set
 from .group import GROUP_FILE_PATH, GroupFile
+from .provides_index import ProvidesIndex, StaleProvidesIndexError
 from .user import PASSWD_FILE_PATH, PasswdFile
 
 
-def gen_subvolume_subtree_provides(
-    subvol: Subvol, subtree: Path
-) -> Generator[ProvidesPath, None, None]:
-    'Yields "Provides" instances for a path `subtree` in `subvol`.'
-    # "Provides" classes use image-absolute paths that are `str` (for now).
-    # Accept any string type to ease future migrations.
-    # pyre-fixme[9]: subtree has type `Path`; used as `bytes`.
-    subtree = b"/" + subtree
+log = get_logger()
 
-    protected_paths = protected_path_set(subvol)
-    for prot_path in protected_paths:
-        rel_to_subtree = (b"/" / prot_path).relpath(subtree)
-        if not rel_to_subtree.has_leading_dot_dot():
-            yield ProvidesDoNotAccess(path=rel_to_subtree)
+# Indexes are keyed by subvolume UUID, so each rebuilt layer leaves its old
+# index behind.  `save_subvolume_provides_index` keeps only this many of the
+# most recently saved or loaded indexes.
+_MAX_PROVIDES_INDEXES = 256
 
-    subtree_full_path = subvol.path(subtree)
-    subtree_exists = False
 
-    filetype_to_relpaths = defaultdict(list)
+def _find_subtree(
+    subvol: Subvol, subtree_full_path: Path, protected_paths: Set[Path]
+) -> List[Tuple[str, Path]]:
+    """
+    Returns `(filetype, relpath)` for every unprotected path in the subtree,
+    with each directory before its contents, in `find -printf %y` notation.
+    """
+    subtree_exists = False
+    types_and_relpaths = []
     # Traverse the subvolume as root, so that we have permission to access
     # everything.
     for type_and_path in subvol.run_as_root(
@@ -103,7 +105,47 @@ def gen_subvolume_subtree_provides(
         if relpath == b".":
             subtree_exists = True
 
-        filetype = filetype_bytes.decode()
+        types_and_relpaths.append((filetype_bytes.decode(), relpath))
+
+    # We should've gotten a CalledProcessError from `find`.
+    assert subtree_exists, f"{subtree_full_path} does not exist"
+    return types_and_relpaths
+
+
+def _readlinks_as_root(subvol: Subvol, abspaths: List[Path]) -> List[bytes]:
+    if not abspaths:
+        return []
+    # xargs --null means each input line needs to be delimited by \0
+    # readlink --zero means each output line ends with \0 instead of \n
+    readlink_vals = subvol.run_as_root(
+        ["xargs", "--null", "readlink", "--zero"],
+        stdout=subprocess.PIPE,
+        input=b"\0".join(abspaths),
+    ).stdout.split(b"\0")[:-1]
+    assert len(abspaths) == len(readlink_vals), (abspaths, readlink_vals)
+    return readlink_vals
+
+
+def gen_subvolume_subtree_provides(
+    subvol: Subvol, subtree: Path
+) -> Generator[ProvidesPath, None, None]:
+    'Yields "Provides" instances for a path `subtree` in `subvol`.'
+    # "Provides" classes use image-absolute paths that are `str` (for now).
+    # Accept any string type to ease future migrations.
+    # pyre-fixme[9]: subtree has type `Path`; used as `bytes`.
+    subtree = b"/" + subtree
+
+    protected_paths = protected_path_set(subvol)
+    for prot_path in protected_paths:
+        rel_to_subtree = (b"/" / prot_path).relpath(subtree)
+        if not rel_to_subtree.has_leading_dot_dot():
+            yield ProvidesDoNotAccess(path=rel_to_subtree)
+
+    subtree_full_path = subvol.path(subtree)
+    filetype_to_relpaths = defaultdict(list)
+    for filetype, relpath in _find_subtree(
+        subvol, subtree_full_path, protected_paths
+    ):
         filetype_to_relpaths[filetype].append(relpath)
 
     for filetype, relpaths in filetype_to_relpaths.items():
@@ -112,41 +154,133 @@ def gen_subvolume_subtree_provides(
         elif filetype == "d":
             yield from [ProvidesDirectory(path=r) for r in relpaths]
         elif filetype == "l":
-            symlink_paths = [str(subtree_full_path / r) for r in relpaths]
-
-            # xargs --null means each input line needs to be delimited by \0
-            # readlink --zero means each output line ends with \0 instead of \n
-            readlink_vals = subvol.run_as_root(
-                ["xargs", "--null", "readlink", "--zero"],
-                stdout=subprocess.PIPE,
-                input="\0".join(symlink_paths),
-                text=True,
-            ).stdout.split("\0")[:-1]
-
-            assert len(relpaths) == len(readlink_vals), (
-                relpaths,
-                readlink_vals,
+            readlink_vals = _readlinks_as_root(
+                subvol, [subtree_full_path / r for r in relpaths]
             )
             yield from [
                 ProvidesSymlink(path=relpath, target=Path(readlink_val))
                 for relpath, readlink_val in zip(relpaths, readlink_vals)
             ]
         else:  # pragma: no cover
-            # pyre-fixme[61]: `abspath` may not be initialized here.
-            raise AssertionError(f"Unknown {filetype} for {abspath}")
+            raise AssertionError(f"Unknown {filetype} for {relpaths}")
 
-    # We should've gotten a CalledProcessError from `find`.
-    assert subtree_exists, f"{subtree} does not exist in {subvol.path()}"
+
+def _provides_index_path(index_dir: Path, subvol: Subvol) -> Path:
+    return index_dir / subvol.uuid()
+
+
+def _prune_provides_indexes(index_dir: Path, max_indexes: int) -> None:
+    "Removes the least recently used indexes, see `_MAX_PROVIDES_INDEXES`."
+    mtimes_and_paths = []
+    for name in os.listdir(index_dir):
+        # Skip in-progress saves from `populate_temp_file_and_rename`.
+        if name.startswith(b"tmp"):
+            continue
+        path = index_dir / name
+        try:
+            mtimes_and_paths.append((os.stat(path).st_mtime_ns, path))
+        except FileNotFoundError:  # pragma: no cover
+            pass  # A concurrent build pruned it.
+    mtimes_and_paths.sort(reverse=True)
+    for _, path in mtimes_and_paths[max_indexes:]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:  # pragma: no cover
+            pass
+
+
+def get_subvolume_provides_index(
+    subvol: Subvol,
+    *,
+    parent: Optional[Subvol],
+    index_dir: Optional[Path],
+    keep_writable: bool = False,
+) -> ProvidesIndex:
+    """
+    If `index_dir` has an index for `parent`, of which `subvol` is a
+    snapshot, applies the `btrfs send --no-data -p` diff to it.  Otherwise,
+    walks the whole of `subvol` with `find`.
+
+    Sending marks `subvol` read-only.  With `keep_writable`, we mark it
+    writable again afterwards.
+    """
+    protected_paths = protected_path_set(subvol)
+
+    def readlinks(relpaths):
+        return _readlinks_as_root(subvol, [subvol.path(r) for r in relpaths])
+
+    if parent is not None and index_dir is not None:
+        try:
+            index_path = _provides_index_path(index_dir, parent)
+            index = ProvidesIndex.load(index_path)
+            # Mark the index as recently used, see `_MAX_PROVIDES_INDEXES`.
+            os.utime(index_path)
+            try:
+                with subvol.mark_readonly_and_gen_send_stream_items(
+                    no_data=True, parent=parent
+                ) as items:
+                    index.apply_send_stream_items(items, protected_paths)
+            finally:
+                if keep_writable:
+                    subvol.set_readonly(False)
+            index.remove_protected_paths(protected_paths)
+            index.resolve_symlinks(readlinks)
+            return index
+        except FileNotFoundError:
+            log.info(f"No provides index for {parent.path()}, using `find`")
+        except StaleProvidesIndexError as ex:  # pragma: no cover
+            log.warning(f"Bad provides index for {parent.path()}: {ex}")
+
+    index = ProvidesIndex()
+    for filetype, relpath in _find_subtree(
+        subvol, subvol.path(), protected_paths
+    ):
+        index.add(relpath, filetype)
+    index.resolve_symlinks(readlinks)
+    return index
+
+
+def save_subvolume_provides_index(
+    subvol: Subvol, *, parent: Optional[Subvol], index_dir: Path
+) -> None:
+    "Persists the index of a finished, read-only layer for its children."
+    index = get_subvolume_provides_index(
+        subvol, parent=parent, index_dir=index_dir
+    )
+    os.makedirs(index_dir, exist_ok=True)
+    index.save(_provides_index_path(index_dir, subvol))
+    # A child build that loses its parent's index just falls back to `find`.
+    _prune_provides_indexes(index_dir, _MAX_PROVIDES_INDEXES)
 
 
 @dataclass(init=False, frozen=True)
 # pyre-fixme[13]: Attribute `subvol` is never initialized.
 class PhasesProvideItem(ImageItem):
     subvol: Subvol
+    # With both of these set, `provides` derives the paths from the parent
+    # layer's saved index, instead of walking the whole subvolume.
+    parent: Optional[Subvol]
+    provides_index_dir: Optional[Path]
+
+    @classmethod
+    def customize_fields(cls, kwargs):
+        super().customize_fields(kwargs)
+        kwargs.setdefault("parent", None)
+        kwargs.setdefault("provides_index_dir", None)
 
     def provides(self):
-        for path in gen_subvolume_subtree_provides(self.subvol, Path("/")):
-            yield path
+        if self.parent is None or self.provides_index_dir is None:
+            yield from gen_subvolume_subtree_provides(self.subvol, Path("/"))
+        else:
+            for prot_path in protected_path_set(self.subvol):
+                yield ProvidesDoNotAccess(path=(b"/" / prot_path).relpath(b"/"))
+            yield from get_subvolume_provides_index(
+                self.subvol,
+                parent=self.parent,
+                index_dir=self.provides_index_dir,
+                # The items are yet to be built.
+                keep_writable=True,
+            ).gen_provides()
 
         # Note: Here we evaluate if the passwd/group file is available
         # in the subvol to emit users and groups.  If the db files are not
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+A `ProvidesIndex` records the type (in `find -printf %y` notation), and the
+symlink target, of every path of a layer that is not protected.  That is
+all that `PhasesProvideItem` needs to compute `provides()`.
+
+Walking a large layer with `find` is slow, so after a layer is built, we
+persist its index, keyed by the UUID of its btrfs subvolume.  A child layer
+then starts from its parent's index, and applies to it the items of a
+`btrfs send --no-data -p PARENT CHILD` stream, which only mentions the
+paths that changed.
+
+The index is a tree, so that renaming a directory -- which `btrfs send`
+does for every new directory -- moves its subtree in O(1).
+
+The on-disk format is `\\0`-separated, starting with `_MAGIC`, followed by
+one `type`, `relpath`, `symlink target` triple per path, with each
+directory before its contents.  The target is empty for non-symlinks.
+"""
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from antlir.btrfs_diff.send_stream import SendStreamItem, SendStreamItems
+from antlir.compiler.requires_provides import (
+    ProvidesDirectory,
+    ProvidesFile,
+    ProvidesPath,
+    ProvidesSymlink,
+)
+from antlir.fs_utils import Path, populate_temp_file_and_rename
+
+from .common import is_path_protected
+
+_MAGIC = b"antlir_provides_index_v1"
+
+# `find -printf %y` types that we `provide` as files.
+_FILE_TYPES = ("b", "c", "p", "f", "s")
+
+_SEND_STREAM_ITEM_TO_TYPE = {
+    SendStreamItems.mkfile: "f",
+    SendStreamItems.mkdir: "d",
+    SendStreamItems.mkfifo: "p",
+    SendStreamItems.mksock: "s",
+    # `find` distinguishes block & char devices, but both become files.
+    SendStreamItems.mknod: "c",
+    SendStreamItems.symlink: "l",
+}
+
+
+class StaleProvidesIndexError(Exception):
+    "The index does not match the subvolume that a send-stream came from."
+
+
+class _Node:
+    __slots__ = ("filetype", "target", "children")
+
+    def __init__(self, filetype: str, target: Optional[bytes] = None):
+        self.filetype = filetype
+        # `None` for a symlink means that it is not yet resolved, see
+        # `resolve_symlinks`.
+        self.target = target
+        self.children: Optional[Dict[bytes, "_Node"]] = (
+            {} if filetype == "d" else None
+        )
+
+
+def _split(relpath: bytes) -> Tuple[bytes, bytes]:
+    "Returns the parent path (b'' for top-level paths), and the basename"
+    parent, _, name = relpath.rpartition(b"/")
+    return parent, name
+
+
+class ProvidesIndex:
+    def __init__(self):
+        self._root = _Node("d")
+
+    def _dir_children(self, relpath: bytes) -> Dict[bytes, _Node]:
+        node = self._root
+        if relpath:
+            for name in relpath.split(b"/"):
+                node = (node.children or {}).get(name)
+                if node is None:
+                    raise StaleProvidesIndexError(f"No directory {relpath}")
+        if node.children is None:
+            raise StaleProvidesIndexError(f"{relpath} is not a directory")
+        return node.children
+
+    def add(
+        self, relpath: bytes, filetype: str, target: Optional[bytes] = None
+    ) -> None:
+        if relpath == b".":
+            assert filetype == "d", filetype
+            return
+        parent, name = _split(relpath)
+        children = self._dir_children(parent)
+        if name in children:
+            raise StaleProvidesIndexError(f"{relpath} already exists")
+        children[name] = _Node(filetype, target)
+
+    def _pop(self, relpath: bytes) -> _Node:
+        parent, name = _split(relpath)
+        node = self._dir_children(parent).pop(name, None)
+        if node is None:
+            raise StaleProvidesIndexError(f"{relpath} does not exist")
+        return node
+
+    def _put(self, relpath: bytes, node: _Node) -> None:
+        parent, name = _split(relpath)
+        children = self._dir_children(parent)
+        # As with `rename (2)`, only an empty directory may be replaced by
+        # a directory, and a directory may not be replaced by a file.
+        old_node = children.get(name)
+        if old_node is not None and (
+            (old_node.children is None) != (node.children is None)
+            or old_node.children
+        ):
+            raise StaleProvidesIndexError(f"Cannot replace {relpath}")
+        children[name] = node
+
+    def apply_send_stream_items(
+        self, items: Iterable[SendStreamItem], protected_paths: Iterable[Path]
+    ) -> None:
+        """
+        Updates the index of the `-p` parent of a `btrfs send --no-data` to
+        be the index of the sent subvolume.  Raises `StaleProvidesIndexError`
+        if the stream does not apply cleanly.
+
+        Paths under `protected_paths` are not indexed, so we skip items
+        that only touch those.  New symlinks are left unresolved.
+        """
+        protected_paths = set(protected_paths)
+
+        def is_protected(path: bytes) -> bool:
+            return is_path_protected(Path(path), protected_paths)
+
+        for item in items:
+            filetype = _SEND_STREAM_ITEM_TO_TYPE.get(type(item))
+            if filetype is not None:
+                if not is_protected(item.path):
+                    self.add(item.path, filetype)
+            elif isinstance(
+                item, (SendStreamItems.unlink, SendStreamItems.rmdir)
+            ):
+                if not is_protected(item.path):
+                    self._pop(item.path)
+            elif isinstance(item, SendStreamItems.rename):
+                if is_protected(item.path):
+                    # We did not index the subtree that is being moved.
+                    if not is_protected(item.dest):
+                        raise StaleProvidesIndexError(
+                            f"{item} moves a protected path"
+                        )
+                    continue
+                node = self._pop(item.path)
+                if not is_protected(item.dest):
+                    self._put(item.dest, node)
+            elif isinstance(item, SendStreamItems.link):
+                # `link` makes a new hardlink at `path` to the file `dest`.
+                if not is_protected(item.path):
+                    if is_protected(item.dest):
+                        raise StaleProvidesIndexError(
+                            f"{item} links to a protected path"
+                        )
+                    parent, name = _split(item.dest)
+                    node = self._dir_children(parent).get(name)
+                    if node is None:
+                        raise StaleProvidesIndexError(f"No source for {item}")
+                    self.add(item.path, node.filetype, node.target)
+            # Other items do not change the type or the path of any inode.
+
+    def remove_protected_paths(self, protected_paths: Iterable[Path]) -> None:
+        "Like `find -prune`, drops protected paths and their subtrees."
+        for prot_path in protected_paths:
+            relpath = prot_path.normpath()
+            parent, name = _split(relpath)
+            try:
+                self._dir_children(parent).pop(name, None)
+            except StaleProvidesIndexError:
+                pass
+
+    def resolve_symlinks(
+        self, readlinks: Callable[[List[Path]], List[bytes]]
+    ) -> None:
+        "`readlinks` maps relpaths of symlinks to their targets"
+        unresolved = [
+            (relpath, node)
+            for relpath, node in self._gen_nodes()
+            if node.filetype == "l" and node.target is None
+        ]
+        if not unresolved:
+            return
+        targets = readlinks([relpath for relpath, _ in unresolved])
+        assert len(targets) == len(unresolved), (unresolved, targets)
+        for (_, node), target in zip(unresolved, targets):
+            node.target = target
+
+    def _gen_nodes(self) -> Iterator[Tuple[Path, _Node]]:
+        "Every directory is yielded before its contents."
+        yield Path(b"."), self._root
+        stack: List[Tuple[bytes, _Node]] = [(b"", self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            for name, child in node.children.items():
+                relpath = prefix + name
+                yield Path(relpath), child
+                if child.children:
+                    stack.append((relpath + b"/", child))
+
+    def gen_entries(self) -> Iterator[Tuple[Path, str, Optional[Path]]]:
+        "Yields `(relpath, filetype, symlink target or None)`"
+        for relpath, node in self._gen_nodes():
+            assert node.filetype != "l" or node.target is not None, relpath
+            yield relpath, node.filetype, Path.or_none(node.target)
+
+    def gen_provides(self) -> Iterator[ProvidesPath]:
+        for relpath, filetype, target in self.gen_entries():
+            if filetype in _FILE_TYPES:
+                yield ProvidesFile(path=relpath)
+            elif filetype == "d":
+                yield ProvidesDirectory(path=relpath)
+            elif filetype == "l":
+                yield ProvidesSymlink(path=relpath, target=target)
+            else:  # pragma: no cover
+                raise AssertionError(f"Unknown {filetype} for {relpath}")
+
+    def save(self, path: Path) -> None:
+        with populate_temp_file_and_rename(
+            path, overwrite=True, mode="wb"
+        ) as f:
+            f.write(_MAGIC)
+            for relpath, filetype, target in self.gen_entries():
+                f.write(
+                    b"\0%s\0%s\0%s"
+                    % (filetype.encode(), relpath, target or b"")
+                )
+
+    @classmethod
+    def load(cls, path: Path) -> "ProvidesIndex":
+        with open(path, "rb") as f:
+            fields = f.read().split(b"\0")
+        if fields[0] != _MAGIC or len(fields) % 3 != 1:
+            raise StaleProvidesIndexError(f"{path} is not a provides index")
+        index = cls()
+        for i in range(1, len(fields), 3):
+            filetype, relpath, target = fields[i : i + 3]
+            index.add(relpath, filetype.decode(), target or None)
+        return index
@@ -32,9 +32,11 @@ from antlir.fs_utils import (
 from antlir.nspawn_in_subvol.args import (
     NspawnPluginArgs,
     PopenArgs,
+    _NspawnOpts,
     new_nspawn_opts,
 )
 from antlir.nspawn_in_subvol.nspawn import run_nspawn
+from antlir.nspawn_in_subvol.plugins import NspawnPlugin
 from antlir.nspawn_in_subvol.plugins.rpm import rpm_nspawn_plugins
 from antlir.rpm.rpm_metadata import RpmMetadata, compare_rpm_versions
 from antlir.subvol_utils import Subvol
@@ -76,8 +78,10 @@ class YumDnfCommand(enum.Enum):
 
 
 # When several of the commands land in the same phase, we need to order them
-# deterministically.  This is meant to be temporary, until this code can be
-# re-tooled to use `yum/dnf shell` to run all operations in one transaction.
+# deterministically.  By default, each command is a separate `yum` / `dnf`
+# invocation.  With `LayerOpts.rpm_single_transaction`, the commands are
+# instead lines of one `yum/dnf shell` script, in this same order, and they
+# all resolve and run as one transaction.
 YUM_DNF_COMMAND_ORDER = {
     cmd: i
     for i, cmd in enumerate(
@@ -222,11 +226,11 @@ def _convert_actions_to_commands(
 
 
 def _rpms_and_bind_ros(
-    names_or_rpms: List[Union[str, _LocalRpm]]
+    names_or_rpms: List[Union[str, _LocalRpm]], *, first_idx: int = 0
 ) -> Tuple[List[str], List[str]]:
     rpms = []
     bind_ros = []
-    for idx, nor in enumerate(names_or_rpms):
+    for idx, nor in enumerate(names_or_rpms, start=first_idx):
         if isinstance(nor, _LocalRpm):
             # For custom bind mount destinations, nspawn is strict on
             # destinations where the parent directories don't exist.
@@ -240,6 +244,76 @@ def _rpms_and_bind_ros(
     return rpms, bind_ros
 
 
+# Where `_yum_dnf_shell_script` is bind-mounted in the build appliance.
+_SHELL_SCRIPT_DEST = "/antlir_yum_dnf_shell_script"
+# Where `LayerOpts.yum_dnf_shared_cache_dir` is bind-mounted in the build
+# appliance, see `_shared_yum_dnf_cache`.
+_SHARED_CACHE_DIR = Path("/antlir_yum_dnf_shared_cache")
+
+
+def _yum_dnf_shell_script(
+    cmds_and_rpms: List[Tuple[YumDnfCommand, List[str]]]
+) -> str:
+    """
+    A `yum/dnf shell` script that queues up all the commands, and then
+    resolves dependencies and runs them as a single transaction.  The
+    arguments are sorted for determinism, as in the one-command-per-run
+    mode.
+    """
+    lines = [
+        " ".join([cmd.value, *(shlex.quote(r) for r in sorted(rpms))])
+        for cmd, rpms in cmds_and_rpms
+    ]
+    lines.append("run")
+    return "".join(l + "\n" for l in lines)
+
+
+def _yum_dnf_shell_expected_rpms(
+    cmds_and_nors: List[Tuple[YumDnfCommand, List[Union[str, _LocalRpm]]]],
+) -> Tuple[List[str], List[str]]:
+    """
+    `yum shell` & `dnf shell` log, but do not fail on, a command they
+    cannot do, e.g. `install-n` of a missing package.  So, after the
+    transaction, we check the RPM DB against what the commands asked for.
+
+    Returns the `rpm --query` arguments that must match an installed
+    package, and those that must not.
+    """
+    installed = []
+    removed = []
+    for cmd, nors in cmds_and_nors:
+        for nor in nors:
+            if cmd == YumDnfCommand.remove_name_if_exists:
+                removed.append(nor)
+            elif isinstance(nor, _LocalRpm):
+                md = nor.metadata
+                installed.append(f"{md.name}-{md.version}-{md.release}")
+            else:
+                installed.append(nor)
+    return sorted(installed), sorted(removed)
+
+
+def _check_rpmdb_script(
+    install_root: Path, installed: List[str], removed: List[str]
+) -> str:
+    "See `_yum_dnf_shell_expected_rpms`."
+    return f"""\
+        bad=""
+        for q in {' '.join(shlex.quote(q) for q in installed)}; do
+            rpm --root={install_root.shell_quote()} --query --quiet "$q" ||
+                bad="$bad $q"
+        done
+        for q in {' '.join(shlex.quote(q) for q in removed)}; do
+            ! rpm --root={install_root.shell_quote()} --query --quiet "$q" ||
+                bad="$bad -$q"
+        done
+        if [ -n "$bad" ]; then
+            echo "ERROR: RPMs not installed (or -removed):$bad" >&2
+            exit 1
+        fi
+        """
+
+
 @contextmanager
 def _prepare_versionlock(
     version_sets: Iterable[Path], version_set_override: Optional[str]
@@ -350,12 +424,39 @@ class RpmActionItem(rpm_action_item_t, ImageItem):
                 # is done in the builder because we need access to the subvol.
                 #
                 # Sort by command for determinism and clearer behaivor.
-                for cmd, nors in sorted(
+                cmds_and_nors = sorted(
                     _convert_actions_to_commands(
                         subvol, build_appliance, action_to_names_or_rpms
                     ).items(),
                     key=lambda cn: YUM_DNF_COMMAND_ORDER[cn[0]],
+                )
+                if (
+                    layer_opts.rpm_single_transaction
+                    and len(cmds_and_nors) > 1
+                ):
+                    _yum_dnf_shell_using_build_appliance(
+                        build_appliance=build_appliance,
+                        cmds_and_nors=cmds_and_nors,
+                        install_root=subvol.path(),
+                        protected_paths=protected_path_set(subvol),
+                        versionlock_list=versionlock_path,
+                        layer_opts=layer_opts,
+                    )
+                    return
+                if (
+                    layer_opts.build_appliance_sessions is not None
+                    and len(cmds_and_nors) > 1
                 ):
+                    _yum_dnf_session_using_build_appliance(
+                        build_appliance=build_appliance,
+                        cmds_and_nors=cmds_and_nors,
+                        install_root=subvol.path(),
+                        protected_paths=protected_path_set(subvol),
+                        versionlock_list=versionlock_path,
+                        layer_opts=layer_opts,
+                    )
+                    return
+                for cmd, nors in cmds_and_nors:
                     # pyre-fixme[6]: Expected `List[Union[_LocalRpm, str]]` for
                     #  1st param but got `Union[_LocalRpm, str]`.
                     rpms, bind_ros = _rpms_and_bind_ros(nors)
@@ -380,59 +481,202 @@ class RpmActionItem(rpm_action_item_t, ImageItem):
         return builder
 
 
-def _yum_dnf_using_build_appliance(
+def _cmds_rpms_and_bind_ros(
+    cmds_and_nors: List[Tuple[YumDnfCommand, List[Union[str, _LocalRpm]]]],
+) -> Tuple[List[Tuple[YumDnfCommand, List[str]]], List[Tuple[str, str]]]:
+    "Like `_rpms_and_bind_ros`, for several commands in one container."
+    cmds_and_rpms = []
+    all_bind_ros = []
+    first_idx = 0
+    for cmd, nors in cmds_and_nors:
+        # Number local RPMs across all commands to keep mounts unique.
+        rpms, bind_ros = _rpms_and_bind_ros(nors, first_idx=first_idx)
+        first_idx += len(nors)
+        cmds_and_rpms.append((cmd, rpms))
+        all_bind_ros.extend(bind_ros)
+    return cmds_and_rpms, all_bind_ros
+
+
+def _yum_dnf_session_using_build_appliance(
     *,
     build_appliance: Subvol,
-    bind_ros: List[Tuple[str, str]],
+    cmds_and_nors: List[Tuple[YumDnfCommand, List[Union[str, _LocalRpm]]]],
     install_root: Path,
     protected_paths: Iterable[Path],
     versionlock_list: Path,
-    yum_dnf_args: List[str],
     layer_opts: LayerOpts,
 ) -> None:
+    """
+    Runs a phase's commands one at a time, as without
+    `rpm_single_transaction`, but in one container from
+    `layer_opts.build_appliance_sessions`.  The repo servers also stay up
+    across the commands.
+    """
+    cmds_and_rpms, all_bind_ros = _cmds_rpms_and_bind_ros(cmds_and_nors)
     work_dir = generate_work_dir()
+    opts, plugins = _yum_dnf_nspawn_opts_and_plugins(
+        build_appliance=build_appliance,
+        cmd=[],
+        bind_ros=all_bind_ros,
+        install_root=install_root,
+        work_dir=work_dir,
+        versionlock_list=versionlock_list,
+        layer_opts=layer_opts,
+    )
+    with layer_opts.build_appliance_sessions.session(
+        opts, plugins=plugins
+    ) as session:
+        for cmd, rpms in cmds_and_rpms:
+            session.run(
+                _yum_dnf_cmd(
+                    work_dir=work_dir,
+                    protected_paths=protected_paths,
+                    yum_dnf_args=[
+                        cmd.value,
+                        "--assumeyes",
+                        # Sort ensures determinism even if `yum` or
+                        # `dnf` is order-dependent
+                        *sorted(rpms),
+                    ],
+                    layer_opts=layer_opts,
+                )
+            )
+
+
+def _yum_dnf_shell_using_build_appliance(
+    *,
+    build_appliance: Subvol,
+    cmds_and_nors: List[Tuple[YumDnfCommand, List[Union[str, _LocalRpm]]]],
+    install_root: Path,
+    protected_paths: Iterable[Path],
+    versionlock_list: Path,
+    layer_opts: LayerOpts,
+) -> None:
+    """
+    Runs all of a phase's commands in one build appliance container, with
+    one repodata load and one dependency resolution.  Fails unless the
+    resulting RPM DB has what the commands asked for.
+    """
+    cmds_and_rpms, all_bind_ros = _cmds_rpms_and_bind_ros(cmds_and_nors)
+    script = _yum_dnf_shell_script(cmds_and_rpms)
+    log.info(f"Running `yum/dnf shell` transaction:\n{script}")
+    with tempfile.NamedTemporaryFile(mode="w") as script_file:
+        script_file.write(script)
+        script_file.flush()
+        _yum_dnf_using_build_appliance(
+            build_appliance=build_appliance,
+            bind_ros=[*all_bind_ros, (script_file.name, _SHELL_SCRIPT_DEST)],
+            install_root=install_root,
+            protected_paths=protected_paths,
+            versionlock_list=versionlock_list,
+            yum_dnf_args=["--assumeyes", "shell", _SHELL_SCRIPT_DEST],
+            layer_opts=layer_opts,
+            expected_rpms=_yum_dnf_shell_expected_rpms(cmds_and_nors),
+        )
+
+
+def _yum_dnf_cmd(
+    *,
+    work_dir: Path,
+    protected_paths: Iterable[Path],
+    yum_dnf_args: List[str],
+    layer_opts: LayerOpts,
+    expected_rpms: Optional[Tuple[List[str], List[str]]] = None,
+) -> List[str]:
     prog_name = not_none(layer_opts.rpm_installer).value
     snapshot_dir = not_none(layer_opts.rpm_repo_snapshot)
+    return [
+        "sh",
+        "-uec",
+        f"""\
+        {
+            (snapshot_dir / 'yum-dnf-from-snapshot').shell_quote()
+        } \
+        --snapshot-dir={snapshot_dir} \
+        {
+            '--shared-cache-dir=' + _SHARED_CACHE_DIR.shell_quote()
+                if layer_opts.yum_dnf_shared_cache_dir else ''
+        } {
+            shlex.quote(prog_name)
+        } {
+            ' '.join(
+                '--protected-path=' + p.shell_quote()
+                    for p in protected_paths
+            )
+        } {
+            '--debug' if layer_opts.debug else ''
+        } \
+        -- \
+        --installroot={work_dir.decode()} {
+            ' '.join(shlex.quote(arg) for arg in yum_dnf_args)
+        }
+        {
+            _check_rpmdb_script(work_dir, *expected_rpms)
+                if expected_rpms else ''
+        }""",
+    ]
+
+
+def _yum_dnf_nspawn_opts_and_plugins(
+    *,
+    build_appliance: Subvol,
+    cmd: List[str],
+    bind_ros: List[Tuple[str, str]],
+    install_root: Path,
+    work_dir: Path,
+    versionlock_list: Path,
+    layer_opts: LayerOpts,
+) -> Tuple[_NspawnOpts, Iterable[NspawnPlugin]]:
+    snapshot_dir = not_none(layer_opts.rpm_repo_snapshot)
+    bind_rws = [(install_root, work_dir)]
+    shared_cache_dir = layer_opts.yum_dnf_shared_cache_dir
+    if shared_cache_dir:
+        os.makedirs(shared_cache_dir, exist_ok=True)
+        bind_rws.append((shared_cache_dir, _SHARED_CACHE_DIR))
     opts = new_nspawn_opts(
-        cmd=[
-            "sh",
-            "-uec",
-            f"""\
-            {
-                (snapshot_dir / 'yum-dnf-from-snapshot').shell_quote()
-            } \
-            --snapshot-dir={snapshot_dir} \
-            {
-                shlex.quote(prog_name)
-            } {
-                ' '.join(
-                    '--protected-path=' + p.shell_quote()
-                        for p in protected_paths
-                )
-            } {
-                '--debug' if layer_opts.debug else ''
-            } \
-            -- \
-            --installroot={work_dir.decode()} {
-                ' '.join(shlex.quote(arg) for arg in yum_dnf_args)
-            }
-            """,
-        ],
+        cmd=cmd,
         layer=build_appliance,
         bindmount_ro=bind_ros,
-        bindmount_rw=[(install_root, work_dir)],
+        bindmount_rw=bind_rws,
         user=pwd.getpwnam("root"),
     )
-    run_nspawn(
-        opts,
-        PopenArgs(),
-        plugins=rpm_nspawn_plugins(
-            opts=opts,
-            plugin_args=NspawnPluginArgs(
-                serve_rpm_snapshots=[snapshot_dir],
-                snapshots_and_versionlocks=[(snapshot_dir, versionlock_list)],
-                # We'll explicitly call the RPM installer wrapper we need.
-                shadow_proxied_binaries=False,
-            ),
+    return opts, rpm_nspawn_plugins(
+        opts=opts,
+        plugin_args=NspawnPluginArgs(
+            serve_rpm_snapshots=[snapshot_dir],
+            snapshots_and_versionlocks=[(snapshot_dir, versionlock_list)],
+            # We'll explicitly call the RPM installer wrapper we need.
+            shadow_proxied_binaries=False,
+            repo_server_blob_cache_dir=layer_opts.repo_server_blob_cache_dir,
+        ),
+    )
+
+
+def _yum_dnf_using_build_appliance(
+    *,
+    build_appliance: Subvol,
+    bind_ros: List[Tuple[str, str]],
+    install_root: Path,
+    protected_paths: Iterable[Path],
+    versionlock_list: Path,
+    yum_dnf_args: List[str],
+    layer_opts: LayerOpts,
+    expected_rpms: Optional[Tuple[List[str], List[str]]] = None,
+) -> None:
+    work_dir = generate_work_dir()
+    opts, plugins = _yum_dnf_nspawn_opts_and_plugins(
+        build_appliance=build_appliance,
+        cmd=_yum_dnf_cmd(
+            work_dir=work_dir,
+            protected_paths=protected_paths,
+            yum_dnf_args=yum_dnf_args,
+            layer_opts=layer_opts,
+            expected_rpms=expected_rpms,
         ),
+        bind_ros=bind_ros,
+        install_root=install_root,
+        work_dir=work_dir,
+        versionlock_list=versionlock_list,
+        layer_opts=layer_opts,
     )
+    run_nspawn(opts, PopenArgs(), plugins=plugins)
@@ -9,15 +9,18 @@ Helpers for setting `stat (2)` options on files, directories, etc, which
 we are creating inside the image.
 """
 
-import os
+import grp
 import pwd
-from typing import Union
+import re
+import sys
+from typing import Iterable, NamedTuple, Optional, Tuple, Union
 
-from antlir.fs_utils import generate_work_dir
-from antlir.nspawn_in_subvol.args import PopenArgs, new_nspawn_opts
-from antlir.nspawn_in_subvol.nspawn import run_nspawn
+from antlir.fs_utils import Path
 from antlir.subvol_utils import Subvol
 
+from .group import GROUP_FILE_PATH, GroupFile, read_group_file
+from .user import PASSWD_FILE_PATH, PasswdFile, read_passwd_file
+
 
 # `mode` can be an integer fully specifying the bits, or a chmod symbolic string
 # like `u+rx`.  In the latter case, the changes are applied on top of mode 0.
@@ -48,6 +51,14 @@ _STAT_EXTRA_PERMS = {
     ("t", "a"): 0b001,
 }
 
+# For `mode_bits`, which follows GNU `chmod`.  In a clause like `ug+rw-x`,
+# each action is either a set of permissions, or a class to copy them from.
+_MODE_CLAUSE_RE = re.compile(r"([ugoa]*)((?:[-+=](?:[ugo]|[rwxXst]*))+)")
+_MODE_ACTION_RE = re.compile(r"([-+=])([ugo]|[rwxXst]*)")
+_MODE_CLASS_MASKS = {"u": 0o4700, "g": 0o2070, "o": 0o1007, "a": 0o7777}
+_MODE_PERM_BITS = {"r": 0o444, "w": 0o222, "x": 0o111, "s": 0o6000, "t": 0o1000}
+_MODE_CLASS_SHIFTS = {"u": 6, "g": 3, "o": 0}
+
 
 def customize_stat_options(kwargs, *, default_mode):
     "Mutates `kwargs`."
@@ -103,89 +114,231 @@ def mode_to_octal_str(mode: Mode) -> str:
     return f"{result:04o}"
 
 
-def mode_to_str(mode: Mode) -> str:
+def mode_bits(mode: Mode, *, is_dir: bool) -> int:
+    """
+    Returns the mode bits that `mode` gives a directory or file.  If `mode`
+    is a string, it is a `chmod` symbolic mode, which we apply on top of
+    mode 0, with all of `chmod`'s actions (`+`, `-`, `=`), and permissions,
+    including copying another class's permissions.  Like `chmod`, `X` only
+    applies to directories, and to files that an earlier clause already
+    made executable.  Unlike `chmod`, omitting the classes means `a`,
+    regardless of the umask.
+    """
+    # `mode` can be the empty string
+    mode = mode or 0
     if isinstance(mode, int):
-        return f"{mode:04o}"
-    # The symbolic mode must be applied after 0ing all bits.
-    return f"a-rwxXst,{mode}"
-
-
-# Future: this should validate that the user & group actually exist in the
-# image's passwd/group databases (blocked on having those be first-class
-# objects in the image build process).
-def build_stat_options(
-    item,
-    subvol: Subvol,
-    full_target_path: str,
-    *,
-    do_not_set_mode=False,
-    build_appliance=None,
-):
-    assert full_target_path.startswith(
-        # pyre-fixme[6]: Expected `Union[str, typing.Tuple[str, ...]]` for 1st
-        #  param but got `Path`.
-        subvol.path()
-    ), "{self}: A symlink to {full_target_path} would point outside the image"
-
-    if build_appliance:
-        work_dir = generate_work_dir()
-
-        # Fall back to using the host passwd if `subvol` doesn't have the DBs.
-        etc_passwd = subvol.path("/etc/passwd")
-        etc_group = subvol.path("/etc/group")
-        if not (etc_passwd.exists() and etc_group.exists()):
-            etc_passwd = "/etc/passwd"
-            etc_group = "/etc/group"
-
-        def run(cmd, **kwargs):
-            run_nspawn(
-                new_nspawn_opts(
-                    cmd=cmd,
-                    layer=build_appliance,
-                    bindmount_rw=[(subvol.path(), work_dir)],
-                    bindmount_ro=[
-                        (etc_passwd, "/etc/passwd"),
-                        (etc_group, "/etc/group"),
-                    ],
-                    user=pwd.getpwnam("root"),
-                    **kwargs,
-                ),
-                PopenArgs(),
-            )
+        return mode
+    result = 0
+    for clause in mode.split(","):
+        m = _MODE_CLAUSE_RE.fullmatch(clause)
+        if not m:
+            raise ValueError(f"Bad clause {clause!r} in chmod mode {mode!r}")
+        class_mask = 0
+        for stat_cls in m.group(1) or "a":
+            class_mask |= _MODE_CLASS_MASKS[stat_cls]
+        for action, perms in _MODE_ACTION_RE.findall(m.group(2)):
+            if perms in _MODE_CLASS_SHIFTS:
+                value = (result >> _MODE_CLASS_SHIFTS[perms] & 0o7) * 0o111
+            else:
+                value = 0
+                for perm in perms:
+                    if perm != "X":
+                        value |= _MODE_PERM_BITS[perm]
+                    elif is_dir or result & 0o111:
+                        value |= 0o111
+            value &= class_mask
+            if action == "+":
+                result |= value
+            elif action == "-":
+                result &= ~value
+            else:
+                result = (result & ~class_mask) | value
+    return result
 
-        target_path_for_run = work_dir / os.path.relpath(
-            full_target_path, subvol.path()
-        )
-    else:
-        run = subvol.run_as_root
-        target_path_for_run = full_target_path
 
-    # `chmod` lacks a --no-dereference flag to protect us from following
-    # `full_target_path` if it's a symlink.  As far as I know, this should
-    # never occur, so just let the exception fly.
-    run(["test", "!", "-L", target_path_for_run])
+def _id_or_number(maybe_id: Optional[int], name: str, db: str) -> int:
+    if maybe_id is not None:
+        return maybe_id
+    if not name.isdigit():
+        raise ValueError(f"{name} is not in the {db} DB")
+    return int(name)
 
-    if do_not_set_mode:
-        assert getattr(item, "mode", None) is None, item
+
+def resolve_user_group(subvol: Subvol, user_group: str) -> Tuple[int, int]:
+    """
+    Resolves `user:group` to numeric IDs via the image's own `/etc/passwd`
+    and `/etc/group`, so that we can set ownership from the host, instead
+    of from a build appliance container that has these DBs bind-mounted.
+    Like `chown`, this also accepts numeric IDs.  Fails if the DBs are
+    symlinks, since those could point at the host's DBs.
+
+    Falls back to the host DBs if `subvol` doesn't have them.
+    """
+    user, group = user_group.split(":")
+    etc_passwd = subvol.path(PASSWD_FILE_PATH)
+    etc_group = subvol.path(GROUP_FILE_PATH)
+    if etc_passwd.exists() and etc_group.exists():
+        uid = PasswdFile(read_passwd_file(subvol)).nameToUID.get(user)
+        gid = GroupFile(read_group_file(subvol)).nameToGID.get(group)
     else:
-        # -R is not a problem since it cannot be the case that we are
-        # creating a directory that already has something inside it.  On the
-        # plus side, it helps with nested directory creation.
-        run(
-            [
-                "chmod",
-                "--recursive",
-                mode_to_str(item.mode),
-                target_path_for_run,
-            ]
+        try:
+            uid = pwd.getpwnam(user).pw_uid
+        except KeyError:
+            uid = None
+        try:
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            gid = None
+    return (
+        _id_or_number(uid, user, "passwd"),
+        _id_or_number(gid, group, "group"),
+    )
+
+
+class StatOptions(NamedTuple):
+    """
+    What `apply_stat_options` should do to one path inside the image.
+    `mode` is numeric, see `mode_bits`.
+    """
+
+    path: Path
+    mode: Optional[int] = None
+    owner: Optional[Tuple[int, int]] = None
+    # Also apply to everything under `path`, without following symlinks.
+    recursive: bool = False
+    # Create the directory `path` if it is missing.  Otherwise, `path`
+    # must already be a directory with exactly this mode & owner, and
+    # without xattrs.
+    ensure_dir: bool = False
+
+
+# Runs as `root` on the host, via `sudo` of our own interpreter, so that
+# we need not rely on `root`'s `PATH` having a `python3`.  It cannot import
+# `antlir`, since `sudo` resets the environment.
+#
+# Every path is resolved inside the image root, one component at a time,
+# with `O_NOFOLLOW`, like `fs_utils.open_beneath`, so that a symlink in the
+# image cannot redirect us to the host.  We `chown` before `chmod`, since
+# `chown` clears the set-ID bits.  `os.chmod` & `os.chown` of an `O_PATH`
+# FD go via `/proc/self/fd`, which refers to the opened inode itself.
+_APPLY_STAT_OPTIONS_PY = r"""
+import json, os, stat, sys
+
+def open_parent_beneath(root_fd, relpath):
+    names = [n for n in relpath.split(b"/") if n not in (b"", b".")]
+    if not names or b".." in names:
+        sys.exit("ERROR: Bad path %r" % relpath)
+    dir_fd = os.dup(root_fd)
+    try:
+        for name in names[:-1]:
+            next_fd = os.open(
+                name,
+                os.O_PATH | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC,
+                dir_fd=dir_fd,
+            )
+            os.close(dir_fd)
+            dir_fd = next_fd
+    except BaseException:
+        os.close(dir_fd)
+        raise
+    return dir_fd, names[-1]
+
+def open_nofollow(dir_fd, name):
+    return os.open(
+        name, os.O_PATH | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd
+    )
+
+def set_stat(fd, mode, owner):
+    if owner is not None:
+        os.chown("/proc/self/fd/%d" % fd, *owner)
+    if mode is not None:
+        os.chmod("/proc/self/fd/%d" % fd, mode)
+
+def set_stat_recursive(fd, mode, owner):
+    set_stat(fd, mode, owner)
+    if not stat.S_ISDIR(os.fstat(fd).st_mode):
+        return
+    dir_fd = os.open(
+        ".", os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC, dir_fd=fd
+    )
+    try:
+        for name in os.listdir(dir_fd):
+            child_fd = open_nofollow(dir_fd, name)
+            try:
+                if not stat.S_ISLNK(os.fstat(child_fd).st_mode):
+                    set_stat_recursive(child_fd, mode, owner)
+                # Like `chmod --recursive`, leave symlinks' modes alone.
+                elif owner is not None:
+                    os.chown(
+                        name, *owner, dir_fd=dir_fd, follow_symlinks=False
+                    )
+            finally:
+                os.close(child_fd)
+    finally:
+        os.close(dir_fd)
+
+def check_dir(fd, path, mode, owner):
+    st = os.fstat(fd)
+    if stat.S_ISLNK(st.st_mode):
+        sys.exit("ERROR: %s is a symlink" % path)
+    if not stat.S_ISDIR(st.st_mode):
+        sys.exit("ERROR: %s is not a directory" % path)
+    expected = "%o %d:%d" % (mode, owner[0], owner[1])
+    actual = "%o %d:%d" % (stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+    if expected != actual:
+        sys.exit(
+            "ERROR: stat did not match %s for %s: %s" % (expected, path, actual)
         )
+    xattrs = [
+        x for x in os.listxattr("/proc/self/fd/%d" % fd)
+        if x != "security.selinux"
+    ]
+    if xattrs:
+        sys.exit("ERROR: xattrs was not empty for %s: %s" % (path, xattrs))
+
+def apply(root_fd, path, mode, owner, recursive, ensure_dir):
+    parent_fd, name = open_parent_beneath(
+        root_fd, path.encode(errors="surrogateescape")
+    )
+    try:
+        made_dir = False
+        if ensure_dir:
+            try:
+                os.mkdir(name, 0o700, dir_fd=parent_fd)
+                made_dir = True
+            except FileExistsError:
+                pass
+        fd = open_nofollow(parent_fd, name)
+    finally:
+        os.close(parent_fd)
+    try:
+        if ensure_dir and not made_dir:
+            check_dir(fd, path, mode, owner)
+        elif stat.S_ISLNK(os.fstat(fd).st_mode):
+            sys.exit("ERROR: %s is a symlink" % path)
+        elif recursive:
+            set_stat_recursive(fd, mode, owner)
+        else:
+            set_stat(fd, mode, owner)
+    finally:
+        os.close(fd)
 
-    run(
-        [
-            "chown",
-            "--no-dereference",
-            "--recursive",
-            item.user_group,
-            target_path_for_run,
-        ],
+root_fd = os.open(sys.argv[1], os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+for opts in json.load(sys.stdin):
+    try:
+        apply(root_fd, **opts)
+    except OSError as ex:
+        sys.exit("ERROR: %s: %s" % (opts["path"], ex))
+"""
+
+
+def apply_stat_options(subvol: Subvol, stat_options: Iterable[StatOptions]):
+    """
+    Applies all of `stat_options`, in order, with a single privileged
+    command, and without booting a container.  Each `path` is inside the
+    image, and no symlinks are followed, see `_APPLY_STAT_OPTIONS_PY`.
+    """
+    subvol.run_as_root(
+        [sys.executable, "-c", _APPLY_STAT_OPTIONS_PY, subvol.path()],
+        input=Path.json_dumps([o._asdict() for o in stat_options]).encode(),
     )
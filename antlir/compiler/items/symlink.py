@@ -5,19 +5,17 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
-import pwd
 
 from antlir.compiler.requires_provides import (
     ProvidesSymlink,
     RequireDirectory,
     RequireFile,
 )
-from antlir.fs_utils import Path, generate_work_dir
-from antlir.nspawn_in_subvol.args import PopenArgs, new_nspawn_opts
-from antlir.nspawn_in_subvol.nspawn import run_nspawn
+from antlir.fs_utils import Path
 from antlir.subvol_utils import Subvol
 from pydantic import root_validator
 
+from .build_appliance_sessions import run_in_build_appliance
 from .common import (
     ImageItem,
     LayerOpts,
@@ -59,6 +57,9 @@ class SymlinkBase(symlink_t, ImageItem):
     def provides(self):
         yield ProvidesSymlink(path=self.dest, target=self.source)
 
+    def build_concurrently(self) -> bool:
+        return True
+
     def build(self, subvol: Subvol, layer_opts: LayerOpts):
         dest = subvol.path(self.dest)
         # Best-practice would tell us to do `subvol.path(self.source)`.
@@ -95,22 +96,17 @@ class SymlinkBase(symlink_t, ImageItem):
                 f"{self}: {self.dest} -> {self.source} exists to {current_link}"
             )
         if layer_opts.build_appliance:
-            build_appliance = layer_opts.build_appliance
-            work_dir = generate_work_dir()
-            rel_dest = work_dir / self.dest
-            opts = new_nspawn_opts(
-                cmd=[
+            run_in_build_appliance(
+                subvol,
+                layer_opts,
+                lambda work_dir: [
                     "ln",
                     "--symbolic",
                     "--no-dereference",
                     rel_source,
-                    rel_dest,
+                    work_dir / self.dest,
                 ],
-                layer=build_appliance,
-                bindmount_rw=[(subvol.path(), work_dir)],
-                user=pwd.getpwnam("root"),
             )
-            run_nspawn(opts, PopenArgs())
         else:
             subvol.run_as_root(
                 ["ln", "--symbolic", "--no-dereference", rel_source, dest]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import subprocess
+import sys
+
+from antlir.fs_utils import Path
+from antlir.subvol_utils import TempSubvolumes
+
+from ..build_appliance_sessions import (
+    BuildApplianceSessions,
+    log as sessions_log,
+    run_in_build_appliance,
+)
+from .common import BaseItemTestCase, get_dummy_layer_opts_ba, render_subvol
+
+
+DUMMY_LAYER_OPTS_BA = get_dummy_layer_opts_ba()
+
+
+class BuildApplianceSessionsTestCase(BaseItemTestCase):
+    def _mkdir(self, subvol, layer_opts, name):
+        run_in_build_appliance(
+            subvol, layer_opts, lambda work_dir: ["mkdir", work_dir / name]
+        )
+
+    def test_one_container_per_layer(self):
+        with TempSubvolumes(Path(sys.argv[0])) as temp_subvolumes:
+            subvol = temp_subvolumes.create("ba-sessions")
+            # The savings are logged once the layer is done.
+            with self.assertLogs(sessions_log) as logs, BuildApplianceSessions(
+                "t"
+            ) as sessions:
+                layer_opts = DUMMY_LAYER_OPTS_BA._replace(
+                    build_appliance_sessions=sessions
+                )
+                for name in ["a", "b", "c"]:
+                    self._mkdir(subvol, layer_opts, name)
+                # A failed command does not end the session.
+                with self.assertRaises(subprocess.CalledProcessError):
+                    self._mkdir(subvol, layer_opts, "a")
+                self._mkdir(subvol, layer_opts, "d")
+                (session,) = sessions._sessions
+                self.assertEqual(5, session.num_cmds)
+            self.assertRegex(
+                "\n".join(logs.output),
+                "t: Ran 5 build appliance commands in 1 containers",
+            )
+            self.assertEqual(
+                [
+                    "(Dir)",
+                    {n: ["(Dir)", {}] for n in ["a", "b", "c", "d"]},
+                ],
+                render_subvol(subvol),
+            )
+
+    def test_without_sessions(self):
+        with TempSubvolumes(Path(sys.argv[0])) as temp_subvolumes:
+            subvol = temp_subvolumes.create("ba-no-sessions")
+            self._mkdir(subvol, DUMMY_LAYER_OPTS_BA, "a")
+            self.assertEqual(
+                ["(Dir)", {"a": ["(Dir)", {}]}], render_subvol(subvol)
+            )
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from antlir.fs_utils import Path, temp_dir
+
+from ..image_source_cache import ImageSourceCache, hash_path
+
+
+# Appends a line to $1 every time it runs, then writes $2 to an output file.
+_COUNTING_GENERATOR = [
+    "-c",
+    'echo ran >> "$1"; echo "$2" > "$3/out"; echo out',
+    "counting_generator",  # $0
+]
+
+
+def _write(path: Path, text: str):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _num_runs(counter: Path) -> int:
+    try:
+        return len(counter.read_text().splitlines())
+    except FileNotFoundError:
+        return 0
+
+
+class ImageSourceCacheTestCase(unittest.TestCase):
+    def test_hash_path(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            data = b"0123456789" * (2 ** 18)  # Spans several read chunks
+            tf.write(data)
+            tf.flush()
+            self.assertEqual(
+                hashlib.sha256(data).hexdigest(),
+                hash_path(tf.name, "sha256"),
+            )
+
+    def test_persistent_digests(self):
+        with temp_dir() as td:
+            src = td / "src"
+            _write(src, "hello")
+            expected = hashlib.sha1(b"hello").hexdigest()
+
+            # A "racily clean" file is hashed, but not cached.
+            with ImageSourceCache(td / "cache") as cache:
+                self.assertEqual(expected, cache.hash_path(src, "sha1"))
+            self.assertEqual([], (td / "cache/digests").listdir())
+
+            os.utime(src, (1, 1))
+            for _ in range(2):
+                with ImageSourceCache(td / "cache") as cache:
+                    self.assertEqual(expected, cache.hash_path(src, "sha1"))
+            self.assertEqual(1, cache.num_hash_hits)
+
+            # Changing the size changes the key
+            _write(src, "hello!")
+            os.utime(src, (1, 1))
+            with ImageSourceCache(td / "cache") as cache:
+                self.assertEqual(
+                    hashlib.sha1(b"hello!").hexdigest(),
+                    cache.hash_path(src, "sha1"),
+                )
+                self.assertEqual(1, cache.num_hash_misses)
+
+    def test_verify_content_hash(self):
+        with temp_dir() as td:
+            for i in range(10):
+                _write(td / str(i), str(i))
+            with ImageSourceCache(max_workers=3) as cache:
+                for i in range(10):
+                    digest = hashlib.sha256(str(i).encode()).hexdigest()
+                    cache.verify_content_hash(
+                        td / str(i), f"sha256:{digest}", f"item {i}"
+                    )
+                cache.wait_for_verifications()
+
+                cache.verify_content_hash(td / "3", "sha256:bad", "item 3")
+                with self.assertRaisesRegex(
+                    AssertionError, "^item 3 failed hash validation, got "
+                ):
+                    cache.wait_for_verifications()
+
+            with self.assertRaisesRegex(AssertionError, "^item 7 failed"):
+                with ImageSourceCache() as cache:
+                    cache.verify_content_hash(td / "7", "sha256:bad", "item 7")
+
+    def test_generate_file_in_memory(self):
+        with temp_dir() as td, ImageSourceCache() as cache:
+            counter = td / "counter"
+            out1 = cache.generate_file(
+                "/bin/bash", [*_COUNTING_GENERATOR, counter, "a"]
+            )
+            out2 = cache.generate_file(
+                "/bin/bash", [*_COUNTING_GENERATOR, counter, "a"]
+            )
+            out3 = cache.generate_file(
+                "/bin/bash", [*_COUNTING_GENERATOR, counter, "b"]
+            )
+            self.assertEqual(out1, out2)
+            self.assertEqual("a\n", Path(out1).read_text())
+            self.assertEqual("b\n", Path(out3).read_text())
+            self.assertEqual(2, _num_runs(counter))
+        self.assertFalse(os.path.exists(out1))
+
+    def test_generate_file_persistent(self):
+        with temp_dir() as td:
+            counter = td / "counter"
+            outs = set()
+            for _ in range(2):
+                with ImageSourceCache(td / "cache") as cache:
+                    outs.add(
+                        cache.generate_file(
+                            "bash", [*_COUNTING_GENERATOR, counter, "a"]
+                        )
+                    )
+            self.assertEqual(1, _num_runs(counter))
+            self.assertEqual(1, cache.num_generator_hits)
+            (out,) = outs
+            self.assertTrue(out.startswith((td / "cache").decode()), out)
+            self.assertEqual("a\n", Path(out).read_text())
+
+    def test_prune_unused_entries(self):
+        with temp_dir() as td:
+            counter = td / "counter"
+            src = td / "src"
+            _write(src, "hello")
+            os.utime(src, (1, 1))
+            with ImageSourceCache(td / "cache") as cache:
+                cache.hash_path(src, "sha1")
+                for arg in ["used", "unused"]:
+                    cache.generate_file(
+                        "bash", [*_COUNTING_GENERATOR, counter, arg]
+                    )
+            (digest,) = (td / "cache/digests").listdir()
+            entries = (td / "cache/generated").listdir()
+            self.assertEqual(2, len(entries))
+            for path in [td / "cache/digests" / digest] + [
+                td / "cache/generated" / e for e in entries
+            ]:
+                os.utime(path, (1, 1))
+
+            # Within `_PRUNE_INTERVAL_SECONDS` of the last prune, only hits
+            # bump the mtime of the entries they use.
+            with ImageSourceCache(td / "cache", max_entry_age_s=60) as cache:
+                cache.generate_file(
+                    "bash", [*_COUNTING_GENERATOR, counter, "used"]
+                )
+            self.assertEqual(1, cache.num_generator_hits)
+            self.assertEqual(2, len((td / "cache/generated").listdir()))
+
+            os.unlink(td / "cache/last_pruned")
+            with ImageSourceCache(td / "cache", max_entry_age_s=60) as cache:
+                self.assertEqual([], (td / "cache/digests").listdir())
+                self.assertEqual(1, len((td / "cache/generated").listdir()))
+                cache.generate_file(
+                    "bash", [*_COUNTING_GENERATOR, counter, "used"]
+                )
+                cache.generate_file(
+                    "bash", [*_COUNTING_GENERATOR, counter, "unused"]
+                )
+            self.assertEqual(1, cache.num_generator_hits)
+            self.assertEqual(3, _num_runs(counter))
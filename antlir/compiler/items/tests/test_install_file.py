@@ -250,6 +250,48 @@ class InstallFileItemTestCase(BaseItemTestCase):
                 render_subvol(subvol),
             )
 
+    def test_install_file_symbolic_modes(self):
+        with temp_dir() as td:
+            with open(td / "data.txt", "w") as df:
+                print("Hello", file=df)
+            os.mkdir(td / "subdir")
+            with open(td / "subdir/exe.sh", "w") as ef:
+                print('#!/bin/sh\necho "Hello"', file=ef)
+            os.chmod(td / "subdir/exe.sh", 0o100)
+
+            # `X` makes only directories executable, while `=` replaces
+            # the bits of the classes it names.
+            dir_item = _install_file_item(
+                from_target="t",
+                source={"source": td},
+                dest="/d",
+                dir_mode="u+rwX,go+rX",
+                data_mode="u+rwX,go+rX",
+                exe_mode="a=rwx,go=u-w",
+            )
+
+            with TempSubvolumes(Path(sys.argv[0])) as temp_subvolumes:
+                subvol = temp_subvolumes.create("symbolic-modes")
+                dir_item.build(subvol, DUMMY_LAYER_OPTS)
+                self.assertEqual(
+                    [
+                        "(Dir)",
+                        {
+                            "d": [
+                                "(Dir)",
+                                {
+                                    "data.txt": ["(File d6)"],
+                                    "subdir": [
+                                        "(Dir)",
+                                        {"exe.sh": ["(File m755 d23)"]},
+                                    ],
+                                },
+                            ]
+                        },
+                    ],
+                    render_subvol(subvol),
+                )
+
     def test_install_file_large_batched_chmod(self):
         # Create a large number of files with long names to intentionally
         # overflow the normal size limit of the chmod call
@@ -15,11 +15,16 @@ from antlir.compiler.requires_provides import (
     ProvidesGroup,
     ProvidesUser,
 )
-from antlir.fs_utils import Path
+from antlir.fs_utils import Path, temp_dir
 from antlir.subvol_utils import TempSubvolumes
 
 from ..group import GROUP_FILE_PATH
-from ..phases_provide import PhasesProvideItem, gen_subvolume_subtree_provides
+from ..phases_provide import (
+    PhasesProvideItem,
+    _prune_provides_indexes,
+    gen_subvolume_subtree_provides,
+    save_subvolume_provides_index,
+)
 from ..user import PASSWD_FILE_PATH
 from .common import (
     BaseItemTestCase,
@@ -124,3 +129,62 @@ lp:x:4:7:lp:/var/spool/lpd:/sbin/nologin
                     ProvidesGroup("root"),
                 },
             )
+
+    def test_phases_provide_from_parent_index(self):
+        with TempSubvolumes() as ts, temp_dir() as index_dir:
+            parent = ts.create("parent")
+            parent.run_as_root(["mkdir", parent.path(".meta")])
+            parent.run_as_root(
+                [
+                    "chown",
+                    "--no-dereference",
+                    f"{os.geteuid()}:{os.getegid()}",
+                    parent.path(),
+                ]
+            )
+            populate_temp_filesystem(parent.path().decode())
+            parent.set_readonly(True)
+            save_subvolume_provides_index(
+                parent, parent=None, index_dir=index_dir
+            )
+
+            child = ts.snapshot(parent, "child")
+            for cmd in [
+                ["rm", "-r", child.path("a/b")],
+                ["mkdir", "-p", child.path("new_dir/sub")],
+                ["touch", child.path("new_dir/sub/f"), child.path(".meta/m")],
+                ["ln", "-s", "../a", child.path("new_dir/sym")],
+                ["mv", child.path("a"), child.path("moved_a")],
+            ]:
+                child.run_as_root(cmd)
+
+            from_index = set(
+                PhasesProvideItem(
+                    from_target="t",
+                    subvol=child,
+                    parent=parent,
+                    provides_index_dir=index_dir,
+                ).provides()
+            )
+            # The items of the layer can still write to it.
+            child.run_as_root(["touch", child.path("after")])
+            child.run_as_root(["rm", child.path("after")])
+            self.assertEqual(
+                set(
+                    PhasesProvideItem(from_target="t", subvol=child).provides()
+                ),
+                from_index,
+            )
+            self.assertIn(ProvidesDirectory(path=Path("/moved_a")), from_index)
+
+    def test_prune_provides_indexes(self):
+        with temp_dir() as index_dir:
+            for i, name in enumerate(["old", "mid", "new", "tmp_saving"]):
+                (index_dir / name).touch()
+                os.utime(index_dir / name, ns=(i, i))
+            # Loading an index marks it as recently used.
+            os.utime(index_dir / "old")
+            _prune_provides_indexes(index_dir, 2)
+            self.assertEqual(
+                {b"old", b"new", b"tmp_saving"}, set(os.listdir(index_dir))
+            )
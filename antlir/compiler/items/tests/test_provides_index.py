@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+from antlir.btrfs_diff.send_stream import SendStreamItems as SI
+from antlir.compiler.requires_provides import (
+    ProvidesDirectory,
+    ProvidesFile,
+    ProvidesSymlink,
+)
+from antlir.fs_utils import Path, temp_dir
+
+from ..provides_index import ProvidesIndex, StaleProvidesIndexError
+
+
+def _parent_index() -> ProvidesIndex:
+    index = ProvidesIndex()
+    for filetype, relpath, target in [
+        ("d", b".", None),
+        ("d", b"etc", None),
+        ("f", b"etc/passwd", None),
+        ("l", b"etc/localtime", b"../usr/share/zoneinfo/UTC"),
+        ("d", b"usr", None),
+        ("d", b"usr/bin", None),
+        ("f", b"usr/bin/sh", None),
+        ("c", b"null", None),
+    ]:
+        index.add(relpath, filetype, target)
+    return index
+
+
+def _entries(index: ProvidesIndex):
+    return {
+        (relpath, filetype, target)
+        for relpath, filetype, target in index.gen_entries()
+    }
+
+
+class ProvidesIndexTestCase(unittest.TestCase):
+    def test_save_and_load(self):
+        index = _parent_index()
+        with temp_dir() as td:
+            index.save(td / "idx")
+            self.assertEqual(
+                _entries(index), _entries(ProvidesIndex.load(td / "idx"))
+            )
+            with open(td / "bad", "wb") as f:
+                f.write(b"not an index")
+            with self.assertRaisesRegex(StaleProvidesIndexError, "not a "):
+                ProvidesIndex.load(td / "bad")
+
+    def test_apply_send_stream_items(self):
+        index = _parent_index()
+        index.apply_send_stream_items(
+            [
+                SI.utimes(
+                    path=b"etc", ctime=(0, 0), mtime=(0, 0), atime=(0, 0)
+                ),
+                # `btrfs send` makes new inodes at temporary paths...
+                SI.mkdir(path=b"o258-7-0"),
+                SI.mkfile(path=b"o258-7-0/app"),
+                SI.symlink(path=b"o258-7-0/sh", dest=b"/usr/bin/sh"),
+                # ... and then moves them into place, subtree and all.
+                SI.rename(path=b"o258-7-0", dest=b"opt"),
+                SI.link(path=b"usr/bin/bash", dest=b"usr/bin/sh"),
+                SI.unlink(path=b"etc/passwd"),
+                SI.mkfile(path=b"o259-7-0"),
+                SI.rename(path=b"o259-7-0", dest=b"etc/localtime"),
+                # Items in protected paths are ignored...
+                SI.mkfile(path=b".meta/flavor"),
+                # ... and so is moving out of the index.
+                SI.mkfile(path=b"o260-7-0"),
+                SI.rename(path=b"o260-7-0", dest=b".meta/gone"),
+                SI.mkdir(path=b"mnt"),
+            ],
+            [Path(".meta/")],
+        )
+        index.remove_protected_paths([Path(".meta/"), Path("mnt/")])
+        index.resolve_symlinks(
+            lambda relpaths: [b"/usr/bin/sh" for _ in relpaths]
+        )
+        self.assertEqual(
+            {
+                (b".", "d", None),
+                (b"etc", "d", None),
+                (b"etc/localtime", "f", None),
+                (b"usr", "d", None),
+                (b"usr/bin", "d", None),
+                (b"usr/bin/sh", "f", None),
+                (b"usr/bin/bash", "f", None),
+                (b"null", "c", None),
+                (b"opt", "d", None),
+                (b"opt/app", "f", None),
+                (b"opt/sh", "l", b"/usr/bin/sh"),
+            },
+            _entries(index),
+        )
+
+    def test_stale_index(self):
+        for bad_item in [
+            SI.unlink(path=b"no_such_file"),
+            SI.mkfile(path=b"no_such_dir/file"),
+            SI.mkfile(path=b"etc/passwd/file"),
+            SI.mkdir(path=b"etc"),
+            SI.rename(path=b"no_such_file", dest=b"x"),
+            SI.rename(path=b"usr", dest=b"etc/passwd"),
+            SI.rename(path=b"null", dest=b"usr"),
+            SI.rename(path=b".meta/x", dest=b"x"),
+            SI.link(path=b"x", dest=b"no_such_file"),
+            SI.link(path=b"x", dest=b".meta/x"),
+        ]:
+            with self.assertRaises(StaleProvidesIndexError):
+                _parent_index().apply_send_stream_items(
+                    [bad_item], [Path(".meta/")]
+                )
+
+    def test_gen_provides(self):
+        self.assertEqual(
+            {
+                ProvidesDirectory(path=Path("/")),
+                ProvidesDirectory(path=Path("/etc")),
+                ProvidesFile(path=Path("/etc/passwd")),
+                ProvidesSymlink(
+                    path=Path("/etc/localtime"),
+                    target=Path("../usr/share/zoneinfo/UTC"),
+                ),
+                ProvidesDirectory(path=Path("/usr")),
+                ProvidesDirectory(path=Path("/usr/bin")),
+                ProvidesFile(path=Path("/usr/bin/sh")),
+                ProvidesFile(path=Path("/null")),
+            },
+            set(_parent_index().gen_provides()),
+        )
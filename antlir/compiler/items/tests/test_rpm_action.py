@@ -7,6 +7,7 @@
 import os
 import subprocess
 import sys
+import tempfile
 from contextlib import contextmanager
 
 from antlir.bzl_const import BZL_CONST
@@ -18,10 +19,15 @@ from antlir.tests.flavor_helpers import get_rpm_installers_supported
 from antlir.tests.layer_resource import layer_resource_subvol
 from antlir.tests.subvol_helpers import check_common_rpm_render, pop_path
 
-from ..common import PhaseOrder
+from ..build_appliance_sessions import BuildApplianceSessions
+from ..common import PhaseOrder, protected_path_set
 from ..rpm_action import (
     RpmAction,
     RpmActionItem,
+    YumDnfCommand,
+    _yum_dnf_session_using_build_appliance,
+    _yum_dnf_shell_script,
+    _yum_dnf_shell_using_build_appliance,
 )
 from .common import BaseItemTestCase, render_subvol
 from .rpm_action_base import create_rpm_action_item, RpmActionItemTestBase
@@ -44,6 +50,24 @@ class InstallerIndependentRpmActionItemTest(BaseItemTestCase):
             ).phase_order(),
         )
 
+    def test_yum_dnf_shell_script(self):
+        self.assertEqual(
+            "remove-n a b\n"
+            "install /localhostrpm_0_x.rpm '/odd name'\n"
+            "install-n c\n"
+            "run\n",
+            _yum_dnf_shell_script(
+                [
+                    (YumDnfCommand.remove_name_if_exists, ["b", "a"]),
+                    (
+                        YumDnfCommand.local_install,
+                        ["/odd name", "/localhostrpm_0_x.rpm"],
+                    ),
+                    (YumDnfCommand.install_name, ["c"]),
+                ]
+            ),
+        )
+
 
 class RpmActionItemTestImpl(RpmActionItemTestBase):
     "Subclasses run these tests with concrete values of `self._YUM_DNF`."
@@ -59,6 +83,121 @@ class RpmActionItemTestImpl(RpmActionItemTestBase):
             layer_resource_subvol(__package__, "test-build-appliance")
         )
 
+    def test_yum_dnf_shell_transaction(self):
+        layer_opts = self._opts(rpm_single_transaction=True)
+        with TempSubvolumes(
+            Path(sys.argv[0])
+        ) as temp_subvolumes, tempfile.NamedTemporaryFile() as versionlock:
+            subvol = temp_subvolumes.create("rpm_shell")
+            subvol.run_as_root(["mkdir", subvol.path(".meta")])
+
+            def run_shell(cmds_and_nors):
+                _yum_dnf_shell_using_build_appliance(
+                    build_appliance=layer_opts.build_appliance,
+                    cmds_and_nors=cmds_and_nors,
+                    install_root=subvol.path(),
+                    protected_paths=protected_path_set(subvol),
+                    versionlock_list=versionlock.name,
+                    layer_opts=layer_opts,
+                )
+
+            def installed():
+                return {
+                    f
+                    for f in ["carrot.txt", "milk.txt"]
+                    if os.path.exists(subvol.path("rpm_test") / f)
+                }
+
+            run_shell([(YumDnfCommand.install_name, ["rpm-test-carrot"])])
+            self.assertEqual({"carrot.txt"}, installed())
+
+            run_shell(
+                [
+                    (YumDnfCommand.remove_name_if_exists, ["rpm-test-carrot"]),
+                    (YumDnfCommand.install_name, ["rpm-test-milk"]),
+                ]
+            )
+            self.assertEqual({"milk.txt"}, installed())
+
+            # `yum shell` & `dnf shell` would exit 0 after failing to
+            # install a package, but the RPM DB check catches it.
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_shell(
+                    [
+                        (
+                            YumDnfCommand.remove_name_if_exists,
+                            ["rpm-test-milk"],
+                        ),
+                        (
+                            YumDnfCommand.install_name,
+                            ["rpm-test-carrot", "rpm-test-nonexistent"],
+                        ),
+                    ]
+                )
+
+    def test_yum_dnf_session(self):
+        with TempSubvolumes(
+            Path(sys.argv[0])
+        ) as temp_subvolumes, tempfile.NamedTemporaryFile() as versionlock:
+            subvol = temp_subvolumes.create("rpm_session")
+            subvol.run_as_root(["mkdir", subvol.path(".meta")])
+            # Must be on the build appliance's volume, see `LayerOpts`.
+            shared_cache_dir = temp_subvolumes.create("shared_cache").path()
+            sessions = BuildApplianceSessions("t")
+            layer_opts = self._opts(
+                build_appliance_sessions=sessions,
+                yum_dnf_shared_cache_dir=shared_cache_dir,
+            )
+
+            def run_session(cmds_and_nors):
+                _yum_dnf_session_using_build_appliance(
+                    build_appliance=layer_opts.build_appliance,
+                    cmds_and_nors=cmds_and_nors,
+                    install_root=subvol.path(),
+                    protected_paths=protected_path_set(subvol),
+                    versionlock_list=versionlock.name,
+                    layer_opts=layer_opts,
+                )
+
+            def installed():
+                return {
+                    f
+                    for f in ["carrot.txt", "milk.txt"]
+                    if os.path.exists(subvol.path("rpm_test") / f)
+                }
+
+            run_session(
+                [
+                    (YumDnfCommand.install_name, ["rpm-test-carrot"]),
+                    (YumDnfCommand.install_name, ["rpm-test-milk"]),
+                ]
+            )
+            self.assertEqual({"carrot.txt", "milk.txt"}, installed())
+            (session,) = sessions._sessions
+            self.assertEqual(2, session.num_cmds)
+
+            # The commands run one at a time, so a failing command does not
+            # undo the ones before it.
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_session(
+                    [
+                        (
+                            YumDnfCommand.remove_name_if_exists,
+                            ["rpm-test-milk"],
+                        ),
+                        (
+                            YumDnfCommand.install_name,
+                            ["rpm-test-nonexistent"],
+                        ),
+                    ]
+                )
+            self.assertEqual({"carrot.txt"}, installed())
+            self.assertEqual([2, 2], [s.num_cmds for s in sessions._sessions])
+            # Both containers used one persistent copy of the repodata cache
+            self.assertEqual(
+                2, len(shared_cache_dir.listdir()), shared_cache_dir.listdir()
+            )
+
     @contextmanager
     def _test_rpm_action_item_install_local_setup(self):
         parent_subvol = layer_resource_subvol(__package__, "test-with-no-rpm")
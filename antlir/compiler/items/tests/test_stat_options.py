@@ -4,11 +4,35 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import subprocess
 import tempfile
 import unittest
 
-from ..stat_options import mode_to_octal_str
+from antlir.fs_utils import Path, temp_dir
+
+from ..stat_options import (
+    StatOptions,
+    apply_stat_options,
+    mode_bits,
+    mode_to_octal_str,
+    resolve_user_group,
+)
+
+
+class _FakeSubvol:
+    def __init__(self, root: Path):
+        self._root = root
+
+    def path(self, relpath: Path = Path("/")) -> Path:
+        return self._root / Path(relpath).strip_leading_slashes()
+
+    # Without `sudo`, so we can only `chown` to our own IDs.
+    def run_as_root(self, args, **kwargs):
+        return subprocess.run(args, check=True, **kwargs)
+
+    def read_path_text(self, relpath: Path) -> str:
+        return self.path(relpath).read_text()
 
 
 class StatOptionsTestCase(unittest.TestCase):
@@ -67,3 +91,122 @@ class StatOptionsTestCase(unittest.TestCase):
             mode_to_octal_str("j+wx")
         with self.assertRaisesRegex(AssertionError, "Only permissions of"):
             mode_to_octal_str("a+rwk")
+
+    def test_mode_bits(self):
+        inputs = [
+            "",
+            "a+rx,u+w",
+            "a=r",
+            "u+rwX,go+rX",
+            "u+x,go+X",
+            "a+rwx,go-w",
+            "=rw,u+x",
+            "u=rwx,g=u,o=g-w",
+            "a+rwx,a-x,u+X",
+            "ug+s,o+t",
+            "u+rwxst",
+            "a=rwx,u-s",
+        ]
+        with temp_dir() as td:
+            os.mkdir(td / "dir")
+            open(td / "file", "w").close()
+            for is_dir, path in [(True, td / "dir"), (False, td / "file")]:
+                for val in inputs:
+                    # `chmod` would apply the umask to `=rw`, but
+                    # `mode_bits` does not.
+                    chmod_val = "a" + val if val.startswith("=") else val
+                    subprocess.check_call(
+                        ["chmod", f"a-rwxXst{',' + chmod_val if val else ''}"]
+                        + [path]
+                    )
+                    self.assertEqual(
+                        os.stat(path).st_mode & 0o7777,
+                        mode_bits(val, is_dir=is_dir),
+                        (val, is_dir),
+                    )
+        self.assertEqual(0o755, mode_bits("u+rwX,go+rX", is_dir=True))
+        self.assertEqual(0o644, mode_bits("u+rwX,go+rX", is_dir=False))
+        self.assertEqual(0o1234, mode_bits(0o1234, is_dir=False))
+        for bad in ["j+r", "u+k", "u", "u+ux", "a+r,"]:
+            with self.assertRaisesRegex(ValueError, "^Bad clause "):
+                mode_bits(bad, is_dir=False)
+
+    def test_resolve_user_group(self):
+        with temp_dir() as td:
+            subvol = _FakeSubvol(td)
+            # Without the image's DBs, we use the host's.
+            self.assertEqual((0, 0), resolve_user_group(subvol, "root:root"))
+            os.mkdir(td / "etc")
+            with (td / "etc/passwd").open("w") as f:
+                f.write(
+                    "root:x:0:0:root:/root:/bin/bash\n"
+                    "alice:x:1234:1234::/home/alice:/bin/sh\n"
+                )
+            with (td / "etc/group").open("w") as f:
+                f.write("root:x:0:\nstaff:x:50:alice\n")
+            self.assertEqual(
+                (1234, 50), resolve_user_group(subvol, "alice:staff")
+            )
+            self.assertEqual((77, 0), resolve_user_group(subvol, "77:root"))
+            with self.assertRaisesRegex(ValueError, "bob is not in the passwd"):
+                resolve_user_group(subvol, "bob:root")
+            with self.assertRaisesRegex(ValueError, "eng is not in the group"):
+                resolve_user_group(subvol, "root:eng")
+            # Don't read the host's DBs via a symlink in the image.
+            os.rename(td / "etc/passwd", td / "passwd")
+            os.symlink(td / "passwd", td / "etc/passwd")
+            with self.assertRaises(OSError):
+                resolve_user_group(subvol, "alice:staff")
+
+    def test_apply_stat_options(self):
+        owner = (os.getuid(), os.getgid())
+        with temp_dir() as td:
+            subvol = _FakeSubvol(td / "root")
+            os.makedirs(td / "root/d/sub")
+            os.mkdir(td / "host")
+            for p in [td / "root/d/f", td / "root/d/sub/g", td / "host/f"]:
+                with open(p, "w"):
+                    pass
+                os.chmod(p, 0o644)
+            os.chmod(td / "host", 0o755)
+            os.symlink(td / "host", td / "root/d/sub/host")
+            os.symlink(td / "host/f", td / "root/d/host_f")
+
+            def mode(p):
+                return os.lstat(td / p).st_mode & 0o7777
+
+            apply_stat_options(
+                subvol,
+                [
+                    StatOptions(
+                        path=Path("/d"), mode=0o750, owner=owner, recursive=True
+                    ),
+                    StatOptions(path=Path("d/f"), mode=0o600),
+                ],
+            )
+            for p in ["root/d", "root/d/sub", "root/d/sub/g"]:
+                self.assertEqual(0o750, mode(p), p)
+            self.assertEqual(0o600, mode("root/d/f"))
+
+            # Neither the last, nor an intermediate, symlink is followed.
+            for path in ["d/host_f", "d/sub/host", "d/sub/host/f"]:
+                with self.assertRaises(subprocess.CalledProcessError):
+                    apply_stat_options(
+                        subvol, [StatOptions(path=Path(path), mode=0o777)]
+                    )
+            self.assertEqual(0o755, mode("host"))
+            self.assertEqual(0o644, mode("host/f"))
+
+            new_dir = StatOptions(
+                path=Path("d/new"), mode=0o751, owner=owner, ensure_dir=True
+            )
+            for _ in range(2):  # Makes the dir, then checks it
+                apply_stat_options(subvol, [new_dir])
+                self.assertEqual(0o751, mode("root/d/new"))
+            for bad in [
+                new_dir._replace(mode=0o755),
+                new_dir._replace(path=Path("d/f")),
+                new_dir._replace(path=Path("d/sub/host")),
+            ]:
+                with self.assertRaises(subprocess.CalledProcessError):
+                    apply_stat_options(subvol, [bad])
@@ -28,7 +28,7 @@ from ..user import (
     UserItem,
     new_passwd_file_line,
     new_shadow_file_line,
-    _read_passwd_file,
+    read_passwd_file,
     _read_shadow_file,
     _write_passwd_file,
     _write_shadow_file,
@@ -538,7 +538,7 @@ lp:!!:1234::::::
         test_subvol = layer_resource_subvol(
             __package__, "test-layer-users-groups-from-scratch"
         )
-        passwd = _read_passwd_file(test_subvol)
+        passwd = read_passwd_file(test_subvol)
         self.assertIn("example", passwd)
 
 
@@ -550,7 +550,7 @@ class ReadWriteMethodsTest(unittest.TestCase):
         _write_passwd_file(sv, _SAMPLE_ETC_PASSWD)
         self.assertEqual(
             _SAMPLE_ETC_PASSWD,
-            _read_passwd_file(sv),
+            read_passwd_file(sv),
         )
         _write_shadow_file(sv, _SAMPLE_ETC_SHADOW)
         self.assertEqual(
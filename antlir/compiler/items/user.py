@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import collections
+import os
 import re
 from dataclasses import dataclass
 from typing import (
@@ -23,16 +24,16 @@ from antlir.compiler.requires_provides import (
     RequireDirectory,
     RequireFile,
 )
-from antlir.fs_utils import Path
+from antlir.fs_utils import Path, open_beneath
 from antlir.subvol_utils import Subvol
 from pydantic import validator
 
 from .common import ImageItem, LayerOpts
 from .group import (
-    _read_group_file,
     _write_group_file,
     GROUP_FILE_PATH,
     GroupFile,
+    read_group_file,
 )
 from .user_t import user_t
 
@@ -270,8 +271,10 @@ _VALID_USERNAME_RE = re.compile(
 
 
 # These provide mocking capabilities for testing
-def _read_passwd_file(subvol: Subvol) -> str:
-    return subvol.read_path_text(PASSWD_FILE_PATH)
+def read_passwd_file(subvol: Subvol) -> str:
+    "Reads the image's passwd DB, refusing to follow symlinks out of it."
+    with os.fdopen(open_beneath(subvol.path(), PASSWD_FILE_PATH)) as f:
+        return f.read()
 
 
 def _write_passwd_file(subvol: Subvol, contents: AnyStr):
@@ -314,7 +317,7 @@ class UserItem(user_t, ImageItem):
 
     # pyre-fixme[9]: layer_opts has type `LayerOpts`; used as `None`.
     def build(self, subvol: Subvol, layer_opts: LayerOpts = None):
-        group_file = GroupFile(_read_group_file(subvol))
+        group_file = GroupFile(read_group_file(subvol))
 
         # this should already be checked by requires/provides
         assert (
@@ -326,7 +329,7 @@ class UserItem(user_t, ImageItem):
         # pyre-fixme[6]: Expected `AnyStr` for 2nd param but got `GroupFile`.
         _write_group_file(subvol, group_file)
 
-        passwd_file = PasswdFile(_read_passwd_file(subvol))
+        passwd_file = PasswdFile(read_passwd_file(subvol))
         uid = self.id or passwd_file.next_user_id()
         passwd_file.add(
             PasswdFileLine(
@@ -15,6 +15,7 @@ from antlir.compiler.items.common import LayerOpts, image_source_item
 from antlir.compiler.items.ensure_dirs_exist import ensure_subdirs_exist_factory
 from antlir.compiler.items.genrule_layer import GenruleLayerItem
 from antlir.compiler.items.group import GroupItem
+from antlir.compiler.items.image_source_cache import ImageSourceCache
 from antlir.compiler.items.install_file import InstallFileItem
 from antlir.compiler.items.make_subvol import (
     LayerFromPackageItem,
@@ -115,6 +116,9 @@ class ItemFactory:
     def __init__(self, exit_stack: ExitStack, layer_opts: LayerOpts):
         self._exit_stack = exit_stack
         self._layer_opts = layer_opts
+        self.source_cache = exit_stack.enter_context(
+            ImageSourceCache(layer_opts.image_source_cache_dir)
+        )
         self._key_to_item_factory = {
             "clone": self._image_sourcify(CloneItem),
             "genrule_layer": GenruleLayerItem,
@@ -140,7 +144,10 @@ class ItemFactory:
 
     def _image_sourcify(self, item_cls):
         return image_source_item(
-            item_cls, exit_stack=self._exit_stack, layer_opts=self._layer_opts
+            item_cls,
+            exit_stack=self._exit_stack,
+            layer_opts=self._layer_opts,
+            source_cache=self.source_cache,
         )
 
     def gen_items_for_feature(self, feature_key: str, target: str, config):
@@ -163,6 +170,10 @@ def gen_items_for_features(
     layer_opts: LayerOpts,
 ):
     factory = ItemFactory(exit_stack, layer_opts)
+    # Materialize all items before yielding any, so that the `content_hash`
+    # checks of `image.source`s run in parallel, and all complete before
+    # the compiler starts acting on the items.
+    items = []
     for key_target_config in gen_included_features(
         features_or_paths=features_or_paths,
         features_ctx=GenFeaturesContext(
@@ -172,7 +183,9 @@ def gen_items_for_features(
         ),
     ):
         try:
-            yield from factory.gen_items_for_feature(*key_target_config)
+            items.extend(factory.gen_items_for_feature(*key_target_config))
         except Exception:  # pragma: no cover
             log.error(f"While constructing image feature {key_target_config}")
             raise
+    factory.source_cache.wait_for_verifications()
+    yield from items
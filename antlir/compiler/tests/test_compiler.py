@@ -87,15 +87,17 @@ def _subvol_mock_lexists_is_btrfs_and_run_as_root(fn):
 
     # IMPORTANT: These mocks are just ignored.
     for ignored_mock in [
-        "antlir.compiler.items.ensure_dirs_exist.run_nspawn",
-        "antlir.compiler.items.ensure_dirs_exist.mode_to_octal_str",
+        "antlir.compiler.items.build_appliance_sessions.run_nspawn",
         "antlir.compiler.items.rpm_action.run_nspawn",
-        "antlir.compiler.items.stat_options.run_nspawn",
-        "antlir.compiler.items.symlink.run_nspawn",
-        "antlir.compiler.items.tarball.run_nspawn",
         "antlir.rpm.rpm_metadata.run_nspawn",
     ]:
         fn = unittest.mock.patch(ignored_mock)(fn)
+    # The fake subvolume has no user & group DBs.
+    for resolve_mock in [
+        "antlir.compiler.items.ensure_dirs_exist.resolve_user_group",
+        "antlir.compiler.items.install_file.resolve_user_group",
+    ]:
+        fn = unittest.mock.patch(resolve_mock, return_value=(0, 0))(fn)
     return fn
 
 
@@ -162,7 +164,7 @@ def mock_user_group_read_write():
     _group_file_mocks = _build_mock_read_write(_group_file)
 
     with unittest.mock.patch(
-        "antlir.compiler.items.user._read_passwd_file",
+        "antlir.compiler.items.user.read_passwd_file",
         side_effect=_passwd_file_mocks[0],
     ), unittest.mock.patch(
         "antlir.compiler.items.user._write_passwd_file",
@@ -174,13 +176,13 @@ def mock_user_group_read_write():
         "antlir.compiler.items.user._write_shadow_file",
         side_effect=_shadow_file_mocks[1],
     ), unittest.mock.patch(
-        "antlir.compiler.items.user._read_group_file",
+        "antlir.compiler.items.user.read_group_file",
         side_effect=_group_file_mocks[0],
     ), unittest.mock.patch(
         "antlir.compiler.items.user._write_group_file",
         side_effect=_group_file_mocks[1],
     ), unittest.mock.patch(
-        "antlir.compiler.items.group._read_group_file",
+        "antlir.compiler.items.group.read_group_file",
         side_effect=_group_file_mocks[0],
     ), unittest.mock.patch(
         "antlir.compiler.items.group._write_group_file",
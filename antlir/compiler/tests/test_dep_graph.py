@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import sys
+import threading
 import unittest
 import unittest.mock
 from dataclasses import dataclass
@@ -1024,8 +1025,11 @@ class DependencyOrderItemsTestCase(DepGraphTestBase):
         )
         res = tuple(dg.gen_dependency_order_items(self.provides_root))
         self.assertNotIn(self.provides_root, res)
-        res = (self.provides_root, self.root_u, self.root_g, *res)
+        self._assert_dependency_order(
+            (self.provides_root, self.root_u, self.root_g, *res)
+        )
 
+    def _assert_dependency_order(self, res):
         for item, items_it_requires in self.item_to_items_it_reqs.items():
             for item_it_requires in items_it_requires:
                 self.assertLess(
@@ -1042,6 +1046,66 @@ class DependencyOrderItemsTestCase(DepGraphTestBase):
                     f"{item} was not before {item_requiring_it}",
                 )
 
+    def test_build_items(self):
+        # Not `build_concurrently()`, so it must build alone.
+        alone = TestImageItem(reqs=[RequireDirectory(path=Path("/a"))])
+        # The only item that provides `/a` just requires the root.
+        (a,) = (
+            i
+            for i, reqs in self.item_to_items_it_reqs.items()
+            if reqs == {self.provides_root}
+        )
+        # `/a/b` and `/a/d` become buildable together, once `/a` is built.
+        # Each waits for the other, so this times out unless they overlap.
+        siblings = {
+            i
+            for i, reqs in self.item_to_items_it_reqs.items()
+            if reqs == {self.provides_root, a}
+        }
+        self.assertEqual(2, len(siblings))
+        siblings_barrier = threading.Barrier(len(siblings), timeout=60)
+        lock = threading.Lock()
+        running = set()
+        built = []
+
+        def build(item):
+            with lock:
+                running.add(item)
+                if alone in running:
+                    self.assertEqual({alone}, running)
+            if item in siblings:
+                siblings_barrier.wait()
+            with lock:
+                running.remove(item)
+                built.append(item)
+
+        dg = DependencyGraph([*self.items, alone], layer_target="t-72")
+        dg.build_items(self.provides_root, build, max_workers=4)
+        self.assertEqual({*self.items, alone}, set(built))
+        self.assertEqual(len(built), len(set(built)))
+        res = (self.provides_root, self.root_u, self.root_g, *built)
+        self._assert_dependency_order(res)
+        self.assertLess(res.index(a), res.index(alone))
+
+    def test_build_items_error(self):
+        first = FilesystemRootItem(from_target="")
+        second = TestImageItem(
+            reqs=[RequireDirectory(path=Path("/"))],
+            provs=[ProvidesDirectory(path=Path("a"))],
+        )
+        third = TestImageItem(reqs=[RequireDirectory(path=Path("/a"))])
+        built = []
+
+        def build(item):
+            built.append(item)
+            if item is second:
+                raise RuntimeError("kaboom")
+
+        dg = DependencyGraph([first, second, third], layer_target="t")
+        with self.assertRaisesRegex(RuntimeError, "^kaboom$"):
+            dg.build_items(self.provides_root, build, max_workers=4)
+        self.assertEqual([second], built)
+
     def test_cycle_detection(self):
         def requires_provides_directory_class(requires_dir, provides_dirs):
             return TestImageItem(
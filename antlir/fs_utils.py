@@ -459,6 +459,43 @@ def create_ro(path, mode):
     return open(path, mode, opener=ro_opener)
 
 
+def open_beneath(root: AnyStr, relpath: AnyStr, flags: int = os.O_RDONLY):
+    """
+    `os.open`s `relpath` inside the directory `root`, and fails with an
+    `OSError` if any component of `relpath` is a symlink.  Use this to read
+    an image's files from the host, where an absolute symlink in the image
+    would otherwise resolve against the host's root.  Returns an FD, which
+    the caller must close.
+
+    With `os.O_PATH`, we `fstat` the last component, since `O_NOFOLLOW`
+    alone would let `O_PATH` open a symlink.
+    """
+    names = [n for n in byteme(relpath).split(b"/") if n not in (b"", b".")]
+    if b".." in names:
+        raise ValueError(f"{relpath} must not contain `..`")
+    dir_fd = os.open(root, os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        for name in names[:-1]:
+            next_fd = os.open(
+                name,
+                os.O_PATH | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC,
+                dir_fd=dir_fd,
+            )
+            os.close(dir_fd)
+            dir_fd = next_fd
+        fd = os.open(
+            names[-1] if names else ".",
+            flags | os.O_NOFOLLOW | os.O_CLOEXEC,
+            dir_fd=dir_fd,
+        )
+    finally:
+        os.close(dir_fd)
+    if flags & os.O_PATH and stat.S_ISLNK(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), relpath)
+    return fd
+
+
 @contextmanager
 def populate_temp_dir_and_rename(dest_path, *, overwrite=False) -> Path:
     """
@@ -8,12 +8,14 @@
 This is a poor man's port of set_up_volume.sh to allow `package.new` to
 emit btrfs loopbacks.
 """
+import fcntl
 import os
 import subprocess
 import sys
-from typing import Iterable, Optional
+import tempfile
+from typing import BinaryIO, Iterable, NamedTuple, Optional, Tuple
 
-from .common import get_logger, kernel_version, run_stdout_to_err
+from .common import get_logger, kernel_version, pipe, run_stdout_to_err
 from .fs_utils import Path, temp_dir
 from .loopback_opts_t import loopback_opts_t
 from .unshare import Unshare, nsenter_as_root, nsenter_as_user
@@ -28,13 +30,61 @@ MIN_CREATE_BYTES = 109 * MiB
 # The smallest size, to which btrfs will GROW a tiny filesystem. For
 # lower values, `btrfs resize` prints:
 #   ERROR: unable to resize '_foo/volume': Invalid argument
-# MIN_GROW_BYTES = 175 * MiB
+MIN_GROW_BYTES = 175 * MiB
 #
 # When a filesystem's `min-dev-size` is small, `btrfs resize` below this
 # limit will fail to shrink with `Invalid argument`.
 MIN_SHRINK_BYTES = 256 * MiB
 
 
+# `fcntl.F_SETPIPE_SZ` is only exposed starting with Python 3.10
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+# The `receive` pipe buffer lets `btrfs receive` keep working while
+# `receive_growing` checks free space.  1MiB is the default unprivileged
+# `/proc/sys/fs/pipe-max-size`.
+_RECEIVE_PIPE_BYTES = MiB
+# Forward at most this much per `splice`, so that we re-check our free
+# space budget often enough.
+_SPLICE_CHUNK_BYTES = 256 * KiB
+
+
+class ReceiveGrowthStats(NamedTuple):
+    "Counters from `BtrfsLoopbackVolume.receive_growing`."
+    grow_cycles: int
+    bytes_spliced: int
+
+
+def _parse_min_free_bytes(usage_out: bytes) -> int:
+    """
+    Extracts the "min" free space from `btrfs filesystem usage -b`:
+
+        Free (estimated):                  96862208      (min: 96862208)
+
+    This is the conservative estimate, which assumes that the unallocated
+    space will all be used for metadata, with its (larger) DUP overhead.
+    """
+    for line in usage_out.split(b"\n"):
+        key, sep, value = line.partition(b":")
+        if sep and key.strip() == b"Free (estimated)":
+            _, sep, min_free = value.partition(b"(min:")
+            assert sep, line
+            return int(min_free.strip().rstrip(b")").strip())
+    raise RuntimeError(
+        f"No free space in `btrfs filesystem usage`: {usage_out}"
+    )
+
+
+def _splice_or_copy(r_fd: int, w_fd: int, max_bytes: int) -> int:
+    "Moves up to `max_bytes` from `r_fd` to `w_fd`, returns 0 on EOF."
+    splice = getattr(os, "splice", None)  # Python 3.10+
+    if splice is not None:
+        return splice(r_fd, w_fd, max_bytes)
+    buf = os.read(r_fd, max_bytes)  # pragma: no cover
+    # `os.write` to a blocking pipe only returns after writing everything
+    os.write(w_fd, buf)  # pragma: no cover
+    return len(buf)  # pragma: no cover
+
+
 class LoopbackVolume:
     def __init__(
         self,
@@ -268,6 +318,156 @@ class BtrfsLoopbackVolume(LoopbackVolume):
             stderr=subprocess.PIPE,
         )
 
+    def receive_growing(
+        self, send: BinaryIO
+    ) -> Tuple[subprocess.CompletedProcess, ReceiveGrowthStats]:
+        """
+        Like `receive`, but interposes on the pipe between `btrfs send` and
+        `btrfs receive`, and grows the filesystem whenever its free space
+        gets too low to absorb the next chunk of the sendstream.  This lets
+        the caller start with a tight size estimate, without having to
+        redo the whole send-receive when it guesses too low.
+
+        Free space is checked much more often than the ratio of free space
+        to sendstream bytes would indicate, since `receive`, the page
+        cache, and btrfs itself all buffer.  There are no absolute
+        guarantees that `receive` won't run out of space, so the caller
+        should still be ready to retry.
+
+        While we check free space, `receive` keeps consuming the data
+        already buffered in its (enlarged) stdin pipe, and the data moves
+        between the pipes via `splice`, without a userspace copy.
+        """
+        grow_cycles = 0
+        bytes_spliced = 0
+        # `receive` can be chatty, so don't risk blocking on its stderr.
+        with tempfile.TemporaryFile() as stderr, pipe() as (
+            r_recv,
+            w_recv,
+        ):
+            try:
+                fcntl.fcntl(w_recv, _F_SETPIPE_SZ, _RECEIVE_PIPE_BYTES)
+            except OSError:  # pragma: no cover
+                log.warning("Could not enlarge the `btrfs receive` pipe")
+            with subprocess.Popen(
+                # pyre-fixme[16]: `Optional` has no attribute `nsenter_as_root`.
+                self._unshare.nsenter_as_root("btrfs", "receive", self.dir()),
+                stdin=r_recv,
+                stdout=2,
+                stderr=stderr,
+            ) as proc:
+                r_recv.close()  # This end is now fully owned by `receive`.
+                budget = 0
+                try:
+                    while True:
+                        if budget <= 0:
+                            budget, grown = self._ensure_receive_headroom()
+                            grow_cycles += grown
+                        num_spliced = _splice_or_copy(
+                            send.fileno(),
+                            w_recv.fileno(),
+                            min(budget, _SPLICE_CHUNK_BYTES),
+                        )
+                        if not num_spliced:
+                            break
+                        budget -= num_spliced
+                        bytes_spliced += num_spliced
+                except BrokenPipeError:
+                    # `receive` died, e.g. out of space despite our best
+                    # efforts.  Let the caller inspect the return code, and
+                    # drain the rest of the sendstream.
+                    pass
+                finally:
+                    w_recv.close()  # Signals EOF to `receive`.
+            stderr.seek(0)
+            return (
+                subprocess.CompletedProcess(
+                    args=proc.args,
+                    returncode=proc.returncode,
+                    stdout=None,
+                    stderr=stderr.read(),
+                ),
+                ReceiveGrowthStats(
+                    grow_cycles=grow_cycles, bytes_spliced=bytes_spliced
+                ),
+            )
+
+    def _ensure_receive_headroom(self) -> Tuple[int, int]:
+        """
+        Implementation detail of `receive_growing`.  Grows the filesystem
+        until its free space is comfortable, and returns the number of
+        sendstream bytes it is safe to forward before the next check,
+        plus the number of grow cycles this took.
+        """
+        grow_cycles = 0
+        while True:
+            free_bytes = self.get_min_free_bytes()
+            # Don't use a growth increment that is TOO small, since each
+            # cycle costs a few subprocesses, and leaves the final FS more
+            # out-of-tune.
+            low_water_bytes = max(64 * MiB, self._size_bytes // 8)
+            if free_bytes >= low_water_bytes:
+                # Budget half of the free space, since something may buffer.
+                return free_bytes // 2, grow_cycles
+            grow_cycles += 1
+            self.grow(
+                max(
+                    MIN_GROW_BYTES,
+                    self._size_bytes + 2 * low_water_bytes - free_bytes,
+                )
+            )
+
+    def get_min_free_bytes(self) -> int:
+        "Syncs the filesystem, and returns its worst-case free space."
+        # pyre-fixme[16]: `Optional` has no attribute `nsenter_as_root`.
+        nsenter = self._unshare.nsenter_as_root
+        run_stdout_to_err(
+            nsenter("btrfs", "filesystem", "sync", self.dir()), check=True
+        )
+        return _parse_min_free_bytes(
+            subprocess.check_output(
+                nsenter("btrfs", "filesystem", "usage", "-b", self.dir())
+            )
+        )
+
+    def grow(self, size_bytes: int):
+        "Grows the mounted filesystem, together with its backing file."
+        assert size_bytes > self._size_bytes, (size_bytes, self._size_bytes)
+        log.info(
+            f"Growing {self._image_path} from {self._size_bytes} to "
+            f"{size_bytes} bytes"
+        )
+        # The order matters: backing file, loop device, filesystem.
+        size_bytes = self._create_or_resize_image_file(size_bytes)
+        run_stdout_to_err(
+            # pyre-fixme[16]: `BtrfsLoopbackVolume` has no attribute
+            # `_loop_dev`.
+            ["sudo", "losetup", "--set-capacity", self._loop_dev],
+            check=True,
+        )
+        run_stdout_to_err(
+            nsenter_as_root(
+                self._unshare,
+                # pyre-fixme[6]: Expected `List[Variable[typing.AnyStr <: [str,
+                #  bytes]]]` for 2nd param but got `str`.
+                "btrfs",
+                # pyre-fixme[6]: Expected `List[Variable[typing.AnyStr <: [str,
+                #  bytes]]]` for 3rd param but got `str`.
+                "filesystem",
+                # pyre-fixme[6]: Expected `List[Variable[typing.AnyStr <: [str,
+                #  bytes]]]` for 4th param but got `str`.
+                "resize",
+                # pyre-fixme[6]: Expected `List[Variable[typing.AnyStr <: [str,
+                #  bytes]]]` for 5th param but got `str`.
+                "max",
+                # pyre-fixme[6]: Expected `List[Variable[typing.AnyStr <: [str,
+                #  bytes]]]` for 6th param but got `Optional[Path]`.
+                self._mount_dir,
+            ),
+            check=True,
+        )
+        self._size_bytes = size_bytes
+
     def _format(self):
         """
         Format the loopback image with a btrfs filesystem of size
@@ -448,6 +448,7 @@ class NspawnPluginArgs(NamedTuple):
     shadow_paths: Iterable[Tuple[Path, Path]] = ()
     snapshots_and_versionlocks: Iterable[Tuple[Path, Path]] = ()
     attach_antlir_dir: AttachAntlirDirMode = AttachAntlirDirMode.OFF
+    repo_server_blob_cache_dir: Optional[Path] = None
 
 
 def _parser_add_plugin_args(parser: argparse.ArgumentParser):
@@ -541,6 +542,14 @@ def _parser_add_plugin_args(parser: argparse.ArgumentParser):
         "debugging layers to figure out why the BA `__antlir__` "
         "directory cannot be attached to the layer.",
     )
+    parser.add_argument(
+        "--repo-server-blob-cache-dir",
+        type=Path.from_argparse,
+        help="A host directory in which the `repo-server`s of the snapshots "
+        "served via `--serve-rpm-snapshot` cache the RPMs & repodata they "
+        "verified, so that later containers need not fetch them from "
+        "storage again.  Safe to share between concurrent containers.",
+    )
 
 
 # Only for internal use by `nspawn-{run,test}-in-subvol`.
@@ -6,7 +6,8 @@
 
 """
 Read the `run.py` docblock first.  Then, review the docs for
-`new_nspawn_opts` and `PopenArgs`, and invoke `{run,popen}_nspawn`.
+`new_nspawn_opts` and `PopenArgs`, and invoke `{run,popen}_nspawn`.  To run
+several commands in one container, use `nspawn_session`.
 
 In this file, we first use `systemd-nspawn` to start the container's init
 system (PID 1).  Then, we enter the container's cgroup, clone its
@@ -70,7 +71,15 @@ import subprocess
 import textwrap
 import time
 from contextlib import closing, contextmanager, nullcontext
-from typing import ContextManager, Iterable, List, Tuple
+from typing import (
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 from antlir.common import byteme, get_logger, pipe
 from antlir.fs_utils import MehStr, Path, temp_dir
@@ -150,6 +159,142 @@ def popen_nspawn(
     )
 
 
+class NspawnSession:
+    """
+    A container that stays up across several commands, see `nspawn_session`.
+    Every command runs as `opts.user`, with `opts.setenv`, in the same
+    container, so commands see each other's changes to its filesystem.
+    """
+
+    def __init__(
+        self,
+        setup: _NspawnSetup,
+        nspawn_proc: subprocess.Popen,
+        *,
+        clonecaps: Path,
+        container_proc_pid: int,
+        popen_args: PopenArgs,
+    ):
+        self._setup = setup
+        self._nspawn_proc = nspawn_proc
+        self._clonecaps = clonecaps
+        self._container_proc_pid = container_proc_pid
+        self._popen_args = popen_args
+
+    def popen(
+        self,
+        cmd: Iterable[MehStr],
+        popen_args: Optional[PopenArgs] = None,
+        *,
+        forward_fd: Iterable[int] = (),
+    ) -> ContextManager[subprocess.Popen]:
+        "Like `popen_nspawn`, but only returns the client process."
+        log.debug(f"NspawnSession.popen {cmd}")
+        return _popen_nsenter_into_container(
+            self._setup._replace(
+                # Any plugin changes to `cmd` & `forward_fd` only made
+                # sense for the command that started the session.
+                opts=self._setup.opts._replace(cmd=cmd, forward_fd=forward_fd),
+                popen_args=self._popen_args
+                if popen_args is None
+                else popen_args,
+            ),
+            self._nspawn_proc,
+            clonecaps=self._clonecaps,
+            container_proc_pid=self._container_proc_pid,
+        )
+
+    def run(
+        self,
+        cmd: Iterable[MehStr],
+        popen_args: Optional[PopenArgs] = None,
+        *,
+        forward_fd: Iterable[int] = (),
+    ) -> subprocess.CompletedProcess:
+        "Like `run_nspawn`, but only returns the client process."
+        # pyre-fixme[16]: `ContextManager` has no attribute `__enter__`.
+        with self.popen(cmd, popen_args, forward_fd=forward_fd) as proc:
+            stdout, stderr = proc.communicate()
+        return subprocess.CompletedProcess(
+            args=proc.args,
+            returncode=proc.returncode,
+            stdout=stdout,
+            stderr=stderr,
+        )
+
+
+@contextmanager
+def nspawn_session(
+    opts: _NspawnOpts,
+    popen_args: PopenArgs,
+    *,
+    plugins: Iterable[NspawnPlugin] = (),
+) -> Iterator[NspawnSession]:
+    """
+    Sets up & starts a container just like `popen_nspawn`, but instead of
+    running `opts.cmd`, yields a `NspawnSession` that runs any number of
+    commands in the container.  This saves the cost of snapshotting the
+    layer, and of starting & stopping the container for each command.
+
+    `popen_args.console` applies to the container, while the rest of
+    `popen_args` is the default for the session's commands.
+
+    While the session is up, `opts.cmd` is replaced by a `cat` that waits
+    for us to close its `stdin`.  This lets plugins work unchanged, e.g.
+    `RepoServers` waits for this command to start before serving RPMs.
+    """
+    sessions = []
+    # pyre-fixme[16]: `Iterable` has no attribute `__enter__`.
+    with _popen_plugin_driver(
+        opts=opts._replace(cmd=["cat"]),
+        popen_args=popen_args._replace(
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL
+        ),
+        # pyre-fixme[6]: Expected `(_NspawnSetup) -> ContextManager[
+        # Tuple[subprocess....
+        post_setup_popen=functools.partial(
+            _post_setup_nspawn_session, sessions.append, popen_args
+        ),
+        plugins=plugins,
+    ) as (cat_proc, _nspawn_proc):
+        (session,) = sessions
+        try:
+            yield session
+        finally:
+            # The container exits once `cat` does.
+            cat_proc.stdin.close()
+
+
+@contextmanager
+def _post_setup_nspawn_session(
+    add_session: Callable[[NspawnSession], None],
+    popen_args: PopenArgs,
+    setup: _NspawnSetup,
+) -> Iterable[Tuple[subprocess.Popen, subprocess.Popen]]:
+    # pyre-fixme[16]: `Iterable` has no attribute `__enter__`.
+    with _popen_nspawn(setup) as (
+        nspawn_proc,
+        container_proc_pid,
+    ), Path.resource(
+        __package__, "clonecaps", exe=True
+    ) as clonecaps, _popen_nsenter_into_container(
+        setup,
+        nspawn_proc,
+        clonecaps=clonecaps,
+        container_proc_pid=container_proc_pid,
+    ) as cat_proc:
+        add_session(
+            NspawnSession(
+                setup,
+                nspawn_proc,
+                clonecaps=clonecaps,
+                container_proc_pid=container_proc_pid,
+                popen_args=popen_args,
+            )
+        )
+        yield cat_proc, nspawn_proc
+
+
 @contextmanager
 def _post_setup_popen_nspawn(
     setup: _NspawnSetup,
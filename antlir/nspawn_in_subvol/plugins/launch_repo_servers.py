@@ -4,14 +4,17 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
 import logging
+import os
 import signal
 import socket
 import subprocess
 import textwrap
+import threading
 import time
 from contextlib import ExitStack, contextmanager
-from typing import List, NamedTuple, Optional
+from typing import Dict, List, NamedTuple, Optional
 
 from antlir.common import (
     FD_UNIX_SOCK_TIMEOUT,
@@ -21,11 +24,24 @@ from antlir.common import (
     recv_fds_from_unix_sock,
 )
 from antlir.fs_utils import Path
+from antlir.send_fds_and_run import send_fds
 
 
 log = get_logger()
 _mockable_popen_for_repo_server = subprocess.Popen
 
+# When set, the `repo-server`s for all containers on the host that use the
+# same snapshot are served by one daemon, whose Unix socket lives in this
+# directory.  This is opt-in, since the `repo-server` in an older snapshot
+# lacks `--daemon-socket`.
+REPO_SERVER_DAEMON_DIR_ENV = "ANTLIR_REPO_SERVER_DAEMON_DIR"
+# Keep in sync with `BLOB_CACHE_DIR_ENV` in `repo_server.py`.  We pass the
+# cache to `repo-server` via the environment, not a flag, since the
+# `repo-server` in an older snapshot would not know the flag.
+_BLOB_CACHE_DIR_ENV = "ANTLIR_REPO_SERVER_BLOB_CACHE_DIR"
+# Each time we start a daemon, we rotate its log if it got bigger than this.
+_MAX_DAEMON_LOG_BYTES = 2 ** 20
+
 
 def _make_debug_print(logger_name, fstring):
     t = time.time()
@@ -154,8 +170,40 @@ class RepoServer(NamedTuple):
         return f"RepoServer({self.rpm_repo_snapshot}, port={self.port})"
 
 
+def _bind_and_listen(rs: RepoServer) -> None:
+    rs.sock.bind(("127.0.0.1", rs.port))
+    # Socket activation: allow requests to queue up, which means that
+    # we don't have to explicitly wait for the repo servers to start --
+    # any in-container clients will do so if/when needed. This reduces
+    # interactive `=container` boot time by hundreds of ms.
+    rs.sock.listen()  # leave the request queue size at default
+
+
+def _repo_server_args(repo_server_bin: Path, rs: RepoServer) -> List[str]:
+    return [
+        repo_server_bin,
+        # TODO: Once the committed BAs all have a `repo-server` that
+        # knows to append `/snapshot` to the path, remove it here, and
+        # tidy up the snapshot resolution code in `repo_server.py`.
+        f"--snapshot-dir={rs.rpm_repo_snapshot / 'snapshot'}",
+        *(["--debug"] if log.isEnabledFor(logging.DEBUG) else []),
+    ]
+
+
+def _repo_server_env(
+    blob_cache_dir: Optional[Path],
+) -> Optional[Dict[str, str]]:
+    if blob_cache_dir is None:
+        return None  # Inherit our environment
+    return {**os.environ, _BLOB_CACHE_DIR_ENV: blob_cache_dir.decode()}
+
+
 @contextmanager
-def _launch_repo_server(repo_server_bin: Path, rs: RepoServer) -> RepoServer:
+def _launch_repo_server(
+    repo_server_bin: Path,
+    rs: RepoServer,
+    blob_cache_dir: Optional[Path] = None,
+) -> RepoServer:
     """
     Invokes `repo-server` with the given snapshot; passes it ownership of
     the bound TCP socket -- it listens & accepts connections.
@@ -163,23 +211,14 @@ def _launch_repo_server(repo_server_bin: Path, rs: RepoServer) -> RepoServer:
     Returns a copy of the `RepoServer` with `server` populated.
     """
     assert rs.proc is None
-    rs.sock.bind(("127.0.0.1", rs.port))
-    # Socket activation: allow requests to queue up, which means that
-    # we don't have to explicitly wait for the repo servers to start --
-    # any in-container clients will do so if/when needed. This reduces
-    # interactive `=container` boot time by hundreds of ms.
-    rs.sock.listen()  # leave the request queue size at default
+    _bind_and_listen(rs)
     with rs.sock, _mockable_popen_for_repo_server(
         [
-            repo_server_bin,
+            *_repo_server_args(repo_server_bin, rs),
             f"--socket-fd={rs.sock.fileno()}",
-            # TODO: Once the committed BAs all have a `repo-server` that
-            # knows to append `/snapshot` to the path, remove it here, and
-            # tidy up the snapshot resolution code in `repo_server.py`.
-            f"--snapshot-dir={rs.rpm_repo_snapshot / 'snapshot'}",
-            *(["--debug"] if log.isEnabledFor(logging.DEBUG) else []),
         ],
         pass_fds=[rs.sock.fileno()],
+        env=_repo_server_env(blob_cache_dir),
     ) as server_proc:
         try:
             # pyre-fixme[7]: Expected `RepoServer` but got
@@ -209,18 +248,176 @@ def _launch_repo_server(repo_server_bin: Path, rs: RepoServer) -> RepoServer:
                     server_proc.kill()
 
 
+def _connect_to_repo_server_daemon(
+    repo_server_bin: Path,
+    rs: RepoServer,
+    daemon_socket: Path,
+    blob_cache_dir: Optional[Path] = None,
+) -> socket.socket:
+    "Connects to the snapshot's daemon, starting one if there is none."
+    deadline = time.monotonic() + FD_UNIX_SOCK_TIMEOUT
+    daemon_proc = None
+    while True:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(daemon_socket)
+        except (FileNotFoundError, ConnectionRefusedError):
+            conn.close()
+        else:
+            if daemon_proc is not None:
+                # Reap our daemon whenever it exits, since we don't wait
+                # for it.  A daemon thread, so it does not keep us alive.
+                threading.Thread(
+                    name="RpSrvReaper", target=daemon_proc.wait, daemon=True
+                ).start()
+            return conn
+        # A daemon that exits with 0 lost the race to another daemon,
+        # which may itself be exiting due to idleness, so start another.
+        if daemon_proc is not None and daemon_proc.poll() is not None:
+            check_popen_returncode(daemon_proc)
+            daemon_proc = None
+        if daemon_proc is None:
+            log.debug(f"Starting `repo-server` daemon at {daemon_socket}")
+            log_path = daemon_socket + b".log"
+            try:
+                if os.stat(log_path).st_size > _MAX_DAEMON_LOG_BYTES:
+                    os.rename(log_path, log_path + b".old")
+            except FileNotFoundError:
+                pass
+            # A new session, so the daemon outlives us, and is not hit by
+            # signals meant for our process group.  It exits when idle.  It
+            # must not hold our stderr open, or whoever reads it would wait
+            # for the daemon to exit.
+            with open(log_path, "ab") as log_file:
+                daemon_proc = _mockable_popen_for_repo_server(
+                    [
+                        *_repo_server_args(repo_server_bin, rs),
+                        f"--daemon-socket={daemon_socket}",
+                    ],
+                    stdin=subprocess.DEVNULL,
+                    stdout=log_file,
+                    stderr=log_file,
+                    start_new_session=True,
+                    env=_repo_server_env(blob_cache_dir),
+                )
+        if time.monotonic() > deadline:  # pragma: no cover
+            raise TimeoutError(f"No `repo-server` daemon at {daemon_socket}")
+        time.sleep(0.1)
+
+
+@contextmanager
+def _serve_via_repo_server_daemon(
+    repo_server_bin: Path,
+    servers: List[RepoServer],
+    daemon_dir: Path,
+    blob_cache_dir: Optional[Path] = None,
+) -> List[RepoServer]:
+    """
+    Hands the listening sockets of `servers`, which must all be for the
+    same snapshot, to that snapshot's `repo-server` daemon.  The daemon
+    serves them until we exit the context.
+
+    The daemon outlives us, and is shared by all containers with the same
+    snapshot, so the snapshot must be in a persistent layer, not in a
+    container's temporary snapshot of it.
+
+    Each `blob_cache_dir` gets its own daemon.
+    """
+    snapshot_dir = servers[0].rpm_repo_snapshot
+    assert all(rs.rpm_repo_snapshot == snapshot_dir for rs in servers)
+    # The daemon is per-snapshot, but Unix socket paths are limited to 108
+    # bytes, so we cannot just use the snapshot's path.  A snapshot rebuilt
+    # at the same path gets a new DB, and thus a new daemon, instead of
+    # being served from a stale index.
+    db = os.stat(snapshot_dir / "snapshot/snapshot.sql3")
+    daemon_key = b"\0".join(
+        [
+            snapshot_dir.realpath(),
+            f"{db.st_ino} {db.st_mtime_ns} {db.st_size}".encode(),
+            blob_cache_dir.realpath() if blob_cache_dir else b"",
+        ]
+    )
+    daemon_socket = daemon_dir / (
+        hashlib.sha256(daemon_key).hexdigest()[:16] + ".sock"
+    )
+    with ExitStack() as stack:
+        for rs in servers:
+            stack.enter_context(rs.sock)
+            _bind_and_listen(rs)
+        # A daemon that is exiting due to idleness may drop the connection
+        # before replying, so retry.
+        for _attempt in range(3):  # pragma: no branch
+            conn = stack.enter_context(
+                _connect_to_repo_server_daemon(
+                    repo_server_bin, servers[0], daemon_socket, blob_cache_dir
+                )
+            )
+            conn.settimeout(FD_UNIX_SOCK_TIMEOUT)
+            try:
+                send_fds(conn, [rs.sock.fileno() for rs in servers])
+                if conn.recv(128):
+                    break
+            except (BrokenPipeError, ConnectionResetError):  # pragma: no cover
+                pass
+            conn.close()  # pragma: no cover
+        else:  # pragma: no cover
+            raise RuntimeError(f"`repo-server` daemon {daemon_socket} failed")
+        # The daemon has its own copies of the sockets now.
+        for rs in servers:
+            rs.sock.close()
+        # pyre-fixme[7]: Expected `List[RepoServer]` but got
+        #  `Generator[List[RepoServer], None, None]`.
+        yield servers
+    # Closing `conn` tells the daemon to stop serving our sockets.
+
+
 @contextmanager
 def launch_repo_servers_for_netns(
-    *, target_pid: int, snapshot_dir: Path, repo_server_bin: Path
+    *,
+    target_pid: int,
+    snapshot_dir: Path,
+    repo_server_bin: Path,
+    blob_cache_dir: Optional[Path] = None,
+    daemon_snapshot_dir: Optional[Path] = None,
 ) -> List[RepoServer]:
     """
     Creates sockets inside the supplied netns, and binds them to the
     supplied ports on localhost.
 
+    With `blob_cache_dir`, the servers share an on-host cache of verified
+    blobs with all other `repo-server`s that use the same directory.
+
+    `daemon_snapshot_dir` is a copy of `snapshot_dir` that outlives the
+    container.  When `REPO_SERVER_DAEMON_DIR_ENV` is set, the servers are
+    run by a daemon shared with other containers, which serves this copy.
+
     Yields a list of (host, port) pairs where the servers will listen.
     """
     with open(snapshot_dir / "ports-for-repo-server") as infile:
         repo_server_ports = {int(v) for v in infile.read().split() if v}
+    daemon_dir = os.environ.get(REPO_SERVER_DAEMON_DIR_ENV)
+    if daemon_dir and daemon_snapshot_dir is not None:
+        with _serve_via_repo_server_daemon(
+            daemon_snapshot_dir / "repo-server",
+            [
+                RepoServer(
+                    rpm_repo_snapshot=daemon_snapshot_dir, port=port, sock=sock
+                )
+                for sock, port in zip(
+                    _create_sockets_inside_netns(
+                        target_pid, len(repo_server_ports)
+                    ),
+                    repo_server_ports,
+                )
+            ],
+            Path(daemon_dir),
+            blob_cache_dir,
+        ) as servers:
+            log.debug(f"Serving {servers} in {target_pid}'s netns via daemon")
+            # pyre-fixme[7]: Expected `List[RepoServer]` but got
+            #  `Generator[List[RepoServer], None, None]`.
+            yield servers
+        return
     with ExitStack() as stack:
         # Start a repo-server instance per port.  Give each one a socket
         # bound to the loopback inside the supplied netns.  We don't
@@ -240,6 +437,7 @@ def launch_repo_servers_for_netns(
                         port=port,
                         sock=sock,
                     ),
+                    blob_cache_dir,
                 )
             )
             log.debug(f"Launched {rs} in {target_pid}'s netns")
@@ -14,6 +14,7 @@ The snapshots must already be in the container's image, and must have been
 built by the `rpm_repo_snapshot()` target, and installed via
 `install_rpm_repo_snapshot()`.
 """
+import os
 import textwrap
 from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
@@ -21,7 +22,7 @@ from io import BytesIO
 from typing import Iterable, List, Optional, Tuple
 
 from antlir.common import get_logger, pipe
-from antlir.fs_utils import Path
+from antlir.fs_utils import ANTLIR_DIR, Path
 from antlir.nspawn_in_subvol.args import PopenArgs, _NspawnOpts
 from antlir.nspawn_in_subvol.plugin_hooks import (
     _NspawnSetup,
@@ -161,9 +162,45 @@ def _wrap_opts_with_container_pid_exfiltrator(
         ), cpe
 
 
+def _persistent_snapshot_dir(
+    setup: _NspawnSetup, snap_dir: Path
+) -> Optional[Path]:
+    """
+    The container's subvolume is usually a temporary snapshot, which is
+    deleted with the container, so a `repo-server` daemon that is shared by
+    containers must serve `snap_dir` from the layer that it was copied
+    from.  Returns `None` if no such layer has the same snapshot DB.
+    """
+    candidates = [setup.opts.layer.path(snap_dir)]
+    ba_path = (
+        setup.opts.subvolume_on_disk.build_appliance_path
+        if setup.opts.subvolume_on_disk
+        else None
+    )
+    # `AttachAntlirDir` copies `ANTLIR_DIR` from the build appliance.
+    if ba_path and snap_dir.startswith(ANTLIR_DIR + b"/"):
+        candidates.append(ba_path / snap_dir.strip_leading_slashes())
+    db = Path("snapshot/snapshot.sql3")
+    st = os.stat(setup.subvol.path(snap_dir / db))
+    for candidate in candidates:
+        try:
+            cst = os.stat(candidate / db)
+        except FileNotFoundError:
+            continue
+        # Snapshots & `cp --archive` preserve both of these.
+        if (cst.st_size, cst.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            return candidate
+    return None
+
+
 class RepoServers(NspawnPlugin):
-    def __init__(self, serve_rpm_snapshots: Iterable[Path]):
+    def __init__(
+        self,
+        serve_rpm_snapshots: Iterable[Path],
+        blob_cache_dir: Optional[Path] = None,
+    ):
         self._serve_rpm_snapshots = serve_rpm_snapshots
+        self._blob_cache_dir = blob_cache_dir
 
     @contextmanager
     def wrap_setup(
@@ -243,6 +280,10 @@ class RepoServers(NspawnPlugin):
                         repo_server_bin=snap_subvol.path(
                             snap_dir / "repo-server"
                         ),
+                        blob_cache_dir=self._blob_cache_dir,
+                        daemon_snapshot_dir=_persistent_snapshot_dir(
+                            setup, snap_dir
+                        ),
                     )
                 )
                 for snap_dir in serve_rpm_snapshots
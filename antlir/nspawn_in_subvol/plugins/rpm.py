@@ -145,7 +145,10 @@ def rpm_nspawn_plugins(
                     if plugin_args.snapshots_and_versionlocks
                     else []
                 ),
-                RepoServers(serve_rpm_snapshots),
+                RepoServers(
+                    serve_rpm_snapshots,
+                    plugin_args.repo_server_blob_cache_dir,
+                ),
             ]
             if serve_rpm_snapshots
             else ()
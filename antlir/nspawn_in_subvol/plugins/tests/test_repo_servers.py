@@ -6,16 +6,23 @@
 
 import functools
 import logging
+import os
 import re
+import shutil
+import socket
 import subprocess
 import tempfile
+import threading
 import unittest
 from contextlib import contextmanager
 
 from antlir.common import check_popen_returncode
+from antlir.fs_utils import Path, temp_dir
+from antlir.rpm import repo_server
 from antlir.tests.flavor_helpers import get_rpm_installers_supported
 
 from .. import launch_repo_servers
+from ..repo_servers import _persistent_snapshot_dir
 from .rpm_base import RpmNspawnTestBase
 
 
@@ -93,6 +100,30 @@ class TestImpl:
     def test_repo_servers_no_antlir_build_appliance(self):
         self._check_repo_servers("no-antlir-build-appliance")
 
+    def test_repo_servers_blob_cache(self):
+        with temp_dir() as td, unittest.mock.patch.object(
+            launch_repo_servers,
+            "_mockable_popen_for_repo_server",
+            side_effect=subprocess.Popen,
+        ) as mock_popen:
+            self._check_yum_dnf_ret(
+                "mice 0.1 a\n",
+                br"Installing\s+: rpm-test-mice-0.1-a.x86_64",
+                self._yum_or_dnf_install(
+                    self._PROG,
+                    "rpm-test-mice",
+                    extra_args=[f"--repo-server-blob-cache-dir={td}"],
+                ),
+            )
+            self.assertEqual(1, len(mock_popen.call_args_list))
+            for call in mock_popen.call_args_list:
+                self.assertEqual(
+                    td.decode(),
+                    call[1]["env"]["ANTLIR_REPO_SERVER_BLOB_CACHE_DIR"],
+                )
+            # The server cached the blobs it fetched from storage.
+            self.assertNotEqual([], (td / "blobs").listdir())
+
 
 class DnfRepoServersTestCase(TestImpl, RpmNspawnTestBase):
     _PROG = "dnf"
@@ -100,3 +131,131 @@ class DnfRepoServersTestCase(TestImpl, RpmNspawnTestBase):
 
 class YumRepoServersTestCase(TestImpl, RpmNspawnTestBase):
     _PROG = "yum"
+
+
+class _FakeDaemonProc:
+    "Runs the `repo-server` daemon loop on a thread, in place of `Popen`."
+
+    def __init__(self, args, **kwargs):
+        prefix = "--daemon-socket="
+        assert args[-1].startswith(prefix), args
+        daemon_socket = Path(args[-1][len(prefix) :])
+        self._thread = threading.Thread(
+            target=repo_server._run_daemon,
+            args=(
+                daemon_socket,
+                lambda sock: repo_server.repo_server(sock, {}, None),
+            ),
+            kwargs={"idle_timeout": 1},
+            daemon=True,
+        )
+        self._thread.start()
+        self.returncode = None
+
+    def poll(self):
+        return None if self._thread.is_alive() else self.wait()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        self.returncode = 0
+        return 0
+
+
+class RepoServerDaemonTestCase(unittest.TestCase):
+    def _write_db(self, snapshot_dir: Path, content: str):
+        with open(snapshot_dir / "snapshot/snapshot.sql3", "w") as f:
+            f.write(content)
+
+    def _serve(self, snapshot_dir: Path, daemon_dir: Path):
+        return launch_repo_servers._serve_via_repo_server_daemon(
+            Path("/fake/repo-server"),
+            [
+                launch_repo_servers.RepoServer(
+                    rpm_repo_snapshot=snapshot_dir,
+                    port=0,
+                    sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                )
+            ],
+            daemon_dir,
+        )
+
+    def test_serve_via_repo_server_daemon(self):
+        with temp_dir() as td, unittest.mock.patch.object(
+            launch_repo_servers,
+            "_mockable_popen_for_repo_server",
+            side_effect=_FakeDaemonProc,
+        ) as mock_popen:
+            snapshot_dir = td / "snapshot_dir"
+            os.makedirs(snapshot_dir / "snapshot")
+            self._write_db(snapshot_dir, "db")
+            os.mkdir(td / "daemons")
+
+            with self._serve(snapshot_dir, td / "daemons"):
+                self.assertEqual(1, len(mock_popen.call_args_list))
+                # A second client reuses the running daemon
+                with self._serve(snapshot_dir, td / "daemons"):
+                    self.assertEqual(1, len(mock_popen.call_args_list))
+
+            # A snapshot rebuilt at the same path gets a new daemon
+            self._write_db(snapshot_dir, "new db")
+            with self._serve(snapshot_dir, td / "daemons"):
+                self.assertEqual(2, len(mock_popen.call_args_list))
+            (sock1, sock2) = sorted(
+                n for n in (td / "daemons").listdir() if n.endswith(b".sock")
+            )
+
+            # A socket left behind by a dead daemon gets replaced
+            os.mkdir(td / "dead")
+            for sock_name in (sock1, sock2):
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.bind(td / "dead" / sock_name)
+            with self._serve(snapshot_dir, td / "dead"):
+                self.assertEqual(3, len(mock_popen.call_args_list))
+
+
+class PersistentSnapshotDirTestCase(unittest.TestCase):
+    def _subvol(self, root: Path):
+        return unittest.mock.Mock(
+            path=lambda p=b"/": root / Path(p).strip_leading_slashes()
+        )
+
+    def _write_db(self, root: Path, snap_dir: Path, content: str):
+        db_dir = root / snap_dir.strip_leading_slashes() / "snapshot"
+        os.makedirs(db_dir)
+        with open(db_dir / "snapshot.sql3", "w") as f:
+            f.write(content)
+
+    def test_persistent_snapshot_dir(self):
+        snap_dir = Path("/__antlir__/rpm/repo-snapshot/default")
+        with temp_dir() as td:
+            for name in ["container", "layer", "ba"]:
+                os.mkdir(td / name)
+            self._write_db(td / "container", snap_dir, "db")
+            setup = unittest.mock.Mock(subvol=self._subvol(td / "container"))
+            setup.opts.layer = self._subvol(td / "layer")
+            setup.opts.subvolume_on_disk.build_appliance_path = td / "ba"
+
+            # Neither the layer nor the build appliance has the snapshot.
+            self.assertIsNone(_persistent_snapshot_dir(setup, snap_dir))
+
+            # A different snapshot at the same path does not count.
+            self._write_db(td / "ba", snap_dir, "other db")
+            self.assertIsNone(_persistent_snapshot_dir(setup, snap_dir))
+
+            # The container's snapshot is a copy of the layer's.
+            shutil.copytree(
+                td / "container/__antlir__", td / "layer/__antlir__"
+            )
+            self.assertEqual(
+                td / "layer" / snap_dir.strip_leading_slashes(),
+                _persistent_snapshot_dir(setup, snap_dir),
+            )
+
+            # `AttachAntlirDir` copied the snapshot from the build appliance.
+            shutil.rmtree(td / "ba/__antlir__")
+            shutil.rmtree(td / "layer/__antlir__")
+            shutil.copytree(td / "container/__antlir__", td / "ba/__antlir__")
+            self.assertEqual(
+                td / "ba" / snap_dir.strip_leading_slashes(),
+                _persistent_snapshot_dir(setup, snap_dir),
+            )
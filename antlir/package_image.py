@@ -236,6 +236,9 @@ from .subvol_utils import Subvol
 class _Opts(NamedTuple):
     build_appliance: Optional[Subvol]
     loopback_opts: loopback_opts_t
+    # See `--btrfs-waste-factor` and `--no-btrfs-grow-during-receive`.
+    btrfs_waste_factor: Optional[float] = None
+    btrfs_grow_during_receive: bool = True
 
 
 class Format:
@@ -320,8 +323,18 @@ class BtrfsImage(Format, format_name="btrfs"):
     """
 
     def package_full(self, subvol: Subvol, output_path: str, opts: _Opts):
+        waste_factor = opts.btrfs_waste_factor
+        if waste_factor is None:
+            # Growing the loopback during `receive` makes retries rare, so
+            # we can afford a much tighter initial size estimate.  2% still
+            # covers the btrfs overhead of most images, which saves grow
+            # cycles.  Without growth, keep the conservative default.
+            waste_factor = 1.02 if opts.btrfs_grow_during_receive else 1.15
         subvol.mark_readonly_and_send_to_new_loopback(
-            output_path, loopback_opts=opts.loopback_opts
+            output_path,
+            loopback_opts=opts.loopback_opts,
+            waste_factor=waste_factor,
+            grow_during_receive=opts.btrfs_grow_during_receive,
         )
 
 
@@ -545,6 +558,21 @@ def parse_args(argv):
     parser.add_argument(
         "--build-appliance", help="Build appliance layer to use when packaging"
     )
+    parser.add_argument(
+        "--btrfs-waste-factor",
+        type=float,
+        help="For the `btrfs` format, size the loopback at this multiple of "
+        "the estimated content size.  Defaults to 1.02 when growing the "
+        "loopback during `receive`, and to 1.15 otherwise.",
+    )
+    parser.add_argument(
+        "--no-btrfs-grow-during-receive",
+        dest="btrfs_grow_during_receive",
+        action="store_false",
+        help="For the `btrfs` format, do not grow the loopback as `btrfs "
+        "receive` fills it.  Instead, retry the whole send-receive with a "
+        "larger loopback when it runs out of space.",
+    )
     # Future: To add support for incremental send-streams, we'd want to
     # use this (see `--ancestor-jsons` in `image/package/new.bzl`)
     #
@@ -603,6 +631,8 @@ def package_image(argv):
             loopback_opts=args.loopback_opts
             if args.loopback_opts
             else loopback_opts_t(),
+            btrfs_waste_factor=args.btrfs_waste_factor,
+            btrfs_grow_during_receive=args.btrfs_grow_during_receive,
         ),
     )
     # Paranoia: images are read-only after being built
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+`repo-server` verifies every blob that it reads from `Storage`, but each
+server only lives as long as one container.  With remote storage, every
+image build would then re-download the same RPMs.
+
+`BlobCache` is an on-host directory of blobs that some `repo-server`
+already verified, keyed by their checksum and size.  It is shared by all
+`repo-server` processes on the host, so these only read a blob from
+`Storage` once, and then serve it from local disk via `sendfile`.
+
+Safety notes:
+
+  - Only blobs that passed verification are added.  The blob is written
+    to a temporary file, which is `fsync`ed before it is atomically
+    renamed into place, so a crash never leaves a truncated entry.
+
+  - The cache is content-addressed, so concurrent writers of the same
+    blob are harmless, and a blob may be shared by many snapshots.
+
+  - The total size is bounded by `max_bytes`.  Reads bump an entry's
+    mtime, and once a process's running estimate of the total passes
+    `max_bytes`, it takes an `flock` on the cache, and evicts the least
+    recently used entries until the cache is down to `_LOW_WATER_RATIO`
+    of `max_bytes`.  Between scans, several processes writing at once
+    may overshoot the bound by a little.
+
+Deleting the cache directory is always safe.
+"""
+import fcntl
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from antlir.common import get_logger
+from antlir.fs_utils import Path
+
+from .common import Checksum
+
+
+log = get_logger()
+
+# After an eviction, the cache is at most this fraction of `max_bytes`, so
+# that we don't rescan the cache on every new blob.
+_LOW_WATER_RATIO = 0.9
+
+
+class BlobCacheWriter:
+    """
+    Accumulates one blob in a temporary file.  A blob that fails to be
+    written, e.g. due to `ENOSPC`, is silently not cached, since the cache
+    is just an optimization.
+    """
+
+    def __init__(self, cache: "BlobCache", path: Path, size: int):
+        self._cache = cache
+        self._path = path
+        self._size = size
+        self._tmp: Optional[BinaryIO] = None
+        try:
+            self._tmp = tempfile.NamedTemporaryFile(
+                dir=cache.tmp_dir, delete=False
+            )
+        except OSError as ex:  # pragma: no cover
+            log.warning(f"Not caching {path}: {ex}")
+
+    def write(self, chunk: bytes) -> None:
+        if self._tmp is None:
+            return
+        try:
+            self._tmp.write(chunk)
+        except OSError as ex:  # pragma: no cover
+            log.warning(f"Not caching {self._path}: {ex}")
+            self._discard()
+
+    def commit(self) -> None:
+        "Call only once the blob was fully written and verified."
+        if self._tmp is None:
+            return
+        try:
+            self._tmp.flush()
+            assert os.fstat(self._tmp.fileno()).st_size == self._size
+            os.fsync(self._tmp.fileno())
+            os.fchmod(self._tmp.fileno(), 0o444)
+            self._tmp.close()
+            os.makedirs(self._path.dirname(), exist_ok=True)
+            os.rename(self._tmp.name, self._path)
+        except OSError as ex:  # pragma: no cover
+            log.warning(f"Not caching {self._path}: {ex}")
+            self._discard()
+            return
+        self._tmp = None
+        self._cache._added(self._size)
+
+    def _discard(self) -> None:
+        if self._tmp is None:
+            return
+        self._tmp.close()
+        try:
+            os.unlink(self._tmp.name)
+        except FileNotFoundError:  # pragma: no cover
+            pass
+        self._tmp = None
+
+
+class BlobCache:
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self.tmp_dir = self._cache_dir / "tmp"
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self._cache_dir / "blobs", exist_ok=True)
+        # Guards the counters below, since `repo-server` is threaded.
+        self._lock = threading.Lock()
+        # Unknown until the first scan of the cache.
+        self._approx_bytes: Optional[int] = None
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def _blob_path(self, checksum: str, size: int) -> Path:
+        cs = Checksum.from_string(checksum)
+        # The checksum comes from a snapshot DB, but let's not allow it to
+        # write outside of the cache.
+        assert re.fullmatch("[a-z0-9]+", cs.algorithm), checksum
+        assert re.fullmatch("[a-f0-9]+", cs.hexdigest), checksum
+        return (
+            self._cache_dir
+            / "blobs"
+            / cs.algorithm
+            / cs.hexdigest[:2]
+            / f"{cs.hexdigest}-{size}"
+        )
+
+    def open(self, checksum: str, size: int) -> Optional[BinaryIO]:
+        "Returns the open blob if it is cached, or None."
+        path = self._blob_path(checksum, size)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.num_misses += 1
+            return None
+        # Cheap paranoia, the entry should never change after `commit`.
+        if os.fstat(f.fileno()).st_size != size:  # pragma: no cover
+            f.close()
+            log.warning(f"Ignoring cached {path} of the wrong size")
+            return None
+        try:
+            os.utime(path)  # Most recently used
+        except OSError:  # pragma: no cover
+            pass  # A cache shared between users, the LRU order is coarser.
+        with self._lock:
+            self.num_hits += 1
+        return f
+
+    @contextmanager
+    def writer(self, checksum: str, size: int) -> Iterator[BlobCacheWriter]:
+        "Uncommitted blobs are discarded on exit."
+        w = BlobCacheWriter(self, self._blob_path(checksum, size), size)
+        try:
+            yield w
+        finally:
+            w._discard()
+
+    def _added(self, size: int) -> None:
+        with self._lock:
+            if (
+                self._approx_bytes is not None
+                and self._approx_bytes + size <= self._max_bytes
+            ):
+                self._approx_bytes += size
+                return
+            self._approx_bytes = self._evict()
+
+    def _gen_blobs(self) -> Iterator[Tuple[int, int, Path]]:
+        "Yields (mtime_ns, size, path) for each cached blob."
+        for dirpath, _, filenames in os.walk(self._cache_dir / "blobs"):
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:  # pragma: no cover
+                    continue  # Evicted by another process
+                yield st.st_mtime_ns, st.st_size, path
+
+    def _evict(self) -> int:
+        "Returns the size of the cache after eviction."
+        with open(self._cache_dir / "lock", "a") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            blobs: List[Tuple[int, int, Path]] = sorted(self._gen_blobs())
+            total = sum(size for _, size, _ in blobs)
+            if total <= self._max_bytes:
+                return total
+            low_water = int(self._max_bytes * _LOW_WATER_RATIO)
+            num_evicted = 0
+            for _, size, path in blobs:
+                if total <= low_water:
+                    break
+                try:
+                    # `repo-server`s that have the blob open can still
+                    # finish sending it.
+                    os.unlink(path)
+                except FileNotFoundError:  # pragma: no cover
+                    pass
+                total -= size
+                num_evicted += 1
+            log.info(
+                f"Evicted {num_evicted} blobs from {self._cache_dir}, "
+                f"{total} bytes remain"
+            )
+            return total
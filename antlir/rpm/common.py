@@ -33,12 +33,14 @@ def snapshot_subdir(snapshot_dir: Path) -> Path:
     return snapshot_dir / "snapshot"
 
 
-def readonly_snapshot_db(snapshot_dir: Path) -> sqlite3.Connection:
-    "Returns a read-only snapshot DB connection"
+def readonly_snapshot_db(
+    snapshot_dir: Path, **kwargs
+) -> sqlite3.Connection:
+    "Returns a read-only snapshot DB connection, `kwargs` go to `connect`"
     db_path = snapshot_subdir(snapshot_dir) / "snapshot.sql3"
     if not db_path.exists():  # The SQLite error lacks the path.
         raise FileNotFoundError(db_path, "RPM snapshot lacks SQL3 DB")
-    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, **kwargs)
 
 
 class DecorateContextEntry(Generic[T], AbstractContextManager):
@@ -63,6 +63,18 @@ def add_standard_args(parser):
         required=True,
         help=("Amount of threads across which the downloads will run. "),
     )
+    parser.add_argument(  # Pass this to `RepoDownloader`
+        "--max-connections-per-host",
+        type=int,
+        help="Limits the concurrent downloads from any one host. By default, "
+        "only `--threads` limits them.",
+    )
+    parser.add_argument(  # Pass this to `RepoDownloader`
+        "--content-addressed-storage",
+        action="store_true",
+        help="Store RPMs & repodata under IDs derived from their checksums, "
+        "skipping the upload of blobs that are already stored.",
+    )
     parser.add_argument(  # Pass this to `init_logging`
         "--debug",
         action="store_true",
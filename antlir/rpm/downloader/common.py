@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import sys
+import threading
 import time
 import traceback
 import urllib.parse
@@ -21,6 +22,7 @@ from typing import (
     Mapping,
     NamedTuple,
     Optional,
+    Tuple,
     Union,
 )
 
@@ -37,6 +39,7 @@ from antlir.rpm.repo_snapshot import (
     MaybeStorageID,
 )
 from antlir.rpm.storage import Storage
+from antlir.rpm.storage.storage import CONTENT_ID_ALGORITHMS
 from antlir.rpm.yum_dnf_conf import YumDnfConfRepo
 
 
@@ -48,6 +51,12 @@ BUFFER_BYTES = 2 ** 19
 DB_MAX_RETRY_S = [2 ** i for i in range(8)]  # 255 sec == 4m15s
 log = get_logger()
 
+# Shared by all downloads in this process, see `_host_connection_slot`.
+_HOST_AND_LIMIT_TO_SEMAPHORE: Dict[
+    Tuple[str, int], threading.BoundedSemaphore
+] = {}
+_HOST_SEMAPHORES_LOCK = threading.Lock()
+
 
 class LogOp(Enum):
     RPM_DOWNLOAD = auto()
@@ -89,7 +98,13 @@ class DownloadConfig(NamedTuple):
     db_cfg: Dict[str, str]
     storage_cfg: Dict[str, str]
     rpm_shard: RpmShard
+    # The total concurrency of the downloads, across all repos.
     threads: int
+    # If set, caps the concurrent downloads from any one host.
+    max_connections_per_host: Optional[int] = None
+    # Store blobs under IDs derived from their checksums, skipping the
+    # upload, and sometimes the download, of already-stored blobs.
+    content_addressed_storage: bool = False
 
     def new_db_conn(
         self, *, readonly: bool, force_master: bool = True
@@ -111,6 +126,15 @@ class DownloadConfig(NamedTuple):
     def new_storage(self):
         return Storage.from_json(self.storage_cfg)
 
+    def content_id(self, checksum: Checksum) -> Optional[str]:
+        "For `Storage.writer`, if content-addressed and the hash is strong."
+        if (
+            self.content_addressed_storage
+            and checksum.algorithm in CONTENT_ID_ALGORITHMS
+        ):
+            return str(checksum)
+        return None
+
 
 # Gets incrementally populated throughout repo downloading; used to carry info
 # through the concurrent downloads until the final repo snapshot is built
@@ -182,12 +206,46 @@ def timeit(callback: Callable):
 
 
 @contextmanager
-def download_resource(repo_url: str, relative_url: str) -> Iterator[BytesIO]:
+def _host_connection_slot(
+    url: str, max_connections: Optional[int]
+) -> Iterator[None]:
+    "Blocks while `max_connections` downloads from `url`'s host are open."
+    if not max_connections:
+        yield
+        return
+    key = (urllib.parse.urlparse(url).netloc, max_connections)
+    with _HOST_SEMAPHORES_LOCK:
+        semaphore = _HOST_AND_LIMIT_TO_SEMAPHORE.get(key)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(max_connections)
+            _HOST_AND_LIMIT_TO_SEMAPHORE[key] = semaphore
+    with semaphore:
+        yield
+
+
+@contextmanager
+def download_resource(
+    repo_url: str,
+    relative_url: str,
+    *,
+    threads: Optional[int] = None,
+    max_connections_per_host: Optional[int] = None,
+) -> Iterator[BytesIO]:
+    """
+    `threads` is how many downloads may run concurrently, which sizes the
+    pool of keep-alive connections to each host.
+    """
     if not repo_url.endswith("/"):
         repo_url += "/"  # `urljoin` needs a trailing / to work right
     assert not relative_url.startswith("/")
+    url = urllib.parse.urljoin(repo_url, relative_url)
+    pool_size = threads
+    if max_connections_per_host and threads:
+        pool_size = min(threads, max_connections_per_host)
     try:
-        with open_url(urllib.parse.urljoin(repo_url, relative_url)) as input:
+        with _host_connection_slot(url, max_connections_per_host), open_url(
+            url, pool_size=pool_size
+        ) as input:
             yield input
     except requests.exceptions.HTTPError as ex:
         # E.g. we can see 404 errors if packages were deleted
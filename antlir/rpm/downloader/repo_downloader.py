@@ -19,6 +19,14 @@ with `download_repos` being the driver that aggregates the thread results and
 returns the final list of snapshots. Additionally, the single driver thread
 performs all writes to mitigate potential concurrency issues with SQLite.
 
+The repomds of all repos are downloaded first, since we check that they are
+consistent, see `gen_repomds_from_repos`.  After that, the repodatas & RPMs
+of all repos are downloaded as one pipeline on a shared thread pool of
+`cfg.threads` workers, see `_gen_pipelined_downloads`.  A repo's RPM
+downloads start as soon as its primary repodata is parsed, without waiting
+for other repos, so the pool does not idle at the tail of each repo.
+`cfg.max_connections_per_host` optionally bounds the downloads from one host.
+
 `download_repos` returns a list of `RepoSnapshot`s containing descriptions of
 the stored objects. The dictionary keys are either "storage IDs" from the
 supplied `Storage` class, or `ReportableError` instances for those that were
@@ -45,15 +53,18 @@ as opposed to a sheared mix of the repo at various points in time) if:
   - `repomd.xml` is replaced atomically (i.e.  via `rename`) after making
     available all the new RPMs & repodatas.
 """
-from typing import Iterable, Iterator, Tuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, FrozenSet, Iterable, Iterator, Set, Tuple, Union
 
 from antlir.common import get_logger, not_none
 from antlir.rpm.downloader.common import DownloadConfig, DownloadResult
-from antlir.rpm.downloader.repodata_downloader import gen_repodatas_from_repomds
+from antlir.rpm.downloader.repodata_downloader import RepodataDownloads
 from antlir.rpm.downloader.repomd_downloader import gen_repomds_from_repos
-from antlir.rpm.downloader.rpm_downloader import gen_rpms_from_repodatas
+from antlir.rpm.downloader.rpm_downloader import RpmDownloads
+from antlir.rpm.open_url import log_host_stats
 from antlir.rpm.repo_sizer import RepoObjectVisitor
 from antlir.rpm.repo_snapshot import RepoSnapshot
+from antlir.rpm.storage.storage import dedup_stats
 from antlir.rpm.yum_dnf_conf import YumDnfConfRepo
 
 
@@ -86,6 +97,63 @@ def visit_results(
                 visitor.visit_rpm(rpm)
 
 
+def _gen_pipelined_downloads(
+    repomd_results: Iterable[DownloadResult],
+    cfg: DownloadConfig,
+    all_snapshot_universes: FrozenSet[str],
+) -> Iterator[DownloadResult]:
+    """
+    Yields each repo's `DownloadResult` once its repodatas & RPMs are
+    downloaded.  All repos share one thread pool.  Each repo's repodata
+    downloads are queued up front, so they run ahead of RPM downloads, which
+    are queued as each primary repodata is parsed.
+
+    The futures' results are handled on this thread, so that the DB writes
+    stay single-threaded.
+    """
+    Stage = Union[RepodataDownloads, RpmDownloads]
+    stage_to_futures: Dict[Stage, Set[Future]] = {}
+    future_to_stage: Dict[Future, Stage] = {}
+    with ThreadPoolExecutor(max_workers=cfg.threads) as executor:
+
+        def start(stage: Stage) -> None:
+            futures = set(stage.submit(executor))
+            stage_to_futures[stage] = futures
+            future_to_stage.update((f, stage) for f in futures)
+
+        try:
+            for res in repomd_results:
+                start(RepodataDownloads(res, cfg))
+            while stage_to_futures:
+                finished = [s for s, fs in stage_to_futures.items() if not fs]
+                for stage in finished:
+                    del stage_to_futures[stage]
+                    res = stage.result()
+                    if isinstance(stage, RepodataDownloads):
+                        start(RpmDownloads(res, cfg, all_snapshot_universes))
+                    else:
+                        yield res
+                if not future_to_stage:
+                    continue
+                done, _ = wait(future_to_stage, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = future_to_stage.pop(future)
+                    stage_to_futures[stage].remove(future)
+                    stage.handle(future)
+        except BaseException:
+            # Don't wait for the queued downloads of a failed snapshot.
+            for future in future_to_stage:
+                future.cancel()
+            # But do record the RPMs that are already in storage.
+            for stage, futures in stage_to_futures.items():
+                if isinstance(stage, RpmDownloads):
+                    try:
+                        stage.abort(futures)
+                    except Exception:  # pragma: no cover
+                        log.exception("While recording downloaded RPMs")
+            raise
+
+
 def download_repos(
     repos_and_universes: Iterable[Tuple[YumDnfConfRepo, str]],
     *,
@@ -97,13 +165,20 @@ def download_repos(
         rw_repo_db.ensure_tables_exist()
         rw_repo_db.commit()
 
-    # Concurrently download repomds, repodatas and RPMs. Materialize the
-    # generators to aggregate the results between each successive step.
+    # Concurrently download repomds, and then pipeline the downloads of
+    # repodatas and RPMs.  We only commit repomds once everything is done.
     repomd_results = list(gen_repomds_from_repos(repos_and_universes, cfg))
-    repodata_results = list(gen_repodatas_from_repomds(repomd_results, cfg))
     rpm_results = list(
-        gen_rpms_from_repodatas(repodata_results, cfg, all_snapshot_universes)
+        _gen_pipelined_downloads(repomd_results, cfg, all_snapshot_universes)
     )
+    # Per-host bandwidth & latency, to tell slow mirrors from slow storage.
+    log_host_stats()
+    dedup = dedup_stats()
+    if dedup.hits or dedup.misses:
+        log.info(
+            f"Content-addressed storage: {dedup.hits} blobs already stored, "
+            f"{dedup.misses} uploaded, {dedup.hit_rate:.1%} hit rate"
+        )
 
     # All downloads have completed - we now want to atomically persist repomds.
     with cfg.new_db_ctx(readonly=False) as rw_repo_db:
@@ -4,19 +4,10 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, Future
 from contextlib import ExitStack
 from types import MappingProxyType
-from typing import (
-    FrozenSet,
-    Iterable,
-    Iterator,
-    List,
-    Mapping,
-    NamedTuple,
-    Optional,
-    Tuple,
-)
+from typing import FrozenSet, List, NamedTuple, Optional
 
 from antlir.common import get_logger, retryable, set_new_key, shuffled
 from antlir.rpm.common import read_chunks
@@ -31,9 +22,8 @@ from antlir.rpm.downloader.common import (
 )
 from antlir.rpm.parse_repodata import get_rpm_parser, pick_primary_repodata
 from antlir.rpm.repo_db import RepodataTable
-from antlir.rpm.repo_objects import Repodata, RepoMetadata, Rpm
+from antlir.rpm.repo_objects import Repodata, Rpm
 from antlir.rpm.repo_snapshot import ReportableError
-from antlir.rpm.yum_dnf_conf import YumDnfConfRepo
 
 
 REPODATA_MAX_RETRY_S = [2 ** i for i in range(10)]  # 1024sec == 17m4s
@@ -92,7 +82,10 @@ def _download_repodata(
         rpm_parser = None
         if is_primary:
             # We'll parse the selected primary file to discover the RPMs.
-            rpm_parser = cm.enter_context(get_rpm_parser(repodata))
+            # Parsing in the background lets us keep reading the download.
+            rpm_parser = cm.enter_context(
+                get_rpm_parser(repodata, background=True)
+            )
 
         if storage_id:
             # Read the primary from storage as we already have an ID
@@ -102,25 +95,41 @@ def _download_repodata(
         else:
             # Nothing stored, must download - can fail due to repo updates
             infile = cm.enter_context(
-                download_resource(repo_url, repodata.location)
+                download_resource(
+                    repo_url,
+                    repodata.location,
+                    threads=cfg.threads,
+                    max_connections_per_host=cfg.max_connections_per_host,
+                )
             )
             # Want to persist the downloaded repodata into storage so that
             # future runs don't need to redownload it
-            outfile = cm.enter_context(storage.writer())
+            outfile = cm.enter_context(
+                storage.writer(content_id=cfg.content_id(repodata.checksum))
+            )
 
         log.info(f"Fetching {repodata} from {repo_url}")
-        for chunk in verify_chunk_stream(
-            read_chunks(infile, BUFFER_BYTES),
-            [repodata.checksum],
-            repodata.size,
-            repodata.location,
-        ):  # May raise a ReportableError
-            if outfile:
-                outfile.write(chunk)
+        try:
+            for chunk in verify_chunk_stream(
+                read_chunks(infile, BUFFER_BYTES),
+                [repodata.checksum],
+                repodata.size,
+                repodata.location,
+            ):  # May raise a ReportableError
+                if outfile:
+                    outfile.write(chunk)
+                if rpm_parser:
+                    assert rpms is not None
+                    try:
+                        rpms.extend(rpm_parser.feed(chunk))
+                    except Exception as ex:
+                        raise RepodataParseError((repodata.location, ex))
+        finally:
+            # Even if the download failed, a parse error explains it best.
             if rpm_parser:
                 assert rpms is not None
                 try:
-                    rpms.extend(rpm_parser.feed(chunk))
+                    rpms.extend(rpm_parser.finish())
                 except Exception as ex:
                     raise RepodataParseError((repodata.location, ex))
         # We consider `source_rpm` mandatory, since it's the best source of
@@ -142,88 +151,94 @@ def _download_repodata(
     return DownloadRepodataReturnType(repodata, False, storage_id, rpms)
 
 
-def _download_repodatas(
-    repo: YumDnfConfRepo, repomd: RepoMetadata, cfg: DownloadConfig
-) -> Tuple[FrozenSet[Rpm], Mapping[str, Repodata]]:
-    rpms = None  # We'll extract these from the primary repodata
-    storage_id_to_repodata = {}  # Newly stored **and** pre-existing
-    repodata_table = RepodataTable()
-    primary_repodata = pick_primary_repodata(repomd.repodatas)
-    log_size(
-        f"`{repo.name}` repodata weighs",
-        sum(rd.size for rd in repomd.repodatas),
-    )
-    rw_db_conn = cfg.new_db_conn(readonly=False)
-    with ThreadPoolExecutor(max_workers=cfg.threads) as executor:
-        futures = [
+class RepodataDownloads:
+    """
+    Downloads the repodatas of one repo on an executor that is shared with
+    other repos, see `repo_downloader.py`.  The driver thread calls
+    `handle` for each finished future, and thus does all the DB writes.
+
+    We explicitly omit any complex clean-up logic here, and store
+    repodatas regardless of whether they end up actually being used (i.e.
+    their referencing repomd gets committed).
+
+    The main reason for this is that the cost we pay to store these
+    dangling repodatas is fairly negligible when compared to the size of
+    the overall repos, and if we ever run into issues of these extra
+    objects taking up too much space, we can easily add a periodic job to
+    scan the db and remove any unused references. We are also able to
+    avoid implementing a lot of complex cleanup logic this way.
+    """
+
+    def __init__(self, res: DownloadResult, cfg: DownloadConfig):
+        self._res = res
+        self._cfg = cfg
+        self._rpms: Optional[FrozenSet[Rpm]] = None  # From the primary
+        self._storage_id_to_repodata = {}  # Newly stored **and** pre-existing
+        self._repodata_table = RepodataTable()
+        self._rw_db_conn = cfg.new_db_conn(readonly=False)
+
+    def submit(self, executor: Executor) -> List[Future]:
+        repomd = self._res.repomd
+        primary_repodata = pick_primary_repodata(repomd.repodatas)
+        log_size(
+            f"`{self._res.repo.name}` repodata weighs",
+            sum(rd.size for rd in repomd.repodatas),
+        )
+        return [
             executor.submit(
                 _download_repodata,
                 repodata,
-                repo_url=repo.base_url,
-                repodata_table=repodata_table,
-                cfg=cfg,
+                repo_url=self._res.repo.base_url,
+                repodata_table=self._repodata_table,
+                cfg=self._cfg,
                 is_primary=repodata is primary_repodata,
             )
             for repodata in shuffled(repomd.repodatas)
         ]
 
-        for future in as_completed(futures):
-            res = future.result()
-            if res.newly_stored:
-                # Don't want to store errors into the repo db -- this should
-                # never be the case as `newly_stored` is only True when we
-                # successfully commit a new repodata to storage
-                assert not isinstance(res.storage_id, ReportableError)
-                # This repodata was newly downloaded and stored in storage, so
-                # we store its storage_id to repo_db regardless of whether we
-                # encounter fatal errors later on that fail the snapshot; see
-                # docblock in `repo_downloader.py` for reasoning
-                storage_id = maybe_write_id(
-                    res.repodata, res.storage_id, repodata_table, rw_db_conn
-                )
-            else:
-                storage_id = res.storage_id
-            if res.maybe_rpms is not None:
-                # RPMs will only have been returned by the primary, thus we
-                # should only enter this block once
-                assert rpms is None
-                # Convert to a set to work around buggy repodatas, which
-                # list the same RPM object twice.
-                rpms = frozenset(res.maybe_rpms)
-            set_new_key(storage_id_to_repodata, storage_id, res.repodata)
-    # It's possible that for non-primary repodatas we received errors when
-    # downloading - in that case we store the error in the sqlite db, thus the
-    # dict should contain an entry for every single repodata
-    assert len(storage_id_to_repodata) == len(repomd.repodatas)
-    if not rpms:
-        log.warning(f"Repo {repo} has no RPMs")
-        rpms = frozenset()
-    return rpms, storage_id_to_repodata
-
-
-def gen_repodatas_from_repomds(
-    repomd_results: Iterable[DownloadResult], cfg: DownloadConfig
-) -> Iterator[DownloadResult]:
-    # For each downloaded repomd, concurrently download the contained
-    # repodatas. This driver runs serially, but each repomd's repodatas are
-    # downloaded in parallel. We could run this driver concurrently as well,
-    # but we're likely already saturating the network with the downloads for a
-    # single repomd and won't see a perf increase from further parallelization.
-    for res in repomd_results:
-        # We explicitly omit any complex clean-up logic here, and store
-        # repodatas regardless of whether they end up actually being used (i.e.
-        # their referencing repomd gets committed).
-        #
-        # The main reason for this is that the cost we pay to store these
-        # dangling repodatas is fairly negligible when compared to the size of
-        # the overall repos, and if we ever run into issues of these extra
-        # objects taking up too much space, we can easily add a periodic job to
-        # scan the db and remove any unused references. We are also able to
-        # avoid implementing a lot of complex cleanup logic this way.
-        rpm_set, storage_id_to_repodata = _download_repodatas(
-            res.repo, res.repomd, cfg
+    def handle(self, future: Future) -> None:
+        res = future.result()
+        if res.newly_stored:
+            # Don't want to store errors into the repo db -- this should
+            # never be the case as `newly_stored` is only True when we
+            # successfully commit a new repodata to storage
+            assert not isinstance(res.storage_id, ReportableError)
+            # This repodata was newly downloaded and stored in storage, so
+            # we store its storage_id to repo_db regardless of whether we
+            # encounter fatal errors later on that fail the snapshot; see
+            # docblock in `repo_downloader.py` for reasoning
+            storage_id = maybe_write_id(
+                res.repodata,
+                res.storage_id,
+                self._repodata_table,
+                self._rw_db_conn,
+            )
+        else:
+            storage_id = res.storage_id
+        if res.maybe_rpms is not None:
+            # RPMs will only have been returned by the primary, thus we
+            # should only enter this block once
+            assert self._rpms is None
+            # Convert to a set to work around buggy repodatas, which
+            # list the same RPM object twice.
+            self._rpms = frozenset(res.maybe_rpms)
+        set_new_key(self._storage_id_to_repodata, storage_id, res.repodata)
+
+    def result(self) -> DownloadResult:
+        "Call once every submitted future was handled."
+        # It's possible that for non-primary repodatas we received errors
+        # when downloading - in that case we store the error in the sqlite
+        # db, thus the dict should contain an entry for every single repodata
+        assert len(self._storage_id_to_repodata) == len(
+            self._res.repomd.repodatas
         )
-        yield res._replace(
-            storage_id_to_repodata=MappingProxyType(storage_id_to_repodata),
-            rpms=rpm_set,
+        rpms = self._rpms
+        if not rpms:
+            log.warning(f"Repo {self._res.repo} has no RPMs")
+            rpms = frozenset()
+        return self._res._replace(
+            storage_id_to_repodata=MappingProxyType(
+                self._storage_id_to_repodata
+            ),
+            rpms=rpms,
         )
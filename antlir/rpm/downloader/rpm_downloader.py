@@ -8,14 +8,14 @@ import hashlib
 import sys
 import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, Future
+from contextlib import ExitStack
 from functools import partial
 from types import MappingProxyType
-from typing import Dict, FrozenSet, Iterable, Iterator, Set, Tuple
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
 
 from antlir.common import get_logger, not_none, retryable, shuffled
 from antlir.rpm.common import read_chunks
-from antlir.rpm.db_connection import DBConnectionContext
 from antlir.rpm.downloader.common import (
     BUFFER_BYTES,
     DownloadConfig,
@@ -23,7 +23,6 @@ from antlir.rpm.downloader.common import (
     LogOp,
     download_resource,
     log_size,
-    maybe_write_id,
     retryable_db_ctx,
     timeit,
     verify_chunk_stream,
@@ -38,11 +37,13 @@ from antlir.rpm.repo_snapshot import (
     MutableRpmError,
     ReportableError,
 )
-from antlir.rpm.yum_dnf_conf import YumDnfConfRepo
 from urllib3.exceptions import ProtocolError  # import a name in case it changes
 
 
 RPM_MAX_RETRY_S = [2 ** i for i in range(9)]  # 512 sec ==  8m32s
+# `RpmDownloads` writes to, and queries, the repo DB in batches of this many
+# RPMs.  Each batch is a transaction.
+_DB_BATCH_SIZE = 500
 log = get_logger()
 
 
@@ -64,19 +65,12 @@ def _is_retryable_http_err(e: Exception) -> bool:
 
 def _detect_mutable_rpms(
     rpm: Rpm,
-    rpm_universe: str,  # NB: Redundant with rpm_table._universe
-    rpm_table: RpmTable,
+    rpm_universe: str,
     storage_id: str,
     all_snapshot_universes: FrozenSet[str],
-    db_conn: DBConnectionContext,
+    # All (canonical_checksum, universe) pairs for this NEVRA in the DB
+    all_canonical_checksums_and_universes: Set[Tuple[Checksum, str]],
 ) -> MaybeStorageID:
-    # Find all (canonical_checksum, universe) pairs for this NEVRA in the DB
-    with retryable_db_ctx(db_conn) as repo_db_ctx:
-        all_canonical_checksums_and_universes = set(
-            repo_db_ctx.get_rpm_canonical_checksums_per_universe(
-                rpm_table, rpm, all_snapshot_universes
-            )
-        )
     assert all_canonical_checksums_and_universes, (rpm, storage_id)
     assert all(
         c.algorithm == CANONICAL_HASH
@@ -142,11 +136,34 @@ def _download_rpm(
     rpm: Rpm, repo_url: str, rpm_table: RpmTable, cfg: DownloadConfig
 ) -> Tuple[Rpm, str]:
     "Returns a storage_id and a copy of `rpm` with a canonical checksum."
-    log.info(f"Downloading {rpm}")
     storage = cfg.new_storage()
-    with download_resource(
-        repo_url, rpm.location
-    ) as input_, storage.writer() as output:
+    content_id = cfg.content_id(rpm.checksum)
+    with ExitStack() as stack:
+        output = None
+        if content_id is not None:
+            # Content-addressed writers store nothing until `commit()`, so
+            # we can cheaply check for the blob before downloading it.
+            output = stack.enter_context(storage.writer(content_id=content_id))
+            if (
+                output.already_stored
+                and rpm.checksum.algorithm == CANONICAL_HASH
+            ):
+                log.info(f"Already stored {rpm}")
+                # The content ID is the canonical checksum, so we need not
+                # even download the RPM.
+                rpm = rpm._replace(canonical_checksum=rpm.checksum)
+                return rpm, not_none(output.commit())
+        log.info(f"Downloading {rpm}")
+        input_ = stack.enter_context(
+            download_resource(
+                repo_url,
+                rpm.location,
+                threads=cfg.threads,
+                max_connections_per_host=cfg.max_connections_per_host,
+            )
+        )
+        if output is None:
+            output = stack.enter_context(storage.writer())
         # Before committing to the DB, let's standardize on one hash
         # algorithm.  Otherwise, it might happen that two repos may
         # store the same RPM hashed with different algorithms, and thus
@@ -180,52 +197,13 @@ def _handle_rpm(
     universe: str,
     repo_url: str,
     rpm_table: RpmTable,
-    all_snapshot_universes: Set[str],
     cfg: DownloadConfig,
 ) -> Tuple[Rpm, MaybeStorageID, float]:
-    """Fetches the specified RPM from the repo DB and downloads it if needed.
+    """Downloads an RPM that `RpmDownloads` did not find in the repo DB.
 
     Returns a 3-tuple of the hydrated RPM, storage ID or exception if one was
-    caught, and bytes downloaded, if a download occurred (used for reporting).
+    caught, and bytes downloaded (used for reporting).
     """
-    # Read-after-write consitency is not needed here as this is the first read
-    # in the execution model. It's possible another concurrent snapshot is
-    # running that could race with this read, but that's not critical as this
-    # section should be idempotent, and at worst we'll duplicate some work by
-    # re-downloading the RPM.
-    with cfg.new_db_ctx(readonly=True, force_master=False) as ro_repo_db:
-        # If we get no `storage_id` back, there are 3 possibilities:
-        #  - `rpm.nevra()` was never seen before.
-        #  - `rpm.nevra()` was seen before, but it was hashed with
-        #     different algorithm(s), so we MUST download and
-        #     compute the canonical checksum to know if its contents
-        #     are the same.
-        #  - `rpm.nevra()` was seen before, **AND** one of the
-        #    prior checksums used `rpm.checksum.algorithms`, but
-        #    produced a different hash value.  In other words, this
-        #    is a `MutableRpmError`, because the same NEVRA must
-        #    have had two different contents.  We COULD explicitly
-        #    detect this error here, and avoid the download.
-        #    However, this severe error should be infrequent, and we
-        #    actually get valuable information from the download --
-        #    this lets us know whether the file is wrong or the
-        #    repodata is wrong.
-        with timeit(
-            partial(log_sample, LogOp.RPM_QUERY, rpm=rpm, universe=universe)
-        ):
-            (
-                storage_id,
-                canonical_chk,
-            ) = ro_repo_db.get_rpm_storage_id_and_checksum(rpm_table, rpm)
-    # If the RPM is already stored with a matching checksum, just update its
-    # `.canonical_checksum`. Note that `rpm` was parsed from repodata, and thus
-    # it's guaranteed to not yet have a `canonical_checksum`.
-    if storage_id:
-        rpm = rpm._replace(canonical_checksum=canonical_chk)
-        # This is a very common case and thus noisy log, so we write to debug
-        log.debug(f"Already stored under {storage_id}: {rpm}")
-        return rpm, storage_id, 0
-    # We have to download the RPM.
     try:
         with timeit(
             partial(log_sample, LogOp.RPM_DOWNLOAD, rpm=rpm, universe=universe)
@@ -236,132 +214,249 @@ def _handle_rpm(
     except ReportableError as ex:
         # This "fake" storage_id is stored in `storage_id_to_rpm`, so the
         # error is propagated to sqlite db through the snapshot. It isn't
-        # written to repo_db however as that happens in the *_impl function
+        # written to repo_db however as that happens in `RpmDownloads`.
         return rpm, ex, 0
 
 
-def _download_rpms(
-    repo: YumDnfConfRepo,
-    universe: str,
-    rpm_table: RpmTable,
-    rpms: Iterable[Rpm],
-    all_snapshot_universes: FrozenSet[str],
-    cfg: DownloadConfig,
-) -> Tuple[Dict[MaybeStorageID, Rpm], float]:
-    storage_id_to_rpm = {}
-    duplicate_rpms = 0
-    rw_db_conn = cfg.new_db_conn(readonly=False)
-    ro_db_conn = cfg.new_db_conn(readonly=True)
-    total_bytes_downloaded = 0
-    with ThreadPoolExecutor(max_workers=cfg.threads) as executor:
-        futures = [
+class RpmDownloads:
+    """
+    Downloads the RPMs of one repo, whose primary repodata was parsed, on
+    an executor that is shared with other repos, see `repo_downloader.py`.
+    The driver thread calls `submit`, `handle` and `result`, and thus does
+    all the DB queries & writes.
+
+    A repo can have 50k RPMs, so per-RPM DB round-trips would dominate the
+    snapshot time.  Instead, `submit` looks up the whole repo's RPMs with a
+    few bulk queries, and only downloads those that are missing.  RPMs are
+    then written to the DB, and checked for mutable contents, in batches of
+    `_DB_BATCH_SIZE`, each with its own commit.  If the snapshot fails,
+    `abort` still writes the pending batch, since its blobs are already in
+    storage.
+    """
+
+    def __init__(
+        self,
+        res: DownloadResult,
+        cfg: DownloadConfig,
+        all_snapshot_universes: FrozenSet[str],
+    ):
+        self._res = res
+        self._cfg = cfg
+        self._all_snapshot_universes = all_snapshot_universes
+        self._rpm_table = RpmTable(res.repo_universe)
+        self._rpms = not_none(res.rpms, "rpms")
+        self._repo_weight_bytes = sum(r.size for r in self._rpms)
+        self._storage_id_to_rpm: Dict[MaybeStorageID, Rpm] = {}
+        self._duplicate_rpms = 0
+        self._total_bytes_downloaded = 0
+        self._rw_db_conn = cfg.new_db_conn(readonly=False)
+        self._ro_db_conn = cfg.new_db_conn(readonly=True)
+        self._start_t = time.time()
+        # Valid storage IDs that are not yet processed by `_write_batch`
+        self._unwritten: List[Tuple[Rpm, str]] = []
+
+    def submit(self, executor: Executor) -> List[Future]:
+        log_size(
+            f"`{self._res.repo.name}` has {len(self._rpms)} RPMs weighing",
+            self._repo_weight_bytes,
+        )
+        self._start_t = time.time()
+        shard_rpms = [r for r in self._rpms if self._cfg.rpm_shard.in_shard(r)]
+        # Read-after-write consistency is not needed here as this is the
+        # first read in the execution model. It's possible another
+        # concurrent snapshot is running that could race with this read, but
+        # that's not critical as the writes are idempotent, and at worst
+        # we'll duplicate some work by re-downloading the RPM.
+        with timeit(
+            partial(
+                log_sample, LogOp.RPM_QUERY, universe=self._res.repo_universe
+            )
+        ), self._cfg.new_db_ctx(
+            readonly=True, force_master=False
+        ) as ro_repo_db:
+            # If an RPM is not found, there are 3 possibilities:
+            #  - `rpm.nevra()` was never seen before.
+            #  - `rpm.nevra()` was seen before, but it was hashed with
+            #     different algorithm(s), so we MUST download and
+            #     compute the canonical checksum to know if its contents
+            #     are the same.
+            #  - `rpm.nevra()` was seen before, **AND** one of the
+            #    prior checksums used `rpm.checksum.algorithms`, but
+            #    produced a different hash value.  In other words, this
+            #    is a `MutableRpmError`, because the same NEVRA must
+            #    have had two different contents.  We COULD explicitly
+            #    detect this error here, and avoid the download.
+            #    However, this severe error should be infrequent, and we
+            #    actually get valuable information from the download --
+            #    this lets us know whether the file is wrong or the
+            #    repodata is wrong.
+            rpm_to_stored = ro_repo_db.get_rpm_storage_ids_and_checksums(
+                self._rpm_table, shard_rpms
+            )
+        to_download = []
+        for rpm in shard_rpms:
+            stored = rpm_to_stored.get(rpm)
+            if stored is None:
+                to_download.append(rpm)
+                continue
+            # If the RPM is already stored with a matching checksum, just
+            # update its `.canonical_checksum`.  Note that `rpm` was parsed
+            # from repodata, and thus it does not yet have one.
+            storage_id, canonical_chk = stored
+            # We still write it, in case it was found via its canonical
+            # checksum, and this repo uses another checksum.
+            self._add_unwritten(
+                rpm._replace(canonical_checksum=canonical_chk), storage_id
+            )
+        log.info(
+            f"`{self._res.repo.name}` has {len(shard_rpms) - len(to_download)}"
+            f" RPMs in the repo DB, will download {len(to_download)}"
+        )
+        return [
             executor.submit(
                 _handle_rpm,
                 rpm,
-                universe,
-                repo.base_url,
-                rpm_table,
-                all_snapshot_universes,
-                cfg,
+                self._res.repo_universe,
+                self._res.repo.base_url,
+                self._rpm_table,
+                self._cfg,
             )
             # Download in random order to reduce collisions from racing writers.
-            for rpm in shuffled(rpms)
-            if cfg.rpm_shard.in_shard(rpm)
+            for rpm in shuffled(to_download)
         ]
-        for future in as_completed(futures):
+
+    def handle(self, future: Future) -> None:
+        try:
             rpm, res_storage_id, bytes_dl = future.result()
-            total_bytes_downloaded += bytes_dl
+            self._total_bytes_downloaded += bytes_dl
+            if isinstance(res_storage_id, ReportableError):
+                self._add_rpm(rpm, res_storage_id)
+            else:
+                self._add_unwritten(rpm, res_storage_id)
+        except BaseException:
+            self._log_repo_download()
+            raise
+
+    def abort(self, futures: Iterable[Future]) -> None:
+        """
+        Call when the snapshot fails, with the futures not yet handled.  We
+        store the already-stored blobs in repo_db regardless of the fatal
+        error; see docblock in `repo_downloader.py` for reasoning.  Blobs
+        from downloads that were still running are stored too, so the
+        caller must first cancel the queued ones.
+        """
+        for future in futures:
+            if future.cancelled():
+                continue
+            try:
+                rpm, res_storage_id, _ = future.result()
+            except BaseException:  # Already logged by the retry logic
+                continue
             if not isinstance(res_storage_id, ReportableError):
-                # If it's valid, we store this storage_id in repo_db regardless
-                # of whether we encounter fatal errors later on that fail the
-                # snapshot; see docblock in `repo_downloader.py` for reasoning
-                with timeit(
-                    partial(
-                        log_sample,
-                        LogOp.REPO_DB_WRITE,
-                        rpm=rpm,
-                        universe=universe,
-                        db_cfg=str(cfg.db_cfg),
-                        db_table=rpm_table.NAME,
-                    )
-                ):
-                    res_storage_id = maybe_write_id(
-                        rpm, res_storage_id, rpm_table, rw_db_conn
-                    )
-                # Detect if this RPM NEVRA occurs with different contents.
-                with timeit(
-                    partial(
-                        log_sample,
-                        LogOp.DETECT_MUTABLE_RPMS,
-                        rpm=rpm,
-                        universe=universe,
-                    )
-                ):
-                    res_storage_id = _detect_mutable_rpms(
-                        rpm,
-                        universe,
-                        rpm_table,
-                        res_storage_id,
-                        all_snapshot_universes,
-                        ro_db_conn,
-                    )
-            existing_rpm = storage_id_to_rpm.get(res_storage_id)
-            if existing_rpm and existing_rpm != rpm:  # pragma: no cover
-                duplicate_rpms += 1
-                message = (
-                    f"Same ID {res_storage_id} with differing RPMs: "
-                    f"{existing_rpm} != {rpm}"
-                )
-                # We don't care if locations diverge because we only need a
-                # single location for a NEVRA to be able to fetch the RPM.
-                if existing_rpm._replace(location=None) == rpm._replace(
-                    location=None
-                ):
-                    log.warning(message)
-                else:
-                    raise RuntimeError(message)
-            storage_id_to_rpm[res_storage_id] = rpm
+                self._unwritten.append((rpm, res_storage_id))
+        batch, self._unwritten = self._unwritten, []
+        if batch:
+            self._store_batch(batch)
 
-    assert len(storage_id_to_rpm) == (
-        sum(cfg.rpm_shard.in_shard(r) for r in rpms) - duplicate_rpms
-    )
-    return storage_id_to_rpm, total_bytes_downloaded
+    def _add_unwritten(self, rpm: Rpm, storage_id: str) -> None:
+        self._unwritten.append((rpm, storage_id))
+        if len(self._unwritten) >= _DB_BATCH_SIZE:
+            self._write_batch()
 
+    def _store_batch(self, batch: List[Tuple[Rpm, str]]) -> List[str]:
+        "Returns the storage IDs in the DB, ours or from racing writers."
+        # We store these storage_ids in repo_db regardless of whether we
+        # encounter fatal errors later on that fail the snapshot; see
+        # docblock in `repo_downloader.py` for reasoning
+        with timeit(
+            partial(
+                log_sample,
+                LogOp.REPO_DB_WRITE,
+                universe=self._res.repo_universe,
+                db_cfg=str(self._cfg.db_cfg),
+                db_table=self._rpm_table.NAME,
+            )
+        ), retryable_db_ctx(self._rw_db_conn) as rw_repo_db:
+            db_storage_ids = rw_repo_db.maybe_store_many(
+                self._rpm_table, batch
+            )
+            rw_repo_db.commit()
+        return db_storage_ids
 
-def gen_rpms_from_repodatas(
-    repodata_results: Iterable[DownloadResult],
-    cfg: DownloadConfig,
-    all_snapshot_universes: FrozenSet[str],
-) -> Iterator[DownloadResult]:
-    for res in repodata_results:
-        res_rpms = not_none(res.rpms, "rpms")
-        repo_weight_bytes = sum(r.size for r in res_rpms)
-        num_rpms = len(res_rpms)
-        log_size(
-            f"`{res.repo.name}` has {num_rpms} RPMs weighing", repo_weight_bytes
-        )
-        start_t = time.time()
-        total_dl = 0
+    def _write_batch(self) -> None:
+        batch, self._unwritten = self._unwritten, []
+        if not batch:
+            return
+        universe = self._res.repo_universe
+        db_storage_ids = self._store_batch(batch)
+        # Detect if these RPM NEVRAs occur with different contents.
+        with timeit(
+            partial(log_sample, LogOp.DETECT_MUTABLE_RPMS, universe=universe)
+        ), retryable_db_ctx(self._ro_db_conn) as ro_repo_db:
+            nevra_to_checksums_and_universes = (
+                ro_repo_db.get_rpms_canonical_checksums_per_universe(
+                    self._rpm_table,
+                    (rpm for rpm, _ in batch),
+                    self._all_snapshot_universes,
+                )
+            )
+        for (rpm, storage_id), db_storage_id in zip(batch, db_storage_ids):
+            if db_storage_id != storage_id:
+                log.warning(
+                    f"Another writer already committed {rpm} at "
+                    f"{db_storage_id}"
+                )
+            self._add_rpm(
+                rpm,
+                _detect_mutable_rpms(
+                    rpm,
+                    universe,
+                    db_storage_id,
+                    self._all_snapshot_universes,
+                    nevra_to_checksums_and_universes.get(rpm.nevra(), set()),
+                ),
+            )
+
+    def _add_rpm(self, rpm: Rpm, res_storage_id: MaybeStorageID) -> None:
+        existing_rpm = self._storage_id_to_rpm.get(res_storage_id)
+        if existing_rpm and existing_rpm != rpm:  # pragma: no cover
+            self._duplicate_rpms += 1
+            message = (
+                f"Same ID {res_storage_id} with differing RPMs: "
+                f"{existing_rpm} != {rpm}"
+            )
+            # We don't care if locations diverge because we only need a
+            # single location for a NEVRA to be able to fetch the RPM.
+            if existing_rpm._replace(location=None) == rpm._replace(
+                location=None
+            ):
+                log.warning(message)
+            else:
+                raise RuntimeError(message)
+        self._storage_id_to_rpm[res_storage_id] = rpm
+
+    def result(self) -> DownloadResult:
+        "Call once every submitted future was handled."
         try:
-            storage_id_to_rpm, total_dl = _download_rpms(
-                res.repo,
-                res.repo_universe,
-                RpmTable(res.repo_universe),
-                res_rpms,
-                all_snapshot_universes,
-                cfg,
+            self._write_batch()
+            assert len(self._storage_id_to_rpm) == (
+                sum(self._cfg.rpm_shard.in_shard(r) for r in self._rpms)
+                - self._duplicate_rpms
             )
-            yield res._replace(
-                storage_id_to_rpm=MappingProxyType(storage_id_to_rpm)
+            return self._res._replace(
+                storage_id_to_rpm=MappingProxyType(self._storage_id_to_rpm)
             )
         finally:
-            log_sample(
-                LogOp.REPO_DOWNLOAD,
-                duration_s=time.time() - start_t,
-                universe=res.repo_universe,
-                repo_name=res.repo.name,
-                repo_num_rpms=num_rpms,
-                repo_downloaded_gb=total_dl / 10 ** 9,
-                repo_weight_gb=repo_weight_bytes / 10 ** 9,
-                error=traceback.format_exc() if any(sys.exc_info()) else None,
-            )
+            self._log_repo_download()
+
+    def _log_repo_download(self) -> None:
+        log_sample(
+            LogOp.REPO_DOWNLOAD,
+            duration_s=time.time() - self._start_t,
+            universe=self._res.repo_universe,
+            repo_name=self._res.repo.name,
+            repo_num_rpms=len(self._rpms),
+            repo_downloaded_gb=self._total_bytes_downloaded / 10 ** 9,
+            repo_weight_gb=self._repo_weight_bytes / 10 ** 9,
+            error=traceback.format_exc() if any(sys.exc_info()) else None,
+        )
@@ -15,6 +15,7 @@ Future work:
 import os
 import re
 import tempfile
+import threading
 import unittest
 from contextlib import contextmanager
 from functools import partial
@@ -36,13 +37,14 @@ from antlir.rpm.downloader import (
 )
 from antlir.rpm.downloader.logger import init_sample_logging
 from antlir.rpm.downloader.repomd_downloader import REPOMD_MAX_RETRY_S
-from antlir.rpm.repo_db import RepodataTable, RepoDBContext
+from antlir.rpm.repo_db import RepodataTable, RepoDBContext, RpmTable
 from antlir.rpm.repo_snapshot import (
     FileIntegrityError,
     HTTPError,
     MutableRpmError,
     RepoSnapshot,
 )
+from antlir.rpm.storage.storage import dedup_stats
 from antlir.rpm.tests import temp_repos
 from antlir.rpm.yum_dnf_conf import YumDnfConfRepo
 
@@ -148,7 +150,12 @@ class DownloadReposTestCase(unittest.TestCase):
         self.maxDiff = 12345
 
     def _make_downloader_from_ctx(
-        self, step_and_repo, tmp_db, dir_name, rpm_shard=None
+        self,
+        step_and_repo,
+        tmp_db,
+        dir_name,
+        rpm_shard=None,
+        content_addressed_storage=False,
     ):
         repo = YumDnfConfRepo(
             name=step_and_repo,
@@ -167,6 +174,7 @@ class DownloadReposTestCase(unittest.TestCase):
                 },
                 rpm_shard=rpm_shard or RpmShard(shard=0, modulo=1),
                 threads=_THREADS,
+                content_addressed_storage=content_addressed_storage,
             ),
         )
 
@@ -230,11 +238,11 @@ class DownloadReposTestCase(unittest.TestCase):
     def _break_open_url(self, url_regex, corrupt_file_fn):
         original_open_url = downloader_common.open_url
 
-        def my_open_url(url):
+        def my_open_url(url, **kwargs):
             if re.match(url_regex, url):
-                with original_open_url(url) as f:
+                with original_open_url(url, **kwargs) as f:
                     return BytesIO(corrupt_file_fn(f.read()))
-            return original_open_url(url)
+            return original_open_url(url, **kwargs)
 
         with mock.patch.object(downloader_common, "open_url") as mock_fn:
             mock_fn.side_effect = my_open_url
@@ -583,6 +591,67 @@ class DownloadReposTestCase(unittest.TestCase):
                 visitors, self._reduce_equal_snapshots(repo_snapshots)
             )
 
+    def test_content_addressed_storage(self):
+        start_stats = dedup_stats()
+        snapshots = []
+        with temp_dir() as storage_dir:
+            # A fresh DB each time, as if the first run had failed after
+            # storing the blobs, but before recording them.
+            for _ in range(2):
+                with tempfile.NamedTemporaryFile() as tmp_db:
+                    ((_, snapshot),) = list(
+                        self._make_downloader_from_ctx(
+                            "0/good_dog",
+                            tmp_db,
+                            storage_dir,
+                            content_addressed_storage=True,
+                        )()
+                    )
+                    self._check_snapshot(snapshot, _GOOD_DOG_LOCATIONS)
+                    snapshots.append(snapshot)
+            stats = dedup_stats()
+
+            # If the repo's checksum is the canonical one, we do not even
+            # download a stored RPM.
+            cfg = repo_downloader.DownloadConfig(
+                db_cfg={},
+                storage_cfg={
+                    "key": "test",
+                    "kind": "filesystem",
+                    "base_dir": storage_dir,
+                },
+                rpm_shard=RpmShard(shard=0, modulo=1),
+                threads=1,
+                content_addressed_storage=True,
+            )
+            storage = cfg.new_storage()
+            sid, rpm = next(iter(snapshots[0].storage_id_to_rpm.items()))
+            rpm = rpm._replace(checksum=rpm.canonical_checksum)
+            with storage.reader(sid) as infile, storage.writer(
+                content_id=str(rpm.checksum)
+            ) as outfile:
+                outfile.write(infile.read())
+                canonical_sid = outfile.commit()
+            self.assertEqual(
+                (rpm, canonical_sid),
+                rpm_downloader._download_rpm(
+                    rpm._replace(canonical_checksum=None),
+                    "file:///dev/null/no-such-repo",
+                    None,  # rpm_table
+                    cfg,
+                ),
+            )
+        first, second = snapshots
+        # The second run stored nothing new.
+        self.assertEqual(first.storage_id_to_rpm, second.storage_id_to_rpm)
+        self.assertEqual(
+            first.storage_id_to_repodata, second.storage_id_to_repodata
+        )
+        self.assertGreater(stats.hits, start_stats.hits)
+        self.assertEqual(
+            stats.hits - start_stats.hits, stats.misses - start_stats.misses
+        )
+
     def test_lose_repodata_commit_race(self):
         "We downloaded & stored a repodata, but in the meantime some other"
         "writer committed the same repodata."
@@ -614,10 +683,10 @@ class DownloadReposTestCase(unittest.TestCase):
         "We downloaded & stored an RPM, but in the meantime some other"
         "writer committed the same RPM."
         original_get_canonical = (
-            RepoDBContext.get_rpm_canonical_checksums_per_universe
+            RepoDBContext.get_rpms_canonical_checksums_per_universe
         )
 
-        # When we download the RPM, the mock `my_maybe_store` writes a
+        # When we download the RPM, the mock `my_maybe_store_many` writes a
         # single `Checksum` here, the canonical one for the `mice` RPM.
         # Then, during mutable RPM detection, the mock `my_get_canonical`
         # grabs this checksum (since it's not actually in the DB).
@@ -625,29 +694,44 @@ class DownloadReposTestCase(unittest.TestCase):
         # The mice object which was "previously stored" via the mocks
         mice_rpms = []
 
-        def my_get_canonical(self, table, rpm, all_snapshot_universes):
-            if rpm.nevra() == "rpm-test-mice-0:0.1-a.x86_64":
-                return {(mice_canonical_checksums[0], "fakeverse")}
-            return original_get_canonical(
-                self, table, rpm, all_snapshot_universes
+        def my_get_canonical(self, table, rpms, all_snapshot_universes):
+            rpms = list(rpms)
+            nevra_to_checksums_and_universes = original_get_canonical(
+                self, table, rpms, all_snapshot_universes
             )
+            for rpm in rpms:
+                if rpm.nevra() == "rpm-test-mice-0:0.1-a.x86_64":
+                    nevra_to_checksums_and_universes[rpm.nevra()] = {
+                        (mice_canonical_checksums[0], "fakeverse")
+                    }
+            return nevra_to_checksums_and_universes
 
-        original_maybe_store = RepoDBContext.maybe_store
+        original_maybe_store_many = RepoDBContext.maybe_store_many
 
-        def my_maybe_store(self, table, obj, storage_id):
-            if re.match(MICE_01_RPM_REGEX, obj.location):
-                mice_rpms.append(obj)
-                assert not mice_canonical_checksums, mice_canonical_checksums
-                mice_canonical_checksums.append(obj.canonical_checksum)
-                return f"fake_already_stored_{obj.location}"
-            return original_maybe_store(self, table, obj, storage_id)
+        def my_maybe_store_many(self, table, objs_and_storage_ids):
+            storage_ids = []
+            for obj, storage_id in objs_and_storage_ids:
+                if re.match(MICE_01_RPM_REGEX, obj.location):
+                    mice_rpms.append(obj)
+                    assert not mice_canonical_checksums, (
+                        mice_canonical_checksums
+                    )
+                    mice_canonical_checksums.append(obj.canonical_checksum)
+                    storage_ids.append(f"fake_already_stored_{obj.location}")
+                else:
+                    storage_ids.extend(
+                        original_maybe_store_many(
+                            self, table, [(obj, storage_id)]
+                        )
+                    )
+            return storage_ids
 
         with mock.patch.object(
             RepoDBContext,
-            "get_rpm_canonical_checksums_per_universe",
+            "get_rpms_canonical_checksums_per_universe",
             new=my_get_canonical,
         ), mock.patch.object(
-            RepoDBContext, "maybe_store", new=my_maybe_store
+            RepoDBContext, "maybe_store_many", new=my_maybe_store_many
         ), self._make_downloader(
             "0/good_dog"
         ) as downloader:
@@ -705,6 +789,51 @@ class DownloadReposTestCase(unittest.TestCase):
                     res = cursor.fetchone()
             self.assertEqual(0, res[0])
 
+    def test_rpm_failure_stores_downloaded_rpms(self):
+        orig_handle_rpm = rpm_downloader._handle_rpm
+        all_others_stored = threading.Condition()
+        stored = []
+
+        def my_handle_rpm(rpm, *args):
+            if rpm.location == _MICE_LOCATION:
+                # Fail only once the other RPMs are stored, so that none of
+                # their downloads get cancelled.
+                with all_others_stored:
+                    self.assertTrue(
+                        all_others_stored.wait_for(
+                            lambda: len(stored) == len(_GOOD_DOG_LOCATIONS) - 1,
+                            timeout=60,
+                        )
+                    )
+                raise RuntimeError("humbug")
+            res_rpm, storage_id, size = orig_handle_rpm(rpm, *args)
+            with all_others_stored:
+                stored.append((res_rpm, storage_id))
+                all_others_stored.notify_all()
+            return res_rpm, storage_id, size
+
+        with mock.patch.object(
+            rpm_downloader, "_handle_rpm", side_effect=my_handle_rpm
+        ), tempfile.NamedTemporaryFile() as tmp_db, temp_dir() as storage_dir:
+            with self.assertRaisesRegex(RuntimeError, "^humbug$"):
+                list(
+                    self._make_downloader_from_ctx(
+                        "0/good_dog", tmp_db, storage_dir
+                    )()
+                )
+            # The other RPMs were downloaded before the failure, but were
+            # not yet written to the DB, since the batch was not full.
+            db_conn = DBConnectionContext.from_json(
+                {"kind": "sqlite", "db_path": tmp_db.name, "readonly": True}
+            )
+            with RepoDBContext(db_conn, db_conn.SQL_DIALECT) as repo_db_ctx:
+                self.assertEqual(
+                    [sid for _, sid in stored],
+                    repo_db_ctx.get_storage_ids(
+                        RpmTable("fakeverse"), [rpm for rpm, _ in stored]
+                    ),
+                )
+
     def test_mutable_rpm(self):
         with tempfile.NamedTemporaryFile() as tmp_db, temp_dir() as storage_dir:
             (good_res,) = list(
@@ -779,7 +908,32 @@ class DownloadReposTestCase(unittest.TestCase):
                 )
 
     def test_download_multiple_repos(self):
-        with tempfile.NamedTemporaryFile() as tmp_db, tempfile.TemporaryDirectory() as storage_dir:  # noqa: E501
+        original_open_url = downloader_common.open_url
+        lock = threading.Lock()
+        num_open = 0
+        max_num_open = 0
+
+        # Repomds are not subject to `max_connections_per_host`
+        @contextmanager
+        def counting_open_url(url, **kwargs):
+            nonlocal num_open, max_num_open
+            if url.endswith("/repomd.xml"):
+                with original_open_url(url, **kwargs) as f:
+                    yield f
+                return
+            with lock:
+                num_open += 1
+                max_num_open = max(max_num_open, num_open)
+            try:
+                with original_open_url(url, **kwargs) as f:
+                    yield f
+            finally:
+                with lock:
+                    num_open -= 1
+
+        with tempfile.NamedTemporaryFile() as tmp_db, tempfile.TemporaryDirectory() as storage_dir, mock.patch.object(  # noqa: E501
+            downloader_common, "open_url", side_effect=counting_open_url
+        ):
             repos = [
                 YumDnfConfRepo(
                     name=repo,
@@ -800,9 +954,12 @@ class DownloadReposTestCase(unittest.TestCase):
                         },
                         rpm_shard=RpmShard(shard=0, modulo=1),
                         threads=_THREADS,
+                        # All the repos are on one "host"
+                        max_connections_per_host=1,
                     ),
                 )
             )
+            self.assertEqual(1, max_num_open)
             # Each snapshot will have unique repomds
             self.assertEqual(
                 len(repo_snapshots), len({x.repomd for _, x in repo_snapshots})
@@ -846,13 +1003,15 @@ class DownloadReposTestCase(unittest.TestCase):
         original_open_url = downloader_common.open_url
         i = 0
 
-        def my_open_url(url):
+        def my_open_url(url, **kwargs):
             nonlocal i
             postfix = "repodata/repomd.xml"
             if postfix in url:
                 i += 1
-                return original_open_url(re.sub(r"/(\d)/", rf"/{i % 2}/", url))
-            return original_open_url(url)
+                return original_open_url(
+                    re.sub(r"/(\d)/", rf"/{i % 2}/", url), **kwargs
+                )
+            return original_open_url(url, **kwargs)
 
         with mock.patch.object(downloader_common, "open_url") as mock_fn:
             mock_fn.side_effect = my_open_url
@@ -4,15 +4,233 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+"""
+`open_url` streams `file://` and `http(s)://` URLs.  HTTP downloads from
+one host share a `requests.Session`, so that concurrent downloads reuse
+keep-alive connections instead of paying for a TCP & TLS handshake per
+object.  Pass `pool_size` to keep up to that many idle connections per host,
+which should match the number of threads downloading from it.
+
+If the connection breaks mid-body, we transparently re-request the rest of
+the object with an HTTP `Range` header, at most `MAX_RESUMES` times per
+object.  We only resume when the server replies with the exact requested
+range of the same representation (`If-Range`), so the bytes we yield are
+always a prefix of one object.  Callers still verify sizes & checksums,
+e.g. via `verify_chunk_stream`.
+
+`host_stats()` reports per-host counters for the process, and
+`log_host_stats()` logs them.
+"""
+import io
+import threading
+import time
 from contextlib import contextmanager
 from io import BytesIO
-from typing import Iterator
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
 
 import requests
+from antlir.common import get_logger
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+# Matches `requests`'s own default for `pool_maxsize`.
+DEFAULT_POOL_SIZE = 10
+MAX_RESUMES = 5
+log = get_logger()
+
+_ORIGIN_AND_POOL_SIZE_TO_SESSION: Dict[
+    Tuple[str, str, int], requests.Session
+] = {}
+_HOST_TO_STATS: Dict[str, "_MutableHostStats"] = {}
+_LOCK = threading.Lock()
+
+
+class HostStats(NamedTuple):
+    requests: int  # Includes the `Range` requests that resumed a download
+    resumes: int
+    bytes: int
+    # Sum over requests of the time from sending the request to receiving
+    # the response headers.
+    latency_seconds: float
+    # Sum over requests of the time from sending the request until the body
+    # was consumed, or the caller stopped reading.
+    transfer_seconds: float
+
+    @property
+    def mean_latency_seconds(self) -> float:
+        return self.latency_seconds / self.requests if self.requests else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return (
+            self.bytes / self.transfer_seconds if self.transfer_seconds else 0.0
+        )
+
+
+class _MutableHostStats:
+    def __init__(self):
+        self.requests = 0
+        self.resumes = 0
+        self.bytes = 0
+        self.latency_seconds = 0.0
+        self.transfer_seconds = 0.0
+
+
+def _update_host_stats(host: str, **deltas) -> None:
+    with _LOCK:
+        stats = _HOST_TO_STATS.get(host)
+        if stats is None:
+            stats = _HOST_TO_STATS[host] = _MutableHostStats()
+        for k, v in deltas.items():
+            setattr(stats, k, getattr(stats, k) + v)
+
+
+def host_stats() -> Dict[str, HostStats]:
+    "Counters for the HTTP downloads made by this process, by host."
+    with _LOCK:
+        return {
+            host: HostStats(**vars(stats))
+            for host, stats in _HOST_TO_STATS.items()
+        }
+
+
+def log_host_stats() -> None:
+    for host, s in sorted(host_stats().items()):
+        log.info(
+            f"{host}: {s.requests} requests ({s.resumes} resumed), "
+            f"{s.bytes / 2 ** 20:,.1f} MiB at "
+            f"{s.bytes_per_second / 2 ** 20:,.1f} MiB/s per request, "
+            f"mean latency {s.mean_latency_seconds * 1000:,.1f}ms"
+        )
+
+
+def _session(scheme: str, host: str, pool_size: int) -> requests.Session:
+    "Shared by all threads downloading from this host."
+    key = (scheme, host, pool_size)
+    with _LOCK:
+        session = _ORIGIN_AND_POOL_SIZE_TO_SESSION.get(key)
+        if session is None:
+            session = requests.Session()
+            # One pool, since the session only talks to one host.
+            session.mount(
+                f"{scheme}://",
+                requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=pool_size
+                ),
+            )
+            _ORIGIN_AND_POOL_SIZE_TO_SESSION[key] = session
+        return session
+
+
+class _ResumableHTTPStream(io.RawIOBase):
+    "The body of a GET, resumed via `Range` requests if the connection breaks."
+
+    def __init__(self, session: requests.Session, url: str, host: str):
+        self._session = session
+        self._url = url
+        self._host = host
+        self._offset = 0
+        self._resumes = 0
+        self._transfer_seconds = 0.0
+        self._response = self._get({})
+        try:
+            self._response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            self._response.close()
+            raise
+        # Sadly, requests 2.x does not verify content-length :/
+        content_length = self._response.headers.get("content-length")
+        self._size = None if content_length is None else int(content_length)
+        # Resume only if the object did not change since our first request.
+        self._validator = self._response.headers.get(
+            "etag"
+        ) or self._response.headers.get("last-modified")
+
+    def _get(self, headers: Dict[str, str]) -> requests.Response:
+        start = time.monotonic()
+        # verify=True is the default, but I want to be explicit about HTTPS,
+        # since this function receives GPG key material.
+        response = self._session.get(
+            self._url, headers=headers, stream=True, verify=True
+        )
+        self._request_start = start
+        _update_host_stats(
+            self._host, requests=1, latency_seconds=time.monotonic() - start
+        )
+        return response
+
+    def _resume(self, ex: Exception) -> None:
+        "Re-raises `ex` unless we can continue reading at `self._offset`."
+        if (
+            self._resumes >= MAX_RESUMES
+            or self._validator is None
+            or self._size is None
+        ):
+            raise ex
+        self._resumes += 1
+        log.warning(
+            f"Resuming {self._url} at byte {self._offset} of {self._size} "
+            f"after {ex}"
+        )
+        self._close_response()
+        self._response = self._get(
+            {"Range": f"bytes={self._offset}-", "If-Range": self._validator}
+        )
+        _update_host_stats(self._host, resumes=1)
+        content_range = self._response.headers.get("content-range", "")
+        if self._response.status_code != 206 or not content_range.startswith(
+            f"bytes {self._offset}-{self._size - 1}/"
+        ):
+            raise ex
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        while True:
+            try:
+                chunk = self._response.raw.read(len(buf))
+            except (ProtocolError, ReadTimeoutError) as ex:
+                self._resume(ex)
+                continue
+            # `urllib3` < 2 does not enforce content-length, so a broken
+            # connection looks like a normal end of the stream.
+            if not chunk and len(buf) and self._size is not None:
+                if self._offset < self._size:  # pragma: no cover
+                    self._resume(
+                        ProtocolError(
+                            f"Connection broken: got {self._offset} of "
+                            f"{self._size} bytes"
+                        )
+                    )
+                    continue
+            break
+        buf[: len(chunk)] = chunk
+        self._offset += len(chunk)
+        _update_host_stats(self._host, bytes=len(chunk))
+        return len(chunk)
+
+    def at_eof(self) -> bool:
+        return self._response.raw.isclosed()
+
+    def check_size(self) -> None:
+        if self._size is not None:
+            assert self._offset == self._size, (self._offset, self._size)
+
+    def _close_response(self) -> None:
+        self._transfer_seconds += time.monotonic() - self._request_start
+        self._response.close()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._close_response()
+            _update_host_stats(
+                self._host, transfer_seconds=self._transfer_seconds
+            )
+        super().close()
 
 
 @contextmanager
-def open_url(url: str) -> Iterator[BytesIO]:
+def open_url(url: str, *, pool_size: Optional[int] = None) -> Iterator[BytesIO]:
     # pyre-fixme[16]: Module `utils` has no attribute `urlparse`.
     parsed_url = requests.utils.urlparse(url)
     if parsed_url.scheme == "file":
@@ -23,16 +241,16 @@ def open_url(url: str) -> Iterator[BytesIO]:
             #  `Generator[io.BufferedReader, None, None]`.
             yield infile
     elif parsed_url.scheme in ["http", "https"]:
-        # verify=True is the default, but I want to be explicit about HTTPS,
-        # since this function receives GPG key material.
-        with requests.get(url, stream=True, verify=True) as r:
-            r.raise_for_status()
-            yield r.raw  # A file-like `io`-style object for the HTTP stream
-            if r.raw.isclosed():  # Proxy for "all data was consumed"
-                # Sadly, requests 2.x does not verify content-length :/
-                # We could check r.raw.length_remaining, likely equivalent.
-                actual_size = r.raw.tell()
-                header_size = int(r.headers["content-length"])
-                assert actual_size == header_size, (actual_size, header_size)
+        session = _session(
+            parsed_url.scheme,
+            parsed_url.netloc,
+            pool_size or DEFAULT_POOL_SIZE,
+        )
+        with _ResumableHTTPStream(session, url, parsed_url.netloc) as stream:
+            # pyre-fixme[7]: Expected `Iterator[BytesIO]` but got
+            #  `Generator[_ResumableHTTPStream, None, None]`.
+            yield stream
+            if stream.at_eof():  # Proxy for "all data was consumed"
+                stream.check_size()
     else:  # pragma: no cover
         raise RuntimeError(f"Unknown URL scheme in {url}")
@@ -6,13 +6,15 @@
 
 import bz2
 import lzma
+import queue
 import re
 import sqlite3
 import tempfile
+import threading
 import zlib
 from collections import defaultdict
 from contextlib import AbstractContextManager
-from typing import Iterable, Iterator, Union
+from typing import Iterable, Iterator, List, Optional, Union
 from xml.etree import ElementTree
 
 from .repo_objects import Checksum, Repodata, Rpm
@@ -99,44 +101,51 @@ class SQLiteRpmParser(AbstractContextManager):
                 break
         if self._unpacker.eof:  # We yield **everything** once the DB is ready
             self._tmp_db.flush()
-            with sqlite3.connect(self._tmp_db.name) as tmp_db:
-                select_res = tmp_db.execute(
+            tmp_db = sqlite3.connect(self._tmp_db.name)
+            try:
+                # Iterate over the cursor instead of `fetchall()`, so that
+                # `BackgroundRpmParser` can hand out the first RPMs while
+                # the query is still running.
+                for (
+                    location,
+                    chk_type,
+                    chk_val,
+                    size,
+                    build_time,
+                    name,
+                    epoch,
+                    version,
+                    release,
+                    arch,
+                    source_rpm,
+                ) in tmp_db.execute(
                     "SELECT "
                     '  "location_href", "checksum_type", "pkgId", '
                     '  "size_package", "time_build", "name", "epoch", '
                     '  "version", "release", "arch", "rpm_sourcerpm" '
                     'FROM "packages";'
-                ).fetchall()
-            tmp_db.close()
-            for (
-                location,
-                chk_type,
-                chk_val,
-                size,
-                build_time,
-                name,
-                epoch,
-                version,
-                release,
-                arch,
-                source_rpm,
-            ) in select_res:
-                yield Rpm(
-                    epoch=int(epoch),
-                    name=name,
-                    version=version,
-                    release=release,
-                    arch=arch,
-                    build_timestamp=build_time,
-                    # The canonical checksum is set after we download the RPM
-                    # pyre-fixme[6]: Expected `Checksum` for 7th param but got
-                    # `None`.
-                    canonical_checksum=None,
-                    checksum=Checksum(algorithm=chk_type, hexdigest=chk_val),
-                    location=location,
-                    source_rpm=source_rpm or None,
-                    size=size,
-                )
+                ):
+                    yield Rpm(
+                        epoch=int(epoch),
+                        name=name,
+                        version=version,
+                        release=release,
+                        arch=arch,
+                        build_timestamp=build_time,
+                        # The canonical checksum is set after we download
+                        # the RPM
+                        # pyre-fixme[6]: Expected `Checksum` for 7th param
+                        # but got `None`.
+                        canonical_checksum=None,
+                        checksum=Checksum(
+                            algorithm=chk_type, hexdigest=chk_val
+                        ),
+                        location=location,
+                        source_rpm=source_rpm or None,
+                        size=size,
+                    )
+            finally:
+                tmp_db.close()
 
 
 class XMLRpmParser(AbstractContextManager):
@@ -264,6 +273,85 @@ class XMLRpmParser(AbstractContextManager):
                     self._package[self._TIME] = elt.attrib["build"]
 
 
+class BackgroundRpmParser(AbstractContextManager):
+    """
+    Runs the decompression & parsing of `SQLiteRpmParser` or `XMLRpmParser`
+    on a background thread.  Without it, the thread that downloads a large
+    primary repodata stops reading from the network every time it feeds a
+    chunk to the parser.  `zlib`, `bz2`, `lzma`, and `sqlite3` all release
+    the GIL, so the two threads genuinely overlap.
+
+    Unlike the wrapped parsers, `feed()` does not block on parsing.  It
+    returns the batches of RPMs that were parsed so far, and `finish()`
+    returns the rest, once all chunks were fed.
+    """
+
+    # The download thread blocks once this many chunks await parsing,
+    # which bounds our RAM use.
+    _MAX_QUEUED_CHUNKS = 64
+    # Hand out RPMs in batches, since a queue operation per RPM is slow.
+    _RPMS_PER_BATCH = 1000
+
+    def __init__(self, parser: Union[SQLiteRpmParser, XMLRpmParser]):
+        self._parser = parser
+        self._chunks = queue.Queue(maxsize=self._MAX_QUEUED_CHUNKS)
+        self._rpm_batches = queue.SimpleQueue()
+        self._exception: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._parse_chunks, daemon=True)
+        self._finished = False
+
+    def __enter__(self):
+        self._parser.__enter__()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        if not self._finished:
+            self._chunks.put(None)
+            self._thread.join()
+        # The wrapped parser detects incomplete & trailing data.
+        return self._parser.__exit__(exc_type, exc_val, exc_tb)
+
+    def _parse_chunks(self) -> None:
+        batch = []
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                break
+            if self._exception is not None:
+                continue  # Keep draining, lest `feed()` block forever
+            try:
+                for rpm in self._parser.feed(chunk):
+                    batch.append(rpm)
+                    if len(batch) >= self._RPMS_PER_BATCH:
+                        self._rpm_batches.put(batch)
+                        batch = []
+                if batch:
+                    self._rpm_batches.put(batch)
+                    batch = []
+            except BaseException as ex:
+                self._exception = ex
+
+    def _parsed_rpms(self) -> List[Rpm]:
+        if self._exception is not None:
+            raise self._exception
+        rpms = []
+        while not self._rpm_batches.empty():
+            rpms.extend(self._rpm_batches.get())
+        return rpms
+
+    def feed(self, chunk: bytes) -> List[Rpm]:
+        self._chunks.put(chunk)
+        return self._parsed_rpms()
+
+    def finish(self) -> List[Rpm]:
+        "Call once every chunk was fed, to wait for the remaining RPMs."
+        self._finished = True
+        self._chunks.put(None)
+        self._thread.join()
+        return self._parsed_rpms()
+
+
 def pick_primary_repodata(repodatas: Iterable[Repodata]) -> Repodata:
     primaries = defaultdict(list)
     for rd in repodatas:
@@ -283,9 +371,14 @@ def pick_primary_repodata(repodatas: Iterable[Repodata]) -> Repodata:
     return primaries[0]
 
 
-def get_rpm_parser(repodata: Repodata) -> Union[SQLiteRpmParser, XMLRpmParser]:
+def get_rpm_parser(
+    repodata: Repodata, *, background: bool = False
+) -> Union[SQLiteRpmParser, XMLRpmParser, BackgroundRpmParser]:
+    "With `background`, remember to call `finish()` after the last `feed()`."
     if repodata.is_primary_sqlite():
-        return SQLiteRpmParser(repodata.location)
+        parser = SQLiteRpmParser(repodata.location)
     elif repodata.is_primary_xml():
-        return XMLRpmParser()
-    raise NotImplementedError(f"Not reached: {repodata}")
+        parser = XMLRpmParser()
+    else:
+        raise NotImplementedError(f"Not reached: {repodata}")
+    return BackgroundRpmParser(parser) if background else parser
@@ -4,11 +4,12 @@
 # LICENSE file in the root directory of this source tree.
 
 "See the `subvol_diff()` docblock."
-import os
-import re
 import subprocess
-from typing import Iterator, Iterable
+from typing import Iterable, Iterator, List, Optional
 
+from antlir.btrfs_diff.inode_utils import erase_utimes_in_range
+from antlir.btrfs_diff.subvolume_diff import diff_subvolumes
+from antlir.btrfs_diff.subvolume_set import SubvolumeSet, SubvolumeSetMutator
 from antlir.common import get_logger
 from antlir.fs_utils import Path
 from antlir.subvol_utils import Subvol
@@ -36,64 +37,6 @@ for p in [
     _PATHS_EXPECTED_TO_DIFFER.add(p.encode())
 
 
-def _parse_diff_output(
-    left_base: bytes,
-    right_base: bytes,
-    out: bytes,
-) -> Iterator[bytes]:
-    """
-    Parse the output of `LANG=C diff --brief --recursive` as a quick and
-    dirty comparison of filesystem contents.  See `subvol_diff` for what
-    should be the long-term approach to replace this.
-
-    In this mode, `diff` only outputs 2 types of lines. We match for both:
-      - "Files left/x and right/x differ" -- yield "x"
-      - "Only in left_or_right/foo: bar" -- yield "foo/bar".  This could
-        also defensibly return "foo", but the upside of returning "foo/bar"
-        is that our fuzzy matching (_PATHS_EXPECTED_TO_DIFFER) can then
-        ignore stuff that exists only in one image (i.e.  we don't care if
-        it exists or not).
-    """
-    left_base = left_base.rstrip(b"/") + b"/"
-    right_base = right_base.rstrip(b"/") + b"/"
-    assert not left_base.startswith(right_base) and not right_base.startswith(
-        left_base
-    ), (left_base, right_base)
-    for l in out.splitlines():
-        m = re.match(b"Files (.*) and (.*) differ$", l)
-        if m:
-            assert all(b" and " not in g for g in m.groups()), ("ambiguous", l)
-            left, right = m.groups()
-            assert left.startswith(left_base) and right.startswith(
-                right_base
-            ), (left_base, right_base, l)
-            left = os.path.relpath(left, left_base)
-            right = os.path.relpath(right, right_base)
-            assert left == right, l
-            log.info(f"File differs {left}")
-            yield left
-            continue
-
-        m = re.match(b"Only in (.*): ([^/]*)$", l)
-        if m:
-            left_or_right, lacks_counterpart = m.groups()
-            assert not re.match(b".*: [^/]*$", left_or_right), ("ambigous", l)
-            left_or_right += b"/"
-            if left_or_right.startswith(left_base):
-                left_or_right = os.path.relpath(left_or_right, left_base)
-            elif left_or_right.startswith(right_base):
-                left_or_right = os.path.relpath(left_or_right, right_base)
-            else:
-                raise AssertionError(
-                    f"Neither left nor right {left_base} {right_base} {l}"
-                )
-            log.info(f"Dir differs {left_or_right}: {lacks_counterpart}")
-            yield left_or_right + b"/" + lacks_counterpart
-            continue
-
-        raise NotImplementedError(f"diff line {l}")
-
-
 def _equal_or_child(child: bytes, potential_parent: bytes) -> bool:
     child = child.rstrip(b"/")
     parent = potential_parent.rstrip(b"/")
@@ -112,53 +55,100 @@ def _discard_path_expected_to_differ(
         yield Path(p)
 
 
-def subvol_diff(left: Subvol, right: Subvol) -> Iterator[Path]:
+def _apply_send_stream(
+    subvols: SubvolumeSet, subvol: Subvol, **kwargs
+) -> SubvolumeSetMutator:
+    with subvol.mark_readonly_and_gen_send_stream_items(
+        no_data=True, **kwargs
+    ) as items:
+        mutator = SubvolumeSetMutator.new(subvols, next(items))
+        for item in items:
+            mutator.apply_item(item)
+    return mutator
+
+
+def _repr_without_utimes(ino) -> str:
+    # Installing the same files at different times is not a difference.
+    erase_utimes_in_range(ino, start=(0, 0), end=(2 ** 64, 0))
+    return repr(ino)
+
+
+def _content_hashes(subvol: Subvol, paths: List[bytes]) -> List[bytes]:
+    "Hashes all the files in one process, since `run_as_root` is slow."
+    if not paths:
+        return []
+    out = subvol.run_as_root(
+        ["xargs", "--null", "--", "sha256sum", "--binary", "--zero", "--"],
+        input=b"".join(subvol.path(p) + b"\0" for p in paths),
+        stdout=subprocess.PIPE,
+    ).stdout
+    # Each record is `<hex digest> *<path>\0`, in the order of `paths`.
+    hashes = [record.split(b" ", 1)[0] for record in out.split(b"\0")[:-1]]
+    assert len(hashes) == len(paths), (paths, out)
+    return hashes
+
+
+def _gen_diff_paths(
+    left: Subvol, right: Subvol, parent: Optional[Subvol]
+) -> Iterator[bytes]:
+    subvols = SubvolumeSet.new()
+    if parent is not None:
+        _apply_send_stream(subvols, parent)
+    diffs = list(
+        diff_subvolumes(
+            _apply_send_stream(subvols, left, parent=parent),
+            _apply_send_stream(subvols, right, parent=parent),
+            inode_repr=_repr_without_utimes,
+        )
+    )
+    # `--no-data` send-streams omit the file contents, so compare those
+    # files whose metadata matched, but whose data may have changed.
+    maybe_same = [d.path for d in diffs if d.left == d.right and d.data_changed]
+    content_differs = {
+        path
+        for path, left_hash, right_hash in zip(
+            maybe_same,
+            _content_hashes(left, maybe_same),
+            _content_hashes(right, maybe_same),
+        )
+        if left_hash != right_hash
+    }
+    for d in diffs:
+        if d.left != d.right or d.path in content_differs:
+            log.info(f"Path differs {d.path}: {d.left} != {d.right}")
+            yield d.path
+
+
+def subvol_diff(
+    left: Subvol, right: Subvol, *, parent: Optional[Subvol] = None
+) -> Iterator[Path]:
     """
     IMPORTANT: This is NOT a generic subvolume-diffing primitive, it's
     currently intended just to compare `subvols.leaf` with the output
     of `replay_rpms_and_compiler_items()`.
 
-    Returns the list of paths whose contents differs between `left` and `right`.
-    This does NOT compare filesystem metadata.
-
-    TODO: Build general comparison primitives.  Use them to make this
-    comparison stronger & faster.  Specifically:
-      - Use `btrfs_diff/` to avoid touching unchanged files, and for
-        a full metadata comparison (--no-data & incremental). Note that
-        this requires implementing incremental sendstream support.
-      - Thereafter, we should not need a `diff` shell-out, just a run an
-        Antlir-internal binary as root.
-      - Do a "smart" comparison of key files & directories, e.g. tolerate
-        only the following "allowable" `/etc/shadow` difference instead of
-        ignoring all differences:
-           $ diff TODO/old/etc/shadow TODO/new/etc/shadow
-           41c41
-           < nginx:!!:18768::::::
-           ---
-           > nginx:!!:18769::::::
+    Returns the list of paths whose contents or metadata differ between
+    `left` and `right`, ignoring only timestamps.  Both are marked
+    read-only.
+
+    When `left` and `right` are both snapshots of `parent`, pass it in.
+    Then, only the paths that changed since the `parent` are compared --
+    we model the `parent` and incremental `--no-data` send-streams of
+    both sides via `btrfs_diff`.  Otherwise, the two full `--no-data`
+    send-streams are compared.  Either way, the only files that we read
+    as root are those with equal metadata, whose data was written.
+
+    TODO: Do a "smart" comparison of key files & directories, e.g.
+    tolerate only the following "allowable" `/etc/shadow` difference
+    instead of ignoring all differences:
+       $ diff TODO/old/etc/shadow TODO/new/etc/shadow
+       41c41
+       < nginx:!!:18768::::::
+       ---
+       > nginx:!!:18769::::::
     """
-    ret = left.run_as_root(
-        [
-            "diff",
-            "--brief",
-            "--recursive",
-            "--no-dereference",
-            left.path(),
-            right.path(),
-        ],
-        env={
-            **os.environ,
-            "LANG": "C",  # We match on stdout, so get predictable strings
-        },
-        stdout=subprocess.PIPE,
-        check=False,
-    )
-
-    if ret.returncode == 0 and not ret.stdout:
-        return  # Subvolumes identical.
-    elif ret.returncode != 1 or not ret.stdout:
-        raise RuntimeError(f"diff internal error: {ret}")
-
+    if left.path() == right.path():
+        return  # Both send-streams would be for the same subvolume.
     yield from _discard_path_expected_to_differ(
-        _parse_diff_output(left.path(), right.path(), ret.stdout)
+        _gen_diff_paths(left, right, parent)
     )
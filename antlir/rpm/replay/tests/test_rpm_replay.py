@@ -75,5 +75,7 @@ class RpmReplayTestCase(unittest.TestCase):
                 ),
                 gen_replay_items=gen_replay_items,
             ) as install_subvol:
-                diff = list(subvol_diff(subvols.leaf, install_subvol))
+                diff = list(
+                    subvol_diff(subvols.leaf, install_subvol, parent=root)
+                )
                 self.assertEqual(diff, [])
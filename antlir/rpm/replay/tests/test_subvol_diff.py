@@ -4,8 +4,6 @@
 # LICENSE file in the root directory of this source tree.
 
 import unittest
-from typing import Optional
-from unittest import mock
 
 from antlir.fs_utils import Path
 from antlir.subvol_utils import TempSubvolumes
@@ -14,45 +12,6 @@ from ..subvol_diff import subvol_diff
 
 
 class ExtractNestedFeaturesTestCase(unittest.TestCase):
-    def mock_subvol_run_as_root_and_assert_raises(
-        self,
-        exception,
-        msg: str,
-        returncode: int,
-        diff_output: Optional[bytes],
-    ):
-        left_subvol = mock.Mock()
-        left_subvol.run_as_root.return_value = mock.Mock(
-            returncode=returncode, stdout=diff_output
-        )
-        left_subvol.path.return_value = b"mock/left"
-
-        right_subvol = mock.Mock()
-        right_subvol.path.return_value = b"mock/right"
-
-        with self.assertRaisesRegex(exception, msg):
-            list(subvol_diff(left_subvol, right_subvol))
-            left_subvol.run_as_root.assert_called_once()
-
-    def test_errors(self):
-        # internal diff fails to produce output
-        self.mock_subvol_run_as_root_and_assert_raises(
-            RuntimeError, "diff internal error: ", -1, None
-        )
-
-        # internal differ produces an unexpected output format
-        self.mock_subvol_run_as_root_and_assert_raises(
-            NotImplementedError, "diff line ", 1, b"wrong diff output format"
-        )
-
-        # diff found in a file whose path isn't in either subvol
-        self.mock_subvol_run_as_root_and_assert_raises(
-            AssertionError,
-            "Neither left nor right ",
-            1,
-            b"Only in fake_path: fake_file",
-        )
-
     def test_identical_subvols(self):
         with TempSubvolumes() as tmp_subvols:
             subvol = tmp_subvols.create("tmp")
@@ -81,5 +40,37 @@ class ExtractNestedFeaturesTestCase(unittest.TestCase):
 
             self.assertEqual(
                 list(subvol_diff(left_subvol, right_subvol)),
-                [b"./bar", b"./foo", b"foo.txt"],
+                [b"bar", b"foo", b"foo.txt"],
+            )
+
+    def test_subvol_diff_with_parent(self):
+        with TempSubvolumes() as tmp_subvols:
+            parent = tmp_subvols.create("parent")
+            parent.run_as_root(["mkdir", parent.path("d")])
+            for name in ["chmod", "same", "content", "unlinked", "d/f"]:
+                parent.overwrite_path_as_root(Path(name), "parent")
+            parent.set_readonly(True)
+            left = tmp_subvols.snapshot(parent, "left")
+            right = tmp_subvols.snapshot(parent, "right")
+
+            # Only one side changed the mode
+            left.run_as_root(["chmod", "0600", left.path("chmod")])
+            # Both sides wrote the same data, or data of the same length
+            for subvol, content in [(left, "samE"), (right, "samE")]:
+                subvol.overwrite_path_as_root(Path("same"), content)
+            for subvol, content in [(left, "lefty"), (right, "right")]:
+                subvol.overwrite_path_as_root(Path("content"), content)
+            right.run_as_root(["rm", right.path("unlinked")])
+            right.run_as_root(["mv", right.path("d"), right.path("e")])
+            for subvol in [left, right]:
+                # Timestamps and paths expected to differ are ignored
+                subvol.run_as_root(["touch", subvol.path("same")])
+                subvol.run_as_root(["mkdir", "-p", subvol.path("var/log")])
+                subvol.overwrite_path_as_root(
+                    Path("var/log/dnf.log"), subvol.path()
+                )
+
+            self.assertEqual(
+                [b"chmod", b"content", b"d", b"d/f", b"e", b"e/f", b"unlinked"],
+                list(subvol_diff(left, right, parent=parent)),
             )
@@ -100,9 +100,23 @@ A database adds value in two key ways:
         snapshot_repos 0 mod 1  # produce a complete snapshot
 """
 import enum
+import itertools
 import re
+from collections import defaultdict
 from contextlib import AbstractContextManager, contextmanager
-from typing import ContextManager, FrozenSet, Iterator, Optional, Tuple, Union
+from typing import (
+    ContextManager,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from antlir.common import byteme
 
@@ -115,6 +129,24 @@ from .repo_objects import Checksum, Repodata, RepoMetadata, Rpm
 # since it's 2020 and `json.dumps` / `repr` are cheap enough.
 _VALID_UNIVERSE_REGEX = re.compile("^[a-zA-Z0-9.]*$")
 
+# The bulk queries, which look up or store many objects per statement, bind
+# a few placeholders per object.  Older SQLite builds allow at most 999
+# placeholders per statement.
+_MAX_PLACEHOLDERS = 900
+
+_NEVRA_COLUMNS = ("name", "epoch", "version", "release", "arch")
+
+
+def _nevra_key(rpm: Rpm) -> tuple:
+    "The values of `_NEVRA_COLUMNS`"
+    return (rpm.name, rpm.epoch, rpm.version, rpm.release, rpm.arch)
+
+
+def _batches(items: Sequence, placeholders_per_item: int) -> Iterator[List]:
+    batch_size = max(1, _MAX_PLACEHOLDERS // placeholders_per_item)
+    for i in range(0, len(items), batch_size):
+        yield list(items[i : i + batch_size])
+
 
 def validate_universe_name(u):
     if not _VALID_UNIVERSE_REGEX.match(u):
@@ -412,6 +444,18 @@ class RepoDBContext(AbstractContextManager):
     def _identifiers(self, identifiers):
         return ", ".join(f"`{i}`" for i in identifiers)
 
+    def _any_key_matches(self, columns, num_keys: int) -> str:
+        """
+        A `WHERE` clause for `num_keys` sets of values of `columns`.  This
+        is a row-value `IN`, which both MySQL and SQLite (3.15+) accept,
+        since an `OR` chain of `num_keys` terms is far slower to parse and
+        plan.  Like `=`, it never matches NULLs.
+        """
+        p = self._placeholder()
+        one_key = ", ".join([p] * len(columns))
+        keys = ", ".join([f"({one_key})"] * num_keys)
+        return f"({self._identifiers(columns)}) IN ({keys})"
+
     def ensure_tables_exist(self, _ensure_line_is_covered=lambda: None):
         # Future: it would be better if this function checked that the table
         # schemas in the DB are exactly as we would create them, and that
@@ -534,7 +578,15 @@ class RepoDBContext(AbstractContextManager):
             # pyre-fixme[7]: Expected `Tuple[str, antlir.rpm.common.Checksum]`
             #  but got `Tuple[None, None]`.
             return None, None
+        return self._rpm_storage_id_and_checksum(tbl, rpm, results)
 
+    def _rpm_storage_id_and_checksum(
+        self, tbl: RpmTable, rpm: Rpm, results
+    ) -> Tuple[str, Checksum]:
+        """
+        `results` are the rows of `rpm`'s NEVRA & universe that match its
+        `checksum`, with the columns of `tbl.column_names()` & `storage_id`.
+        """
         # We can get multiple results:
         #  - at most 1 match on the `checksum` column
         #  - many matches on the `canonical_checksum` column
@@ -559,6 +611,57 @@ class RepoDBContext(AbstractContextManager):
         assert rpm.checksum in (other_checksums | canonical_checksums)
         return (storage_ids.pop(), canonical_checksums.pop())
 
+    def get_rpm_storage_ids_and_checksums(
+        self, tbl: RpmTable, rpms: Iterable[Rpm]
+    ) -> Dict[Rpm, Tuple[str, Checksum]]:
+        """
+        Bulk `get_rpm_storage_id_and_checksum`, which makes one query per
+        batch of NEVRAs, instead of one query per RPM.  RPMs that are not
+        yet stored are omitted from the result.
+        """
+        rpms = list(rpms)
+        assert all(rpm.canonical_checksum is None for rpm in rpms), rpms
+        col_names = tbl.column_names()
+        nevra_idxs = [col_names.index(c) for c in _NEVRA_COLUMNS]
+        checksum_idx = col_names.index("checksum")
+        canonical_idx = col_names.index("canonical_checksum")
+        nevra_to_results = defaultdict(list)
+        p = self._placeholder()
+        with self._cursor() as cursor:
+            for batch in _batches(
+                list(dict.fromkeys(_nevra_key(rpm) for rpm in rpms)),
+                len(_NEVRA_COLUMNS),
+            ):
+                cursor.execute(
+                    f"""
+                    SELECT {self._identifiers(col_names)}, `storage_id`
+                    FROM `{tbl.NAME}`
+                    WHERE `universe` = {p} AND (
+                        {self._any_key_matches(_NEVRA_COLUMNS, len(batch))}
+                    )
+                """,
+                    (tbl._universe, *itertools.chain.from_iterable(batch)),
+                )
+                for db_values in cursor.fetchall():
+                    nevra_to_results[
+                        tuple(db_values[i] for i in nevra_idxs)
+                    ].append(db_values)
+        rpm_to_storage_id_and_checksum = {}
+        for rpm in rpms:
+            checksum = str(rpm.checksum)
+            # The same filter as the `WHERE` of the single-RPM query.
+            results = [
+                db_values
+                for db_values in nevra_to_results.get(_nevra_key(rpm), ())
+                if checksum
+                in (db_values[checksum_idx], db_values[canonical_idx])
+            ]
+            if results:
+                rpm_to_storage_id_and_checksum[
+                    rpm
+                ] = self._rpm_storage_id_and_checksum(tbl, rpm, results)
+        return rpm_to_storage_id_and_checksum
+
     def get_rpm_canonical_checksums_per_universe(
         self, table: RpmTable, rpm: Rpm, all_snapshot_universes: FrozenSet[str]
     ) -> Iterator[Tuple[Checksum, str]]:
@@ -598,6 +701,47 @@ class RepoDBContext(AbstractContextManager):
             for (canonical_checksum, universe) in cursor.fetchall():
                 yield (Checksum.from_string(canonical_checksum), universe)
 
+    def get_rpms_canonical_checksums_per_universe(
+        self,
+        table: RpmTable,
+        rpms: Iterable[Rpm],
+        all_snapshot_universes: FrozenSet[str],
+    ) -> Dict[str, Set[Tuple[Checksum, str]]]:
+        """
+        Bulk `get_rpm_canonical_checksums_per_universe`, keyed by
+        `Rpm.nevra()`.  NEVRAs without any rows are omitted.
+        """
+        p = self._placeholder()
+        assert table._universe in all_snapshot_universes
+        all_snapshot_universe_ps = ", ".join([p] * len(all_snapshot_universes))
+        nevra_key_to_nevra = {_nevra_key(rpm): rpm.nevra() for rpm in rpms}
+        nevra_to_checksums_and_universes = defaultdict(set)
+        with self._cursor() as cursor:
+            for batch in _batches(
+                list(nevra_key_to_nevra), len(_NEVRA_COLUMNS)
+            ):
+                cursor.execute(
+                    f"""
+                    SELECT {self._identifiers(_NEVRA_COLUMNS)},
+                        `canonical_checksum`, `universe`
+                    FROM `{table.NAME}`
+                    WHERE `universe` IN ({all_snapshot_universe_ps}) AND (
+                        {self._any_key_matches(_NEVRA_COLUMNS, len(batch))}
+                    )
+                """,
+                    (
+                        *all_snapshot_universes,
+                        *itertools.chain.from_iterable(batch),
+                    ),
+                )
+                for *nevra_key, canonical_checksum, universe in (
+                    cursor.fetchall()
+                ):
+                    nevra_to_checksums_and_universes[
+                        nevra_key_to_nevra[tuple(nevra_key)]
+                    ].add((Checksum.from_string(canonical_checksum), universe))
+        return dict(nevra_to_checksums_and_universes)
+
     def get_storage_id(
         self, table: StorageTable, obj: Union["Rpm", Repodata]
     ) -> Optional[str]:
@@ -622,19 +766,62 @@ class RepoDBContext(AbstractContextManager):
             if not results:
                 return None
             (db_values,) = results
-            # Check that the DB columns we got back agree with `obj`.
-            for col_name, db_val, val in zip(
-                table.column_names(), db_values[:-1], table.column_values(obj)
+            return self._checked_storage_id(table, obj, db_values)
+
+    def _checked_storage_id(
+        self, table: StorageTable, obj: Union["Rpm", Repodata], db_values
+    ) -> str:
+        "Check that the DB columns we got back agree with `obj`."
+        for col_name, db_val, val in zip(
+            table.column_names(), db_values[:-1], table.column_values(obj)
+        ):
+            # This `if` is explained in the `Repodata.build_timestamp`
+            # doc.  In essence, we could have seen the same repodata
+            # from a `repomd.xml` that was built either earlier or later
+            # than the one already in the DB.
+            if not (col_name == "build_timestamp" and type(obj) is Repodata):
+                assert db_val == val, (db_val, val, obj)
+        return db_values[-1]  # We put `storage_id` last
+
+    def get_storage_ids(
+        self, table: StorageTable, objs: Iterable[Union["Rpm", Repodata]]
+    ) -> List[Optional[str]]:
+        "Bulk `get_storage_id`, returns storage IDs in the order of `objs`."
+        objs = list(objs)
+        col_names = table.column_names()
+        # pyre-fixme[16]: `StorageTable` has no attribute `KEY_COLUMNS`.
+        key_columns = table.KEY_COLUMNS
+        key_idxs = [col_names.index(c) for c in key_columns]
+        # pyre-fixme[16]: `StorageTable` has no attribute `NAME`.
+        table_name = table.NAME
+        key_to_db_values = {}
+        with self._cursor() as cursor:
+            for batch in _batches(
+                # pyre-fixme[16]: `StorageTable` has no attribute `key`.
+                list(dict.fromkeys(table.key(obj) for obj in objs)),
+                len(key_columns),
             ):
-                # This `if` is explained in the `Repodata.build_timestamp`
-                # doc.  In essence, we could have seen the same repodata
-                # from a `repomd.xml` that was built either earlier or later
-                # than the one already in the DB.
-                if not (
-                    col_name == "build_timestamp" and type(obj) is Repodata
-                ):
-                    assert db_val == val, (db_val, val, obj)
-            return db_values[-1]  # We put `storage_id` last
+                cursor.execute(
+                    f"""
+                    SELECT {self._identifiers(col_names)}, `storage_id`
+                    FROM `{table_name}`
+                    WHERE {self._any_key_matches(key_columns, len(batch))}
+                """,
+                    tuple(itertools.chain.from_iterable(batch)),
+                )
+                for db_values in cursor.fetchall():
+                    key_to_db_values[
+                        tuple(db_values[i] for i in key_idxs)
+                    ] = db_values
+        storage_ids = []
+        for obj in objs:
+            db_values = key_to_db_values.get(table.key(obj))
+            storage_ids.append(
+                None
+                if db_values is None
+                else self._checked_storage_id(table, obj, db_values)
+            )
+        return storage_ids
 
     def maybe_store(self, table: StorageTable, obj, storage_id: str) -> str:
         """
@@ -667,5 +854,48 @@ class RepoDBContext(AbstractContextManager):
             # pyre-fixme[7]: Expected `str` but got `Optional[str]`.
             return self.get_storage_id(table, obj)
 
+    def maybe_store_many(
+        self,
+        table: StorageTable,
+        objs_and_storage_ids: Iterable[Tuple[Union["Rpm", Repodata], str]],
+    ) -> List[str]:
+        """
+        Bulk `maybe_store`, which inserts a batch of objects per statement.
+        Returns the storage IDs in the order of `objs_and_storage_ids`,
+        pre-existing ones where an object had already been stored.
+        """
+        objs_and_storage_ids = list(objs_and_storage_ids)
+        # See `maybe_store` for why this matters.
+        assert all(sid is not None for _, sid in objs_and_storage_ids)
+        col_names = table.column_names()
+        row_ps = f"({', '.join([self._placeholder()] * (len(col_names) + 1))})"
+        # pyre-fixme[16]: `StorageTable` has no attribute `NAME`.
+        table_name = table.NAME
+        storage_ids = []
+        with self._cursor() as cursor:
+            for batch in _batches(objs_and_storage_ids, len(col_names) + 1):
+                cursor.execute(
+                    f"""
+                    INSERT {self._or_ignore()} INTO `{table_name}`
+                    ({self._identifiers(col_names)}, `storage_id`)
+                    VALUES {', '.join([row_ps] * len(batch))}
+                """,
+                    tuple(
+                        itertools.chain.from_iterable(
+                            (*table.column_values(obj), sid)
+                            for obj, sid in batch
+                        )
+                    ),
+                )
+                if cursor.rowcount == len(batch):
+                    # We won the race to insert all of our storage IDs
+                    storage_ids.extend(sid for _, sid in batch)
+                else:
+                    # Some objects were already stored, find their IDs.
+                    storage_ids.extend(
+                        self.get_storage_ids(table, (obj for obj, _ in batch))
+                    )
+        return storage_ids
+
     def commit(self):
         self._conn.commit()
@@ -10,7 +10,20 @@ previously produced by `snapshot-repos`.
 
 Validates content checksums, so the snapshot's blobstore does not have to be
 100% trustworthy, we just need to trust the provenance of the
-`--snapshot-dir`.
+`--snapshot-dir`.  Each blob is verified once per server lifetime -- blobs
+in local files are then served via `sendfile`, see `do_GET`.
+
+With `--blob-cache-dir`, blobs from non-local storage are also kept in an
+on-host cache after they are verified, see `blob_cache.py`.  The cache is
+shared by all `repo-server`s on the host, so it outlives this process.
+
+Connections are served concurrently, with HTTP/1.1 keep-alive.
+
+With `--daemon-socket`, one long-lived server per snapshot serves many
+containers, which share its caches, see `serve_repo_server_daemon`.
+
+Startup is fast even for huge snapshots, since RPMs & repodata are looked
+up in the snapshot DB on demand, see `SnapshotDBLocationToObj`.
 
 Here is how to run a test invocation of this server:
 
@@ -26,24 +39,35 @@ Here is how to run a test invocation of this server:
   ' buck-out/gen/antlir/rpm/repo-server.par --snapshot-dir YOUR_SNAPSHOT/
 
 """
+import fcntl
+import functools
 import json
 import os
 import socket
 import sqlite3
+import threading
 import time
 import urllib.parse
+from contextlib import ExitStack
 
 # pyre-fixme[21]: Could not find name `HTTPStatus` in `http.server`.
 from http.server import BaseHTTPRequestHandler, HTTPStatus
-from socketserver import BaseServer
-from typing import Mapping, Tuple
-
-from antlir.common import get_logger, init_logging, set_new_key
+from socketserver import BaseServer, ThreadingMixIn
+from typing import Callable, Dict, Iterator, Mapping, Optional, Set, Tuple
+
+from antlir.common import (
+    FD_UNIX_SOCK_TIMEOUT,
+    get_logger,
+    init_logging,
+    recv_fds,
+    set_new_key,
+)
 from antlir.fs_utils import Path
 
+from .blob_cache import BlobCache, BlobCacheWriter
 from .common import Checksum, readonly_snapshot_db, snapshot_subdir
 from .repo_snapshot import FileIntegrityError, ReportableError
-from .storage import Storage
+from .storage import Storage, StorageInput
 
 
 log = get_logger()
@@ -51,18 +75,139 @@ log = get_logger()
 # How big are our reads against Storage? Exposed for the unit test.
 _CHUNK_SIZE = 2 ** 21
 
+# With a threaded server, two requests may discover the same integrity
+# error at once, and only one of them should memoize it.
+_MEMOIZE_ERROR_LOCK = threading.Lock()
+
+# `launch_repo_servers.py` runs the `repo-server` that is inside the
+# snapshot, which may predate `--blob-cache-dir`, so the flags also default
+# to these environment variables, which older servers ignore.
+BLOB_CACHE_DIR_ENV = "ANTLIR_REPO_SERVER_BLOB_CACHE_DIR"
+BLOB_CACHE_MAX_BYTES_ENV = "ANTLIR_REPO_SERVER_BLOB_CACHE_MAX_BYTES"
+_DEFAULT_BLOB_CACHE_MAX_BYTES = 20 * 2 ** 30
+
+# A `--daemon-socket` server outlives its clients by this many seconds, so
+# that back-to-back containers can reuse its caches.
+_DEFAULT_DAEMON_IDLE_TIMEOUT = 600
+# Clients send their sockets with a short, unused message.
+_DAEMON_MSG_LEN = 128
+_DAEMON_MAX_FDS = 64
+
+
+def _obj_from_row(
+    build_timestamp, checksum, error, error_json, size, storage_id
+) -> dict:
+    obj = {
+        "checksum": checksum,
+        "size": size,
+        "build_timestamp": build_timestamp,
+    }
+    # `storage_id` is populated in the DB table for `mutable_rpm`
+    # errors, but we don't want to serve up those files.
+    if storage_id and not error and not error_json:
+        obj["storage_id"] = storage_id
+    elif error and error_json:
+        obj["error"] = {"error": error, **json.loads(error_json)}
+    else:  # pragma: no cover
+        raise AssertionError(f"{storage_id} {error} {error_json}")
+    return obj
+
+
+class SnapshotDBLocationToObj(Mapping[str, dict]):
+    """
+    A `location_to_obj` that looks up "repodata" and "rpm" rows in the
+    snapshot DB on demand, via their `("repo", "path")` primary keys.
+    Copying 100k+ rows into a `dict` at startup would delay every
+    container that starts a `repo-server`, and would cost tens of MB per
+    server, while a typical container only fetches a few objects.
+
+    The `repomd.xml`s, and GPG keys are few & small, so they are loaded
+    up-front into `_overlay`.  The objects that we looked up recently are
+    kept in an LRU cache, so that `HEAD` followed by `GET` does not query
+    the DB twice.
+
+    `RepoSnapshotHTTPRequestHandler` writes objects with memoized errors
+    back to `location_to_obj`.  Those go in `_overlay`, since the LRU
+    would eventually forget them, and the DB row lacks the error.
+    """
+
+    def __init__(
+        self,
+        db: sqlite3.Connection,
+        overlay: Dict[str, dict],
+        *,
+        cache_size: int = 4096,
+    ):
+        # Queried from the server's threads, so `db` must be opened with
+        # `check_same_thread=False`.
+        self._db = db
+        self._db_lock = threading.Lock()
+        self._overlay = overlay
+        self._repos = {
+            repo for (repo,) in db.execute('SELECT "repo" FROM "repomd"')
+        }
+        self._cached_query = functools.lru_cache(maxsize=cache_size)(
+            self._query
+        )
 
-# Future: we could query the RPM table lazily, which would save ~1 second of
-# startup time for the FB production repo snapshot.
-def add_snapshot_db_objs(db):
-    location_to_obj = {}
+    def _query(self, location: str) -> Optional[dict]:
+        # Repo names might contain `/`, so try every prefix of `location`
+        # that names a repo.
+        for idx, char in enumerate(location):
+            if char != "/" or location[:idx] not in self._repos:
+                continue
+            for table in ["repodata", "rpm"]:
+                with self._db_lock:
+                    row = self._db.execute(
+                        f"""
+                    SELECT
+                        "build_timestamp", "checksum", "error",
+                        "error_json", "size", "storage_id"
+                    FROM "{table}" WHERE "repo" = ? AND "path" = ?
+                    """,
+                        (location[:idx], location[idx + 1 :]),
+                    ).fetchone()
+                if row is not None:
+                    return _obj_from_row(*row)
+        return None
+
+    def __getitem__(self, location: str) -> dict:
+        obj = self._overlay.get(location)
+        if obj is None:
+            obj = self._cached_query(location)
+        if obj is None:
+            raise KeyError(location)
+        return obj
+
+    def __setitem__(self, location: str, obj: dict) -> None:
+        self._overlay[location] = obj
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._overlay
+        for table in ["repodata", "rpm"]:
+            with self._db_lock:
+                rows = self._db.execute(
+                    f'SELECT "repo", "path" FROM "{table}"'
+                ).fetchall()
+            for repo, path in rows:
+                location = os.path.join(repo, path)
+                if location not in self._overlay:
+                    yield location
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def read_snapshot_dir(snapshot_dir: Path) -> SnapshotDBLocationToObj:
+    db = readonly_snapshot_db(snapshot_dir, check_same_thread=False)
+    overlay = {}
     for repo, build_timestamp, metadata_xml in db.execute(
         """
     SELECT "repo", "build_timestamp", "metadata_xml" FROM "repomd"
     """
     ).fetchall():
         set_new_key(
-            location_to_obj,
+            overlay,
             os.path.join(repo, "repodata/repomd.xml"),
             {
                 "size": len(metadata_xml),
@@ -70,44 +215,6 @@ def add_snapshot_db_objs(db):
                 "content_bytes": metadata_xml.encode(),
             },
         )
-    for table in ["repodata", "rpm"]:
-        for (
-            repo,
-            path,
-            build_timestamp,
-            checksum,
-            error,
-            error_json,
-            size,
-            storage_id,
-        ) in db.execute(
-            f"""
-        SELECT
-            "repo", "path", "build_timestamp", "checksum", "error",
-            "error_json", "size", "storage_id"
-        FROM "{table}"
-        """
-        ).fetchall():
-            obj = {
-                "checksum": checksum,
-                "size": size,
-                "build_timestamp": build_timestamp,
-            }
-            # `storage_id` is populated in the DB table for `mutable_rpm`
-            # errors, but we don't want to serve up those files.
-            if storage_id and not error and not error_json:
-                obj["storage_id"] = storage_id
-            elif error and error_json:
-                obj["error"] = {"error": error, **json.loads(error_json)}
-            else:  # pragma: no cover
-                raise AssertionError(f"{storage_id} {error} {error_json}")
-            set_new_key(location_to_obj, os.path.join(repo, path), obj)
-    return location_to_obj
-
-
-def read_snapshot_dir(snapshot_dir: Path):
-    with readonly_snapshot_db(snapshot_dir) as db:
-        location_to_obj = add_snapshot_db_objs(db)
     repos_dir = snapshot_subdir(snapshot_dir) / "repos"
     for repo in repos_dir.listdir():
         # Make JSON metadata for the repo's GPG keys.
@@ -115,19 +222,29 @@ def read_snapshot_dir(snapshot_dir: Path):
         for key_filename in key_dir.listdir():
             with open(key_dir / key_filename, "rb") as infile:
                 key_content = infile.read()
-            location_to_obj[(repo / key_filename).decode()] = {
+            overlay[(repo / key_filename).decode()] = {
                 "size": len(key_content),
                 # We don't have a good timestamp for these, so set it to
                 # "now".  Caching efficiency losses should be negligible :)
                 "build_timestamp": int(time.time()),
                 "content_bytes": key_content,  # Instead of `storage_id`
             }
-    return location_to_obj
+    return SnapshotDBLocationToObj(db, overlay)
+
+
+def _verified_blob_key(obj: dict) -> Tuple[str, str, int]:
+    return (obj["storage_id"], obj["checksum"], obj["size"])
 
 
 class RepoSnapshotHTTPRequestHandler(BaseHTTPRequestHandler):
     server_version = "RPMRepoSnapshot"
-    protocol_version = "HTTP/1.0"
+    # Keep-alive lets `yum` and `dnf` fetch all the RPMs of a transaction
+    # over a few reused connections.  Every response has a
+    # `Content-Length`, and we close the connection on integrity errors,
+    # since the client would otherwise wait for the rest of the body.
+    protocol_version = "HTTP/1.1"
+    # Close idle keep-alive connections, freeing their server threads.
+    timeout = 60
 
     def __init__(
         self,
@@ -136,23 +253,42 @@ class RepoSnapshotHTTPRequestHandler(BaseHTTPRequestHandler):
         # retries from succeeding.
         location_to_obj: Mapping[str, dict],
         storage: Storage,
+        # Blobs whose checksums were verified since the server started,
+        # see `_verified_blob_key`.
+        verified_blobs: Optional[Set[Tuple[str, str, int]]] = None,
+        # On-host cache of verified blobs, shared with other servers.
+        blob_cache: Optional[BlobCache] = None,
         **kwargs,
     ):
         self.location_to_obj = location_to_obj
         self.storage = storage
+        self.verified_blobs = (
+            set() if verified_blobs is None else verified_blobs
+        )
+        self.blob_cache = blob_cache
         super().__init__(*args, **kwargs)
 
-    def _memoize_error(self, obj, error: ReportableError):
+    def _memoize_error(self, location: str, obj, error: ReportableError):
         """
         Any size or checksum errors we see are likely to be permanent, so we
         MUTATE `obj` with the error, hiding the old `storage_id` inside.
+        `obj` is also stored back into `location_to_obj`, in case that is a
+        `SnapshotDBLocationToObj`, which could otherwise forget it.
+
+        Our caller stops sending the body, so the connection must close.
         """
-        error_dict = {
-            **error.to_dict(),
-            # Since `storage_id` is hidden, `send_head` will show the error.
-            "storage_id": obj.pop("storage_id"),
-        }
-        set_new_key(obj, "error", error_dict)
+        self.close_connection = True
+        with _MEMOIZE_ERROR_LOCK:
+            if "error" in obj:  # pragma: no cover
+                return  # A concurrent request already memoized an error.
+            error_dict = {
+                **error.to_dict(),
+                # Since `storage_id` is hidden, `send_head` will show the
+                # error.
+                "storage_id": obj.pop("storage_id"),
+            }
+            set_new_key(obj, "error", error_dict)
+            self.location_to_obj[location] = obj
 
     # The default logging implementation does not flush. Gross.
     def log_message(self, format, *args, _antlir_logger=log.debug):
@@ -177,49 +313,90 @@ class RepoSnapshotHTTPRequestHandler(BaseHTTPRequestHandler):
         if "content_bytes" in obj:
             self.wfile.write(obj["content_bytes"])
             return
+        if self._sendfile_cached_blob(obj):
+            log.debug(f"Sent {location} from the blob cache")
+            return
+
+        # pyre-fixme[16]: `Storage` has no attribute `reader`.
+        with self.storage.reader(obj["storage_id"]) as input:
+            log.debug(f"Got storage for {location}")
+            if not self._sendfile_verified_blob(obj, input):
+                self._send_and_verify_blob(location, obj, input)
+
+        log.debug(f"Normal exit for GET {location}")
 
+    def _sendfile_verified_blob(self, obj: dict, input: StorageInput) -> bool:
+        """
+        Returns False if we cannot send the blob without verifying it.
+
+        A blob that we already verified, which is a regular file on a local
+        filesystem (as with `FilesystemStorage`), is sent by the kernel via
+        `sendfile`, without a copy or a re-hash in Python.  We still check
+        the size, in case the blob was truncated or replaced.
+        """
+        if _verified_blob_key(obj) not in self.verified_blobs:
+            return False
+        local_file = input.local_file()
+        if (
+            local_file is None
+            or os.fstat(local_file.fileno()).st_size != obj["size"]
+        ):
+            return False
+        self.connection.sendfile(local_file, 0, obj["size"])
+        return True
+
+    def _sendfile_cached_blob(self, obj: dict) -> bool:
+        "Returns False if the blob is not in the on-host blob cache."
+        if self.blob_cache is None:
+            return False
+        cached = self.blob_cache.open(obj["checksum"], obj["size"])
+        if cached is None:
+            return False
+        with cached:
+            self.connection.sendfile(cached, 0, obj["size"])
+        return True
+
+    def _send_and_verify_blob(
+        self, location: str, obj: dict, input: StorageInput
+    ) -> None:
         # This binary blob must be fetched from `self.storage`. We don't
         # trust our storage, so we have to verify the checksum before
         # sending the entire blob back to the client.
+        with ExitStack() as stack:
+            # Local blobs are already cheap to read, don't copy them.
+            cache_writer = (
+                stack.enter_context(
+                    self.blob_cache.writer(obj["checksum"], obj["size"])
+                )
+                if self.blob_cache is not None and input.local_file() is None
+                else None
+            )
+            if (
+                self._send_and_verify_chunks(location, obj, input, cache_writer)
+                and cache_writer
+            ):
+                cache_writer.commit()
+
+    def _send_and_verify_chunks(
+        self,
+        location: str,
+        obj: dict,
+        input: StorageInput,
+        cache_writer: Optional[BlobCacheWriter],
+    ) -> bool:
+        "Returns True if the whole blob was sent, and passed verification."
+
         bytes_left = obj["size"]
         checksum = Checksum.from_string(obj["checksum"])
-        # pyre-fixme[16]: `Storage` has no attribute `reader`.
-        with self.storage.reader(obj["storage_id"]) as input:
-            log.debug(f"Got storage for {location}")
-            hash = checksum.hasher()
-            while True:
-                chunk = input.read(_CHUNK_SIZE)
-                log.debug(f"{len(chunk)}-byte chunk for {location}")
-                bytes_left -= len(chunk)
-                if not chunk:
-                    if bytes_left != 0:  # The client will see an error.
-                        self._memoize_error(
-                            obj,
-                            FileIntegrityError(
-                                location=location,
-                                failed_check="size",
-                                expected=obj["size"],
-                                actual=obj["size"] - bytes_left,
-                            ),
-                        )
-                    break
-
-                #
-                # Check for errors **before** sending out more data -- this
-                # might be the last chunk, and so we signal errors by
-                # refusing to send the last bit of data.
-                #
-
-                # It's possible that we have a chunk after the last chunk,
-                # but we don't want to send that last chunk since the client
-                # might conclude all is well upon receiving enough data.
-                if bytes_left == 0:
-                    # The next `if` will error if we get a non-empty chunk.
-                    # The error's `actual=` might be an underestimate.
-                    bytes_left -= len(input.read())
-
-                if bytes_left < 0:
+        hash = checksum.hasher()
+        while True:
+            chunk = input.read(_CHUNK_SIZE)
+            log.debug(f"{len(chunk)}-byte chunk for {location}")
+            bytes_left -= len(chunk)
+            if not chunk:
+                if bytes_left != 0:  # The client will see an error.
                     self._memoize_error(
+                        location,
                         obj,
                         FileIntegrityError(
                             location=location,
@@ -228,25 +405,58 @@ class RepoSnapshotHTTPRequestHandler(BaseHTTPRequestHandler):
                             actual=obj["size"] - bytes_left,
                         ),
                     )
-                    break  # Incomplete content, client will see an error.
-
-                hash.update(chunk)
-                if bytes_left == 0 and hash.hexdigest() != checksum.hexdigest:
-                    self._memoize_error(
-                        obj,
-                        FileIntegrityError(
-                            location=location,
-                            failed_check=checksum.algorithm,
-                            expected=checksum.hexdigest,
-                            actual=hash.hexdigest(),
-                        ),
-                    )
-                    break  # Incomplete content, client will see an error.
-
-                # If this is the last chunk, the stream was error-free.
-                self.wfile.write(chunk)
-
-        log.debug(f"Normal exit for GET {location}")
+                break
+
+            #
+            # Check for errors **before** sending out more data -- this
+            # might be the last chunk, and so we signal errors by
+            # refusing to send the last bit of data.
+            #
+
+            # It's possible that we have a chunk after the last chunk,
+            # but we don't want to send that last chunk since the client
+            # might conclude all is well upon receiving enough data.
+            if bytes_left == 0:
+                # The next `if` will error if we get a non-empty chunk.
+                # The error's `actual=` might be an underestimate.
+                bytes_left -= len(input.read())
+
+            if bytes_left < 0:
+                self._memoize_error(
+                    location,
+                    obj,
+                    FileIntegrityError(
+                        location=location,
+                        failed_check="size",
+                        expected=obj["size"],
+                        actual=obj["size"] - bytes_left,
+                    ),
+                )
+                break  # Incomplete content, client will see an error.
+
+            hash.update(chunk)
+            if bytes_left == 0 and hash.hexdigest() != checksum.hexdigest:
+                self._memoize_error(
+                    location,
+                    obj,
+                    FileIntegrityError(
+                        location=location,
+                        failed_check=checksum.algorithm,
+                        expected=checksum.hexdigest,
+                        actual=hash.hexdigest(),
+                    ),
+                )
+                break  # Incomplete content, client will see an error.
+
+            # If this is the last chunk, the stream was error-free.
+            self.wfile.write(chunk)
+            if cache_writer:
+                cache_writer.write(chunk)
+
+        if bytes_left == 0 and "error" not in obj:
+            self.verified_blobs.add(_verified_blob_key(obj))
+            return True
+        return False
 
     def do_HEAD(self):
         self.send_head()
@@ -367,19 +577,173 @@ class HTTPSocketServer(BaseServer):
         request.close()
 
 
-def repo_server(sock, location_to_obj: Mapping[str, dict], storage: Storage):
+class _SingleThreadedRequestHandler(RepoSnapshotHTTPRequestHandler):
+    # With keep-alive, one client could monopolize a single-threaded server.
+    protocol_version = "HTTP/1.0"
+
+
+class ThreadingHTTPSocketServer(ThreadingMixIn, HTTPSocketServer):
+    """
+    Serves each connection on its own thread, so that `dnf`'s parallel
+    downloads are not serialized.  The work is mostly I/O, or hashing and
+    `sendfile`, which release the GIL.
+    """
+
+    # Threads may be waiting on idle keep-alive connections, so shutdown
+    # should not wait for them.
+    daemon_threads = True
+
+
+def repo_server(
+    sock,
+    location_to_obj: Mapping[str, dict],
+    storage: Storage,
+    *,
+    threaded: bool = True,
+    blob_cache: Optional[BlobCache] = None,
+    verified_blobs: Optional[Set[Tuple[str, str, int]]] = None,
+):
     """
     BEWARE: `location_to_obj` is mutated if we discover checksum errors to
     prevent client retries from succeeding.
+
+    `verified_blobs` may be shared by several servers, see
+    `serve_repo_server_daemon`.
     """
-    return HTTPSocketServer(
+    # Shared by all requests, so that each blob is verified just once.
+    if verified_blobs is None:
+        verified_blobs = set()
+    handler_cls = (
+        RepoSnapshotHTTPRequestHandler
+        if threaded
+        else _SingleThreadedRequestHandler
+    )
+    return (ThreadingHTTPSocketServer if threaded else HTTPSocketServer)(
         sock,
-        lambda *args, **kwargs: RepoSnapshotHTTPRequestHandler(
-            *args, location_to_obj=location_to_obj, storage=storage, **kwargs
+        lambda *args, **kwargs: handler_cls(
+            *args,
+            location_to_obj=location_to_obj,
+            storage=storage,
+            verified_blobs=verified_blobs,
+            blob_cache=blob_cache,
+            **kwargs,
         ),
     )
 
 
+def _serve_daemon_client(
+    conn: socket.socket,
+    make_server: Callable[[socket.socket], HTTPSocketServer],
+    on_done: Callable[[], None],
+):
+    """
+    Serves the listening sockets that the client sends with its first
+    message, until the client closes the connection.
+    """
+    try:
+        with conn, ExitStack() as stack:
+            conn.settimeout(FD_UNIX_SOCK_TIMEOUT)
+            _msg, fds = recv_fds(conn, _DAEMON_MSG_LEN, _DAEMON_MAX_FDS)
+            socks = [
+                stack.enter_context(socket.socket(fileno=fd)) for fd in fds
+            ]
+            for sock in socks:
+                httpd = stack.enter_context(make_server(sock))
+                threading.Thread(
+                    name=f"RpSrv{sock.fileno()}",
+                    target=httpd.serve_forever,
+                    daemon=True,
+                ).start()
+                stack.callback(httpd.shutdown)
+            conn.sendall(b"serving")
+            log.debug(f"`repo-server` daemon is serving {len(socks)} sockets")
+            # The client holds the connection open for as long as it needs
+            # the sockets served -- e.g. until its container exits.
+            conn.settimeout(None)
+            while conn.recv(_DAEMON_MSG_LEN):
+                pass  # pragma: no cover
+    finally:
+        on_done()
+
+
+def serve_repo_server_daemon(
+    listen_sock: socket.socket,
+    make_server: Callable[[socket.socket], HTTPSocketServer],
+    *,
+    idle_timeout: float,
+):
+    """
+    Lets many containers share one `repo-server` process, and thus one
+    `location_to_obj`, `verified_blobs`, and `blob_cache`.  Clients connect
+    to the Unix socket `listen_sock`, and send listening TCP sockets, see
+    `launch_repo_servers.py`.  Each gets served by `make_server(sock)` until
+    the client disconnects.
+
+    Returns after `idle_timeout` seconds without any clients.
+    """
+    num_clients = 0
+    num_clients_lock = threading.Lock()
+
+    def on_done():
+        nonlocal num_clients
+        with num_clients_lock:
+            num_clients -= 1
+
+    listen_sock.settimeout(idle_timeout)
+    while True:
+        try:
+            conn, _addr = listen_sock.accept()
+        except socket.timeout:
+            with num_clients_lock:
+                if num_clients == 0:
+                    log.debug("`repo-server` daemon is idle, exiting")
+                    return
+            continue
+        with num_clients_lock:
+            num_clients += 1
+        threading.Thread(
+            name="RpSrvClient",
+            target=_serve_daemon_client,
+            args=(conn, make_server, on_done),
+            daemon=True,
+        ).start()
+
+
+def _run_daemon(
+    daemon_socket: Path,
+    make_server: Callable[[socket.socket], HTTPSocketServer],
+    *,
+    idle_timeout: float,
+):  # pragma: no cover
+    # Clients that race to start a daemon for the same socket may start
+    # several, but only the one that holds the lock gets to serve.
+    lock_fd = os.open(
+        daemon_socket + b".lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600
+    )
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.debug(f"Another `repo-server` daemon serves {daemon_socket}")
+        return
+    try:
+        # A daemon that crashed may have left its socket behind.
+        if os.path.lexists(daemon_socket):
+            os.unlink(daemon_socket)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as lsock:
+            lsock.bind(daemon_socket)
+            lsock.listen()
+            try:
+                serve_repo_server_daemon(
+                    lsock, make_server, idle_timeout=idle_timeout
+                )
+            finally:
+                # Unlink before closing, so new clients start a new daemon
+                # instead of connecting to a dying one.
+                os.unlink(daemon_socket)
+    finally:
+        os.close(lock_fd)
+
+
 # Tested manually, as described in the file-level docblock.
 def main():  # pragma: no cover
     import argparse
@@ -395,13 +759,45 @@ def main():  # pragma: no cover
         help="Multi-repo snapshot directory, with per-repo subdirectories, "
         "each containing repomd.xml, repodata.json, and rpm.json",
     )
-    parser.add_argument(
+    sock_group = parser.add_mutually_exclusive_group(required=True)
+    sock_group.add_argument(
         "--socket-fd",
-        required=True,
         type=int,
         help="Listen on this socket. We assume that another process creates, "
         " binds, and (optionally) listens on the socket for us.",
     )
+    sock_group.add_argument(
+        "--daemon-socket",
+        type=Path.from_argparse,
+        help="Run as a daemon that listens on this Unix socket path, and "
+        "serves the TCP sockets that clients send over it. Exits after "
+        "--daemon-idle-timeout seconds without clients.",
+    )
+    parser.add_argument(
+        "--daemon-idle-timeout",
+        type=float,
+        default=_DEFAULT_DAEMON_IDLE_TIMEOUT,
+        help="See --daemon-socket. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--blob-cache-dir",
+        type=Path.from_argparse,
+        default=os.environ.get(BLOB_CACHE_DIR_ENV),
+        help="On-host cache of verified blobs, which may be shared by many "
+        f"servers. Defaults to ${BLOB_CACHE_DIR_ENV}, or no cache.",
+    )
+    parser.add_argument(
+        "--blob-cache-max-bytes",
+        type=int,
+        default=int(
+            os.environ.get(
+                BLOB_CACHE_MAX_BYTES_ENV, _DEFAULT_BLOB_CACHE_MAX_BYTES
+            )
+        ),
+        help="Evict the least-recently used blobs when the cache is larger "
+        f"than this. Defaults to ${BLOB_CACHE_MAX_BYTES_ENV}, or "
+        "%(default)s.",
+    )
     parser.add_argument("--debug", action="store_true", help="Log more")
     args = parser.parse_args()
     init_logging(debug=args.debug)
@@ -420,10 +816,34 @@ def main():  # pragma: no cover
             snapshot_subdir(args.snapshot_dir) / storage["base_dir"]
         ).normpath()
 
+    location_to_obj = read_snapshot_dir(args.snapshot_dir)
+    storage = Storage.from_json(storage)
+    blob_cache = (
+        BlobCache(args.blob_cache_dir, max_bytes=args.blob_cache_max_bytes)
+        if args.blob_cache_dir
+        else None
+    )
+
+    if args.daemon_socket:
+        verified_blobs = set()
+        _run_daemon(
+            args.daemon_socket,
+            lambda sock: repo_server(
+                sock,
+                location_to_obj,
+                storage,
+                blob_cache=blob_cache,
+                verified_blobs=verified_blobs,
+            ),
+            idle_timeout=args.daemon_idle_timeout,
+        )
+        return
+
     with repo_server(
         socket.socket(fileno=args.socket_fd),
-        read_snapshot_dir(args.snapshot_dir),
-        Storage.from_json(storage),
+        location_to_obj,
+        storage,
+        blob_cache=blob_cache,
     ) as httpd:
         # In the current usage, we start listening in `_launch_repo_server`,
         # but leaving this here should be harmless.
@@ -90,6 +90,8 @@ def snapshot_repo(argv):
                     storage_cfg=args.storage,
                     rpm_shard=args.rpm_shard,
                     threads=args.threads,
+                    max_connections_per_host=args.max_connections_per_host,
+                    content_addressed_storage=args.content_addressed_storage,
                 ),
             )
         )
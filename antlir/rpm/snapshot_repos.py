@@ -33,7 +33,7 @@ import os
 import sys
 from configparser import ConfigParser
 from io import StringIO
-from typing import Callable, Dict, FrozenSet, Iterable, List
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
 
 from antlir.common import get_logger, init_logging
 from antlir.fs_utils import Path, create_ro, populate_temp_dir_and_rename
@@ -125,6 +125,8 @@ def snapshot_repos(
     gpg_key_allowlist_dir: str,
     exclude: FrozenSet[str],
     threads: int,
+    max_connections_per_host: Optional[int] = None,
+    content_addressed_storage: bool = False,
 ):
     all_repos_sizer = RepoSizer()
     shard_sizer = RepoSizer()
@@ -157,6 +159,8 @@ def snapshot_repos(
                 storage_cfg=storage_cfg,
                 rpm_shard=rpm_shard,
                 threads=threads,
+                max_connections_per_host=max_connections_per_host,
+                content_addressed_storage=content_addressed_storage,
             ),
             visitors=[all_repos_sizer],
         ):
@@ -264,6 +268,8 @@ def snapshot_repos_from_args(argv: List[str]):
             gpg_key_allowlist_dir=args.gpg_key_allowlist_dir,
             exclude=frozenset(args.exclude),
             threads=args.threads,
+            max_connections_per_host=args.max_connections_per_host,
+            content_addressed_storage=args.content_addressed_storage,
         )
 
 
@@ -4,11 +4,24 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import atexit
+import io
+import json
 import subprocess
+import threading
 import uuid
 from abc import abstractmethod
 from contextlib import contextmanager
-from typing import ContextManager, List, Mapping, NamedTuple
+from typing import (
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from antlir.common import check_popen_returncode, get_logger
 
@@ -21,12 +34,152 @@ from antlir.rpm.storage.storage import _CommitCallback
 
 log = get_logger()
 
+# Idle batch workers, shared by all storage instances in this process, since
+# e.g. the RPM downloader makes a new `Storage` for each blob.
+_CMD_AND_ENV_TO_IDLE_WORKERS: Dict[
+    Tuple[Tuple[str, ...], Tuple[Tuple[str, str], ...]], List["_BatchWorker"]
+] = {}
+_BATCH_WORKERS_LOCK = threading.Lock()
+
+
+class _BatchWorker:
+    "A `_batch_cmd` process, see the protocol in `CLIObjectStorage`."
+
+    def __init__(self, cmd: List[str], env: Mapping):
+        self.proc = subprocess.Popen(
+            cmd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        # False while a request is in flight.  A worker that is out of sync
+        # with us, e.g. because a reader stopped early, is not reused.
+        self.in_sync = True
+
+    def send(self, op: str, path: str) -> None:
+        self.in_sync = False
+        self.proc.stdin.write(
+            json.dumps({"op": op, "path": path}).encode() + b"\n"
+        )
+
+    def write(self, data: bytes) -> None:
+        if data:  # An empty chunk would end the blob
+            self.proc.stdin.write(b"%d\n" % len(data))
+            self.proc.stdin.write(data)
+
+    def end_chunks(self) -> None:
+        self.proc.stdin.write(b"0\n")
+
+    def _read_line(self) -> bytes:
+        line = self.proc.stdout.readline()
+        if not line.endswith(b"\n"):
+            raise RuntimeError(f"{self.proc.args} exited mid-response")
+        return line
+
+    def read_chunk_size(self) -> int:
+        return int(self._read_line())
+
+    def read_status(self, op: str, path: str) -> Dict:
+        self.proc.stdin.flush()
+        status = json.loads(self._read_line())
+        self.in_sync = True
+        if not status["ok"]:
+            raise subprocess.CalledProcessError(
+                returncode=1,
+                cmd=[*self.proc.args, op, path],
+                output=status.get("error"),
+            )
+        return status
+
+    def close(self) -> None:
+        try:
+            self.proc.stdin.close()  # The worker exits at EOF
+        except BrokenPipeError:  # pragma: no cover
+            pass
+        if not self.in_sync:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+@contextmanager
+def _batch_worker(cmd: List[str], env: Mapping) -> Iterator[_BatchWorker]:
+    "Lends out an idle worker, or starts a new one."
+    key = (tuple(cmd), tuple(sorted(env.items())))
+    with _BATCH_WORKERS_LOCK:
+        idle = _CMD_AND_ENV_TO_IDLE_WORKERS.setdefault(key, [])
+        worker = idle.pop() if idle else None
+    if worker is not None and worker.proc.poll() is not None:
+        log.warning(
+            f"Batch worker {cmd[0]} exited with {worker.proc.returncode}"
+        )
+        worker.close()
+        worker = None
+    if worker is None:
+        worker = _BatchWorker(cmd, env)
+    try:
+        yield worker
+    finally:
+        if worker.in_sync and worker.proc.poll() is None:
+            with _BATCH_WORKERS_LOCK:
+                idle.append(worker)
+        else:
+            worker.close()
+
+
+@atexit.register
+def _close_idle_batch_workers() -> None:
+    with _BATCH_WORKERS_LOCK:
+        workers = [
+            w for ws in _CMD_AND_ENV_TO_IDLE_WORKERS.values() for w in ws
+        ]
+        _CMD_AND_ENV_TO_IDLE_WORKERS.clear()
+    for worker in workers:
+        worker.close()
+
+
+class _BatchReadStream(io.RawIOBase):
+    "The blob from a `get` request, as a file."
+
+    def __init__(self, worker: _BatchWorker, path: str):
+        self._worker = worker
+        self._path = path
+        self._chunk_left = 0
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        while not self._chunk_left:
+            if self._done:
+                return 0
+            self._chunk_left = self._worker.read_chunk_size()
+            if not self._chunk_left:
+                self._done = True
+                # Raises if the blob could not be read
+                self._worker.read_status("get", self._path)
+        n = self._worker.proc.stdout.readinto(
+            memoryview(buf)[: min(len(buf), self._chunk_left)]
+        )
+        if not n:
+            raise RuntimeError(f"{self._worker.proc.args} exited mid-blob")
+        self._chunk_left -= n
+        return n
+
 
 class _StorageRemover(NamedTuple):
     storage: Storage
     procs: List[subprocess.Popen]
 
     def remove(self, sid: str) -> None:
+        # pyre-fixme[16]: `Storage` has no attribute `_batch_cmd`.
+        if self.storage._batch_cmd() is not None:
+            # Removes are quick once the worker is up, so wait for each.
+            # pyre-fixme[16]: `Storage` has no attribute `_batch_remove`.
+            self.storage._batch_remove(
+                # pyre-fixme[16]: `Storage` has no attribute
+                # `_path_for_storage_id`.
+                self.storage._path_for_storage_id(self.storage.strip_key(sid))
+            )
+            return
         self.procs.append(
             subprocess.Popen(
                 # pyre-fixme[16]: `Storage` has no attribute `_remove_cmd`.
@@ -49,6 +202,29 @@ class CLIObjectStorage(Storage):
     This abstract base class exists because most blob-store CLIs will
     behave very similarly, and can reuse the plumbing that turns them
     into `Storage` objects. Look at `S3Storage` for a concrete example.
+
+    Starting a CLI per blob is terrible for small blobs (most system RPMs
+    are small).  If the CLI supports it, `_batch_cmd` should start a worker
+    that serves many requests, one at a time, over its stdin & stdout.
+    This process keeps the workers running, and starts more as needed to
+    serve concurrent requests.  The protocol:
+
+      - Each request is a JSON line `{"op": ..., "path": ...}`, where `op`
+        is one of `get`, `put`, `remove` and `exists`.
+      - A blob is a series of chunks, each being its decimal size on a
+        line, followed by that many bytes.  An empty chunk ends the blob.
+      - After a `put` request, we send the blob.  After a `get` request, the
+        worker sends the blob, or just an empty chunk if it cannot.
+      - Then, the worker replies with a JSON status line, `{"ok": true}` or
+        `{"ok": false, "error": "..."}`.  A failed `put` must not leave a
+        partial blob behind, and neither may a `put` whose worker is killed
+        before the empty chunk -- that is how we abort content-addressed
+        writes.  The status of `exists` also has `"exists": true/false`.
+      - The worker exits when its stdin is closed.
+
+    Without `_batch_cmd`, `writer(content_id=...)` still skips blobs that
+    are already stored, but stores new ones under random IDs, since a
+    `_write_cmd` killed mid-blob may leave a partial blob behind.
     """
 
     @abstractmethod
@@ -75,17 +251,69 @@ class CLIObjectStorage(Storage):
     def _configured_env(self) -> Mapping:
         ...  # pragma: no cover
 
+    def _batch_cmd(self) -> Optional[List[str]]:
+        "Override to batch requests, see the docblock."
+        return None
+
+    def _batch_remove(self, path: str) -> None:
+        # pyre-fixme[6]: `_batch_cmd` is not `None` when we get here.
+        with _batch_worker(self._batch_cmd(), self._configured_env()) as w:
+            w.send("remove", path)
+            w.read_status("remove", path)
+
+    def _exists(self, path: str) -> bool:
+        batch_cmd = self._batch_cmd()
+        if batch_cmd is not None:
+            with _batch_worker(batch_cmd, self._configured_env()) as w:
+                w.send("exists", path)
+                return w.read_status("exists", path)["exists"]
+        proc = subprocess.run(
+            self._exists_cmd(path=path), env=self._configured_env(), stdout=2
+        )
+        if proc.returncode == 1:  # Like `test -e`
+            return False
+        proc.check_returncode()
+        return True
+
     # Separate function so the unit-test can mock it.
     @classmethod
     def _make_storage_id(cls) -> str:
         return str(uuid.uuid4()).replace("-", "")
 
     @contextmanager
-    def writer(self) -> ContextManager[StorageOutput]:
-        sid = self._make_storage_id()
+    def writer(
+        self, *, content_id: Optional[str] = None
+    ) -> ContextManager[StorageOutput]:
+        if content_id is None:
+            sid = self._make_storage_id()
+        else:
+            sid = self._content_sid(content_id)
         path = self._path_for_storage_id(sid)
+        if content_id is not None:
+            already_stored = self._exists(path)
+            self._count_dedup(already_stored)
+            if already_stored:
+                with self._already_stored_writer(sid) as output:
+                    yield output
+                return
+        batch_cmd = self._batch_cmd()
+        if batch_cmd is None and content_id is not None:
+            # A `cli` may stream the blob to its destination, leaving a
+            # truncated blob at `path` if we abort it.  Later writers would
+            # then take that for the stored content, so store misses under
+            # a random ID instead, with the usual commit semantics.  Only
+            # the batch protocol guarantees atomic `put`s, see the docblock.
+            content_id = None
+            sid = self._make_storage_id()
+            path = self._path_for_storage_id(sid)
         log_prefix = f"{self.__class__.__name__}"
         log.debug(f"{log_prefix} - Writing to {path}")
+        if batch_cmd is not None:
+            with self._batch_writer(
+                batch_cmd, sid, path, content_addressed=content_id is not None
+            ) as output:
+                yield output
+            return
         with subprocess.Popen(
             self._write_cmd(
                 # The underlying CLI is expected to read the blob from stdin
@@ -150,13 +378,56 @@ class CLIObjectStorage(Storage):
                 #  `Optional[typing.IO[typing.Any]]`.
                 yield StorageOutput(output=proc.stdin, commit_callback=commit)
 
+    @contextmanager
+    def _batch_writer(
+        self,
+        batch_cmd: List[str],
+        sid: str,
+        path: str,
+        *,
+        content_addressed: bool,
+    ) -> Iterator[StorageOutput]:
+        with _batch_worker(batch_cmd, self._configured_env()) as worker:
+            worker.send("put", path)
+
+            @contextmanager
+            def get_id_and_release_resources():
+                worker.end_chunks()
+                # Once the worker replies, the `sid` is available to read.
+                worker.read_status("put", path)
+                yield sid
+
+            # pyre-fixme[6]: Expected `ContextManager[typing.Any]` for 2nd
+            # param but got `() -> Any`.
+            with _CommitCallback(
+                self,
+                get_id_and_release_resources,
+                # Nothing to do: the `put` is still in flight, so the worker
+                # is out of sync, and will be killed, see the docblock.
+                abort=(lambda: None) if content_addressed else None,
+            ) as commit:
+                # pyre-fixme[6]: Expected `IO[typing.Any]` for 1st param but
+                #  got `_BatchWorker`.
+                yield StorageOutput(output=worker, commit_callback=commit)
+
     @contextmanager
     def reader(self, sid: str) -> ContextManager[StorageInput]:
-        # We currently waste significant time per read waiting for CLIs
-        # to start, which is terrible for small reads (most system
-        # RPMs are small).
+        # Without a `_batch_cmd`, we waste significant time per read
+        # waiting for CLIs to start, see the class docblock.
         path = self._path_for_storage_id(self.strip_key(sid))
         log_prefix = f"{self.__class__.__name__}"
+        batch_cmd = self._batch_cmd()
+        if batch_cmd is not None:
+            with _batch_worker(batch_cmd, self._configured_env()) as worker:
+                worker.send("get", path)
+                worker.proc.stdin.flush()
+                # If the caller stops reading early, the worker is
+                # discarded, rather than reused.
+                # pyre-fixme[7]: Expected
+                #  `ContextManager[antlir.rpm.storage.storage.StorageInput]`
+                #  but got `Generator[...]`.
+                yield StorageInput(input=_BatchReadStream(worker, path))
+            return
         with subprocess.Popen(
             self._read_cmd(path=path),
             env=self._configured_env(),
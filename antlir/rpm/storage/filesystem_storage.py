@@ -8,7 +8,7 @@ import os
 import stat
 import uuid
 from contextlib import contextmanager
-from typing import AnyStr, ContextManager
+from typing import AnyStr, ContextManager, Iterator, Optional
 
 from antlir.fs_utils import Path
 
@@ -37,24 +37,71 @@ class FilesystemStorage(Storage, plugin_kind="filesystem"):
         """
         return self.base_dir / sid[:3] / sid[3:6] / sid[6:9] / sid[9:]
 
-    @contextmanager
-    def writer(self) -> ContextManager[StorageOutput]:
-        sid = str(uuid.uuid4()).replace("-", "")
-        sid_path = self._path_for_storage_id(sid)
+    def _open_new(self, path: Path):
         try:
-            # pyre-fixme[16]: `str` has no attribute `dirname`.
-            os.makedirs(sid_path.dirname())
+            os.makedirs(path.dirname())
         except FileExistsError:  # pragma: no cover
             pass
-
-        with os.fdopen(
+        return os.fdopen(
             os.open(
-                sid_path,
+                path,
                 os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
                 mode=stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH,
             ),
             "wb",
-        ) as outfile:
+        )
+
+    @contextmanager
+    def _content_addressed_writer(
+        self, content_id: str
+    ) -> Iterator[StorageOutput]:
+        sid = self._content_sid(content_id)
+        sid_path = self._path_for_storage_id(sid)
+        already_stored = os.path.exists(sid_path)
+        self._count_dedup(already_stored)
+        if already_stored:
+            with self._already_stored_writer(sid) as output:
+                yield output
+            return
+
+        # Only the final `link` makes the blob visible, so that readers &
+        # racing writers never see a partial blob.
+        tmp_path = Path(sid_path + f".tmp-{uuid.uuid4().hex}".encode())
+        with self._open_new(tmp_path) as outfile:
+
+            @contextmanager
+            def get_id_and_release_resources():
+                outfile.close()
+                try:
+                    os.link(tmp_path, sid_path)
+                except FileExistsError:
+                    pass  # A racing writer stored the same content
+                finally:
+                    os.unlink(tmp_path)
+                yield sid
+
+            def abort():
+                outfile.close()
+                os.unlink(tmp_path)
+
+            # pyre-fixme[6]: Expected `ContextManager[typing.Any]` for 2nd
+            # param but got `() -> Any`.
+            with _CommitCallback(
+                self, get_id_and_release_resources, abort=abort
+            ) as commit:
+                yield StorageOutput(output=outfile, commit_callback=commit)
+
+    @contextmanager
+    def writer(
+        self, *, content_id: Optional[str] = None
+    ) -> ContextManager[StorageOutput]:
+        if content_id is not None:
+            with self._content_addressed_writer(content_id) as output:
+                yield output
+            return
+
+        sid = str(uuid.uuid4()).replace("-", "")
+        with self._open_new(self._path_for_storage_id(sid)) as outfile:
 
             @contextmanager
             def get_id_and_release_resources():
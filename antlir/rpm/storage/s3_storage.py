@@ -4,13 +4,26 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import io
+"""
+`S3Storage` streams blobs to S3 in parts of `part_bytes`, so a writer holds
+at most one part in RAM, regardless of the blob size.  Blobs that fit in
+one part take a single `PutObject`, larger ones use a multipart upload,
+which is aborted if the write fails, so that no orphaned parts are billed.
+
+boto3 sessions are not thread-safe, so each thread caches its own client,
+instead of setting up a session per request.  Reads go through `open_url`,
+which keeps a pool of connections per host.
+
+For tests, or to use an S3-compatible store, set `endpoint_url`.  Then,
+objects are addressed path-style, as `<endpoint_url>/<bucket>/<key>`.
+"""
 import logging
 import os.path
+import threading
 import uuid
 import warnings
 from contextlib import contextmanager
-from typing import ContextManager
+from typing import Any, ContextManager, Dict, List, Optional
 
 from antlir.common import get_logger
 from antlir.rpm.storage.storage import _CommitCallback
@@ -19,8 +32,88 @@ from ..open_url import open_url
 from ..storage import Storage, StorageInput, StorageOutput
 
 
+# S3 requires parts of at least 5MiB, except the last, and allows 10,000
+# parts, so this caps blobs at 78GiB.
+DEFAULT_PART_BYTES = 8 * 2 ** 20
 log = get_logger()
 
+# Populated by `S3Storage._client`, see the module docblock.
+_THREAD_LOCAL = threading.local()
+
+
+class _MultipartWriter:
+    "Uploads a blob in parts of `part_bytes`, buffering at most one part."
+
+    def __init__(self, client, bucket: str, key: str, part_bytes: int):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_bytes = part_bytes
+        self._buf = bytearray()
+        self._upload_id: Optional[str] = None
+        self._parts: List[Dict[str, Any]] = []
+
+    def write(self, data: bytes) -> None:
+        self._buf += data
+        while len(self._buf) >= self._part_bytes:
+            self._upload_part(self._part_bytes)
+
+    def _upload_part(self, size: int) -> None:
+        try:
+            if self._upload_id is None:
+                self._upload_id = self._client.create_multipart_upload(
+                    Bucket=self._bucket, Key=self._key
+                )["UploadId"]
+            part_number = len(self._parts) + 1
+            res = self._client.upload_part(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                PartNumber=part_number,
+                Body=bytes(memoryview(self._buf)[:size]),
+            )
+        except BaseException:
+            self.abort()
+            raise
+        self._parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+        del self._buf[:size]
+
+    def commit(self) -> None:
+        if self._upload_id is None:  # Blobs that fit in one part
+            self._client.put_object(
+                Bucket=self._bucket, Key=self._key, Body=bytes(self._buf)
+            )
+        else:
+            if self._buf:
+                self._upload_part(len(self._buf))
+            try:
+                self._client.complete_multipart_upload(
+                    Bucket=self._bucket,
+                    Key=self._key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts},
+                )
+            except BaseException:
+                self.abort()
+                raise
+        self._buf = bytearray()
+
+    def abort(self) -> None:
+        self._buf = bytearray()
+        upload_id = self._upload_id
+        if upload_id is None:
+            return
+        self._upload_id = None
+        self._parts = []
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=self._bucket, Key=self._key, UploadId=upload_id
+            )
+        # The original error is more useful.  Bucket lifecycle rules can
+        # clean up the parts later.
+        except Exception:  # pragma: no cover
+            log.exception(f"Failed to abort upload {upload_id} of {self._key}")
+
 
 class S3Storage(Storage, plugin_kind="s3"):
     def __init__(
@@ -31,12 +124,16 @@ class S3Storage(Storage, plugin_kind="s3"):
         prefix: str,
         region: str,
         timeout_seconds: float = 400,
+        part_bytes: int = DEFAULT_PART_BYTES,
+        endpoint_url: Optional[str] = None,
     ):
         self.key = key
         self.bucket = bucket
         self.prefix = prefix
         self.region = region
         self.timeout_seconds = timeout_seconds
+        self.part_bytes = part_bytes
+        self.endpoint_url = endpoint_url
 
     def _object_key(self, sid: str) -> str:
         key = sid
@@ -47,7 +144,10 @@ class S3Storage(Storage, plugin_kind="s3"):
     @contextmanager
     def reader(self, sid: str) -> ContextManager[StorageInput]:
         key = self._object_key(sid)
-        url = f"https://{self.bucket}.s3-{self.region}.amazonaws.com/{key}"
+        if self.endpoint_url:
+            url = f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{key}"
+        else:
+            url = f"https://{self.bucket}.s3-{self.region}.amazonaws.com/{key}"
         with open_url(url) as f:
             # pyre-fixme[7]: Expected
             #  `ContextManager[antlir.rpm.storage.storage.StorageInput]` but got
@@ -55,52 +155,87 @@ class S3Storage(Storage, plugin_kind="s3"):
             yield StorageInput(input=f)
 
     @property
-    def s3(self):
+    def _client(self):
         # botocore does not support running from a pex/zip (aka a 'standalone'
         # binary that gets installed in an image), so only import it when on
         # the write path, which happens in an 'inplace' context on the host
         import boto3
 
-        boto3.set_stream_logger("", logging.WARNING)
-        # botocore is not threadsafe, each thread needs its own session.
-        session = boto3.session.Session()
-        # Reads require no credentials, writes go through AWS authentication
-        # and will fail if the required environment variables are not set
-        # Full details here, but in practice it's ok to ignore the intricacies.
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
-        s3 = session.resource("s3")
-        return s3.Bucket(self.bucket)
+        endpoint_to_client = getattr(_THREAD_LOCAL, "endpoint_to_client", None)
+        if endpoint_to_client is None:
+            endpoint_to_client = _THREAD_LOCAL.endpoint_to_client = {}
+        client = endpoint_to_client.get(self.endpoint_url)
+        if client is None:
+            boto3.set_stream_logger("", logging.WARNING)
+            # botocore is not threadsafe, each thread needs its own session.
+            session = boto3.session.Session()
+            # Reads require no credentials, writes go through AWS
+            # authentication and will fail if the required environment
+            # variables are not set.  Full details here, but in practice
+            # it's ok to ignore the intricacies.
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
+            client = endpoint_to_client[self.endpoint_url] = session.client(
+                "s3", endpoint_url=self.endpoint_url
+            )
+        return client
 
     @contextmanager
-    def writer(self) -> ContextManager[StorageOutput]:
-        sid = str(uuid.uuid4()).replace("-", "")
+    def writer(
+        self, *, content_id: Optional[str] = None
+    ) -> ContextManager[StorageOutput]:
+        if content_id is None:
+            sid = str(uuid.uuid4()).replace("-", "")
+        else:
+            sid = self._content_sid(content_id)
         key = os.path.join(self.prefix, sid)
+        if content_id is not None:
+            already_stored = self._exists(key)
+            self._count_dedup(already_stored)
+            if already_stored:
+                with self._already_stored_writer(key) as output:
+                    yield output
+                return
         log_prefix = f"{self.__class__.__name__}"
         log.debug(f"{log_prefix} - Writing to {key}")
 
-        buf = io.BytesIO()
+        upload = _MultipartWriter(
+            self._client, self.bucket, key, self.part_bytes
+        )
 
         @contextmanager
         def get_id_and_release_resources():
-            buf.seek(0)
             # boto3 spews unclosed resource warnings everywhere, without a
             # possible fix client side :(
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore", ResourceWarning)
-                self.s3.upload_fileobj(buf, key)
+                upload.commit()
             # S3 does not do partial puts, if the request returned 200, then
             # there is read-after-write guarantees
             yield key
 
         # pyre-fixme[6]: Expected `ContextManager[typing.Any]` for 2nd param
         # but got `() -> Any`.
-        with _CommitCallback(self, get_id_and_release_resources) as commit:
+        with _CommitCallback(
+            self,
+            get_id_and_release_resources,
+            # Content-addressed uploads are only visible once complete, so
+            # an uncommitted one can just be dropped.
+            abort=None if content_id is None else upload.abort,
+        ) as commit:
             # pyre-fixme[7]: Expected
             # `ContextManager[antlir.rpm.storage.storage.StorageOutput]` but
             # got `Generator[antlir.rpm.storage.storage.StorageOutput, None,
             # None]`.
-            yield StorageOutput(output=buf, commit_callback=commit)
+            yield StorageOutput(output=upload, commit_callback=commit)
+
+    def _exists(self, key: str) -> bool:
+        res = self._client.list_objects_v2(
+            Bucket=self.bucket, Prefix=key, MaxKeys=1
+        )
+        return any(o["Key"] == key for o in res.get("Contents", ()))
 
     def remove(self, sid: str) -> None:
         key = self._object_key(sid)
-        self.s3.delete_objects(Delete={"Objects": [{"Key": key}]})
+        self._client.delete_objects(
+            Bucket=self.bucket, Delete={"Objects": [{"Key": key}]}
+        )
@@ -16,16 +16,45 @@ distributed large blob storage, in a transparent way.
 Then, the only thing we then need to version is an index of "repo file" to
 "storage ID", which is quite VCS-friendly when emitted as e.g. sorted JSON.
 """
+import io
 import logging
+import os
 import re
-from contextlib import AbstractContextManager
-from typing import IO, Callable, ContextManager
+import stat
+import threading
+from contextlib import AbstractContextManager, contextmanager
+from typing import IO, Callable, ContextManager, Iterator, NamedTuple, Optional
 
 from antlir.rpm.pluggable import Pluggable
 
 
 log = logging.getLogger(__name__)
 
+# Content IDs must use one of these, since a collision would make a
+# `writer(content_id=...)` return somebody else's blob.
+CONTENT_ID_ALGORITHMS = frozenset(["sha256", "sha384", "sha512"])
+_CONTENT_ID_REGEX = re.compile("^([a-z0-9]+):([0-9a-f]+)$")
+
+# Counts of `writer(content_id=...)` calls in this process, by whether the
+# blob was already stored.
+_DEDUP_STATS = {True: 0, False: 0}
+_DEDUP_STATS_LOCK = threading.Lock()
+
+
+class DedupStats(NamedTuple):
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def dedup_stats() -> DedupStats:
+    with _DEDUP_STATS_LOCK:
+        return DedupStats(hits=_DEDUP_STATS[True], misses=_DEDUP_STATS[False])
+
 
 class StorageOutput:
     """
@@ -36,8 +65,17 @@ class StorageOutput:
     _commit_callback: Callable[[bool], str]
     _output: IO
 
-    def __init__(self, *, output: IO, commit_callback: "_CommitCallback"):
+    def __init__(
+        self,
+        *,
+        output: IO,
+        commit_callback: "_CommitCallback",
+        already_stored: bool = False,
+    ):
         self._output = output
+        # With `writer(content_id=...)`, True if the blob was already
+        # stored, in which case writes are discarded.
+        self.already_stored = already_stored
         # pyre-fixme[8]: Attribute has type `(bool) -> str`; used as
         # `_CommitCallback`.
         self._commit_callback = commit_callback
@@ -80,6 +118,17 @@ class StorageInput:
     def read(self, size=None):
         return self._input.read() if size is None else self._input.read(size)
 
+    def local_file(self) -> Optional[IO]:
+        """
+        Returns the underlying file if it is a regular file on a local
+        filesystem, which can e.g. be `sendfile`d.  Otherwise, `None`.
+        """
+        try:
+            fd = self._input.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+        return self._input if stat.S_ISREG(os.fstat(fd).st_mode) else None
+
 
 class Storage(Pluggable):
     """
@@ -108,6 +157,14 @@ class Storage(Pluggable):
 
         # NB: removed IDs may remain readable for some time if cleanup is lazy
         storage.remove(sid)
+
+    `writer(content_id='sha256:...')` stores the blob under an ID derived
+    from its checksum, which the caller must verify before `commit()`.  If
+    that ID is already stored, e.g. by a racing writer, or by a run that
+    failed before recording it, the writes are discarded, and `commit()`
+    returns the existing ID.  Such blobs may be shared by many writers, so
+    they are published only by an explicit `commit()`, and are never
+    removed automatically.
     """
 
     _KEY_REGEX = re.compile("[-_a-zA-Z0-9]+$")
@@ -118,6 +175,36 @@ class Storage(Pluggable):
         assert self._KEY_REGEX.match(self.key)
         return f"{self.key}:{sid}"
 
+    def _content_sid(self, content_id: str) -> str:
+        "The ID, without the key, for `writer(content_id=...)`."
+        m = _CONTENT_ID_REGEX.match(content_id)
+        assert m, f"Bad content ID: {content_id}"
+        algorithm, hexdigest = m.groups()
+        assert algorithm in CONTENT_ID_ALGORITHMS, content_id
+        # The `.` keeps these apart from the random IDs.
+        return f"{hexdigest}.{algorithm}"
+
+    def _count_dedup(self, already_stored: bool) -> None:
+        with _DEDUP_STATS_LOCK:
+            _DEDUP_STATS[already_stored] += 1
+
+    @contextmanager
+    def _already_stored_writer(self, sid: str) -> Iterator[StorageOutput]:
+        "A `writer(content_id=...)` that discards the writes."
+
+        @contextmanager
+        def get_id_and_release_resources():
+            yield sid
+
+        with _CommitCallback(
+            self, get_id_and_release_resources, abort=lambda: None
+        ) as commit:
+            yield StorageOutput(
+                output=_DISCARD_OUTPUT,
+                commit_callback=commit,
+                already_stored=True,
+            )
+
     def strip_key(self, sid: str) -> str:
         "Implementations use this to accept user-provided IDs (e.g. reader)"
         key, sid = sid.split(":", 1)
@@ -126,6 +213,14 @@ class Storage(Pluggable):
         return sid
 
 
+class _DiscardOutput:
+    def write(self, data: bytes) -> None:
+        pass
+
+
+_DISCARD_OUTPUT = _DiscardOutput()
+
+
 class _CommitCallback(AbstractContextManager):
     """
     Ensures the same commit semantics for every storage implementation.
@@ -141,13 +236,22 @@ class _CommitCallback(AbstractContextManager):
                 # errors do not prevent us from learning the ID, which may be
                 # needed to later remove the already-written blob.
                 release_resources_that_were_held_for_the_blob_write()
+
+    Content-addressed writers also pass `abort`, which releases the
+    resources without storing the blob.  It replaces the automatic commit &
+    remove of uncommitted blobs, since their IDs may be shared.
     """
 
     def __init__(
-        self, storage: Storage, get_id_and_release_resources: ContextManager
+        self,
+        storage: Storage,
+        get_id_and_release_resources: ContextManager,
+        *,
+        abort: Optional[Callable[[], None]] = None,
     ):
         self.storage = storage
         self.get_id_and_release_resources = get_id_and_release_resources
+        self.abort = abort
         self.id = None  # Populated via `get_id_and_release_resources()`
         self.remove = True  # Remove the blob if commit is not called
         self.remove_on_exception = False
@@ -185,13 +289,19 @@ class _CommitCallback(AbstractContextManager):
     def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
         # The end user never called `commit`, so they did not get an ID, and
         # we should try to clean up.
-        if self.get_id_and_release_resources is not None:
+        if self.get_id_and_release_resources is not None and self.abort:
+            assert self.id is None
+            # pyre-fixme[8]: Attribute has type `ContextManager[typing.Any]`;
+            # used as `None`.
+            self.get_id_and_release_resources = None
+            try:
+                self.abort()
+            except BaseException:  # pragma: no cover
+                log.exception(f"Error aborting a blob write to {self.storage}")
+        elif self.get_id_and_release_resources is not None:
             assert self.id is None
             assert self.remove
             try:
-                # NB: If any of our storage implementation supported an
-                # explicit "abort" feature, we could plumb it through here,
-                # and tell the implementation to avoid committing altogether.
                 self(remove_on_exception=True)
                 self.remove = True
             except BaseException:  # pragma: no cover
@@ -211,7 +321,8 @@ class _CommitCallback(AbstractContextManager):
                 assert self.get_id_and_release_resources is None
                 self.remove = True
 
-        if self.remove and self.id:
+        # Content-addressed blobs may be shared, see `Storage`.
+        if self.remove and self.id and not self.abort:
             # pyre-fixme[16]: `Storage` has no attribute `remove`.
             self.storage.remove(self.id)
 
@@ -4,11 +4,13 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import hashlib
 import unittest
 from typing import List, Tuple
 from unittest.mock import MagicMock, patch
 
 from .. import Storage  # Module import to ensure we get plugins
+from ..storage import DedupStats, dedup_stats
 
 
 class StorageBaseTestCase(unittest.TestCase):
@@ -110,3 +112,64 @@ class StorageBaseTestCase(unittest.TestCase):
                 *([] if skip_empty_writes else range(len(writes) + 1)),
             ]
         ]
+
+    def check_content_addressed(self, storage: Storage) -> str:
+        "Checks `writer(content_id=...)`, returns the ID of the stored blob."
+        content = b"content-addressed" * 10000
+        content_id = "sha256:" + hashlib.sha256(content).hexdigest()
+        start_stats = dedup_stats()
+
+        # Neither an exception, nor a missing commit store the blob.
+        with self.assertRaisesRegex(RuntimeError, "^humbug$"):
+            # pyre-fixme[16]: `Storage` has no attribute `writer`.
+            with storage.writer(content_id=content_id) as output:
+                self.assertFalse(output.already_stored)
+                output.write(content[:5])
+                raise RuntimeError("humbug")
+        with storage.writer(content_id=content_id) as output:
+            self.assertFalse(output.already_stored)
+            output.write(content)
+
+        with storage.writer(content_id=content_id) as output:
+            self.assertFalse(output.already_stored)
+            output.write(content)
+            sid = output.commit()
+        self.assertIn(content_id.split(":")[1], sid)
+
+        # Once stored, the writes are discarded, and nothing is removed,
+        # even without a commit.
+        with storage.writer(content_id=content_id) as output:
+            self.assertTrue(output.already_stored)
+            output.write(b"ignored")
+            self.assertEqual(sid, output.commit())
+        with storage.writer(content_id=content_id) as output:
+            self.assertTrue(output.already_stored)
+        # pyre-fixme[16]: `Storage` has no attribute `reader`.
+        with storage.reader(sid) as input:
+            self.assertEqual(content, input.read())
+
+        # Racing writers of the same content both succeed.
+        content2 = b"racing writers"
+        content_id2 = "sha512:" + hashlib.sha512(content2).hexdigest()
+        with storage.writer(
+            content_id=content_id2
+        ) as output1, storage.writer(content_id=content_id2) as output2:
+            output1.write(content2)
+            output2.write(content2)
+            sid2 = output1.commit()
+            self.assertEqual(sid2, output2.commit())
+        with storage.reader(sid2) as input:
+            self.assertEqual(content2, input.read())
+
+        self.assertEqual(
+            DedupStats(
+                hits=start_stats.hits + 2, misses=start_stats.misses + 5
+            ),
+            dedup_stats(),
+        )
+
+        # Weak hashes could collide, handing out the wrong blob.
+        with self.assertRaisesRegex(AssertionError, "^sha:"):
+            with storage.writer(content_id="sha:" + "0" * 40):
+                pass  # pragma: no cover
+        return sid
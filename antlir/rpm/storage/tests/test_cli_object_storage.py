@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+from typing import List, Mapping, Optional
+from unittest import mock
+
+from .. import cli_object_storage
+from ..cli_object_storage import CLIObjectStorage
+from .cli_object_storage_base_test import CLIObjectStorageBaseTestCase
+
+
+# Implements the `_batch_cmd` protocol from `CLIObjectStorage` on top of a
+# directory.
+_DIR_WORKER = """
+import json, os, sys
+base_dir = sys.argv[1]
+inp, out = sys.stdin.buffer, sys.stdout.buffer
+
+def reply(error=None, **status):
+    status.update(ok=not error, error=error)
+    out.write(json.dumps(status).encode() + b"\\n")
+    out.flush()
+
+for line in inp:
+    req = json.loads(line)
+    path = os.path.join(base_dir, req["path"])
+    status = {}
+    try:
+        if req["op"] == "put":
+            chunks = []
+            while True:
+                size = int(inp.readline())
+                if not size:
+                    break
+                chunks.append(inp.read(size))
+            with open(path, "wb") as f:
+                f.write(b"".join(chunks))
+        elif req["op"] == "get":
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                out.write(b"0\\n")
+                raise
+            if data:
+                out.write(b"%d\\n%s" % (len(data), data))
+            out.write(b"0\\n")
+        elif req["op"] == "exists":
+            status["exists"] = os.path.exists(path)
+        else:
+            os.remove(path)
+    except OSError as ex:
+        reply(str(ex))
+    else:
+        reply(**status)
+"""
+
+
+class _DirCLIStorage(CLIObjectStorage, plugin_kind="test_dir_cli"):
+    "Stores blobs in a directory via shell commands, or a batch worker."
+
+    def __init__(
+        self,
+        *,
+        key: str,
+        base_dir: str = "/dev/null/not-a-dir",
+        batch: bool = True,
+    ):
+        self.key = key
+        self.base_dir = base_dir
+        self.batch = batch
+
+    def _path_for_storage_id(self, sid: str) -> str:
+        return sid
+
+    def _full_path(self, path: str) -> str:
+        return os.path.join(self.base_dir, path)
+
+    def _read_cmd(self, *args, path: str) -> List[str]:
+        return ["cat", self._full_path(path)]
+
+    def _write_cmd(self, *args, path: str) -> List[str]:
+        return ["sh", "-c", 'cat > "$1"', "sh", self._full_path(path)]
+
+    def _remove_cmd(self, *args, path: str) -> List[str]:
+        return ["rm", self._full_path(path)]
+
+    def _exists_cmd(self, *args, path: str) -> List[str]:
+        return ["test", "-e", self._full_path(path)]
+
+    def _configured_env(self) -> Mapping:
+        return {"PATH": os.environ["PATH"]}
+
+    def _batch_cmd(self) -> Optional[List[str]]:
+        if not self.batch:
+            return None
+        return [sys.executable, "-c", _DIR_WORKER, self.base_dir]
+
+
+class CLIObjectStorageTestCase(CLIObjectStorageBaseTestCase):
+    def setUp(self):
+        td = tempfile.TemporaryDirectory()
+        self.addCleanup(td.cleanup)
+        self.storage = _DirCLIStorage(key="test", base_dir=td.name)
+        # Don't leak this test's workers into the next.
+        self.addCleanup(cli_object_storage._close_idle_batch_workers)
+
+    def _decorate_id(self, sid: str) -> str:
+        return f"test-{sid}"
+
+    def test_write_and_read_back(self):
+        with mock.patch.object(
+            cli_object_storage,
+            "_BatchWorker",
+            wraps=cli_object_storage._BatchWorker,
+        ) as mock_worker:
+            self._test_write_and_read_back(_DirCLIStorage)
+        # The test does hundreds of requests, some of them nested.
+        self.assertLessEqual(mock_worker.call_count, 3)
+
+    def test_write_and_read_back_without_batch(self):
+        self.storage.batch = False
+        self._test_write_and_read_back(_DirCLIStorage)
+
+    def test_uncommitted(self):
+        self._test_uncommited(_DirCLIStorage)
+        self.assertEqual([], os.listdir(self.storage.base_dir))
+
+    def test_error_cleanup(self):
+        self._test_error_cleanup("test_dir_cli")
+
+    def test_content_addressed(self):
+        self.check_content_addressed(self.storage)
+        self.assertEqual(2, len(os.listdir(self.storage.base_dir)))
+
+    def test_content_addressed_without_batch(self):
+        content = b"streamed" * 100000
+        content_id = "sha256:" + hashlib.sha256(content).hexdigest()
+        self.storage.batch = False
+
+        # `cat` streams to the destination, so an aborted write must not
+        # leave a truncated blob where later writers would look for it.
+        with self.storage.writer(content_id=content_id) as output:
+            self.assertFalse(output.already_stored)
+            output.write(content[: len(content) // 2])
+        self.assertEqual([], os.listdir(self.storage.base_dir))
+        with self.storage.writer(content_id=content_id) as output:
+            self.assertFalse(output.already_stored)
+            output.write(content)
+            sid = output.commit()
+        self.assertNotIn(content_id.split(":")[1], sid)
+        with self.storage.reader(sid) as f:
+            self.assertEqual(content, f.read())
+
+        # Blobs stored under their content ID, here by a batch worker, are
+        # still found.
+        self.storage.batch = True
+        with self.storage.writer(content_id=content_id) as output:
+            self.assertFalse(output.already_stored)
+            output.write(content)
+            content_sid = output.commit()
+        self.storage.batch = False
+        with self.storage.writer(content_id=content_id) as output:
+            self.assertTrue(output.already_stored)
+            self.assertEqual(content_sid, output.commit())
+        self.assertEqual(2, len(os.listdir(self.storage.base_dir)))
+
+    def test_partial_read_discards_worker(self):
+        with self.storage.writer() as out:
+            out.write(b"a" * 100000)
+            sid = out.commit()
+        with self.storage.reader(sid) as f:
+            self.assertEqual(b"aaa", f.read(3))
+        # The worker was killed, since it was still sending the blob.
+        self.assertEqual(
+            [[]],
+            list(cli_object_storage._CMD_AND_ENV_TO_IDLE_WORKERS.values()),
+        )
+        with self.storage.reader(sid) as f:
+            self.assertEqual(b"a" * 100000, f.read())
+        ((worker,),) = cli_object_storage._CMD_AND_ENV_TO_IDLE_WORKERS.values()
+
+        # A failed request leaves the worker usable.
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            self.storage.remove("test:no-such-blob")
+        self.assertRegex(ctx.exception.output, "No such file")
+        self.assertEqual(
+            [[worker]],
+            list(cli_object_storage._CMD_AND_ENV_TO_IDLE_WORKERS.values()),
+        )
+
+    def test_worker_died(self):
+        with self.storage.writer() as out:
+            out.write(b"abc")
+            sid = out.commit()
+        # Killing the worker while it serves `sid` would race: its whole
+        # reply fits in the pipe, and may be sent before the kill.  This
+        # blob does not fit, so the worker is still sending it.
+        with self.storage.writer() as out:
+            out.write(b"a" * 2 ** 20)
+            big_sid = out.commit()
+        ((worker,),) = cli_object_storage._CMD_AND_ENV_TO_IDLE_WORKERS.values()
+        # Mid-request
+        with self.assertRaisesRegex(RuntimeError, "exited mid-blob"):
+            with self.storage.reader(big_sid) as f:
+                self.assertEqual(b"aaa", f.read(3))
+                worker.proc.kill()
+                f.read()
+        # While idle
+        with self.storage.reader(sid) as f:
+            self.assertEqual(b"abc", f.read())
+        ((worker,),) = cli_object_storage._CMD_AND_ENV_TO_IDLE_WORKERS.values()
+        worker.proc.kill()
+        worker.proc.wait()
+        with self.assertLogs(cli_object_storage.log) as logs:
+            with self.storage.reader(sid) as f:
+                self.assertEqual(b"abc", f.read())
+        self.assertRegex("\n".join(logs.output), "exited with -9")
@@ -4,12 +4,14 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import io
 import itertools
 import os
 import tempfile
 from collections import Counter
 from contextlib import contextmanager
 
+from ..storage import StorageInput
 from .storage_base_test import Storage, StorageBaseTestCase
 
 
@@ -50,3 +52,31 @@ class FilesystemStorageTestCase(StorageBaseTestCase):
                 with storage.writer() as writer:
                     raise RuntimeError("abracadabra")
             self.assertEqual([], os.listdir(storage.base_dir))
+
+    def test_content_addressed(self):
+        with self._temp_storage() as storage:
+            sid = self.check_content_addressed(storage)
+            # Only the stored blobs are left, no temporary files.
+            self.assertEqual(
+                2, sum(len(fs) for _, _, fs in os.walk(storage.base_dir))
+            )
+            self.assertTrue(
+                storage._path_for_storage_id(storage.strip_key(sid)).endswith(
+                    b".sha256"
+                )
+            )
+
+    def test_local_file(self):
+        with self._temp_storage() as storage:
+            with storage.writer() as writer:
+                writer.write(b"foo")
+                sid = writer.commit()
+            with storage.reader(sid) as reader:
+                local_file = reader.local_file()
+                self.assertIsNotNone(local_file)
+                self.assertEqual(3, os.fstat(local_file.fileno()).st_size)
+        # Not regular files
+        self.assertIsNone(StorageInput(input=io.BytesIO(b"foo")).local_file())
+        r_fd, w_fd = os.pipe()
+        with os.fdopen(r_fd, "rb") as r, os.fdopen(w_fd, "wb"):
+            self.assertIsNone(StorageInput(input=r).local_file())
@@ -4,40 +4,119 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import io
-from contextlib import contextmanager
-from unittest.mock import ANY, MagicMock, patch
+import http.server
+import threading
+from unittest.mock import MagicMock, patch
 
+from ...open_url import host_stats
 from .. import s3_storage
 from .storage_base_test import Storage, StorageBaseTestCase
 
 
+class _FakeS3Client:
+    """
+    An in-memory stand-in for the boto3 S3 client calls that we use.  Like
+    the real S3, objects are readable as soon as their write returns.
+    """
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.objects = {}
+        self.uploads = {}  # Upload ID -> {part number: bytes}
+        self.peers = set()  # Client addresses of the HTTP connections
+        self.calls = []
+        self.fail_upload_part = False
+
+    def _check(self, name, Bucket):
+        assert Bucket == self.bucket, Bucket
+        self.calls.append(name)
+
+    def put_object(self, *, Bucket, Key, Body):
+        self._check("put_object", Bucket)
+        self.objects[Key] = bytes(Body)
+
+    def create_multipart_upload(self, *, Bucket, Key):
+        self._check("create_multipart_upload", Bucket)
+        upload_id = f"upload{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, *, Bucket, Key, UploadId, PartNumber, Body):
+        self._check("upload_part", Bucket)
+        if self.fail_upload_part:
+            raise RuntimeError("upload_part failed")
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"etag{PartNumber}"}
+
+    def complete_multipart_upload(
+        self, *, Bucket, Key, UploadId, MultipartUpload
+    ):
+        self._check("complete_multipart_upload", Bucket)
+        parts = self.uploads.pop(UploadId)
+        assert [p["PartNumber"] for p in MultipartUpload["Parts"]] == list(
+            range(1, len(parts) + 1)
+        )
+        self.objects[Key] = b"".join(parts[i] for i in sorted(parts))
+
+    def abort_multipart_upload(self, *, Bucket, Key, UploadId):
+        self._check("abort_multipart_upload", Bucket)
+        del self.uploads[UploadId]
+
+    def list_objects_v2(self, *, Bucket, Prefix, MaxKeys):
+        self._check("list_objects_v2", Bucket)
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        return {"Contents": [{"Key": k} for k in keys[:MaxKeys]]}
+
+    def delete_objects(self, *, Bucket, Delete):
+        self._check("delete_objects", Bucket)
+        for key in [o["Key"] for o in Delete["Objects"]]:
+            del self.objects[key]
+
+
 class S3StorageTestCase(StorageBaseTestCase):
     bucket = "antlir-test"
     region = "test-region"
     prefix = "test/prefix"
 
-    # some methods to mock an in-memory s3 bucket
-    # this matches the read-after-write consistency guarantee from the real s3
-    def _mock_upload_fileobj(self, contents, key: str):
-        self.objects[key] = contents.getbuffer()
+    def _serve(self):
+        "Serves the fake's objects path-style, like an S3-compatible store."
+        fake = self.fake
 
-    def _mock_delete_objects(self, Delete):
-        for key in [o["Key"] for o in Delete["Objects"]]:
-            del self.objects[key]
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                fake.peers.add(self.client_address)
+                _, bucket, key = self.path.split("/", 2)
+                content = (
+                    fake.objects.get(key) if bucket == fake.bucket else None
+                )
+                if content is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
 
-    @contextmanager
-    def _mock_open_url(self, url: str):
-        urlprefix = f"https://{self.bucket}.s3-{self.region}.amazonaws.com/"
-        assert url.startswith(urlprefix)
-        key = url[len(urlprefix) :]
-        yield io.BytesIO(self.objects[key])
+        def stop():
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+
+        self.addCleanup(stop)
+        return "http://{}:{}".format(*httpd.socket.getsockname())
 
     def setUp(self):
-        self.objects = {}
-        self.s3 = MagicMock()
-        self.s3.upload_fileobj.side_effect = self._mock_upload_fileobj
-        self.s3.delete_objects.side_effect = self._mock_delete_objects
+        self.fake = _FakeS3Client(self.bucket)
+        self.endpoint_url = self._serve()
         self.storage = Storage.make(
             key="test",
             kind="s3",
@@ -45,37 +124,114 @@ class S3StorageTestCase(StorageBaseTestCase):
             prefix=self.prefix,
             region=self.region,
             timeout_seconds=3,
+            # Tiny parts, so that the base test's writes use multipart
+            part_bytes=100000,
+            endpoint_url=self.endpoint_url,
         )
-        self.boto3_session_patch = patch("boto3.session.Session")
+        boto3_session_patch = patch("boto3.session.Session")
+        session = boto3_session_patch.start()
+        self.addCleanup(boto3_session_patch.stop)
         mock_session = MagicMock()
-        session = self.boto3_session_patch.start()
         session.return_value = mock_session
-        mock_resource = MagicMock()
-        mock_session.resource.return_value = mock_resource
-        mock_resource.Bucket.return_value = self.s3
+        mock_session.client.return_value = self.fake
+        # Don't leak cached clients between tests.
+        self.addCleanup(s3_storage._THREAD_LOCAL.__dict__.clear)
         # basic checks to make sure the mocks are setup correctly
-        self.assertEqual(self.storage.s3, self.s3)
-        mock_session.resource.assert_called_with("s3")
-        mock_resource.Bucket.assert_called_with(self.bucket)
-        s3_storage.open_url = self._mock_open_url
-
-    def tearDown(self):
-        self.boto3_session_patch.stop()
+        self.assertIs(self.storage._client, self.fake)
+        mock_session.client.assert_called_with(
+            "s3", endpoint_url=self.endpoint_url
+        )
+        self.mock_session = mock_session
 
     def test_write_and_read_back(self):
-        # Do a bunch of mock writes and ensure that the s3 client was called
-        # with each storage id s3 key.
-        # The s3 client does not do any partial writes or buffering, so as long
-        # as it is called with the correct contents, that is enough to pass.
         for contents, sid in self.check_storage_impl(self.storage):
-            self.s3.upload_fileobj.assert_any_call(
-                ANY, self.storage._object_key(sid)
-            )
-            # ensure that the written data was sent to s3 correctly, as one
-            # blob regardless of how many chunks it was input as
-            with self.storage.reader(sid) as f:
-                actual = f.read()
-                self.assertEqual(actual, b"".join(contents))
+            self.assertIn(self.storage._object_key(sid), self.fake.objects)
+        # Both the single-request and the multipart paths ran, and no
+        # uploads were left behind.
+        self.assertIn("put_object", self.fake.calls)
+        self.assertIn("complete_multipart_upload", self.fake.calls)
+        self.assertEqual({}, self.fake.uploads)
+
+    def test_client_per_thread(self):
+        self.assertIs(self.storage._client, self.storage._client)
+        self.assertEqual(1, self.mock_session.client.call_count)
+        threads = [
+            threading.Thread(target=lambda: self.storage._client)
+            for _ in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(4, self.mock_session.client.call_count)
+
+    def test_multipart_parts(self):
+        with self.storage.writer() as out:
+            for _ in range(5):
+                out.write(b"a" * 45000)
+            sid = out.commit()
+        self.assertEqual(
+            [
+                "create_multipart_upload",
+                "upload_part",
+                "upload_part",
+                "upload_part",
+                "complete_multipart_upload",
+            ],
+            self.fake.calls,
+        )
+        self.assertEqual(
+            b"a" * 225000, self.fake.objects[self.storage._object_key(sid)]
+        )
+
+    def test_multipart_abort(self):
+        self.fake.fail_upload_part = True
+        with self.assertRaisesRegex(RuntimeError, "^upload_part failed$"):
+            with self.storage.writer() as out:
+                out.write(b"a" * 150000)
+        self.assertEqual(
+            [
+                "create_multipart_upload",
+                "upload_part",
+                "abort_multipart_upload",
+                # The automatic commit stores the empty remainder, and
+                # removes it, since the write failed.
+                "put_object",
+                "delete_objects",
+            ],
+            self.fake.calls,
+        )
+        self.assertEqual({}, self.fake.uploads)
+        self.assertEqual({}, self.fake.objects)
+
+        # A failed last part also aborts the upload.
+        self.fake.calls.clear()
+        with self.assertRaisesRegex(RuntimeError, "^upload_part failed$"):
+            with self.storage.writer() as out:
+                self.fake.fail_upload_part = False
+                out.write(b"a" * 150000)
+                self.fake.fail_upload_part = True
+                out.commit()
+        self.assertEqual(
+            [
+                "create_multipart_upload",
+                "upload_part",
+                "upload_part",
+                "abort_multipart_upload",
+            ],
+            self.fake.calls,
+        )
+        self.assertEqual({}, self.fake.uploads)
+        self.assertEqual({}, self.fake.objects)
+
+    def test_content_addressed(self):
+        sid = self.check_content_addressed(self.storage)
+        self.assertTrue(sid.startswith(f"test:{self.prefix}/"), sid)
+        # Aborted uploads are not left behind, and neither are the
+        # automatic commits that remove uncommitted random-ID blobs.
+        self.assertEqual({}, self.fake.uploads)
+        self.assertEqual(2, len(self.fake.objects))
+        self.assertNotIn("delete_objects", self.fake.calls)
 
     def test_writer_prefix(self):
         # Reads are expected to already have the prefix, but writes should
@@ -90,14 +246,32 @@ class S3StorageTestCase(StorageBaseTestCase):
             out.write(b"Hello world!")
             sid = out.commit()
         key = self.storage._object_key(sid)
-        self.assertIn(key, self.objects)
+        self.assertIn(key, self.fake.objects)
         self.storage.remove(sid)
-        self.assertNotIn(key, self.objects)
-        self.s3.delete_objects.called_with(self.bucket, key)
+        self.assertNotIn(key, self.fake.objects)
+
+    def test_reader_reuses_connections(self):
+        with self.storage.writer() as out:
+            out.write(b"Hello world!")
+            sid = out.commit()
+        for _ in range(3):
+            with self.storage.reader(sid) as f:
+                self.assertEqual(b"Hello world!", f.read())
+        self.assertEqual(
+            3, host_stats()[self.endpoint_url[len("http://") :]].requests
+        )
+        self.assertEqual(1, len(self.fake.peers))
 
     def test_reader_url(self):
+        storage = Storage.make(
+            key="test",
+            kind="s3",
+            bucket=self.bucket,
+            prefix=self.prefix,
+            region=self.region,
+        )
         with patch("antlir.rpm.storage.s3_storage.open_url") as open_url:
-            with self.storage.reader("test/prefix/1234") as _:
+            with storage.reader("test/prefix/1234") as _:
                 pass
             open_url.assert_called_with(
                 "https://antlir-test.s3-test-region.amazonaws.com/"
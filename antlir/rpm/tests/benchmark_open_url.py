@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measures how fast `open_url` downloads many objects from one host, as the
+snapshotter does with RPMs.  Several client threads fetch their share of
+the objects from a local HTTP/1.1 server, first with a fresh connection
+per object, like a bare `requests.get`, and then via `open_url`'s pool of
+keep-alive connections.
+
+With `--drop-every N`, the server breaks every Nth response mid-body, to
+show the cost of resuming with `Range` requests.  The baseline has no way
+to resume, so it skips those passes.
+
+  $ buck run //antlir/rpm:benchmark-open-url -- --num-objects 2000
+"""
+import argparse
+import http.server
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+import requests
+from antlir.common import init_logging
+
+from ..open_url import host_stats, log_host_stats, open_url
+
+
+@contextmanager
+def _serve(obj_bytes: int, drop_every: int):
+    "Serves the same random `obj_bytes` blob at every path."
+    content = os.urandom(obj_bytes)
+    counter = itertools.count(1)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            start = 0
+            range_hdr = self.headers.get("Range")
+            if range_hdr:
+                start = int(range_hdr[len("bytes=") : -len("-")])
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range",
+                    f"bytes {start}-{len(content) - 1}/{len(content)}",
+                )
+            else:
+                self.send_response(200)
+            self.send_header("ETag", '"bench"')
+            self.send_header("Content-Length", str(len(content) - start))
+            self.end_headers()
+            if not range_hdr and drop_every and next(counter) % drop_every == 0:
+                self.wfile.write(content[: len(content) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(content[start:])
+
+        def log_message(self, *args):
+            pass
+
+    with http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler) as httpd:
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            host, port = httpd.socket.getsockname()
+            yield f"http://{host}:{port}/"
+        finally:
+            httpd.shutdown()
+            thread.join()
+
+
+def _fetch_unpooled(url: str) -> int:
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        return len(r.raw.read())
+
+
+def _fetch_pooled(url: str, pool_size: int) -> int:
+    with open_url(url, pool_size=pool_size) as f:
+        return len(f.read())
+
+
+def _timed_pass(urls: List[str], clients: int, fetch):
+    "Returns (seconds, bytes) to fetch `urls` with `clients` threads."
+    results = [0] * clients
+
+    def client(i):
+        results[i] = sum(fetch(url) for url in urls[i::clients])
+
+    threads = [
+        threading.Thread(target=client, args=(i,)) for i in range(clients)
+    ]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.monotonic() - start, sum(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--num-objects", type=int, default=1000)
+    parser.add_argument("--object-bytes", type=int, default=2 ** 16)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=8,
+        help="Concurrent downloads, like `snapshot-repos --threads`",
+    )
+    parser.add_argument(
+        "--drop-every",
+        type=int,
+        default=0,
+        help="Break every Nth response mid-body, 0 to never break any",
+    )
+    parser.add_argument("--debug", action="store_true", help="Log more")
+    args = parser.parse_args(argv)
+    init_logging(debug=args.debug)
+
+    with _serve(args.object_bytes, args.drop_every) as base_url:
+        urls = [f"{base_url}obj{i}" for i in range(args.num_objects)]
+        modes = [
+            (
+                "pooled keep-alive",
+                lambda url: _fetch_pooled(url, args.clients),
+            )
+        ]
+        if not args.drop_every:
+            modes.insert(0, ("connection per object", _fetch_unpooled))
+        for mode, fetch in modes:
+            seconds, num_bytes = _timed_pass(urls, args.clients, fetch)
+            print(
+                f"{mode}: {len(urls)} objects, "
+                f"{num_bytes / 2 ** 20:.1f} MiB in {seconds:.2f}s = "
+                f"{len(urls) / seconds:.1f} objects/s, "
+                f"{num_bytes / 2 ** 20 / seconds:.1f} MiB/s"
+            )
+        (stats,) = host_stats().values()
+        print(f"pooled: {stats.requests} requests, {stats.resumes} resumed")
+        log_host_stats()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
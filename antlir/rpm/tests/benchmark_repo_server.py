@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measures how fast `repo-server` feeds RPMs to an installer.  This emulates
+the download phase of a `dnf install` of many RPMs: several client threads,
+like `dnf`'s `max_parallel_downloads`, each fetch their share of the RPMs
+over one keep-alive connection.
+
+The RPMs are random blobs in a `FilesystemStorage`.  Each server mode gets
+a cold pass, which verifies every checksum, and a warm pass, which is
+served via `sendfile`.
+
+  $ buck run //antlir/rpm:benchmark-repo-server -- --num-rpms 500
+"""
+import argparse
+import hashlib
+import http.client
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Mapping
+
+from antlir.common import init_logging
+
+from ..repo_server import repo_server
+from ..storage import Storage
+
+
+def _make_rpms(
+    storage: Storage, num_rpms: int, rpm_bytes: int
+) -> Mapping[str, dict]:
+    location_to_obj = {}
+    for i in range(num_rpms):
+        content = os.urandom(rpm_bytes)
+        with storage.writer() as out:
+            out.write(content)
+            sid = out.commit()
+        location_to_obj[f"pkgs/rpm{i}.rpm"] = {
+            "size": rpm_bytes,
+            "build_timestamp": 0,
+            "storage_id": sid,
+            "checksum": "sha256:" + hashlib.sha256(content).hexdigest(),
+        }
+    return location_to_obj
+
+
+@contextmanager
+def _serve(location_to_obj, storage: Storage, *, threaded: bool):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    with repo_server(
+        sock, location_to_obj, storage, threaded=threaded
+    ) as httpd:
+        httpd.server_activate()
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            yield sock.getsockname()
+        finally:
+            httpd.shutdown()
+            thread.join()
+
+
+def _fetch_all(host: str, port: int, locations: List[str]) -> int:
+    "Returns the number of bytes fetched over one connection."
+    # HTTP/1.0 servers close the connection after each response, and
+    # `http.client` transparently reconnects.
+    conn = http.client.HTTPConnection(host, port)
+    total = 0
+    try:
+        for location in locations:
+            conn.request("GET", "/" + location)
+            resp = conn.getresponse()
+            assert resp.status == 200, (location, resp.status)
+            total += len(resp.read())
+    finally:
+        conn.close()
+    return total
+
+
+def _timed_pass(host: str, port: int, locations: List[str], clients: int):
+    "Returns (seconds, bytes) to fetch `locations` with `clients` threads."
+    results = [0] * clients
+
+    def client(i):
+        results[i] = _fetch_all(host, port, locations[i::clients])
+
+    threads = [
+        threading.Thread(target=client, args=(i,)) for i in range(clients)
+    ]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.monotonic() - start, sum(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--num-rpms", type=int, default=200)
+    parser.add_argument("--rpm-bytes", type=int, default=2 ** 20)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=10,
+        help="Concurrent connections, `dnf` defaults to 3, and allows 20",
+    )
+    parser.add_argument("--debug", action="store_true", help="Log more")
+    args = parser.parse_args(argv)
+    init_logging(debug=args.debug)
+
+    with tempfile.TemporaryDirectory() as td:
+        storage = Storage.make(key="bench", kind="filesystem", base_dir=td)
+        location_to_obj = _make_rpms(storage, args.num_rpms, args.rpm_bytes)
+        locations = sorted(location_to_obj)
+        for threaded in [False, True]:
+            mode = "threaded HTTP/1.1" if threaded else "single-threaded"
+            with _serve(
+                location_to_obj, storage, threaded=threaded
+            ) as (host, port):
+                for pass_name in ["cold", "warm"]:
+                    seconds, num_bytes = _timed_pass(
+                        host, port, locations, args.clients
+                    )
+                    print(
+                        f"{mode}, {pass_name}: {len(locations)} RPMs, "
+                        f"{num_bytes / 2 ** 20:.1f} MiB in {seconds:.2f}s = "
+                        f"{len(locations) / seconds:.1f} RPMs/s, "
+                        f"{num_bytes / 2 ** 20 / seconds:.1f} MiB/s"
+                    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import os
+import unittest
+
+from antlir.fs_utils import temp_dir
+
+from ..blob_cache import BlobCache
+
+
+def _checksum(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def _add(cache: BlobCache, data: bytes) -> None:
+    with cache.writer(_checksum(data), len(data)) as w:
+        w.write(data)
+        w.commit()
+
+
+def _is_cached(cache: BlobCache, data: bytes) -> bool:
+    f = cache.open(_checksum(data), len(data))
+    if f is None:
+        return False
+    f.close()
+    return True
+
+
+class BlobCacheTestCase(unittest.TestCase):
+    def test_write_and_open(self):
+        with temp_dir() as td:
+            cache = BlobCache(td, max_bytes=100)
+            self.assertIsNone(cache.open(_checksum(b"abc"), 3))
+
+            # Uncommitted blobs are not cached
+            with cache.writer(_checksum(b"abc"), 3) as w:
+                w.write(b"abc")
+            self.assertIsNone(cache.open(_checksum(b"abc"), 3))
+            self.assertEqual([], (td / "tmp").listdir())
+
+            _add(cache, b"abc")
+            # Another process sharing the cache sees the blob.
+            with BlobCache(td, max_bytes=100).open(
+                _checksum(b"abc"), 3
+            ) as f:
+                self.assertEqual(b"abc", f.read())
+            # The size is part of the key.
+            self.assertIsNone(cache.open(_checksum(b"abc"), 4))
+            self.assertEqual((0, 3), (cache.num_hits, cache.num_misses))
+
+            with self.assertRaises(AssertionError):
+                cache.open("sha256:../../etc/passwd", 3)
+
+    def test_lru_eviction(self):
+        with temp_dir() as td:
+            cache = BlobCache(td, max_bytes=35)
+            blobs = [str(i).encode() * 10 for i in range(3)]
+            for i, blob in enumerate(blobs):
+                _add(cache, blob)
+                path = cache._blob_path(_checksum(blob), len(blob))
+                os.utime(path, (i, i))
+            # Blob 0 becomes the most recently used.
+            self.assertTrue(_is_cached(cache, blobs[0]))
+
+            _add(cache, b"x" * 10)  # 40 bytes > 35, so evict down to 31
+            self.assertEqual(
+                [True, False, True], [_is_cached(cache, b) for b in blobs]
+            )
+            self.assertTrue(_is_cached(cache, b"x" * 10))
@@ -4,13 +4,21 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import http.server
 import subprocess
 import sys
+import threading
 import unittest
+import urllib.parse
+from contextlib import contextmanager
+from unittest import mock
 
+import requests
+import urllib3
 from antlir.fs_utils import temp_dir
 
-from ..open_url import open_url
+from .. import open_url as open_url_module
+from ..open_url import host_stats, log as open_url_log, log_host_stats, open_url
 
 
 class OpenUrlTestCase(unittest.TestCase):
@@ -46,3 +54,98 @@ with hs.HTTPServer(('localhost', 0), hs.SimpleHTTPRequestHandler) as httpd:
                         self.assertEqual(b"world", in_f.read())
                 finally:
                     proc.kill()
+
+    @contextmanager
+    def _serve(
+        self, content: bytes, *, drop_after: int, etag=True, honor_range=True
+    ):
+        "Yields the URL of `content`, and the `Range` of each request."
+        ranges = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.path != "/obj":
+                    self.send_error(404)
+                    return
+                range_hdr = self.headers.get("Range")
+                ranges.append(range_hdr)
+                if range_hdr and honor_range:
+                    start = int(range_hdr[len("bytes=") : -len("-")])
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range",
+                        f"bytes {start}-{len(content) - 1}/{len(content)}",
+                    )
+                else:
+                    start = 0
+                    self.send_response(200)
+                if etag:
+                    self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(content) - start))
+                self.end_headers()
+                if start:
+                    self.wfile.write(content[start:])
+                else:  # Break the connection mid-body
+                    self.wfile.write(content[:drop_after])
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        with http.server.ThreadingHTTPServer(
+            ("localhost", 0), Handler
+        ) as httpd:
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.start()
+            try:
+                host, port = httpd.socket.getsockname()
+                yield f"http://{host}:{port}/obj", ranges
+            finally:
+                httpd.shutdown()
+                thread.join()
+
+    def test_resume(self):
+        content = b"0123456789" * 1000
+        with self._serve(content, drop_after=3000) as (url, ranges):
+            with open_url(url, pool_size=2) as in_f:
+                self.assertEqual(content[:10], in_f.read(10))
+                self.assertEqual(content[10:], in_f.read())
+            self.assertEqual([None, "bytes=3000-"], ranges)
+            stats = host_stats()[urllib.parse.urlparse(url).netloc]
+        self.assertEqual(2, stats.requests)
+        self.assertEqual(1, stats.resumes)
+        self.assertEqual(len(content), stats.bytes)
+        self.assertGreater(stats.bytes_per_second, 0)
+        self.assertGreater(stats.mean_latency_seconds, 0)
+        with self.assertLogs(open_url_log) as logs:
+            log_host_stats()
+        self.assertRegex("\n".join(logs.output), r" 2 requests \(1 resumed\)")
+
+    def _check_not_resumed(self, expected_ranges, **kwargs):
+        with self._serve(b"x" * 5000, drop_after=100, **kwargs) as (
+            url,
+            ranges,
+        ):
+            with self.assertRaisesRegex(
+                urllib3.exceptions.ProtocolError, "Connection broken"
+            ), open_url(url) as in_f:
+                in_f.read()
+            self.assertEqual(expected_ranges, ranges)
+
+    def test_no_resume(self):
+        # Without a validator, we cannot tell if the object changed.
+        self._check_not_resumed([None], etag=False)
+        # The server ignored our `Range`.
+        self._check_not_resumed([None, "bytes=100-"], honor_range=False)
+        with mock.patch.object(open_url_module, "MAX_RESUMES", 0):
+            self._check_not_resumed([None])
+
+    def test_http_error(self):
+        with self._serve(b"", drop_after=0) as (url, ranges):
+            with self.assertRaises(requests.exceptions.HTTPError), open_url(
+                url + "-missing"
+            ):
+                pass  # pragma: no cover
+        self.assertEqual([], ranges)
@@ -10,11 +10,16 @@ import lzma
 import os
 import unittest
 from io import BytesIO
+from unittest import mock
 from typing import Iterator, Set, Tuple
 
 from antlir.fs_utils import Path
 
-from ..parse_repodata import get_rpm_parser, pick_primary_repodata
+from ..parse_repodata import (
+    BackgroundRpmParser,
+    get_rpm_parser,
+    pick_primary_repodata,
+)
 from ..repo_objects import Repodata, RepoMetadata
 from ..tests.temp_repos import (
     SAMPLE_STEPS,
@@ -36,14 +41,16 @@ def find_test_repos(repos_root: Path) -> Iterator[Tuple[Path, RepoMetadata]]:
                 yield p, RepoMetadata.new(xml=f.read())
 
 
-def _rpm_set(infile: BytesIO, rd: Repodata):
+def _rpm_set(infile: BytesIO, rd: Repodata, *, background: bool = False):
     rpms = set()
-    with get_rpm_parser(rd) as parser:
+    with get_rpm_parser(rd, background=background) as parser:
         while True:  # Exercise feed-in-chunks behavior
             chunk = infile.read(127)  # Our repodatas are tiny
             if not chunk:
                 break
             rpms.update(parser.feed(chunk))
+        if background:
+            rpms.update(parser.finish())
     assert len(rpms) > 0  # we have no empty test repos
     return rpms
 
@@ -101,6 +108,15 @@ class ParseRepodataTestCase(unittest.TestCase):
             ) as sf:
                 sql_rpms = _rpm_set(sf, sql_rd)
                 self.assertEqual(_rpm_set(xf, xml_rd), sql_rpms)
+                # Tiny batches, so that we check that none get lost.
+                with mock.patch.object(
+                    BackgroundRpmParser, "_RPMS_PER_BATCH", 2
+                ):
+                    for f, rd in [(sf, sql_rd), (xf, xml_rd)]:
+                        f.seek(0)
+                        self.assertEqual(
+                            sql_rpms, _rpm_set(f, rd, background=True)
+                        )
 
                 # A joint test of repo parsing and `temp_repos`: check that
                 # we had exactly the RPMs that were specified.
@@ -170,8 +186,18 @@ class ParseRepodataTestCase(unittest.TestCase):
                 # instead of going down the `unused_data` branch.
                 pass
 
-            with self.assertRaisesRegex(RuntimeError, "archive is incomplete"):
-                _rpm_set(BytesIO(bz_data[:-5]), sql_rd)
+            for background in [False, True]:
+                with self.assertRaisesRegex(
+                    RuntimeError, "archive is incomplete"
+                ):
+                    _rpm_set(
+                        BytesIO(bz_data[:-5]), sql_rd, background=background
+                    )
+
+            # In the background, the first error is raised by a later
+            # `feed()` or `finish()`, while the rest of the input is ignored.
+            with self.assertRaisesRegex(OSError, "Invalid data stream"):
+                _rpm_set(BytesIO(bz_data[3:]), sql_rd, background=True)
 
             # Some in-the-wild primary SQLite dbs are .gz or .xz, while
             # internally they are all are .bz2, so let's recompress.
@@ -12,7 +12,13 @@ from unittest import mock
 
 from ..common import Checksum
 from ..db_connection import DBConnectionContext
-from ..repo_db import RepodataTable, RepoDBContext, RpmTable, SQLDialect
+from ..repo_db import (
+    RepodataTable,
+    RepoDBContext,
+    RpmTable,
+    SQLDialect,
+    _MAX_PLACEHOLDERS,
+)
 from ..repo_objects import Repodata, RepoMetadata, Rpm
 
 
@@ -313,6 +319,95 @@ class RepoDBTestCase(unittest.TestCase):
                 ),
             )
 
+    def test_bulk_rpm_queries(self):
+        table = RpmTable("fakeverse")
+        other_table = RpmTable("otherverse")
+        # Enough RPMs to need several batches per query
+        rpms = [
+            _FAKE_RPM._replace(
+                version=str(i),
+                checksum=Checksum("fa", f"ke{i}"),
+                canonical_checksum=Checksum("can", f"onical{i}"),
+            )
+            for i in range(_MAX_PLACEHOLDERS // 3)
+        ]
+        with self._make_db_ctx() as db_ctx:
+            self.assertEqual(
+                [None] * len(rpms), db_ctx.get_storage_ids(table, rpms)
+            )
+            # Store the even RPMs in a batch, with a duplicate.
+            self.assertEqual(
+                ["sid0", *(f"sid{i}" for i in range(0, len(rpms), 2))],
+                db_ctx.maybe_store_many(
+                    table,
+                    [
+                        (rpms[0], "sid0"),
+                        *((rpms[i], f"sid{i}") for i in range(0, len(rpms), 2)),
+                    ],
+                ),
+            )
+            # A racing writer had stored the even RPMs
+            self.assertEqual(
+                [f"sid{i - i % 2}" for i in range(len(rpms))],
+                db_ctx.maybe_store_many(
+                    table,
+                    [(rpm, f"sid{i - i % 2}") for i, rpm in enumerate(rpms)],
+                ),
+            )
+            self.assertEqual(
+                [f"sid{i - i % 2}" for i in range(len(rpms))],
+                db_ctx.get_storage_ids(table, rpms),
+            )
+            # A mutable RPM in another universe
+            db_ctx.maybe_store(
+                other_table,
+                rpms[1]._replace(canonical_checksum=Checksum("oth", "er")),
+                "sid_other",
+            )
+
+            unstored = _FAKE_RPM._replace(
+                version="unstored", checksum=Checksum("fa", "ke")
+            )
+            lookups = [
+                rpm._replace(canonical_checksum=None)
+                for rpm in [*rpms, unstored]
+            ]
+            # Looking up by the canonical checksum also works.
+            lookups.append(
+                lookups[3]._replace(checksum=rpms[3].canonical_checksum)
+            )
+            self.assertEqual(
+                {
+                    rpm: db_ctx.get_rpm_storage_id_and_checksum(table, rpm)
+                    for rpm in lookups
+                    if rpm is not lookups[len(rpms)]
+                },
+                db_ctx.get_rpm_storage_ids_and_checksums(table, lookups),
+            )
+
+            self.assertEqual(
+                {
+                    rpm.nevra(): set(
+                        db_ctx.get_rpm_canonical_checksums_per_universe(
+                            table, rpm, {"fakeverse", "otherverse"}
+                        )
+                    )
+                    for rpm in rpms
+                },
+                db_ctx.get_rpms_canonical_checksums_per_universe(
+                    table, [*rpms, unstored], {"fakeverse", "otherverse"}
+                ),
+            )
+            self.assertEqual(
+                {
+                    (Checksum("can", "onical1"), "fakeverse"),
+                    (Checksum("oth", "er"), "otherverse"),
+                },
+                db_ctx.get_rpms_canonical_checksums_per_universe(
+                    table, [rpms[1]], {"fakeverse", "otherverse"}
+                )[rpms[1].nevra()],
+            )
+
     def test_universe_charset(self):
         # Until convinced otherwise, we hate underscores since they look
         # like spaces and needlessly exacerbate our RSI.
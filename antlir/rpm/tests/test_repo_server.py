@@ -6,23 +6,33 @@
 
 import email
 import hashlib
+import http.client
 import os
 import socket
 import sqlite3
 import tempfile
 import threading
 import unittest
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 from typing import Mapping, Tuple
+from unittest import mock
 
 import requests
+from antlir.common import listen_temporary_unix_socket
 from antlir.fs_utils import temp_dir
+from antlir.send_fds_and_run import send_fds
 
+from ..blob_cache import BlobCache
 from ..common import Checksum
 from ..repo_objects import Repodata, RepoMetadata, Rpm
-from ..repo_server import _CHUNK_SIZE, read_snapshot_dir, repo_server
+from ..repo_server import (
+    _CHUNK_SIZE,
+    read_snapshot_dir,
+    repo_server,
+    serve_repo_server_daemon,
+)
 from ..repo_snapshot import MutableRpmError, RepoSnapshot
-from ..storage import Storage
+from ..storage import Storage, StorageInput
 from . import temp_repos
 
 
@@ -71,10 +81,12 @@ class RepoServerTestCase(unittest.TestCase):
         )
 
     @contextmanager
-    def repo_server_thread(self, location_to_obj):
+    def repo_server_thread(self, location_to_obj, *, blob_cache=None):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.bind(("127.0.0.1", 0))
-        with repo_server(sock, location_to_obj, self.storage) as httpd:
+        with repo_server(
+            sock, location_to_obj, self.storage, blob_cache=blob_cache
+        ) as httpd:
             httpd.server_activate()
             thread = threading.Thread(name="RpSrv", target=httpd.serve_forever)
             thread.start()
@@ -158,6 +170,127 @@ class RepoServerTestCase(unittest.TestCase):
         self.assertIn(str(actual), msg)
         self.assertIn(str(expected), msg)
 
+    def test_keep_alive_and_verify_once(self):
+        location_to_obj = {}
+        for i in range(3):
+            content, sid = self._write(str(i).encode() * (_CHUNK_SIZE + i))
+            location_to_obj[f"{i}.rpm"] = {
+                "size": len(content),
+                "build_timestamp": 0,
+                "storage_id": sid,
+                "checksum": str(_checksum("sha256", content)),
+            }
+        with self.repo_server_thread(location_to_obj) as (host, port):
+            conn = http.client.HTTPConnection(host, port)
+            with mock.patch.object(
+                Checksum, "hasher", autospec=True, side_effect=Checksum.hasher
+            ) as mock_hasher:
+                for _ in range(2):  # The 2nd pass uses `sendfile`
+                    for i in range(3):
+                        conn.request("GET", f"/{i}.rpm")
+                        resp = conn.getresponse()
+                        self.assertEqual(200, resp.status)
+                        self.assertEqual(11, resp.version)  # HTTP/1.1
+                        self.assertEqual(
+                            str(i).encode() * (_CHUNK_SIZE + i), resp.read()
+                        )
+                        self.assertIsNotNone(conn.sock)  # Kept alive
+            self.assertEqual(3, mock_hasher.call_count)
+            conn.close()
+
+    def test_blob_cache(self):
+        content, sid = self._write(b"cached" * _CHUNK_SIZE)
+        location_to_obj = {
+            "a.rpm": {
+                "size": len(content),
+                "build_timestamp": 0,
+                "storage_id": sid,
+                "checksum": str(_checksum("sha256", content)),
+            }
+        }
+        with temp_dir() as td, mock.patch.object(
+            # Pretend that the storage is remote
+            StorageInput,
+            "local_file",
+            return_value=None,
+        ):
+            # Each server has its own `verified_blobs`, but they share the
+            # cache, so only the first server reads the blob.
+            for expected_misses in [1, 0]:
+                cache = BlobCache(td, max_bytes=2 * len(content))
+                with self.repo_server_thread(
+                    location_to_obj, blob_cache=cache
+                ) as (host, port), mock.patch.object(
+                    self.storage, "reader", wraps=self.storage.reader
+                ) as mock_reader:
+                    for _ in range(2):
+                        req = requests.get(f"http://{host}:{port}/a.rpm")
+                        req.raise_for_status()
+                        self.assertEqual(content, req.content)
+                self.assertEqual(expected_misses, mock_reader.call_count)
+                self.assertEqual(expected_misses, cache.num_misses)
+                self.assertEqual(2 - expected_misses, cache.num_hits)
+
+    def test_daemon(self):
+        content, sid = self._write(b"shared")
+        location_to_obj = {
+            "a.rpm": {
+                "size": len(content),
+                "build_timestamp": 0,
+                "storage_id": sid,
+                "checksum": str(_checksum("sha256", content)),
+            }
+        }
+        verified_blobs = set()
+        with listen_temporary_unix_socket() as (unix_path, unix_sock):
+            daemon = threading.Thread(
+                target=serve_repo_server_daemon,
+                args=(
+                    unix_sock,
+                    lambda sock: repo_server(
+                        sock,
+                        location_to_obj,
+                        self.storage,
+                        verified_blobs=verified_blobs,
+                    ),
+                ),
+                kwargs={"idle_timeout": 0.5},
+            )
+            daemon.start()
+            # Two clients with two sockets each share `verified_blobs`.
+            with ExitStack() as stack:
+                ports = []
+                for _ in range(2):
+                    socks = []
+                    for _ in range(2):
+                        sock = stack.enter_context(socket.socket())
+                        sock.bind(("127.0.0.1", 0))
+                        sock.listen()
+                        ports.append(sock.getsockname()[1])
+                        socks.append(sock)
+                    conn = stack.enter_context(socket.socket(socket.AF_UNIX))
+                    conn.connect(unix_path)
+                    send_fds(conn, [s.fileno() for s in socks])
+                    self.assertEqual(b"serving", conn.recv(128))
+                    for sock in socks:
+                        sock.close()  # The daemon has its own copy
+                with mock.patch.object(
+                    Checksum,
+                    "hasher",
+                    autospec=True,
+                    side_effect=Checksum.hasher,
+                ) as mock_hasher:
+                    for port in ports:
+                        req = requests.get(f"http://127.0.0.1:{port}/a.rpm")
+                        req.raise_for_status()
+                        self.assertEqual(content, req.content)
+                self.assertEqual(1, mock_hasher.call_count)
+            # The clients disconnected, so the daemon stops serving, and
+            # exits once idle.
+            daemon.join()
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                requests.get(f"http://127.0.0.1:{ports[0]}/a.rpm")
+
     # Future: A slightly cleverer layout of this test would avoid spinniang
     # up and tearing down a bunch of servers, making it much faster.
     def test_bad_blobs(self):
@@ -260,7 +393,35 @@ class RepoServerTestCase(unittest.TestCase):
             os.mkdir(repo_dir / "gpg_keys")
             with open(repo_dir / "gpg_keys" / "RPM-GPG-safekey", "wb") as outf:
                 outf.write(b"public key")
-            with self.repo_server_thread(read_snapshot_dir(td)) as (h, p):
+            location_to_obj = read_snapshot_dir(td)
+            self.assertEqual(
+                {
+                    "mine/RPM-GPG-safekey",
+                    "mine/pkgs/good.rpm",
+                    "mine/pkgs/mutable.rpm",
+                    "mine/repodata/repomd.xml",
+                    "mine/repodata/the_only",
+                },
+                set(location_to_obj),
+            )
+            self.assertEqual(5, len(location_to_obj))
+            self.assertNotIn("mine/pkgs", location_to_obj)
+            self.assertNotIn("mine", location_to_obj)
+            self.assertNotIn("other/pkgs/good.rpm", location_to_obj)
+            good_obj = location_to_obj["mine/pkgs/good.rpm"]
+            self.assertEqual(
+                {
+                    "size": len(rpm_bytes),
+                    "build_timestamp": 456,
+                    "checksum": str(rpm.best_checksum()),
+                    "storage_id": rpm_sid,
+                },
+                good_obj,
+            )
+            # The LRU hands out the same object, so `_memoize_error`
+            # mutations are seen by the next request.
+            self.assertIs(good_obj, location_to_obj["mine/pkgs/good.rpm"])
+            with self.repo_server_thread(location_to_obj) as (h, p):
                 # A vanilla 404 doesn't affect the server's operation
                 req = requests.get(f"http://{h}:{p}//DOES_NOT_EXIST")
                 self.assertEqual(404, req.status_code)
@@ -55,6 +55,7 @@ class YumDnfFromSnapshotTestImpl:
         # Create IMAGE_ROOT/<META_DIR> by default, since it's always
         # protected, if it exists.
         extra_mkdirs=frozenset([META_DIR.decode()]),
+        shared_cache_dir=None,
     ):
         if install_args is None:
             install_args = _INSTALL_ARGS
@@ -75,6 +76,7 @@ class YumDnfFromSnapshotTestImpl:
             self._yum_dnf_from_snapshot(
                 protected_paths=protected_paths,
                 yum_dnf_args=[f"--installroot={install_root}", *install_args],
+                shared_cache_dir=shared_cache_dir,
             )
             yield install_root
 
@@ -180,6 +182,55 @@ class YumDnfFromSnapshotTestImpl:
         else:
             raise NotImplementedError(self._YUM_DNF)
 
+    def test_shared_cache(self):
+        # The shared cache must be on the same filesystem as `/`, and
+        # deleting `sv` also deletes the read-only cache subvolume.
+        with _temp_subvol("test_shared_cache") as sv:
+            shared_cache_dir = sv.path("shared_cache")
+            for _ in range(2):
+                with self._install(
+                    protected_paths=[], shared_cache_dir=shared_cache_dir
+                ) as install_root:
+                    self._check_installed_content(
+                        install_root,
+                        {
+                            "carrot.txt": "carrot 2 rc0\n",
+                            "milk.txt": "milk 2.71 8\n",
+                            "post.txt": "stuff\n",
+                        },
+                    )
+            # Both installs used the same read-only copy of the cache.
+            (lock_name,) = [
+                p for p in shared_cache_dir.listdir() if p.endswith(b".lock")
+            ]
+            shared_cache = shared_cache_dir / lock_name[: -len(b".lock")]
+            self.assertEqual(
+                {lock_name, shared_cache.basename()},
+                set(shared_cache_dir.listdir()),
+            )
+            prog = self._YUM_DNF.value
+            self.assertEqual(
+                set((_SNAPSHOT_DIR / f"{prog}/var/cache/{prog}").listdir()),
+                set(shared_cache.listdir()),
+            )
+            self.assertEqual(
+                b"ro=true\n",
+                subprocess.check_output(
+                    ["btrfs", "property", "get", "-ts", shared_cache, "ro"]
+                ),
+            )
+
+            # Caches in use, or used recently, are kept.
+            yum_dnf_from_snapshot._prune_shared_yum_dnf_caches(
+                shared_cache_dir
+            )
+            self.assertTrue(os.path.exists(shared_cache))
+            os.utime(shared_cache_dir / lock_name, (0, 0))
+            yum_dnf_from_snapshot._prune_shared_yum_dnf_caches(
+                shared_cache_dir
+            )
+            self.assertEqual([], shared_cache_dir.listdir())
+
     def test_fail_to_write_to_protected_path(self):
         # Nothing fails with no specified protection, or with META_DIR
         # explicitly protected, whether or not META_DIR exists.
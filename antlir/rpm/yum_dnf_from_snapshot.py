@@ -85,6 +85,9 @@ The current tool works well, with these caveats:
 """
 import argparse
 import base64
+import fcntl
+import hashlib
+import json
 import logging
 import os
 import pwd
@@ -92,6 +95,7 @@ import shutil
 import subprocess
 import tempfile
 import textwrap
+import time
 import uuid
 from configparser import ConfigParser
 from contextlib import contextmanager, nullcontext
@@ -129,6 +133,10 @@ assert SHADOWED_PATHS_ROOT.startswith(b"/"), SHADOWED_PATHS_ROOT
 # installer binary.  So we make this mock point available.
 _LIBRENAME_SHADOWED_PATHS_ROOT = SHADOWED_PATHS_ROOT
 
+# Shared caches that no install used for this long get deleted, see
+# `_shared_yum_dnf_cache`.
+_SHARED_CACHE_MAX_AGE_SECONDS = 7 * 24 * 3600
+
 
 def _install_to_current_root(install_root):
     return install_root.realpath() == b"/"
@@ -437,9 +445,179 @@ def _resolve_rpm_installer_binary(
         return yum_dnf_binary
 
 
+def _reflink_copy_via_root_bind_mount(
+    src: Path, dest: Path, *, mountpoint: Path
+) -> None:
+    """
+    Reflink-copies the contents of the directory `src` into the existing
+    directory `dest`, both given as absolute paths on the root FS.
+    `mountpoint` is an empty directory on the root FS, which is transiently
+    re-purposed -- read the long comment in `_set_up_yum_dnf_cache`.
+    """
+    subprocess.check_call(
+        [
+            "sudo",
+            "unshare",
+            "-m",
+            "bash",
+            "-uec",
+            ";".join(
+                [
+                    f"mount -o bind / {mountpoint.shell_quote()}",
+                    " ".join(
+                        [
+                            "cp",
+                            "--archive",
+                            "--reflink=always",
+                            "--no-target-directory",
+                            (
+                                mountpoint / src.strip_leading_slashes()
+                            ).shell_quote(),
+                            (
+                                mountpoint / dest.strip_leading_slashes()
+                            ).shell_quote(),
+                        ]
+                    ),
+                ]
+            ),
+        ]
+    )
+
+
+def _shared_cache_key(snapshot_cache: Path, yum_dnf_binary: Path) -> str:
+    """
+    Content-addresses the snapshot's repodata cache, and the installer that
+    reads it, since a cache is only valid for the `yum` / `dnf` that wrote
+    it.  Both are immutable parts of the build appliance, so the sizes &
+    mtimes of their files stand in for their content.  Unlike inode
+    numbers, these are the same in every build appliance container, so all
+    layers built with one build appliance share the cache.
+    """
+    st = os.stat(yum_dnf_binary)
+    entries = [[yum_dnf_binary.realpath().decode(), st.st_size, st.st_mtime_ns]]
+    for dirpath, dirnames, filenames in os.walk(snapshot_cache):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = Path(dirpath) / filename
+            st = os.lstat(path)
+            entries.append(
+                [
+                    path.relpath(snapshot_cache).decode(),
+                    st.st_size,
+                    st.st_mtime_ns,
+                ]
+            )
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+def _delete_subvol(path: Path) -> None:
+    subprocess.check_call(
+        ["sudo", "btrfs", "subvolume", "delete", path],
+        stdout=subprocess.DEVNULL,
+    )
+
+
+@contextmanager
+def _locked_shared_cache_entry(shared_cache_dir: Path, key: str):
+    "Yields once we hold the lock of a live entry of `shared_cache_dir`."
+    lock_path = shared_cache_dir / f"{key}.lock"
+    while True:
+        with open(lock_path, "a") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            # Pruning unlinks the lock of the entry it deletes, retry.
+            if os.fstat(lock_f.fileno()).st_nlink:
+                yield lock_f
+                return
+
+
+def _prune_shared_yum_dnf_caches(shared_cache_dir: Path) -> None:
+    "Deletes the shared caches that no install used for a while."
+    cutoff = time.time() - _SHARED_CACHE_MAX_AGE_SECONDS
+    for name in shared_cache_dir.listdir():
+        if not name.endswith(b".lock"):
+            continue
+        lock_path = shared_cache_dir / name
+        with open(lock_path, "a") as lock_f:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # In use, so not stale
+            if os.fstat(lock_f.fileno()).st_mtime >= cutoff:
+                continue
+            shared_cache = shared_cache_dir / name[: -len(b".lock")]
+            log.info(f"Deleting unused shared cache {shared_cache}")
+            if os.path.exists(shared_cache):
+                _delete_subvol(shared_cache)
+            os.unlink(lock_path)
+
+
+def _shared_yum_dnf_cache(
+    yum_dnf: YumDnf,
+    yum_dnf_binary: Path,
+    snapshot_dir: Path,
+    shared_cache_dir: Path,
+) -> Path:
+    """
+    Returns a read-only subvolume under `shared_cache_dir` with a copy of
+    the snapshot's repodata cache, populating it on first use.  See
+    `_shared_cache_key` for what it is keyed on.
+
+    `shared_cache_dir` is normally bind-mounted from the host, so that the
+    cache persists across build appliance containers.  Each use bumps the
+    mtime of the cache's lock file, and populating a new cache deletes the
+    ones unused for `_SHARED_CACHE_MAX_AGE_SECONDS`.
+    """
+    prog = yum_dnf.value
+    snapshot_cache = snapshot_dir / f"{prog}/var/cache/{prog}"
+    key = _shared_cache_key(snapshot_cache, yum_dnf_binary)
+    shared_cache = shared_cache_dir / key
+    os.makedirs(shared_cache_dir, exist_ok=True)
+    # Concurrent installers wait for the first one to populate the cache.
+    with _locked_shared_cache_entry(shared_cache_dir, key) as lock_f:
+        os.utime(lock_f.fileno())
+        if os.path.exists(shared_cache):
+            return shared_cache
+        _prune_shared_yum_dnf_caches(shared_cache_dir)
+        start = time.monotonic()
+        # Reflinks cannot cross mounts, so we populate a subvolume on the
+        # root FS.  Snapshots only need to stay on the same filesystem, so
+        # we snapshot it into `shared_cache_dir`.
+        tmp_name = f"{key}.{uuid.uuid4().hex}"
+        tmp_cache = Path("/") / tmp_name
+        subprocess.check_call(
+            ["sudo", "btrfs", "subvolume", "create", tmp_cache],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            _reflink_copy_via_root_bind_mount(
+                snapshot_cache, tmp_cache, mountpoint=tmp_cache
+            )
+            # An interrupted populate can leak this, which costs space
+            # until the host's volume is cleaned up, but is otherwise
+            # harmless, since it is never a valid key.
+            subprocess.check_call(
+                ["sudo", "btrfs", "subvolume", "snapshot", "-r"]
+                + [tmp_cache, shared_cache_dir / tmp_name],
+                stdout=subprocess.DEVNULL,
+            )
+            os.rename(shared_cache_dir / tmp_name, shared_cache)
+        finally:
+            _delete_subvol(tmp_cache)
+        log.info(
+            f"Populated shared {prog} cache {shared_cache} in "
+            f"{time.monotonic() - start:.2f}s"
+        )
+    return shared_cache
+
+
 @contextmanager
 def _set_up_yum_dnf_cache(
-    yum_dnf: YumDnf, install_root: Path, snapshot_dir: Path
+    yum_dnf: YumDnf,
+    install_root: Path,
+    snapshot_dir: Path,
+    *,
+    yum_dnf_binary: Path,
+    shared_cache_dir: Optional[Path] = None,
 ) -> Path:
     """
     Reflink-copy (and clean up on exit) the snapshot's repodata cache into
@@ -461,6 +639,14 @@ def _set_up_yum_dnf_cache(
 
     On the other hand, a copy is very cheap thanks to `btrfs`, and
     eliminates concurrency bugs.
+
+    With `shared_cache_dir`, we instead take a `btrfs` snapshot of a
+    read-only copy of the cache in that directory, see
+    `_shared_yum_dnf_cache`.  When a container runs many installs, this
+    is much cheaper than reflinking each file of the cache every time, and
+    so is deleting the snapshot afterwards.  This is only used when the
+    install root is not `/`, since the shared cache would otherwise leak
+    into the image being built.
     """
     # Our ephemeral cache set-up is very particular, for reasons that boil
     # down to the fact that as of 2020, Linux does not allow reflinks to
@@ -503,48 +689,51 @@ def _set_up_yum_dnf_cache(
     cache_dest = Path(b"/" + cache_name)
     prog = yum_dnf.value
     install_to_cur_root = _install_to_current_root(install_root)
+    use_shared_cache = shared_cache_dir is not None and not install_to_cur_root
+    cache_is_subvol = False
+    start = time.monotonic()
     try:
-        os.mkdir(cache_dest)  # needed for the `/` bind-mount below
         if not install_to_cur_root:
             os.mkdir(install_root / cache_name)  # `_isolate_yum_dnf` bind-mount
-        log.debug(f"Setting up ephemeral {prog} cache in {cache_dest}")
-        subprocess.check_call(
-            [
-                "sudo",
-                "unshare",
-                "-m",
-                "bash",
-                "-uec",
-                ";".join(
-                    [
-                        # This odd `mount` is explained in the long doc above.
-                        f"mount -o bind / {cache_dest}",
-                        " ".join(
-                            [
-                                "cp",
-                                "--archive",
-                                "--reflink=always",
-                                "--no-target-directory",
-                                (
-                                    cache_dest
-                                    / snapshot_dir.strip_leading_slashes()
-                                    / f"{prog}/var/cache/{prog}"
-                                ).shell_quote(),
-                                (cache_dest / cache_name).shell_quote(),
-                            ]
-                        ),
-                    ]
-                ),
-            ]
+        if use_shared_cache:
+            shared_cache = _shared_yum_dnf_cache(
+                yum_dnf, yum_dnf_binary, snapshot_dir, shared_cache_dir
+            )
+            log.debug(f"Snapshotting {shared_cache} to {cache_dest}")
+            subprocess.check_call(
+                ["sudo", "btrfs", "subvolume", "snapshot"]
+                + [shared_cache, cache_dest],
+                stdout=subprocess.DEVNULL,
+            )
+            cache_is_subvol = True
+        else:
+            os.mkdir(cache_dest)  # needed for the `/` bind-mount
+            log.debug(f"Setting up ephemeral {prog} cache in {cache_dest}")
+            _reflink_copy_via_root_bind_mount(
+                snapshot_dir / f"{prog}/var/cache/{prog}",
+                cache_dest,
+                mountpoint=cache_dest,
+            )
+        log.info(
+            f"Set up {'shared' if use_shared_cache else 'ephemeral'} {prog} "
+            f"cache in {time.monotonic() - start:.2f}s"
         )
         # pyre-fixme[7]: Expected `Path` but got `Generator[Path, None, None]`.
         yield cache_dest
     finally:
+        start = time.monotonic()
         if not install_to_cur_root:
             os.rmdir(install_root / cache_name)
         # The assert is paranoia to make sure we don't `rm` something wrong.
         assert cache_dest == b"/" + cache_name, cache_dest
-        subprocess.check_call(["sudo", "rm", "-rf", cache_dest])
+        if cache_is_subvol:
+            subprocess.check_call(
+                ["sudo", "btrfs", "subvolume", "delete", cache_dest],
+                stdout=subprocess.DEVNULL,
+            )
+        else:
+            subprocess.check_call(["sudo", "rm", "-rf", cache_dest])
+        log.info(f"Tore down {prog} cache in {time.monotonic() - start:.2f}s")
 
 
 def yum_dnf_from_snapshot(
@@ -554,8 +743,12 @@ def yum_dnf_from_snapshot(
     protected_paths: List[str],
     yum_dnf_args: List[str],
     yum_dnf_binary: Optional[Path] = None,
+    shared_cache_dir: Optional[Path] = None,
 ):
     yum_dnf_binary = _resolve_rpm_installer_binary(yum_dnf, yum_dnf_binary)
+    # The `builddep` hack below changes `yum_dnf_binary`, but the cache
+    # still comes from this one.
+    cache_yum_dnf_binary = yum_dnf_binary
     _ensure_antlir_container()
     _ensure_private_network()
 
@@ -671,7 +864,13 @@ def yum_dnf_from_snapshot(
     ) as protected_path_to_dummy, (
         nullcontext()
         if is_makecache
-        else _set_up_yum_dnf_cache(yum_dnf, install_root, snapshot_dir)
+        else _set_up_yum_dnf_cache(
+            yum_dnf,
+            install_root,
+            snapshot_dir,
+            yum_dnf_binary=cache_yum_dnf_binary,
+            shared_cache_dir=shared_cache_dir,
+        )
     ) as cache_dir:
         cmd = [
             "sudo",
@@ -766,6 +965,16 @@ if __name__ == "__main__":  # pragma: no cover
             "argument via `PATH`. This is the non-shadowed path to the "
             "actual RPM installer binary that we are wrapping.",
         )
+        cli.parser.add_argument(
+            "--shared-cache-dir",
+            type=Path.from_argparse,
+            help="Optional absolute path to a directory on the same `btrfs` "
+            "filesystem as `/`, e.g. bind-mounted from the host, so that it "
+            "persists across containers. Instead of copying the snapshot's "
+            "repodata cache for each invocation, keep a read-only copy per "
+            "snapshot & installer here, and take a `btrfs` snapshot of it. "
+            "Ignored when installing to `/`.",
+        )
         cli.parser.add_argument(
             "--protected-path",
             action="append",
@@ -800,6 +1009,7 @@ if __name__ == "__main__":  # pragma: no cover
             snapshot_dir=args.snapshot_dir,
             protected_paths=args.protected_path,
             yum_dnf_args=args.args,
+            shared_cache_dir=args.shared_cache_dir,
         )
     except BaseException as ex:
         what_ran = f"""`{args.yum_dnf.value} {
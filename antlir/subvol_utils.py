@@ -16,6 +16,8 @@ from typing import AnyStr, BinaryIO, Iterable, Iterator, Optional, TypeVar
 
 from .artifacts_dir import find_artifacts_dir
 from .btrfs_diff.freeze import DoNotFreeze
+from .btrfs_diff.parse_send_stream import parse_send_stream
+from .btrfs_diff.send_stream import SendStreamItem
 from .common import (
     check_popen_returncode,
     get_logger,
@@ -116,6 +118,65 @@ def _query_uuid(subvol: "Subvol", path: Path):
     return subvol_metadata[2].split(b":")[1].decode().strip()
 
 
+def _query_subvol_id(subvol: "Subvol", path: Path) -> int:
+    res = subvol.run_as_root(
+        ["btrfs", "subvolume", "show", path], stdout=subprocess.PIPE
+    )
+    res.check_returncode()
+    # See `_query_uuid` for a sample of the output format.
+    for line in res.stdout.split(b"\n"):
+        k, sep, v = line.partition(b":")
+        if sep and k.strip() == b"Subvolume ID":
+            return int(v.strip())
+    raise RuntimeError(f"No `Subvolume ID` for {path}: {res.stdout}")
+
+
+# `btrfs qgroup show` emits these on stderr when the numbers it prints
+# cannot be trusted.  The exit code is 1 for the first, 0 for the rest.
+_QGROUPS_DISABLED_ERRORS = (b"ERROR: can't list qgroups: quotas not enabled",)
+_QGROUPS_UNRELIABLE_WARNINGS = (
+    b"WARNING: qgroup data inconsistent, rescan recommended",
+    b"WARNING: rescan is running, qgroup data may be incorrect",
+)
+
+
+def _parse_qgroup_referenced_bytes(
+    subvol_id: int, returncode: int, stdout: bytes, stderr: bytes
+) -> Optional[int]:
+    """
+    Parses `btrfs qgroup show --raw --sync` output, returning the bytes in
+    referenced extents of the level-0 qgroup of `subvol_id`.  Returns
+    `None` if quotas are disabled, or if the qgroup data is unreliable.
+    Fails on any other unexpected output, since a silently wrong size
+    estimate would make for hard-to-debug packaging failures.
+    """
+    stderr_lines = [l for l in stderr.strip().split(b"\n") if l]
+    for l in stderr_lines:
+        if l.strip() in _QGROUPS_DISABLED_ERRORS:
+            log.warning(f"Not using qgroups to estimate size: {l}")
+            return None
+        if l.strip() in _QGROUPS_UNRELIABLE_WARNINGS and returncode == 0:
+            log.warning(f"Not using qgroups to estimate size: {l}")
+            return None
+    if returncode != 0 or stderr_lines:
+        raise RuntimeError(
+            f"Unexpected `btrfs qgroup show` exit code {returncode}, "
+            f"stderr: {stderr}"
+        )
+    qgroup_id = f"0/{subvol_id}".encode()
+    for line in stdout.split(b"\n"):
+        fields = line.split()
+        # qgroupid         rfer         excl
+        # --------         ----         ----
+        # 0/1432     1381523456        16384
+        if fields and fields[0] == qgroup_id:
+            return int(fields[1])
+    # This happens for subvolumes created before quotas were enabled,
+    # until somebody runs a rescan.
+    log.warning(f"Not using qgroups to estimate size: no qgroup {qgroup_id}")
+    return None
+
+
 # Subvol is marked as `DoNotFreeze` as it's hash is just of
 # byte string that contains the path to the subvol. It's member
 # variables are just a cache of the external state of the subvol
@@ -431,14 +492,46 @@ class Subvol(DoNotFreeze):
         # Delete from the innermost to the outermost
         for inner_path in sorted(subvols, reverse=True):
             uuid = _query_uuid(self, inner_path)
+            subvol_id = _query_subvol_id(self, inner_path)
             self.run_as_root(["btrfs", "subvolume", "delete", inner_path])
+            self._destroy_qgroup(subvol_id)
             # Will succeed even if this subvolume was created by a
             # subcommand, and is not tracked in `_UUID_TO_SUBVOLS`
             _mark_deleted(uuid)
 
+        subvol_id = _query_subvol_id(self, self.path())
         self.run_as_root(["btrfs", "subvolume", "delete", self.path()])
+        self._destroy_qgroup(subvol_id)
         self._mark_deleted()
 
+    def _destroy_qgroup(self, subvol_id: int):
+        """
+        Implementation detail for `delete`.
+
+        Older kernels do not remove the level-0 qgroup of a deleted
+        subvolume, so with quotas enabled, every build would leak one.  The
+        wrapper directory is on the same volume, and outlives the subvol.
+
+        This is best-effort: if quotas are disabled, or the kernel already
+        removed the qgroup, there is nothing to clean up.
+        """
+        ret = self.run_as_root(
+            [
+                "btrfs",
+                "qgroup",
+                "destroy",
+                f"0/{subvol_id}",
+                self.path().dirname(),
+            ],
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        if ret.returncode != 0:
+            log.debug(
+                f"Did not destroy qgroup 0/{subvol_id} of {self._path}: "
+                + ret.stderr.decode(errors="surrogateescape").strip()
+            )
+
     def _gen_inner_subvol_paths(self) -> Iterable[Path]:
         """
         Implementation detail for `delete`.
@@ -615,6 +708,10 @@ class Subvol(DoNotFreeze):
             assert inner_subvol == os.path.normpath(inner_subvol), inner_subvol
             yield self.path(inner_subvol)
 
+    def uuid(self) -> str:
+        "The btrfs UUID, which changes whenever the subvolume is recreated."
+        return _query_uuid(self, self.path())
+
     def set_readonly(self, readonly: bool):
         self.run_as_root(
             [
@@ -695,6 +792,28 @@ class Subvol(DoNotFreeze):
             # pyre-fixme[16]: Optional type has no attribute `read`.
             return proc.stdout.read()
 
+    @contextmanager
+    def mark_readonly_and_gen_send_stream_items(
+        self, *, skip_data: bool = False, **kwargs
+    ) -> Iterator[Iterator[SendStreamItem]]:
+        """
+        Like `mark_readonly_and_get_sendstream`, and takes the same
+        `no_data` and `parent` arguments, but parses the stream while
+        `btrfs send` writes it.  Memory use does not grow with the size of
+        the subvolume, so e.g. `SubvolumeSetMutator.apply_item` can consume
+        the items of a layer much larger than RAM.
+
+        With `skip_data`, writes become `update_extent` items, as with
+        `no_data`, but unlike `no_data`, `btrfs send` still reports clones.
+
+        Consume all the items before exiting the context -- exiting early
+        kills `btrfs send` with a broken pipe, which is an error.
+        """
+        with self._mark_readonly_and_send(
+            stdout=subprocess.PIPE, **kwargs
+        ) as proc:
+            yield parse_send_stream(proc.stdout, skip_data=skip_data)
+
     @contextmanager
     def mark_readonly_and_write_sendstream_to_file(
         self, outfile: BinaryIO, **kwargs
@@ -707,6 +826,8 @@ class Subvol(DoNotFreeze):
         output_path,
         loopback_opts: loopback_opts_t,
         waste_factor=1.15,
+        *,
+        grow_during_receive: bool = False,
     ) -> int:
         """
         Overwrites `ouput_path` with a new btrfs image, and send this
@@ -718,7 +839,8 @@ class Subvol(DoNotFreeze):
         multiplying it by `waste_factor` to ensure that `receive` does not
         run out of space.  If out-of-space does occur, this function repeats
         multiply-send-receive until we succeed, so a low `waste_factor` can
-        make image builds much slower.
+        make image builds much slower -- unless you pass
+        `grow_during_receive`, see below.
 
         ## Notes on setting `waste_factor`
 
@@ -757,10 +879,12 @@ class Subvol(DoNotFreeze):
             it possible to resize a populated filesystem to have a size
             **below** what you would have needed to populate its content.
 
-          - There is an alternative strategy to "multiply by waste_factor &
-            re-send", which is to implement a `pv`-style function that
-            sits on a pipe between `send` and `receive`, and does the
-            following to make sure `receive` never runs out of space:
+          - `grow_during_receive=True` enables an alternative strategy to
+            "multiply by waste_factor & re-send", which is implemented by
+            `BtrfsLoopbackVolume.receive_growing`.  This is a `pv`-style
+            function that sits on a pipe between `send` and `receive`, and
+            does the following to make sure `receive` never runs out of
+            space:
               - `btrfs filesystem sync`, `usage`, and if "min" free space
                 drops too low, `resize`
               - `splice` (via `ctypes`, or write this interposition program
@@ -785,13 +909,17 @@ class Subvol(DoNotFreeze):
                 while the minimum size to which we can shrink via `resize`
                 is 256MiB, so the early growth tactics should reflect this.
 
-            The advantage of this strategy of interposing on a pipe, if
-            implemented well, is that we should be able to achieve a smaller
-            waste factor without paying occasionally doubling our wall clock
-            and IOP costs due to retries.  The disadvantage is that if we do
-            a lot of grow cycles prior to our shrink, the resulting
-            filesystem may end up being more out-of-tune than if we had
-            started with a large enough size from the beginning.
+            The advantage of this strategy of interposing on a pipe is that
+            we can use a much smaller waste factor (~1.02) without paying
+            occasionally doubling our wall clock and IOP costs due to
+            retries.  The disadvantage is that if we do a lot of grow cycles
+            prior to our shrink, the resulting filesystem may end up being
+            more out-of-tune than if we had started with a large enough
+            size from the beginning.  The number of grow cycles, and of
+            bytes spliced, is logged for each attempt.
+
+            The size-minimizing second pass never grows, since it is
+            bounded by the size that the first pass achieved.
         """
         if loopback_opts.size_mb:
             leftover_bytes, image_size = self._send_to_loopback_if_fits(
@@ -823,7 +951,10 @@ class Subvol(DoNotFreeze):
                 attempts += 1
                 fs_bytes *= waste_factor
                 leftover_bytes, image_size = self._send_to_loopback_if_fits(
-                    output_path, int(fs_bytes), loopback_opts
+                    output_path,
+                    int(fs_bytes),
+                    loopback_opts,
+                    grow_during_receive=grow_during_receive,
                 )
 
                 if leftover_bytes == 0:
@@ -916,16 +1047,17 @@ class Subvol(DoNotFreeze):
         necessary to contain this subvolume.  The caller is responsible for
         appropriately padding this size when creating the destination FS.
 
-        ## Future: Query the subvolume qgroup to estimate its size
+        If quotas are enabled on the volume, this is an `O(1)` query of the
+        subvolume's qgroup, instead of the more costly filesystem tree
+        traversal of `du`.  We fall back to `du` (with a `log.warning`) if
+        quotas are disabled, e.g. in an older `buck-image-out`, or if the
+        qgroup data is inconsistent.  Enabling quotas and triggering a
+        `rescan -w` would also be an option, but requires more code/testing.
+
+        Notes on qgroups:
 
-          - If quotas are enabled, this should be an `O(1)` operation
-            instead of the more costly filesystem tree traversal.  NB:
-            qgroup size estimates tend to run a bit (~1%) lower than `du`,
-            so growth factors may need a tweak.  `_estimate_content_bytes()`
-            should `log.warning` and fall back to `du` if quotas are
-            disabled in an older `buck-image-out`.  It's also an option to
-            enable quotas and to trigger a `rescan -w`, but requires more
-            code/testing.
+          - qgroup size estimates tend to run a bit (~1%) lower than `du`,
+            so growth factors may need a tweak.
 
           - Using qgroups for builds is a good stress test of the qgroup
             subsystem. It would help us gain confidence in that (a) they
@@ -939,31 +1071,39 @@ class Subvol(DoNotFreeze):
           - Eventually, we'd enable quotas by default for `buck-image-out`
             volumes.
 
-          - Need to delete the qgroup whenever we delete a subvolume.  Two
-            main cases: `Subvol.delete` and `subvolume_garbage_collector.py`.
-            Can check if we are leaking cgroups by building & running &
+          - `Subvol.delete` destroys the qgroup of every subvolume it
+            deletes, which also covers `subvolume_garbage_collector.py`.
+            Can check if we are leaking qgroups by building & running &
             image tests, and looking to see if that leaves behind 0-sized
-            cgroups unaffiliated with subvolumes.
-
-          - The basic logic for qgroups looks like this:
-
-            $ sudo btrfs subvol show buck-image-out/volume/example |
-                grep 'Subvolume ID'
-                    Subvolume ID:           1432
-
-            $ sudo btrfs qgroup show --raw --sync buck-image-out/volume/ |
-                grep ^0/1432
-            0/1432     1381523456        16384
-            # We want the second column, bytes in referenced extents.
-
-            # For the `qgroup show` operation, check for **at least** these
-            # error signals on stderr -- with exit code 1:
-            ERROR: can't list qgroups: quotas not enabled
-            # ... and with exit code 0:
-            WARNING: qgroup data inconsistent, rescan recommended
-            WARNING: rescan is running, qgroup data may be incorrect
-            # Moreover, I would have the build fail on any unknown output.
+            qgroups unaffiliated with subvolumes.
         """
+        start_time = time.time()
+        size = self._estimate_content_bytes_via_qgroup()
+        if size is not None:
+            log.info(
+                f"qgroup estimated size of {self._path} as {size} in "
+                f"{time.time() - start_time} seconds"
+            )
+            return size
+        return self._estimate_content_bytes_via_du()
+
+    def _estimate_content_bytes_via_qgroup(self) -> Optional[int]:
+        """
+        Returns the bytes in referenced extents of this subvolume's qgroup,
+        or `None` if quotas cannot give us a trustworthy answer.
+        """
+        subvol_id = _query_subvol_id(self, self.path())
+        ret = self.run_as_root(
+            ["btrfs", "qgroup", "show", "--raw", "--sync", self.path()],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        return _parse_qgroup_referenced_bytes(
+            subvol_id, ret.returncode, ret.stdout, ret.stderr
+        )
+
+    def _estimate_content_bytes_via_du(self):
         # Not adding `-x` since buck-built subvolumes should not have other
         # filesystems mounted inside them.
         start_time = time.time()
@@ -994,7 +1134,9 @@ class Subvol(DoNotFreeze):
         self,
         output_path,
         fs_size_bytes: int,
-        loopback_opts: loopback_opts_t
+        loopback_opts: loopback_opts_t,
+        *,
+        grow_during_receive: bool = False,
         # pyre-fixme[31]: Expression `(int, int)` is not a valid type.
     ) -> (int, int):
         """
@@ -1002,6 +1144,9 @@ class Subvol(DoNotFreeze):
         subvolume to it. Returns a tuple of two values. The first is the number
         of bytes which didn't fit in that space. It is zero if the subvolume
         fits. The second value is the image size in the end of operation.
+
+        With `grow_during_receive`, the loopback starts at the specified
+        size, but grows as needed while receiving.
         """
         open(output_path, "wb").close()
         with pipe() as (r_send, w_send), Unshare(
@@ -1016,7 +1161,16 @@ class Subvol(DoNotFreeze):
         ):
             w_send.close()  # This end is now fully owned by `btrfs send`.
             with r_send:
-                recv_ret = loop_vol.receive(r_send)
+                if grow_during_receive:
+                    recv_ret, growth = loop_vol.receive_growing(r_send)
+                    log.info(
+                        f"Received {growth.bytes_spliced} sendstream bytes "
+                        f"of {self._path} into {output_path} with "
+                        f"{growth.grow_cycles} grow cycles, from "
+                        f"{fs_size_bytes} to {loop_vol.get_size()} bytes"
+                    )
+                else:
+                    recv_ret = loop_vol.receive(r_send)
                 if recv_ret.returncode != 0:
                     if recv_ret.stderr.endswith(self._OUT_OF_SPACE_SUFFIX):
                         log.info("Will retry receive, did not fit")
@@ -181,6 +181,7 @@ def garbage_collect_subvolumes(
             ), (maybe_lockfile, expected_lock_path)
             if maybe_lockfile:
                 expected_lock_path.unlink()
+            # This also destroys the subvolume's qgroup, if quotas are on.
             Subvol(wrapper_path / subvol, already_exists=True).delete()
         else:  # No subvolume in wrapper
             # We don't expect to see a stray lockfile here because we delete
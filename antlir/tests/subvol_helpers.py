@@ -9,7 +9,7 @@ import subprocess
 
 from antlir.btrfs_diff.tests.render_subvols import (
     RenderedTree,
-    render_sendstream,
+    render_send_stream_items,
 )
 from antlir.tests.flavor_helpers import render_flavor
 
@@ -29,7 +29,11 @@ def render_subvol(subvol: Subvol) -> RenderedTree:
         == "ro=true"
     )
     try:
-        return render_sendstream(subvol.mark_readonly_and_get_sendstream())
+        # Rendering only needs the sizes of the writes, not their data.
+        with subvol.mark_readonly_and_gen_send_stream_items(
+            skip_data=True
+        ) as items:
+            return render_send_stream_items(items)
     finally:
         subvol.set_readonly(was_readonly)
 
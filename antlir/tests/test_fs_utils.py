@@ -23,6 +23,7 @@ from ..fs_utils import (
     Path,
     create_ro,
     generate_work_dir,
+    open_beneath,
     open_for_read_decompress,
     populate_temp_dir_and_rename,
     populate_temp_file_and_rename,
@@ -355,6 +356,31 @@ class TestFsUtils(unittest.TestCase):
             with open(td / "hello_rw") as in_f:
                 self.assertEqual("world_rw -- appended", in_f.read())
 
+    def test_open_beneath(self):
+        with temp_dir() as td:
+            os.makedirs(td / "root/d")
+            for path, text in [(td / "root/d/f", "in root"), (td / "f", "")]:
+                with open(path, "w") as f:
+                    f.write(text)
+            os.symlink(td, td / "root/host")
+            os.symlink(td / "f", td / "root/d/host_f")
+
+            fd = open_beneath(td / "root", "/d/./f")
+            with os.fdopen(fd) as f:
+                self.assertEqual("in root", f.read())
+            os.close(open_beneath(td / "root", "d", os.O_PATH))
+            os.close(open_beneath(td / "root", "", os.O_PATH))
+
+            for relpath in ["host/f", "d/host_f"]:
+                with self.assertRaises(OSError):
+                    open_beneath(td / "root", relpath)
+            for relpath in ["host", "d/host_f"]:
+                with self.assertRaises(OSError) as ctx:
+                    open_beneath(td / "root", relpath, os.O_PATH)
+                self.assertEqual(errno.ELOOP, ctx.exception.errno)
+            with self.assertRaisesRegex(ValueError, "must not contain"):
+                open_beneath(td / "root", "d/../f")
+
     def _check_has_one_file(self, dir_path, filename, contents):
         self.assertEqual([filename.encode()], os.listdir(dir_path))
         with open(dir_path / filename) as in_f:
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import contextlib
+import os
 import subprocess
 import unittest
 import unittest.mock
@@ -16,8 +17,10 @@ from antlir.loopback import (
     LoopbackVolume,
     btrfs_compress_mount_opts,
     MIN_CREATE_BYTES,
+    MIN_GROW_BYTES,
     MIN_SHRINK_BYTES,
     MiB,
+    _parse_min_free_bytes,
 )
 from antlir.unshare import Unshare, Namespace
 
@@ -147,3 +150,52 @@ class LoopbackTestCases(unittest.TestCase):
                 ret = vol.receive(f)
                 self.assertEqual(0, ret.returncode)
                 self.assertIn(b"At subvol create_ops", ret.stderr)
+
+    def test_btrfs_loopback_receive_growing(self):
+        with Unshare([Namespace.MOUNT, Namespace.PID]) as ns, temp_dir() as td:
+            image_path = td / "image.btrfs"
+
+            with BtrfsLoopbackVolume(
+                unshare=ns,
+                image_path=image_path,
+                size_bytes=MIN_CREATE_BYTES,
+            ) as vol, open(
+                Path(__file__).dirname() / "create_ops.sendstream", "rb"
+            ) as f:
+                ret, stats = vol.receive_growing(f)
+                self.assertEqual(0, ret.returncode)
+                self.assertIn(b"At subvol create_ops", ret.stderr)
+                f.seek(0)
+                self.assertEqual(len(f.read()), stats.bytes_spliced)
+                # A fresh minimal FS has too little free space for comfort
+                self.assertGreaterEqual(stats.grow_cycles, 1)
+                self.assertGreaterEqual(vol.get_size(), MIN_GROW_BYTES)
+
+    def test_btrfs_loopback_grow(self):
+        with self._test_workspace() as (ns, td):
+            image_path = td / "image.btrfs"
+            with BtrfsLoopbackVolume(
+                unshare=ns,
+                image_path=image_path,
+                size_bytes=MIN_CREATE_BYTES,
+            ) as vol:
+                free_before = vol.get_min_free_bytes()
+                vol.grow(MIN_GROW_BYTES + 64 * MiB)
+                self.assertEqual(MIN_GROW_BYTES + 64 * MiB, vol.get_size())
+                self.assertEqual(
+                    MIN_GROW_BYTES + 64 * MiB, os.stat(image_path).st_size
+                )
+                self.assertLess(free_before, vol.get_min_free_bytes())
+
+    def test_parse_min_free_bytes(self):
+        self.assertEqual(
+            96862208,
+            _parse_min_free_bytes(
+                b"Overall:\n"
+                b"    Device size:\t\t   114294784\n"
+                b"    Free (estimated):\t\t   103153664\t(min: 96862208)\n"
+                b"    Global reserve:\t\t     3407872\t(used: 0)\n"
+            ),
+        )
+        with self.assertRaisesRegex(RuntimeError, "No free space"):
+            _parse_min_free_bytes(b"Overall:\n")
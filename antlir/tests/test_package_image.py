@@ -9,6 +9,7 @@ import pwd
 import stat
 import subprocess
 import tempfile
+import unittest.mock
 from contextlib import contextmanager
 from typing import Iterator
 
@@ -23,7 +24,7 @@ from antlir.tests.image_package_testbase import ImagePackageTestCaseBase
 from antlir.tests.layer_resource import layer_resource, layer_resource_subvol
 
 from ..loopback_opts_t import loopback_opts_t
-from ..package_image import Format, package_image
+from ..package_image import Format, _Opts, package_image
 from ..unshare import Namespace, Unshare, nsenter_as_root
 
 
@@ -150,6 +151,27 @@ class PackageImageTestCase(ImagePackageTestCaseBase):
             os.stat(self._sibling_path("fixed-size.btrfs")).st_size, 225 * MiB
         )
 
+    def test_btrfs_loopback_sizing_opts(self):
+        for opts_kwargs, waste_factor, grow in [
+            ({}, 1.02, True),
+            ({"btrfs_grow_during_receive": False}, 1.15, False),
+            ({"btrfs_waste_factor": 1.3}, 1.3, True),
+        ]:
+            subvol = unittest.mock.Mock()
+            opts = _Opts(
+                build_appliance=None,
+                loopback_opts=loopback_opts_t(),
+                **opts_kwargs,
+            )
+            Format.make("btrfs").package_full(subvol, "out", opts)
+            send = subvol.mark_readonly_and_send_to_new_loopback
+            send.assert_called_once_with(
+                "out",
+                loopback_opts=opts.loopback_opts,
+                waste_factor=waste_factor,
+                grow_during_receive=grow,
+            )
+
     def test_package_image_as_btrfs_loopback_writable(self):
         with self._package_image(
             self._sibling_path("create_ops.layer"),
@@ -10,12 +10,16 @@ import subprocess
 import sys
 import tempfile
 import unittest.mock
+from io import BytesIO
 
+from antlir.btrfs_diff.parse_send_stream import parse_send_stream
+from antlir.btrfs_diff.send_stream import SendStreamItems
 from antlir.btrfs_diff.tests.demo_sendstreams_expected import (
     render_demo_as_corrupted_by_gnu_tar,
     render_demo_subvols,
 )
 
+from .. import subvol_utils
 from ..artifacts_dir import ensure_per_repo_artifacts_dir_exists
 from ..fs_utils import Path, temp_dir
 from ..loopback_opts_t import loopback_opts_t
@@ -26,6 +30,8 @@ from ..subvol_utils import (
     TempSubvolumes,
     volume_dir,
     with_temp_subvols,
+    _parse_qgroup_referenced_bytes,
+    _query_subvol_id,
     _query_uuid,
     _UUID_TO_SUBVOLS,
 )
@@ -232,6 +238,52 @@ class SubvolTestCase(AntlirTestCase):
             outfile.seek(0)
             self.assertEqual(sendstream, outfile.read())
 
+    @with_temp_subvols
+    def test_mark_readonly_and_gen_send_stream_items(self, temp_subvols):
+        parent = temp_subvols.create("parent")
+        parent.run_as_root(["tee", parent.path("a")], input=b"abc")
+        parent.set_readonly(True)  # Required by `btrfs send -p`
+        child = temp_subvols.snapshot(parent, "child")
+        child.run_as_root(["tee", child.path("b")], input=b"defg")
+
+        with child.mark_readonly_and_gen_send_stream_items() as items:
+            streamed = list(items)
+        self.assertEqual(
+            list(
+                parse_send_stream(
+                    BytesIO(child.mark_readonly_and_get_sendstream())
+                )
+            ),
+            streamed,
+        )
+        self.assertIn(
+            SendStreamItems.write(path=b"b", offset=0, data=b"defg"), streamed
+        )
+
+        # Skipping data just turns writes into extents
+        with child.mark_readonly_and_gen_send_stream_items(
+            skip_data=True
+        ) as items:
+            self.assertEqual(
+                [
+                    SendStreamItems.update_extent(
+                        path=i.path, offset=i.offset, len=len(i.data)
+                    )
+                    if isinstance(i, SendStreamItems.write)
+                    else i
+                    for i in streamed
+                ],
+                list(items),
+            )
+
+        # A `--no-data` send relative to the parent only has the new file
+        with child.mark_readonly_and_gen_send_stream_items(
+            no_data=True, parent=parent
+        ) as items:
+            paths = {i.path for i in items}
+        self.assertIn(b"b", paths)
+        self.assertNotIn(b"a", paths)
+
     @with_temp_subvols
     def _test_mark_readonly_and_send_to_new_loopback(
         self, temp_subvols, multi_pass_size_minimization
@@ -289,6 +341,38 @@ class SubvolTestCase(AntlirTestCase):
                     ),
                 )
 
+    @with_temp_subvols
+    def test_mark_readonly_and_send_to_new_loopback_growing(
+        self, temp_subvols
+    ):
+        sv = temp_subvols.create("subvol")
+        sv.run_as_root(
+            [
+                "dd",
+                "if=/dev/urandom",
+                b"of=" + sv.path("d"),
+                "bs=1M",
+                "count=600",
+            ]
+        )
+        with tempfile.NamedTemporaryFile() as loop_path, self.assertLogs(
+            subvol_utils.log
+        ) as logs:
+            # The too-low waste factor from the above test needs 2 tries
+            # without growth, but just one with it.
+            self.assertEqual(
+                1,
+                sv.mark_readonly_and_send_to_new_loopback(
+                    loop_path.name,
+                    loopback_opts=loopback_opts_t(),
+                    waste_factor=1.00015,
+                    grow_during_receive=True,
+                ),
+            )
+        self.assertRegex(
+            "\n".join(logs.output), "sendstream bytes .* with [1-9][0-9]* grow"
+        )
+
     def test_mark_readonly_and_send_to_new_loopback(self):
         self._test_mark_readonly_and_send_to_new_loopback(
             multi_pass_size_minimization=False
@@ -578,3 +662,73 @@ class SubvolTestCase(AntlirTestCase):
                 ),
                 "8ec28ee3-e2cf-3345-8871-4bc4f85a3efc",
             )
+            self.assertEqual(
+                Subvol("/dev/null/unused").uuid(),
+                "8ec28ee3-e2cf-3345-8871-4bc4f85a3efc",
+            )
+
+    def test_query_subvol_id(self):
+        stdout = (
+            b"tmp/x\n\tName: \t\t\tx\n"
+            b"\tSubvolume ID: \t\t1432\n\tGeneration: \t\t92\n"
+        )
+        with unittest.mock.patch(
+            "antlir.subvol_utils.Subvol.run_as_root",
+            unittest.mock.Mock(
+                return_value=subprocess.CompletedProcess(
+                    args=[], returncode=0, stdout=stdout
+                )
+            ),
+        ):
+            self.assertEqual(
+                1432,
+                _query_subvol_id(
+                    Subvol("/dev/null/unused"), "/dev/null/no-such-dir"
+                ),
+            )
+
+    def test_parse_qgroup_referenced_bytes(self):
+        stdout = (
+            b"qgroupid         rfer         excl \n"
+            b"--------         ----         ---- \n"
+            b"0/5             16384        16384 \n"
+            b"0/1432     1381523456        16384 \n"
+        )
+        self.assertEqual(
+            1381523456, _parse_qgroup_referenced_bytes(1432, 0, stdout, b"")
+        )
+        # Subvolume created before quotas were enabled
+        self.assertIsNone(_parse_qgroup_referenced_bytes(7, 0, stdout, b""))
+        self.assertIsNone(
+            _parse_qgroup_referenced_bytes(
+                1432, 1, b"", b"ERROR: can't list qgroups: quotas not enabled\n"
+            )
+        )
+        for warning in (
+            b"WARNING: qgroup data inconsistent, rescan recommended\n",
+            b"WARNING: rescan is running, qgroup data may be incorrect\n",
+        ):
+            self.assertIsNone(
+                _parse_qgroup_referenced_bytes(1432, 0, stdout, warning)
+            )
+        with self.assertRaisesRegex(RuntimeError, "Unexpected .* exit code"):
+            _parse_qgroup_referenced_bytes(1432, 0, stdout, b"WARNING: boo\n")
+        with self.assertRaisesRegex(RuntimeError, "Unexpected .* exit code"):
+            _parse_qgroup_referenced_bytes(1432, 1, stdout, b"")
+
+    def test_estimate_content_bytes_falls_back_to_du(self):
+        sv = Subvol("/dev/null/unused")
+        with unittest.mock.patch.object(
+            Subvol, "_estimate_content_bytes_via_qgroup", return_value=None
+        ), unittest.mock.patch.object(
+            Subvol, "_estimate_content_bytes_via_du", return_value=37
+        ) as du_mock:
+            self.assertEqual(37, sv._estimate_content_bytes())
+            du_mock.assert_called_once_with()
+        with unittest.mock.patch.object(
+            Subvol, "_estimate_content_bytes_via_qgroup", return_value=42
+        ), unittest.mock.patch.object(
+            Subvol, "_estimate_content_bytes_via_du"
+        ) as du_mock:
+            self.assertEqual(42, sv._estimate_content_bytes())
+            du_mock.assert_not_called()
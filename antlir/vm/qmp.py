@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+A minimal client for the QEMU Machine Protocol, just enough to drive the
+migrations that save & restore VM snapshots, see `antlir/vm/snapshot.py`.
+
+The protocol is line-delimited JSON over a unix socket: QEMU first sends
+a greeting, and we must negotiate capabilities before issuing commands.
+Asynchronous events may arrive at any time, and are ignored.
+"""
+import asyncio
+import json
+from typing import Any, Dict
+
+from antlir.common import get_logger
+from antlir.fs_utils import Path
+
+
+logger = get_logger()
+
+
+class QMPError(Exception):
+    pass
+
+
+class QMPClient:
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def connect(cls, sockfile: Path, timeout_ms: int) -> "QMPClient":
+        "Waits for QEMU to create `sockfile`, and negotiates capabilities."
+        sockfile.wait_for(timeout_ms=timeout_ms)
+        client = cls(*(await asyncio.open_unix_connection(str(sockfile))))
+        try:
+            greeting = await client._read_msg()
+            if "QMP" not in greeting:
+                raise QMPError(f"Bad QMP greeting: {greeting}")
+            await client.execute("qmp_capabilities")
+        except BaseException:
+            await client.close()
+            raise
+        return client
+
+    async def _read_msg(self) -> Dict[str, Any]:
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise QMPError("QMP connection closed")
+            msg = json.loads(line)
+            if "event" in msg:
+                logger.debug(f"QMP event: {msg}")
+                continue
+            return msg
+
+    async def execute(self, command: str, **arguments) -> Any:
+        msg = {"execute": command}
+        if arguments:
+            msg["arguments"] = arguments
+        self._writer.write(json.dumps(msg).encode() + b"\n")
+        await self._writer.drain()
+        res = await self._read_msg()
+        if "error" in res:
+            raise QMPError(f"{command} failed: {res['error']}")
+        return res["return"]
+
+    async def close(self) -> None:
+        self._writer.close()
+        await self._writer.wait_closed()
@@ -13,6 +13,7 @@ from typing import (
 )
 
 from antlir.common import get_logger
+from antlir.fs_utils import Path
 from antlir.vm.vm import ConsoleRedirect, ShellMode, vm, VMExecOpts
 from antlir.vm.vm_opts_t import vm_opts_t
 
@@ -44,6 +45,7 @@ async def run(
     opts: vm_opts_t,
     shell: Optional[ShellMode],
     timeout_ms: int,
+    snapshot_dir: Optional[Path],
     # antlir.vm.run specific args
     cmd: List[str],
 ) -> Optional[int]:
@@ -59,6 +61,7 @@ async def run(
         console=console,
         timeout_ms=timeout_ms,
         shell=shell,
+        snapshot_dir=snapshot_dir,
     ) as (instance, boot_ms, timeout_ms):
 
         # If we are run with `--shell` mode, we don't get an instance since
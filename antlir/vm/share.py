@@ -12,7 +12,7 @@ from contextlib import AsyncExitStack, contextmanager
 from dataclasses import dataclass, field
 from typing import Generator, Iterable, Optional, Tuple
 
-from antlir.common import get_logger
+from antlir.common import get_logger, not_none
 from antlir.fs_utils import Path, temp_dir
 
 
@@ -106,9 +106,13 @@ class Plan9Export(Share):
     readonly: bool = True
 
     @property
-    def mount_unit(self) -> Tuple[str, str]:
+    def mount_options(self) -> str:
         cache = "loose" if self.readonly else "none"
         ro_rw = "ro" if self.readonly else "rw"
+        return f"version=9p2000.L,posixacl,cache={cache},{ro_rw}"
+
+    @property
+    def mount_unit(self) -> Tuple[str, str]:
         return (
             self._systemd_escape_mount(self.mountpoint),
             f"""[Unit]
@@ -121,7 +125,7 @@ Before=local-fs.target
 What={self.mount_tag}
 Where={self.mountpoint!s}
 Type=9p
-Options=version=9p2000.L,posixacl,cache={cache},{ro_rw}
+Options={self.mount_options}
 """,
         )
 
@@ -260,6 +264,9 @@ class BtrfsSeedRootDisk(Share):
     child_dev: str = "vdb"
     # This is dynamically created during the __post_init__
     child_disk: Optional[Path] = None
+    # If set, the child disk is a qcow2 overlay on top of this saved child
+    # disk, see `antlir/vm/snapshot.py`.
+    snapshot_disk: Optional[Path] = None
 
     def __post_init__(self) -> None:
         # Reaching into the object like this is lame.
@@ -290,11 +297,22 @@ class BtrfsSeedRootDisk(Share):
             (
                 "driver=qcow2,node-name=child,read-only=off,"
                 f"file.driver=file,file.filename={self.child_disk!s}"
+                + (
+                    ",backing.driver=qcow2,backing.file.driver=file,"
+                    f"backing.file.filename={self.snapshot_disk!s}"
+                    if self.snapshot_disk
+                    else ""
+                )
             ),
             "--device",
             "virtio-blk,drive=child",
         )
 
+    @property
+    def rw_disk(self) -> Path:
+        "The qcow2 disk that receives the guest's writes."
+        return not_none(self.child_disk)
+
     @property
     def kernel_args(self) -> Iterable[str]:
         return (
@@ -318,6 +336,9 @@ class QCow2RootDisk(Share):
     subvol: str = "volume"
     dev: str = "vda"
     cow_disk: Optional[Path] = None
+    # If set, the COW disk is a qcow2 overlay on top of this saved COW
+    # disk, see `antlir/vm/snapshot.py`.
+    snapshot_disk: Optional[Path] = None
 
     def __post_init__(self) -> None:
         object.__setattr__(
@@ -331,18 +352,31 @@ class QCow2RootDisk(Share):
 
     @property
     def qemu_args(self) -> Iterable[str]:
+        # The saved COW disk goes between our COW disk and the root image.
+        backing = "backing.backing." if self.snapshot_disk else "backing."
         return (
             "--blockdev",
             (
                 "driver=qcow2,node-name=root-drive,"
                 f"file.driver=file,file.filename={self.cow_disk!s},"
-                "backing.driver=raw,backing.file.driver=file,"
-                f"backing.file.filename={self.path!s}"
+                + (
+                    "backing.driver=qcow2,backing.file.driver=file,"
+                    f"backing.file.filename={self.snapshot_disk!s},"
+                    if self.snapshot_disk
+                    else ""
+                )
+                + f"{backing}driver=raw,{backing}file.driver=file,"
+                f"{backing}file.filename={self.path!s}"
             ),
             "--device",
             "virtio-blk,drive=root-drive",
         )
 
+    @property
+    def rw_disk(self) -> Path:
+        "The qcow2 disk that receives the guest's writes."
+        return not_none(self.cow_disk)
+
     @property
     def kernel_args(self) -> Iterable[str]:
         return (
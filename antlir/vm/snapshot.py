@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Booting the VM dominates the runtime of short `vmtest`s.  Given a snapshot
+directory (`--snapshot-dir`, or `$ANTLIR_VM_SNAPSHOT_DIR`), the first `vm()`
+to boot a given configuration saves its booted state there, and later VMs
+restore clones of that state instead of booting.
+
+A snapshot consists of:
+  - `state`: QEMU's migration stream, i.e. the memory & device state,
+  - `disk`: the root disk's writable qcow2 layer, as of the save,
+  - `meta.json`: how long the cold boot took, for reporting.
+Each restored VM writes to a fresh qcow2 overlay on top of `disk`, so the
+clones never see each other's changes.
+
+QEMU refuses to migrate while the guest has 9p shares mounted, so we
+unmount them before saving, and mount them over SSH after each restore.
+A nice side effect is that restored VMs see the current contents of the
+shares.  VMs with other kinds of shares, e.g. `BtrfsDisk`, never use
+snapshots, since the guest could cache stale contents of those.
+
+Snapshots are keyed on everything that must match between the saved and
+the restoring QEMU: the `vm_opts_t`, the identity of the emulator, disk,
+kernel & initrd files, and the shares' tags & mountpoints.  The host paths
+of the shares may differ, since they are not part of the migrated state.
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import time
+from contextlib import AsyncExitStack
+from typing import Iterable, List, NamedTuple, Optional
+
+from antlir.common import get_logger
+from antlir.fs_utils import Path
+from antlir.vm.guest_ssh import GuestSSHConnection
+from antlir.vm.qmp import QMPClient, QMPError
+from antlir.vm.share import BtrfsSeedRootDisk, Plan9Export, QCow2RootDisk, Share
+from antlir.vm.vm_opts_t import vm_opts_t
+
+
+logger = get_logger()
+
+SNAPSHOT_DIR_ENV = "ANTLIR_VM_SNAPSHOT_DIR"
+
+
+class VMSnapshot(NamedTuple):
+    path: Path
+
+    @property
+    def state(self) -> Path:
+        return self.path / "state"
+
+    @property
+    def disk(self) -> Path:
+        return self.path / "disk"
+
+    def exists(self) -> bool:
+        return (self.path / "meta.json").exists()
+
+    def cold_boot_ms(self) -> int:
+        with (self.path / "meta.json").open() as f:
+            return json.load(f)["boot_elapsed_ms"]
+
+
+def _file_identity(path: Path) -> List[int]:
+    st = os.stat(path)
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def find_snapshot(
+    snapshot_dir: Path, opts: vm_opts_t, shares: Iterable[Share]
+) -> Optional[VMSnapshot]:
+    """
+    Returns where the snapshot for this VM lives, whether or not it was
+    saved yet.  `shares` excludes the root disk & the `export_spec`.
+    """
+    key = {
+        "opts": json.loads(opts.json()),
+        "files": [
+            _file_identity(p)
+            for p in [
+                opts.runtime.emulator.binary.path,
+                opts.disk.package.path,
+                opts.kernel.artifacts.vmlinuz.path,
+                opts.initrd.path,
+            ]
+        ],
+        "shares": [],
+    }
+    for share in shares:
+        if not isinstance(share, Plan9Export):
+            logger.debug(f"Not using VM snapshots due to {share}")
+            return None
+        key["shares"].append(
+            [share.mount_tag, str(share.mountpoint), share.mount_options]
+        )
+    return VMSnapshot(
+        snapshot_dir
+        / hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    )
+
+
+def make_root_disk(
+    opts: vm_opts_t, stack: AsyncExitStack, snapshot_disk: Optional[Path]
+) -> Share:
+    "With `snapshot_disk`, the root disk is an overlay on top of it."
+    return (BtrfsSeedRootDisk if opts.disk.seed else QCow2RootDisk)(
+        path=opts.disk.package.path,
+        qemu_img=opts.runtime.emulator.img_util.path,
+        stack=stack,
+        snapshot_disk=snapshot_disk,
+    )
+
+
+async def _wait_until(cond, timeout_ms: int, what: str) -> None:
+    start_ms = int(time.monotonic() * 1000)
+    while int(time.monotonic() * 1000) - start_ms < timeout_ms:
+        if await cond():
+            return
+        await asyncio.sleep(0.05)
+    raise QMPError(f"Timeout waiting for {what}: {timeout_ms}ms")
+
+
+async def resume_guest(
+    ssh: GuestSSHConnection, shares: Iterable[Share], timeout_ms: int
+) -> None:
+    """
+    Syncs the guest's clock, which stopped at the save, and mounts the 9p
+    shares, like the generated mount units do at boot.
+    """
+    script = "\n".join(
+        [
+            f"date --set=@{time.time():.3f} > /dev/null",
+            *(
+                f"mountpoint -q {share.mountpoint.shell_quote()} || "
+                f"mount -t 9p -o trans=virtio,{share.mount_options} "
+                f"{shlex.quote(share.mount_tag)} "
+                f"{share.mountpoint.shell_quote()}"
+                # Parents before children
+                for share in sorted(
+                    (s for s in shares if isinstance(s, Plan9Export)),
+                    key=lambda s: len(s.mountpoint.normpath().split(b"/")),
+                )
+            ),
+        ]
+    )
+    await ssh.run(
+        ["sh", "-uec", shlex.quote(script)], timeout_ms=timeout_ms, check=True
+    )
+
+
+async def save_snapshot(
+    snapshot: VMSnapshot,
+    *,
+    qmp: QMPClient,
+    ssh: GuestSSHConnection,
+    root_disk: Share,
+    shares: Iterable[Share],
+    boot_elapsed_ms: int,
+    timeout_ms: int,
+) -> None:
+    """
+    Saves the state of the running, freshly booted VM, unless another VM
+    already saved, or is saving, the same snapshot.  The VM keeps running
+    afterwards, with its shares mounted again.
+    """
+    os.makedirs(snapshot.path.dirname(), exist_ok=True)
+    with open(snapshot.path + b".lock", "w") as lock_f:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug(f"Another VM is saving {snapshot.path}")
+            return
+        if snapshot.exists():
+            return
+        start_ms = int(time.monotonic() * 1000)
+        tmp_snapshot = VMSnapshot(Path(snapshot.path + b".tmp"))
+        shutil.rmtree(tmp_snapshot.path, ignore_errors=True)
+        os.mkdir(tmp_snapshot.path)
+        try:
+            await ssh.run(
+                ["umount", "--all", "--types", "9p"],
+                timeout_ms=timeout_ms,
+                check=True,
+            )
+            await qmp.execute("stop")
+            await qmp.execute(
+                "migrate",
+                uri=f"exec:cat > {tmp_snapshot.state.shell_quote()}",
+            )
+
+            async def _migrated():
+                status = (await qmp.execute("query-migrate")).get("status")
+                if status == "failed":
+                    raise QMPError(f"Failed to save {snapshot.path}")
+                return status == "completed"
+
+            await _wait_until(_migrated, timeout_ms, "VM state save")
+            # QEMU flushed the paused VM's writes when the migration ended.
+            shutil.copyfile(root_disk.rw_disk, tmp_snapshot.disk)
+            with (tmp_snapshot.path / "meta.json").open("w") as f:
+                json.dump({"boot_elapsed_ms": boot_elapsed_ms}, f)
+            os.rename(tmp_snapshot.path, snapshot.path)
+        # The snapshot is just an optimization, so the VM carries on.
+        except Exception as ex:  # pragma: no cover
+            logger.warning(f"Failed to save VM snapshot {snapshot.path}: {ex}")
+            return
+        finally:
+            shutil.rmtree(tmp_snapshot.path, ignore_errors=True)
+            await qmp.execute("cont")
+            await resume_guest(ssh, shares, timeout_ms)
+    logger.info(
+        f"Saved VM snapshot {snapshot.path} in "
+        f"{int(time.monotonic() * 1000) - start_ms}ms"
+    )
+
+
+async def restore_snapshot(
+    snapshot: VMSnapshot, *, qmp: QMPClient, timeout_ms: int
+) -> None:
+    "Loads the state into a QEMU started with `-incoming defer`."
+    await qmp.execute(
+        "migrate-incoming", uri=f"exec:cat {snapshot.state.shell_quote()}"
+    )
+
+    async def _running():
+        return (await qmp.execute("query-status"))["running"]
+
+    # QEMU resumes the VM once the incoming migration is done.
+    await _wait_until(_running, timeout_ms, "VM state restore")
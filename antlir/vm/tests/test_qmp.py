@@ -0,0 +1,79 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import asyncio
+import json
+import tempfile
+
+from antlir.fs_utils import Path
+from antlir.tests.common import AntlirTestCase
+from antlir.vm.qmp import QMPClient, QMPError
+
+
+class TestQMP(AntlirTestCase):
+    async def _serve(self, greeting, handle_cmd):
+        "Yields a `QMPClient` for a fake QEMU."
+        received = []
+
+        async def _handle(r, w):
+            w.write(json.dumps(greeting).encode() + b"\n")
+            while True:
+                line = await r.readline()
+                if not line:
+                    break
+                cmd = json.loads(line)
+                received.append(cmd)
+                responses = handle_cmd(cmd)
+                if responses is None:  # Hang up
+                    break
+                for res in responses:
+                    w.write(json.dumps(res).encode() + b"\n")
+                await w.drain()
+            w.close()
+
+        td = tempfile.TemporaryDirectory()
+        self.addCleanup(td.cleanup)
+        sock = Path(td.name) / "qmp.sock"
+        server = await asyncio.start_unix_server(_handle, path=sock)
+        self.addCleanup(server.close)
+        return sock, received
+
+    async def test_execute(self):
+        def _handle_cmd(cmd):
+            # Events are skipped
+            yield {"event": "STOP"}
+            if cmd["execute"] == "query-status":
+                yield {"return": {"running": True}}
+            elif cmd["execute"] == "bad":
+                yield {"error": {"class": "GenericError", "desc": "oops"}}
+            else:
+                yield {"return": {}}
+
+        sock, received = await self._serve({"QMP": {}}, _handle_cmd)
+        qmp = await QMPClient.connect(sock, timeout_ms=1000)
+        self.assertEqual({"running": True}, await qmp.execute("query-status"))
+        self.assertEqual({}, await qmp.execute("migrate", uri="exec:cat"))
+        with self.assertRaisesRegex(QMPError, "bad failed: .*oops"):
+            await qmp.execute("bad")
+        await qmp.close()
+        self.assertEqual(
+            [
+                {"execute": "qmp_capabilities"},
+                {"execute": "query-status"},
+                {"execute": "migrate", "arguments": {"uri": "exec:cat"}},
+                {"execute": "bad"},
+            ],
+            received,
+        )
+
+    async def test_bad_greeting(self):
+        sock, _ = await self._serve({"hello": 1}, lambda cmd: [])
+        with self.assertRaisesRegex(QMPError, "Bad QMP greeting"):
+            await QMPClient.connect(sock, timeout_ms=1000)
+
+    async def test_closed(self):
+        sock, _ = await self._serve({"QMP": {}}, lambda cmd: None)
+        with self.assertRaisesRegex(QMPError, "QMP connection closed"):
+            await QMPClient.connect(sock, timeout_ms=1000)
@@ -5,9 +5,11 @@
 
 import asyncio
 import os
+import shlex
 import socket
 import subprocess
 import tempfile
+import sys
 import threading
 import unittest
 
@@ -93,6 +95,15 @@ class TestAntlirVM(AntlirTestCase):
             ),
         )
 
+        # Test --snapshot-dir
+        self.assertEqual(
+            VMExecOpts(
+                opts=opts_instance,
+                snapshot_dir=Path("/snap"),
+            ),
+            VMExecOpts.parse_cli([opts_cli_arg, "--snapshot-dir=/snap"]),
+        )
+
     async def test_api_ssh(self):
         opts_instance = vm_opts_t.from_env("test-vm-qcow2-json")
 
@@ -134,6 +145,31 @@ class TestAntlirVM(AntlirTestCase):
             )
             self.assertEqual(proc.returncode, 0)
 
+    async def test_api_snapshot(self):
+        for opts_env in ["test-vm-qcow2-json", "test-vm-seed-json"]:
+            opts_instance = vm_opts_t.from_env(opts_env)
+            with tempfile.TemporaryDirectory() as td:
+                # The first VM boots & saves, the second one restores.
+                for cmd in [
+                    "touch /var/after-save",
+                    # Clones start from the saved state, and mount the
+                    # repo again.
+                    "! test -e /var/after-save && "
+                    f"test -e {Path(sys.argv[0]).shell_quote()}",
+                ]:
+                    async with vm(
+                        opts=opts_instance, snapshot_dir=Path(td)
+                    ) as (instance, boottime_ms, timeout_ms):
+                        self.assertGreater(boottime_ms, 0)
+                        await instance.run(
+                            cmd=["sh", "-c", shlex.quote(cmd)],
+                            timeout_ms=timeout_ms,
+                            check=True,
+                        )
+                self.assertEqual(
+                    1, len([p for p in os.listdir(td) if p.endswith(".lock")])
+                )
+
     async def test_api_console(self):
         opts_instance = vm_opts_t.from_env("test-vm-seed-json")
 
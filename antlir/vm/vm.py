@@ -38,7 +38,16 @@ from antlir.shape import Shape
 from antlir.unshare import Namespace, Unshare
 from antlir.vm.common import insertstack
 from antlir.vm.guest_ssh import GuestSSHConnection
-from antlir.vm.share import BtrfsSeedRootDisk, Plan9Export, Share, QCow2RootDisk
+from antlir.vm.qmp import QMPClient
+from antlir.vm.share import Plan9Export, Share
+from antlir.vm.snapshot import (
+    SNAPSHOT_DIR_ENV,
+    find_snapshot,
+    make_root_disk,
+    restore_snapshot,
+    resume_guest,
+    save_snapshot,
+)
 from antlir.vm.tap import VmTap
 from antlir.vm.vm_opts_t import vm_opts_t
 
@@ -136,6 +145,8 @@ class VMExecOpts(Shape):
     # How many millis to allow the VM to run.  The timeout starts
     # as soon as the emulator process is spawned.
     timeout_ms: int = DEFAULT_TIMEOUT_MS
+    # Save & restore snapshots of the booted VM here
+    snapshot_dir: Optional[Path] = None
 
     # Future:  Since we're using `Shape` for this, which uses pydantic.  I
     # think it is possible automagically construct this based on the field
@@ -222,6 +233,16 @@ class VMExecOpts(Shape):
             "as soon as the emulator is spawned.",
         )
 
+        parser.add_argument(
+            "--snapshot-dir",
+            type=Path.from_argparse,
+            default=os.environ.get(SNAPSHOT_DIR_ENV),
+            help="The first VM to boot with a given configuration saves a "
+            "snapshot of its booted state in this directory, and later VMs "
+            "restore it instead of booting.  Defaults to the "
+            f"{SNAPSHOT_DIR_ENV} environment variable.",
+        )
+
     @classmethod
     def parse_cli(cls, argv) -> "VMExecOpts":
         """
@@ -261,7 +282,13 @@ async def vm(
     bind_repo_ro: bool = True,
     shell: Optional[ShellMode] = None,
     shares: Optional[List[Share]] = None,
+    snapshot_dir: Optional[Path] = None,
 ) -> AsyncGenerator[Tuple[Optional[GuestSSHConnection], int, int], None]:
+    """
+    Boots a VM, or with `snapshot_dir`, may restore one instead, see
+    `antlir/vm/snapshot.py`.  Either way, the yielded `boot_elapsed_ms` is
+    the time until the VM was ready.
+    """
 
     notify_sockfile = Path(
         os.path.join(
@@ -279,23 +306,6 @@ async def vm(
     # in-repo testing.
     repo_cfg = repo_config()
 
-    # Setup the root disk fist since without this, nothing works
-    if opts.disk.seed:
-        root_disk = BtrfsSeedRootDisk(
-            path=opts.disk.package.path,
-            qemu_img=opts.runtime.emulator.img_util.path,
-            stack=stack,
-        )
-    else:
-        root_disk = QCow2RootDisk(
-            path=opts.disk.package.path,
-            qemu_img=opts.runtime.emulator.img_util.path,
-            stack=stack,
-        )
-
-    # Root disk is always first
-    shares.insert(0, root_disk)
-
     # Modules are always required, insert the export for them here.
     # Note: This Share used "generator=False" because the initrd
     # will mount these into the rootfs before the switch-root.
@@ -347,6 +357,29 @@ async def vm(
         for mount in repo_cfg.host_mounts_for_repo_artifacts:
             shares.append(Plan9Export(path=mount, mountpoint=mount))
 
+    # A restored VM has to mount these itself, see `resume_guest`.
+    guest_shares = list(shares)
+    snapshot = (
+        find_snapshot(snapshot_dir, opts, guest_shares)
+        if snapshot_dir and shell is None
+        else None
+    )
+    restore = snapshot is not None and snapshot.exists()
+    qmp_sockfile = Path(
+        os.path.join(
+            tempfile.gettempdir(), "vmtest_qmp_" + uuid.uuid4().hex + ".sock"
+        )
+    )
+
+    # Root disk is always first
+    root_disk = make_root_disk(
+        opts,
+        stack,
+        # pyre-fixme[16]: `Optional` has no attribute `disk`.
+        snapshot.disk if restore else None,
+    )
+    shares.insert(0, root_disk)
+
     # Add the export share that the mount-generator will use to discover
     # all of the 9p mounts.
     shares.append(stack.enter_context(Share.export_spec(shares)))
@@ -410,11 +443,18 @@ async def vm(
         ),
         # socket/serial device pair (for use by _wait_for_boot)
         "-chardev",
-        f"socket,path={notify_sockfile},id=notify,server",
+        # A restored VM already sent its notification, don't wait for it.
+        f"socket,path={notify_sockfile},id=notify,server"
+        + (",nowait" if restore else ""),
         "-device",
         "virtserialport,chardev=notify,name=notify-host",
     ] + list(tapdev.qemu_args)
 
+    if snapshot:
+        args.extend(["-qmp", f"unix:{qmp_sockfile},server,nowait"])
+    if restore:
+        args.extend(["-incoming", "defer"])
+
     # The firmware to boot the emulator with
     args.extend(
         [
@@ -473,21 +513,39 @@ async def vm(
                 stderr=console,
             )
 
-        try:
-            boot_elapsed_ms = await _wait_for_boot(
-                notify_sockfile, timeout_ms=timeout_ms
-            )
-        # This is difficult to cover in a unittest since it means intentionally
-        # causing a real VM to fail to boot, which could result in resource
-        # leakage. Since the  _wait_for_boot method has full test coverage
-        # we'll skip covering this exception.
-        except asyncio.TimeoutError:  # pragma: no cover
-            raise VMBootError(f"Timeout waiting for boot event: {timeout_ms}ms")
+        start_ms = int(time.monotonic() * 1000)
+        if restore:
+            qmp = await QMPClient.connect(qmp_sockfile, timeout_ms=timeout_ms)
+            stack.push_async_callback(qmp.close)
+            # Finished once the shares are mounted, below.
+            boot_elapsed_ms = None
+            # pyre-fixme[6]: Expected `VMSnapshot` but got `Optional`.
+            await restore_snapshot(snapshot, qmp=qmp, timeout_ms=timeout_ms)
+        else:
+            try:
+                boot_elapsed_ms = await _wait_for_boot(
+                    notify_sockfile, timeout_ms=timeout_ms
+                )
+            # This is difficult to cover in a unittest since it means
+            # intentionally causing a real VM to fail to boot, which could
+            # result in resource leakage. Since the  _wait_for_boot method
+            # has full test coverage we'll skip covering this exception.
+            except asyncio.TimeoutError:  # pragma: no cover
+                raise VMBootError(
+                    f"Timeout waiting for boot event: {timeout_ms}ms"
+                )
 
-        logger.debug(
-            f"VM boot time: {boot_elapsed_ms}ms, "
-            f"timeout_ms is now: {timeout_ms}ms"
-        )
+            logger.debug(
+                f"VM boot time: {boot_elapsed_ms}ms, "
+                f"timeout_ms is now: {timeout_ms}ms"
+            )
+            # QEMU only creates the QMP socket once something connected to
+            # the notify socket, so this must come after the boot.
+            if snapshot:
+                qmp = await QMPClient.connect(
+                    qmp_sockfile, timeout_ms=timeout_ms
+                )
+                stack.push_async_callback(qmp.close)
         logger.debug(f"VM ipv6: {tapdev.guest_ipv6_ll}")
 
         if shell == ShellMode.console:  # pragma: no cover
@@ -521,6 +579,25 @@ async def vm(
                 tapdev=tapdev,
                 options=opts.runtime.connection.options,
             ) as ssh:
+                if restore:
+                    await resume_guest(ssh, guest_shares, timeout_ms)
+                    boot_elapsed_ms = int(time.monotonic() * 1000) - start_ms
+                    logger.info(
+                        f"VM restore time: {boot_elapsed_ms}ms, vs. "
+                        # pyre-fixme[16]: `Optional` has no attribute
+                        #  `cold_boot_ms`.
+                        f"{snapshot.cold_boot_ms()}ms to boot it"
+                    )
+                elif snapshot:
+                    await save_snapshot(
+                        snapshot,
+                        qmp=qmp,
+                        ssh=ssh,
+                        root_disk=root_disk,
+                        shares=guest_shares,
+                        boot_elapsed_ms=boot_elapsed_ms,
+                        timeout_ms=timeout_ms,
+                    )
                 yield (ssh, boot_elapsed_ms, timeout_ms)
 
     # Note: The error cases are not yet covered properly in tests.
@@ -211,6 +211,7 @@ async def run(
     opts: vm_opts_t,
     shell: Optional[ShellMode],
     timeout_ms: int,
+    snapshot_dir: Optional[Path],
     # antlir.vm.vmtest specific args
     devel_layer: bool,
     gtest_list_tests: bool,
@@ -307,6 +308,7 @@ async def run(
         shares=shares,
         shell=shell,
         timeout_ms=timeout_ms,
+        snapshot_dir=snapshot_dir,
     ) as (instance, boot_elapsed_ms, timeout_ms):
 
         # If we are run with `--shell` mode, we don't get an instance since